@@ -0,0 +1,50 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+"""Measure the per-accept cost of building the peer's I2PAddress.
+
+Run from the source root: PYTHONPATH=. python benchmarks/address_b32.py
+"""
+from __future__ import print_function
+
+import base64
+import hashlib
+import timeit
+
+from txi2p import address
+from txi2p.sam.base import peerSAM
+from txi2p.test.util import TEST_B64
+
+N = 20000
+PEER_LINE = ('%s FROM_PORT=34444 TO_PORT=0' % TEST_B64).encode('utf-8')
+
+
+def eagerB32(destination):
+    # What I2PAddress.__init__ used to do for every address
+    raw_key = base64.b64decode(destination.encode('utf-8'), b'-~')
+    hash = hashlib.sha256(raw_key)
+    base32_hash = base64.b32encode(hash.digest()).decode('utf-8')
+    return base32_hash.lower().replace('=', '')+'.b32.i2p'
+
+
+def bench(label, f):
+    t = min(timeit.repeat(f, number=N, repeat=3)) / N
+    print('%-40s %6.2fus' % (label, t * 1e6))
+
+
+def main():
+    bench('Accept, eager B32 (old)',
+          lambda: (peerSAM(PEER_LINE), eagerB32(TEST_B64)))
+    bench('Accept, host never read',
+          lambda: peerSAM(PEER_LINE))
+    bench('Accept, host read (cached)',
+          lambda: peerSAM(PEER_LINE).host)
+
+    def uncached():
+        address._b32Cache.clear()
+        return peerSAM(PEER_LINE).host
+    bench('Accept, host read (cache miss)', uncached)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+"""Measure the memory held by the I2PAddresses of many live streams.
+
+Each stream gets a fresh copy of its peer's Destination string, as it would
+when parsed off the wire, and the streams are spread across a small number of
+peers.
+
+Run from the source root: PYTHONPATH=. python benchmarks/address_memory.py
+"""
+from __future__ import print_function
+
+import base64
+import os
+import tracemalloc
+
+from txi2p.address import I2PAddress
+
+STREAMS = 20000
+PEERS = 50
+
+
+class OldI2PAddress(object):
+    # The previous layout: an instance __dict__ and an unshared Destination.
+    def __init__(self, destination, host=None, port=None):
+        self.destination = destination
+        self.host = host
+        self.port = int(port) if port else None
+
+
+def peers():
+    return [base64.b64encode(os.urandom(387), b'-~').decode('utf-8')
+            for i in range(PEERS)]
+
+
+def measure(cls, dests):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    streams = []
+    for i in range(STREAMS):
+        # Copy the string, as if freshly read from a socket
+        dest = (dests[i % PEERS] + ' ')[:-1]
+        streams.append(cls(dest, 'peer%d.i2p' % (i % PEERS), 81))
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used
+
+
+def main():
+    dests = peers()
+    old = measure(OldI2PAddress, dests)
+    new = measure(I2PAddress, dests)
+    print('%d streams to %d peers' % (STREAMS, PEERS))
+    print('Unshared, with __dict__: %8.1f KiB' % (old / 1024.0))
+    print('Interned, __slots__:     %8.1f KiB' % (new / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
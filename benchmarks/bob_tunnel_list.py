@@ -0,0 +1,112 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+"""Measure the cost of a tunnel operation's ``list`` as BOB has more tunnels.
+
+Each run builds the ``list`` output of a router with N tunnels, where our
+tunnel is not among them and the default ports are taken, and times:
+
+- parsing the reply with the BOB grammar, which is what every tunnel
+  operation paid before listings were cached;
+- the linear nickname scan and port probing against a list that
+  processTunnelList used to do;
+- the same lookup with a TunnelInventory and PortAllocator;
+- a cached BOBControlClient.listTunnels() call.
+
+Run from the source root: PYTHONPATH=. python benchmarks/bob_tunnel_list.py
+"""
+from __future__ import print_function
+
+import time
+
+from twisted.internet.task import Clock
+
+from txi2p.bob.control import BOBControlClient
+from txi2p.bob.inventory import PortAllocator, TunnelInventory
+from txi2p.bob.protocol import DEFAULT_INPORT, DEFAULT_OUTPORT
+from txi2p.test.util import FakeEndpoint
+
+SIZES = [100, 200, 300]
+ROUNDS = 20
+# Parsing is slow enough that once per size is plenty
+PARSE_ROUNDS = 1
+
+LINE = ('DATA NICKNAME: tunnel%d STARTING: false RUNNING: true '
+        'STOPPING: false KEYS: true QUIET: false INPORT: %d '
+        'INHOST: localhost OUTPORT: %d OUTHOST: localhost\n')
+
+
+def listOutput(n):
+    # The ports in use start at the end of the list, so that probing from
+    # there collides with every one of them.
+    lines = [LINE % (i, DEFAULT_INPORT + 2*(n + i),
+                     DEFAULT_OUTPORT + 2*(n + i)) for i in range(n)]
+    return ''.join(lines) + 'OK Listing done\n'
+
+
+def connectedClient():
+    endpoint = FakeEndpoint()
+    client = BOBControlClient(endpoint, clock=Clock())
+    client.command('getdest')
+    endpoint.proto.dataReceived('BOB 00.00.10\nOK\nOK shrubbery\n')
+    return endpoint, client
+
+
+def parse(output):
+    endpoint, client = connectedClient()
+    start = time.time()
+    for i in range(PARSE_ROUNDS):
+        d = client.command('list')
+        endpoint.proto.dataReceived(output)
+    result = []
+    d.addCallback(result.append)
+    return (time.time() - start) / PARSE_ROUNDS, result[0]
+
+
+def listScan(tunnels):
+    start = time.time()
+    for i in range(ROUNDS):
+        used_ports = []
+        for t in tunnels:
+            if t['nickname'] == 'spam':
+                pass
+            else:
+                if t['inport']:
+                    used_ports.append(t['inport'])
+                if t['outport']:
+                    used_ports.append(t['outport'])
+        offset = 2*len(tunnels)
+        while (DEFAULT_INPORT + offset) in used_ports or \
+                (DEFAULT_OUTPORT + offset) in used_ports:
+            offset += 2
+    return (time.time() - start) / ROUNDS
+
+
+def inventoryLookup(tunnels):
+    start = time.time()
+    for i in range(ROUNDS):
+        inventory = TunnelInventory(tunnels)
+        inventory.get('spam')
+        PortAllocator().allocate(inventory, 'spam')
+    return (time.time() - start) / ROUNDS
+
+
+def cachedListing(output):
+    endpoint, client = connectedClient()
+    client.listTunnels()
+    endpoint.proto.dataReceived(output)
+    start = time.time()
+    for i in range(ROUNDS):
+        client.listTunnels()
+    return (time.time() - start) / ROUNDS
+
+
+if __name__ == '__main__':
+    print('%-8s %12s %12s %14s %12s' % (
+        'tunnels', 'parse ms', 'scan ms', 'inventory ms', 'cached us'))
+    for n in SIZES:
+        output = listOutput(n)
+        parseTime, tunnels = parse(output)
+        print('%-8d %12.2f %12.2f %14.2f %12.2f' % (
+            n, parseTime * 1e3, listScan(tunnels) * 1e3,
+            inventoryLookup(tunnels) * 1e3, cachedListing(output) * 1e6))
@@ -0,0 +1,59 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+"""Measure the startup cost of importing txi2p and building protocols.
+
+Compares compiling the grammar once per protocol class (the old behaviour)
+against the shared, lazily-compiled grammars, with and without the on-disk
+cache.
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+IMPORT = 'import txi2p.plugins'
+
+PER_CLASS = '''
+from ometa.grammar import OMeta
+from txi2p import grammar
+for source in [grammar.samGrammarSource] * 6 + [grammar.bobGrammarSource] * 3:
+    OMeta(source).parseGrammar('Grammar')
+'''
+
+FIRST_USE = IMPORT + '''
+from txi2p import grammar
+grammar.getSAMGrammar()
+grammar.getBOBGrammar()
+'''
+
+
+def timeit(code, env=None, runs=3):
+    timer = 'import time; t = time.time()\n%s\nprint(time.time() - t)' % code
+    best = None
+    for i in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', timer], env=env)
+        t = float(out.decode('utf-8').split()[-1])
+        best = t if best is None else min(best, t)
+    return best
+
+
+def main():
+    cacheDir = tempfile.mkdtemp()
+    cached = dict(os.environ, TXI2P_GRAMMAR_CACHE=cacheDir)
+    try:
+        print('Import only:                 %.3fs' % timeit(IMPORT))
+        print('Nine per-class compilations: %.3fs' % timeit(PER_CLASS, runs=1))
+        print('Shared grammars, first use:  %.3fs' % timeit(FIRST_USE))
+        # Populate the cache, then measure loading from it.
+        timeit(FIRST_USE, cached, runs=1)
+        print('Shared grammars, disk cache: %.3fs' % timeit(FIRST_USE, cached))
+    finally:
+        shutil.rmtree(cacheDir)
+
+
+if __name__ == '__main__':
+    main()
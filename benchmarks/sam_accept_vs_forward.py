@@ -0,0 +1,95 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+"""Compare the per-connection cost of STREAM ACCEPT and STREAM FORWARD.
+
+Incoming streams are driven over in-memory transports, with a stand-in for
+the SAM bridge, so this measures the work done by txi2p and counts the SAM
+control round trips each mode needs. In a real deployment every round trip
+also costs a trip to the SAM bridge.
+
+Run from the source root: PYTHONPATH=. python benchmarks/sam_accept_vs_forward.py
+"""
+from __future__ import print_function
+
+import timeit
+
+from twisted.internet import defer
+from twisted.internet.protocol import Factory, Protocol
+from twisted.test import proto_helpers
+
+from txi2p.address import I2PAddress
+from txi2p.sam.base import I2PFactoryWrapper
+from txi2p.sam.session import SAMSession
+from txi2p.sam.stream import StreamAcceptPort
+from txi2p.test.util import TEST_B64
+
+N = 5000
+PEER_LINE = ('%s FROM_PORT=34444 TO_PORT=0\n' % TEST_B64).encode('utf-8')
+
+
+class Bridge(object):
+    """Answers HELLO and STREAM ACCEPT as soon as they are sent."""
+    roundTrips = 0
+
+    def connect(self, fac):
+        proto = fac.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.2\n')
+        proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
+        self.roundTrips += 2
+        return defer.succeed(proto)
+
+
+class Session(SAMSession):
+    # Stream bookkeeping is the same in both modes
+    def addStream(self, stream, direction=None, peer=None):
+        pass
+
+    def setStreamPeer(self, stream, peer):
+        pass
+
+    def removeStream(self, stream):
+        pass
+
+
+def acceptMode():
+    bridge = Bridge()
+    session = Session()
+    session.samEndpoint = bridge
+    session.samVersion = '3.2'
+    session.id = 'bench'
+    session.address = I2PAddress(TEST_B64)
+    port = StreamAcceptPort(session, Factory.forProtocol(Protocol), 8, 8)
+    port.startListening()
+    bridge.roundTrips = 0
+
+    def incoming():
+        port.accepts[0].parser.dataReceived(PEER_LINE)
+    t = min(timeit.repeat(incoming, number=N, repeat=3)) / N
+    roundTrips = bridge.roundTrips / (3.0 * N)
+    port.stopListening()
+    return t, roundTrips
+
+
+def forwardMode():
+    fac = I2PFactoryWrapper(Factory.forProtocol(Protocol), I2PAddress(TEST_B64))
+
+    def incoming():
+        proto = fac.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        proto.dataReceived(PEER_LINE)
+    t = min(timeit.repeat(incoming, number=N, repeat=3)) / N
+    return t, 0
+
+
+def main():
+    for label, mode in [('STREAM ACCEPT', acceptMode),
+                        ('STREAM FORWARD', forwardMode)]:
+        t, roundTrips = mode()
+        print('%-16s %7.1fus/connection %4.1f SAM round trips/connection' % (
+            label, t * 1e6, roundTrips))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+"""Compare resolving many hostnames one connection at a time with
+NamingResolver.lookupMany().
+
+The SAM bridge is an in-memory stand-in that answers each command after a
+fixed delay, standing in for the round trip to a SAM bridge. Opening a
+connection also takes a round trip, for the TCP handshake. Lookups are made
+three ways:
+
+- one after another, each on its own connection, as a client resolving
+  names in a loop did before NamingResolver;
+- all at once, each on its own connection;
+- all at once with NamingResolver.lookupMany(), pipelined on one connection.
+
+Run from the source root: PYTHONPATH=. python benchmarks/sam_naming_lookups.py
+"""
+from __future__ import print_function
+
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.test import proto_helpers
+
+from txi2p.sam.base import makeSAMProtocol, SAMSender, SAMReceiver, SAMFactory
+from txi2p.sam.naming import NamingResolver
+from txi2p.test.util import TEST_B64
+
+N = 200
+RTT = 0.010
+NAMES = ['host%d.i2p' % i for i in range(N)]
+
+
+class BridgeTransport(proto_helpers.StringTransport):
+    """Answers HELLO and NAMING LOOKUP lines RTT seconds after they are
+    written."""
+
+    def __init__(self, proto):
+        proto_helpers.StringTransport.__init__(self)
+        self.proto = proto
+
+    def write(self, data):
+        for line in data.split(b'\n')[:-1]:
+            if line.startswith(b'HELLO'):
+                reply = b'HELLO REPLY RESULT=OK VERSION=3.3\n'
+            elif line.startswith(b'NAMING LOOKUP'):
+                name = line.split(b'NAME=')[1]
+                reply = (b'NAMING REPLY RESULT=OK NAME=' + name +
+                         b' VALUE=' + TEST_B64.encode('utf-8') + b'\n')
+            else:
+                continue
+            reactor.callLater(RTT, self.proto.dataReceived, reply)
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+
+class Bridge(object):
+    def __init__(self):
+        self.connections = 0
+
+    def connect(self, fac):
+        self.connections += 1
+        def connected():
+            proto = fac.buildProtocol(None)
+            proto.makeConnection(BridgeTransport(proto))
+            return proto
+        # The TCP handshake
+        return task.deferLater(reactor, RTT, connected)
+
+
+class OneShotLookupReceiver(SAMReceiver):
+    """HELLO, then one NAMING LOOKUP."""
+
+    def command(self):
+        self.sender.sendNamingLookup(self.factory.name)
+        self.currentRule = 'State_naming'
+
+    def postLookup(self, dest):
+        self.sender.transport.loseConnection()
+        self.factory.deferred.callback(dest)
+
+
+class OneShotLookupFactory(SAMFactory):
+    protocol = makeSAMProtocol(SAMSender, OneShotLookupReceiver)
+
+    def __init__(self, name):
+        self.name = name
+        self.deferred = defer.Deferred()
+
+
+def oneShotLookup(bridge, name):
+    fac = OneShotLookupFactory(name)
+    bridge.connect(fac)
+    return fac.deferred
+
+
+def oneShotInTurn(bridge):
+    results = []
+    d = defer.succeed(None)
+    for name in NAMES:
+        d.addCallback(lambda _, name=name: oneShotLookup(bridge, name))
+        d.addCallback(results.append)
+    return d.addCallback(lambda _: results)
+
+
+def oneShotAtOnce(bridge):
+    return defer.gatherResults([oneShotLookup(bridge, name)
+                                for name in NAMES])
+
+
+def pipelined(bridge):
+    resolver = NamingResolver(bridge)
+    d = resolver.lookupMany(NAMES)
+    def close(results):
+        resolver.close()
+        return results
+    return d.addCallback(close)
+
+
+@defer.inlineCallbacks
+def measure(label, f):
+    bridge = Bridge()
+    start = time.time()
+    results = yield f(bridge)
+    elapsed = time.time() - start
+    assert len(results) == N
+    print('%-34s %7.2f ms/name  %7.0f ms total  %4d connections' % (
+        label, elapsed / N * 1e3, elapsed * 1e3, bridge.connections))
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    print('Resolving %d names, %.0f ms per round trip to the SAM bridge' % (
+        N, RTT * 1e3))
+    yield measure('Connection per lookup, in turn', oneShotInTurn)
+    yield measure('Connection per lookup, at once', oneShotAtOnce)
+    yield measure('NamingResolver.lookupMany', pipelined)
+
+
+if __name__ == '__main__':
+    task.react(main)
@@ -0,0 +1,131 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+"""Compare the throughput of RAW and DATAGRAM sessions.
+
+Datagrams are sent over loopback UDP to a stand-in for the SAM bridge, which
+loops each one straight back to the session's forward port in the format the
+SAM bridge would deliver it. This measures the work done by txi2p and the
+bytes exchanged with the SAM bridge per message. Inside I2P, a repliable
+datagram additionally carries the sender's Destination (387+ bytes) and a
+signature (64 bytes for Ed25519), which the router must create and check.
+
+Run from the source root: PYTHONPATH=. python benchmarks/sam_raw_vs_datagram.py
+"""
+from __future__ import print_function
+
+import time
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import DatagramProtocol
+
+from txi2p.address import I2PAddress
+from txi2p.sam.datagram import (
+    DatagramForwardProtocol,
+    SAMI2PDatagramPort,
+    SAMI2PRawPort,
+)
+from txi2p.sam.session import SAMSession
+from txi2p.test.util import TEST_B64
+
+N = 20000
+WINDOW = 64
+BATCH = 16
+PAYLOAD = b'x' * 64
+PEER = I2PAddress(TEST_B64, port=81)
+
+
+class Bridge(DatagramProtocol):
+    """Loops sent datagrams back as if they had arrived from PEER."""
+
+    def __init__(self, style):
+        self.style = style
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.forwardAddr = None
+
+    def datagramReceived(self, data, addr):
+        self.bytesIn += len(data)
+        payload = data.split(b'\n', 1)[1]
+        if self.style == 'DATAGRAM':
+            data = ('%s FROM_PORT=81 TO_PORT=0\n' % TEST_B64).encode('utf-8') + payload
+        else:
+            data = payload
+        self.bytesOut += len(data)
+        self.transport.write(data, self.forwardAddr)
+
+
+class Sink(DatagramProtocol):
+    def __init__(self, batch):
+        self.batch = batch
+        self.received = 0
+        self.sent = 0
+        self.done = defer.Deferred()
+
+    def datagramReceived(self, datagram, addr):
+        self.received += 1
+        if self.received == N:
+            self.done.callback(None)
+        elif self.sent - self.received < WINDOW:
+            self.send()
+
+    def send(self):
+        if self.sent >= N:
+            return
+        if self.batch > 1:
+            count = min(self.batch, N - self.sent)
+            self.transport.writeSequence([PAYLOAD] * count, PEER)
+            self.sent += count
+        else:
+            self.transport.write(PAYLOAD, PEER)
+            self.sent += 1
+
+
+@defer.inlineCallbacks
+def run(style, portClass, batch):
+    bridge = Bridge(style)
+    bridgePort = reactor.listenUDP(0, bridge, interface='127.0.0.1')
+    forwardProto = DatagramForwardProtocol()
+    udpPort = reactor.listenUDP(0, forwardProto, interface='127.0.0.1')
+    bridge.forwardAddr = ('127.0.0.1', udpPort.getHost().port)
+
+    s = SAMSession()
+    s.samVersion = '3.2'
+    s.id = 'bench'
+    s.style = style
+    s.address = I2PAddress(TEST_B64)
+    sink = Sink(batch)
+    port = portClass(s, forwardProto, sink,
+                     ('127.0.0.1', bridgePort.getHost().port))
+    port.startListening()
+
+    start = time.time()
+    while sink.sent < WINDOW:
+        sink.send()
+    yield sink.done
+    elapsed = time.time() - start
+
+    yield port.stopListening()
+    yield bridgePort.stopListening()
+    print('%-8s batch=%-3d %8.0f msg/s  %5.1f us/msg  '
+          'to SAM %4.0f B/msg  from SAM %4.0f B/msg' % (
+              style, batch, N / elapsed, elapsed / N * 1e6,
+              bridge.bytesIn / float(N), bridge.bytesOut / float(N)))
+
+
+@defer.inlineCallbacks
+def main():
+    print('%d round trips of %d-byte payloads over loopback UDP' % (
+        N, len(PAYLOAD)))
+    try:
+        yield run('DATAGRAM', SAMI2PDatagramPort, 1)
+        yield run('RAW', SAMI2PRawPort, 1)
+        yield run('DATAGRAM', SAMI2PDatagramPort, BATCH)
+        yield run('RAW', SAMI2PRawPort, BATCH)
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
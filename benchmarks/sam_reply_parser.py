@@ -0,0 +1,56 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+"""Compare the Parsley grammar and the fast-path parser for SAM replies.
+
+Run from the source root: PYTHONPATH=. python benchmarks/sam_reply_parser.py
+"""
+from __future__ import print_function
+
+import timeit
+
+from ometa.tube import TrampolinedParser
+
+from txi2p import grammar
+from txi2p.sam.parser import SAMReplyParser
+from txi2p.test.util import TEST_B64
+
+REPLIES = [
+    ('State_hello', 'HELLO REPLY RESULT=OK VERSION=3.2\n'),
+    ('State_naming', 'NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=%s\n' % TEST_B64),
+    ('State_connect', 'STREAM STATUS RESULT=OK\n'),
+    ('State_accept', 'STREAM STATUS RESULT=CANT_REACH_PEER MESSAGE="Can\'t reach peer"\n'),
+]
+N_GRAMMAR = 20
+N_FAST = 2000
+
+
+class Receiver(object):
+    currentRule = None
+
+    def _ignore(self, *args, **kwargs):
+        pass
+    hello = lookupReply = connect = accept = _ignore
+
+
+def main():
+    g = grammar.getSAMGrammar()
+    receiver = Receiver()
+    for rule, reply in REPLIES:
+        receiver.currentRule = rule
+        data = reply.encode('utf-8')
+
+        def slow():
+            TrampolinedParser(g, receiver, {}).receive(data.decode('utf-8'))
+
+        def fast():
+            SAMReplyParser(receiver).receive(data)
+
+        tSlow = min(timeit.repeat(slow, number=N_GRAMMAR, repeat=3)) / N_GRAMMAR
+        tFast = min(timeit.repeat(fast, number=N_FAST, repeat=3)) / N_FAST
+        print('%-14s %8.1fus grammar %6.2fus fast (%dx)' % (
+            rule, tSlow * 1e6, tFast * 1e6, tSlow / tFast))
+
+
+if __name__ == '__main__':
+    main()
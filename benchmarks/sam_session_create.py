@@ -0,0 +1,97 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+"""Measure SAM session creation latency with and without NAMING LOOKUP ME.
+
+The SAM bridge is an in-memory stand-in that answers each command after a
+fixed delay, standing in for the round trip to a SAM bridge (and its work).
+Sessions are created one after another; the "lookup" case forces the old
+behaviour of asking the bridge for the session's own Destination.
+
+Run from the source root: PYTHONPATH=. python benchmarks/sam_session_create.py
+"""
+from __future__ import print_function
+
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.test import proto_helpers
+
+from txi2p.sam import session
+from txi2p.test.util import TEST_B64, TEST_PRIV_B64
+
+N = 50
+RTT = 0.010
+
+
+class BridgeTransport(proto_helpers.StringTransport):
+    """Answers SAM commands after RTT seconds."""
+
+    def __init__(self, proto):
+        proto_helpers.StringTransport.__init__(self)
+        self.proto = proto
+        self.commands = 0
+
+    def write(self, data):
+        for line in data.split(b'\n')[:-1]:
+            self.commands += 1
+            if line.startswith(b'HELLO'):
+                reply = b'HELLO REPLY RESULT=OK VERSION=3.1\n'
+            elif line.startswith(b'SESSION CREATE'):
+                reply = ('SESSION STATUS RESULT=OK DESTINATION=%s\n' %
+                         TEST_PRIV_B64).encode('utf-8')
+            elif line.startswith(b'NAMING LOOKUP'):
+                reply = ('NAMING REPLY RESULT=OK NAME=ME VALUE=%s\n' %
+                         TEST_B64).encode('utf-8')
+            reactor.callLater(RTT, self.proto.dataReceived, reply)
+
+    def setTcpKeepAlive(self, enabled):
+        pass
+
+
+class Bridge(object):
+    def __init__(self):
+        self.transports = []
+
+    def connect(self, fac):
+        fac.doStart()
+        proto = fac.buildProtocol(None)
+        transport = BridgeTransport(proto)
+        self.transports.append(transport)
+        proto.makeConnection(transport)
+        return defer.succeed(proto)
+
+
+@defer.inlineCallbacks
+def run(label):
+    bridge = Bridge()
+    start = time.time()
+    for i in range(N):
+        fac = session.SessionCreateFactory('bench%d' % i)
+        yield bridge.connect(fac)
+        yield fac.deferred
+    elapsed = time.time() - start
+    commands = sum(t.commands for t in bridge.transports)
+    print('%-24s %6.1f ms/session  %.0f round trips/session' % (
+        label, elapsed / N * 1e3, float(commands) / N))
+
+
+def noDerivation(privKey):
+    raise ValueError()
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    print('%d sessions, %.0f ms per round trip to the SAM bridge' % (
+        N, RTT * 1e3))
+    derive = session.destinationFromPrivateKey
+    session.destinationFromPrivateKey = noDerivation
+    try:
+        yield run('NAMING LOOKUP ME')
+    finally:
+        session.destinationFromPrivateKey = derive
+    yield run('Derived from private key')
+
+
+if __name__ == '__main__':
+    task.react(main)
@@ -0,0 +1,74 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+"""Measure the cost of tearing down streams as a session holds more of them.
+
+Each run registers N streams with a SAMSession, then removes them in a random
+order, as streams to different peers close independently. The cost per
+teardown should stay flat as N grows. For comparison, the same churn is run
+against a plain list, which is what SAMSession used before.
+
+Run from the source root: PYTHONPATH=. python benchmarks/sam_stream_registry.py
+"""
+from __future__ import print_function
+
+import random
+import time
+
+from txi2p.sam.registry import INBOUND, OUTBOUND
+from txi2p.sam.session import SAMSession
+
+SIZES = [1000, 5000, 20000, 50000]
+PEERS = 100
+
+
+class Stream(object):
+    pass
+
+
+def listChurn(streams):
+    registered = []
+    for stream, direction, peer in streams:
+        registered.append(stream)
+    order = list(registered)
+    random.shuffle(order)
+    start = time.time()
+    for stream in order:
+        if stream in registered:
+            registered.remove(stream)
+    return time.time() - start
+
+
+def registryChurn(streams):
+    s = SAMSession()
+    for stream, direction, peer in streams:
+        s.addStream(stream, direction, peer)
+    order = [stream for stream, direction, peer in streams]
+    random.shuffle(order)
+    start = time.time()
+    for stream in order:
+        s.removeStream(stream)
+    return time.time() - start
+
+
+def registryQueries(streams):
+    s = SAMSession()
+    for stream, direction, peer in streams:
+        s.addStream(stream, direction, peer)
+    start = time.time()
+    for i in range(PEERS):
+        s.countStreams('peer%d' % i)
+        s.countStreams(direction=INBOUND)
+    return (time.time() - start) / (2 * PEERS)
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    print('%-8s %16s %16s %18s' % (
+        'streams', 'list us/remove', 'registry us/rm', 'registry us/count'))
+    for n in SIZES:
+        streams = [(Stream(), (INBOUND, OUTBOUND)[i % 2], 'peer%d' % (i % PEERS))
+                   for i in range(n)]
+        print('%-8d %16.2f %16.2f %18.2f' % (
+            n, listChurn(streams) / n * 1e6, registryChurn(streams) / n * 1e6,
+            registryQueries(streams) * 1e6))
@@ -0,0 +1,82 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+"""Measure the per-chunk cost of delivering data on an established SAM stream.
+
+The SAM bridge is stood in for by an in-memory transport; the stream is driven
+through HELLO and STREAM CONNECT before timing starts.
+
+Run from the source root: PYTHONPATH=. python benchmarks/sam_stream_throughput.py
+"""
+from __future__ import print_function
+
+import timeit
+
+from twisted.internet.protocol import Protocol, Factory
+from twisted.test import proto_helpers
+
+from txi2p.address import I2PAddress
+from txi2p.sam import base
+from txi2p.sam.stream import StreamConnectFactory
+from txi2p.test.util import TEST_B64
+
+N = 200000
+CHUNK = b'x' * 4096
+
+
+class Sink(Protocol):
+    received = 0
+
+    def dataReceived(self, data):
+        self.received += len(data)
+
+
+class Session(object):
+    id = 'bench'
+    namingCache = None
+    address = I2PAddress(TEST_B64)
+
+    def addStream(self, stream, direction=None, peer=None):
+        pass
+
+    def setStreamPeer(self, stream, peer):
+        pass
+
+    def removeStream(self, stream):
+        pass
+
+
+def connectedStream():
+    fac = StreamConnectFactory(Factory.forProtocol(Sink), Session(), 'spam.i2p',
+                               'spam')
+    proto = fac.buildProtocol(None)
+    proto.makeConnection(proto_helpers.StringTransport())
+    proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+    proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
+    return proto
+
+
+def bench(label):
+    proto = connectedStream()
+    t = min(timeit.repeat(lambda: proto.dataReceived(CHUNK),
+                          number=N, repeat=3)) / N
+    print('%-32s %6.3fus/chunk %8.1f MiB/s' % (
+        label, t * 1e6, len(CHUNK) / t / (1 << 20)))
+
+
+def main():
+    bench('Bound data path')
+
+    bound = base.SAMReceiver.bindDataPath
+    def unbound(self):
+        # The previous behaviour: keep routing through the parser
+        self.currentRule = 'State_readData'
+    base.SAMReceiver.bindDataPath = unbound
+    try:
+        bench('Via parser and receiver (old)')
+    finally:
+        base.SAMReceiver.bindDataPath = bound
+
+
+if __name__ == '__main__':
+    main()
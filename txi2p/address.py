@@ -3,15 +3,146 @@
 
 from builtins import object
 import base64
+from collections import OrderedDict, deque
 import hashlib
-from twisted.internet.interfaces import IAddress, ITransport
+import weakref
+from twisted.internet.interfaces import (
+    IAddress,
+    IConsumer,
+    IPushProducer,
+    ITransport,
+)
 from twisted.internet.protocol import Protocol
-from twisted.python.util import FancyEqMixin
 from zope.interface import implementer
 
 
+# Maximum number of Destinations whose B32 address is remembered
+B32_CACHE_SIZE = 1024
+
+_b32Cache = OrderedDict()
+
+
+def destinationToB32(destination):
+    """Compute the B32 address of a Destination.
+
+    Results are memoized in a bounded, process-wide cache.
+
+    Args:
+        destination (str): An I2P Destination string in I2P-style B64 format.
+
+    Returns:
+        str: The ``fiftytwocharacters.b32.i2p`` address of ``destination``.
+    """
+    try:
+        b32 = _b32Cache.pop(destination)
+    except KeyError:
+        raw_key = base64.b64decode(destination.encode('utf-8'), b'-~')
+        hash = hashlib.sha256(raw_key)
+        base32_hash = base64.b32encode(hash.digest()).decode('utf-8')
+        b32 = base32_hash.lower().replace('=', '')+'.b32.i2p'
+        while len(_b32Cache) >= B32_CACHE_SIZE:
+            _b32Cache.popitem(last=False)
+    # (Re-)insert to mark as most recently used
+    _b32Cache[destination] = b32
+    return b32
+
+
+# Length of the public key and signing public key fields of a Destination
+_DEST_KEYS_LENGTH = 384
+# Certificate types
+_CERT_NULL = 0
+_CERT_KEY = 5
+# Private key lengths by crypto type (ElGamal, ECIES-X25519)
+_PRIVATE_KEY_LENGTHS = {0: 256, 4: 32}
+# Signing private key lengths by SigType code
+_SIGNING_PRIVATE_KEY_LENGTHS = {
+    0: 20,     # DSA_SHA1
+    1: 32,     # ECDSA_SHA256_P256
+    2: 48,     # ECDSA_SHA384_P384
+    3: 66,     # ECDSA_SHA512_P521
+    4: 512,    # RSA_SHA256_2048
+    5: 768,    # RSA_SHA384_3072
+    6: 1024,   # RSA_SHA512_4096
+    7: 32,     # EdDSA_SHA512_Ed25519
+    8: 32,     # EdDSA_SHA512_Ed25519ph
+    11: 32,    # RedDSA_SHA512_Ed25519
+}
+
+
+def destinationFromPrivateKey(privKey):
+    """Extract the public Destination from a private key.
+
+    The private key, as returned by SAM and BOB and stored in keyfiles, is the
+    Destination followed by its private keys. The length of the Destination
+    depends on its certificate, and the length of the private keys on the
+    crypto and signature types in that certificate.
+
+    Args:
+        privKey (str): The private key in I2P-style B64 format.
+
+    Returns:
+        str: The Destination in I2P-style B64 format.
+
+    Raises:
+        ValueError: if ``privKey`` is not a private key of a known type,
+            including private keys with offline signatures.
+    """
+    try:
+        raw = base64.b64decode(privKey.encode('utf-8'), b'-~')
+    except (TypeError, ValueError):
+        raise ValueError('Invalid B64 in private key')
+    header = bytearray(raw[_DEST_KEYS_LENGTH:_DEST_KEYS_LENGTH + 7])
+    if len(header) < 3:
+        raise ValueError('Private key too short')
+    certType = header[0]
+    certLength = (header[1] << 8) | header[2]
+    destLength = _DEST_KEYS_LENGTH + 3 + certLength
+    if certType == _CERT_NULL and certLength == 0:
+        sigType, cryptoType = 0, 0
+    elif certType == _CERT_KEY and certLength >= 4 and len(header) == 7:
+        sigType = (header[3] << 8) | header[4]
+        cryptoType = (header[5] << 8) | header[6]
+    else:
+        raise ValueError('Unsupported certificate type %d' % certType)
+    if sigType not in _SIGNING_PRIVATE_KEY_LENGTHS or \
+            cryptoType not in _PRIVATE_KEY_LENGTHS:
+        raise ValueError('Unsupported key types %d/%d' % (sigType, cryptoType))
+    if len(raw) != destLength + _PRIVATE_KEY_LENGTHS[cryptoType] + \
+            _SIGNING_PRIVATE_KEY_LENGTHS[sigType]:
+        raise ValueError('Private key has the wrong length')
+    return base64.b64encode(raw[:destLength], b'-~').decode('utf-8')
+
+
+class _Destination(object):
+    # Holds a shared Destination string. A plain str can't be weakly
+    # referenced, and a subclass of it would leak out of I2PAddress.
+    __slots__ = ('value', '__weakref__')
+
+    def __init__(self, value):
+        self.value = value
+
+# Pool of Destination strings in use by live I2PAddresses
+_destinations = weakref.WeakValueDictionary()
+
+
+def _sharedDestination(destination):
+    shared = _destinations.get(destination)
+    if shared is None:
+        shared = _destinations[destination] = _Destination(destination)
+    return shared
+
+
+def internDestination(destination):
+    """Get the shared copy of a Destination string.
+
+    All live :class:`I2PAddress` objects for the same Destination share one
+    copy of it. The copy is released once no address refers to it.
+    """
+    return _sharedDestination(destination).value
+
+
 @implementer(IAddress)
-class I2PAddress(FancyEqMixin, object):
+class I2PAddress(object):
     """An :class:`IAddress` that represents the address of an I2P Destination.
 
     Args:
@@ -29,6 +160,7 @@ class I2PAddress(FancyEqMixin, object):
         port (int): An integer representing the port number. Will be ``None`` if
             no port is configured.
     """
+    __slots__ = ('_destination', '_host', 'port')
     compareAttributes = ('destination', 'port')
 
     def __init__(self, destination, host=None, port=None):
@@ -39,15 +171,47 @@ class I2PAddress(FancyEqMixin, object):
         self.port = int(port) if port else None
 
         if host:
-            self.host = host
+            self._host = host
+        elif isinstance(destination, I2PAddress):
+            # Don't force the other address to compute its host
+            self._host = destination._host
         elif hasattr(destination, 'host'):
-            self.host = destination.host
+            self._host = destination.host
         else:
-            raw_key = base64.b64decode(destination.encode('utf-8'), b'-~')
-            hash = hashlib.sha256(raw_key)
-            base32_hash = base64.b32encode(hash.digest()).decode('utf-8')
-            self.host = base32_hash.lower().replace('=', '')+'.b32.i2p'
+            # Computed on first access
+            self._host = None
+
+    @property
+    def destination(self):
+        return self._destination.value
+
+    @destination.setter
+    def destination(self, destination):
+        self._destination = _sharedDestination(destination)
 
+    @property
+    def host(self):
+        if self._host is None:
+            self._host = destinationToB32(self.destination)
+        return self._host
+
+    @host.setter
+    def host(self, host):
+        self._host = host
+
+    # Equivalent to twisted.python.util.FancyEqMixin, which can't be used
+    # because it would give every instance a __dict__.
+    def __eq__(self, other):
+        if isinstance(self, other.__class__):
+            return all(getattr(self, name) == getattr(other, name)
+                       for name in self.compareAttributes)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
 
     def __repr__(self):
         if self.port:
@@ -58,15 +222,76 @@ class I2PAddress(FancyEqMixin, object):
 
 
     def __hash__(self):
-        return hash((self.host, self.port))
+        # Not the host, so that hashing doesn't compute the B32 address
+        return hash((self.destination, self.port))
+
+
+# The longest first line a BOB tunnel connection will buffer: the peer's
+# Destination on a server tunnel, or an ERROR on a client tunnel
+MAX_TUNNEL_LINE = 4096
+
+# Default bounds on data held by an I2PTunnelTransport while the underlying
+# transport is not accepting writes
+DEFAULT_HIGH_WATER = 64 * 1024
+DEFAULT_LOW_WATER = 16 * 1024
+
+
+@implementer(IPushProducer)
+class _WriteThrottle(object):
+    # Registered with the underlying transport on behalf of an
+    # I2PTunnelTransport, so that the transport's write-side pause and resume
+    # don't get confused with the application pausing the read side.
+    def __init__(self, tunnelTransport):
+        self._tunnelTransport = tunnelTransport
+
+    def pauseProducing(self):
+        self._tunnelTransport._pauseWriting()
 
+    def resumeProducing(self):
+        self._tunnelTransport._resumeWriting()
 
-@implementer(ITransport)
+    def stopProducing(self):
+        self._tunnelTransport._stopWriting()
+
+
+@implementer(ITransport, IConsumer, IPushProducer)
 class I2PTunnelTransport(object):
-    def __init__(self, wrappedTransport, localAddr, peerAddr=None, invertTLS=False):
+    """A transport for a connection to or from an I2P Destination.
+
+    Writes and reads are passed through to the underlying transport. When a
+    streaming producer is registered, writes made while the underlying
+    transport is full are held here; the producer is paused once
+    ``highWater`` bytes are held, and resumed once no more than ``lowWater``
+    bytes are. Pulling producers are registered directly with the underlying
+    transport.
+
+    Pausing this transport (as an :class:`IPushProducer`) stops reading from
+    the underlying transport.
+
+    Args:
+        highWater (int): Bytes held before the producer is paused.
+        lowWater (int): Bytes held before a paused producer is resumed.
+    """
+    producer = None
+    streamingProducer = False
+
+    def __init__(self, wrappedTransport, localAddr, peerAddr=None,
+                 invertTLS=False, highWater=DEFAULT_HIGH_WATER,
+                 lowWater=DEFAULT_LOW_WATER):
+        if lowWater > highWater:
+            raise ValueError('lowWater must not be greater than highWater')
         self.t = wrappedTransport
         self._localAddr = localAddr
         self.peerAddr = peerAddr
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self._buffer = deque()
+        self._bufferLen = 0
+        self._writePaused = False
+        self._producerPaused = False
+        # Bind the hot paths directly, bypassing __getattr__
+        self.write = wrappedTransport.write
+        self.writeSequence = wrappedTransport.writeSequence
 
         # Workaround for https://tahoe-lafs.org/trac/tahoe-lafs/ticket/2861
         if invertTLS and hasattr(self.t, 'startTLS'):
@@ -84,12 +309,96 @@ class I2PTunnelTransport(object):
     def getHost(self):
         return self._localAddr
 
+    # IConsumer
+
+    def registerProducer(self, producer, streaming):
+        if self.producer is not None:
+            raise RuntimeError(
+                'Cannot register producer %s, because producer %s was never '
+                'unregistered.' % (producer, self.producer))
+        self.producer = producer
+        self.streamingProducer = streaming
+        if streaming:
+            self.t.registerProducer(_WriteThrottle(self), True)
+        else:
+            self.t.registerProducer(producer, False)
+
+    def unregisterProducer(self):
+        if self.producer is None:
+            return
+        self.producer = None
+        self._producerPaused = False
+        self._writePaused = False
+        self.t.unregisterProducer()
+        # Nothing can throttle writes any more, so hand over everything held
+        data, self._buffer, self._bufferLen = list(self._buffer), deque(), 0
+        self.write = self.t.write
+        self.writeSequence = self.t.writeSequence
+        if data:
+            self.t.writeSequence(data)
+
+    # IPushProducer (read side)
+
+    def pauseProducing(self):
+        self.t.pauseProducing()
+
+    def resumeProducing(self):
+        self.t.resumeProducing()
+
+    def stopProducing(self):
+        self.t.stopProducing()
+
+    # Write side, driven by the underlying transport through _WriteThrottle
+
+    def _bufferWrite(self, data):
+        if data:
+            self._buffer.append(data)
+            self._bufferLen += len(data)
+            self._checkHighWater()
+
+    def _bufferWriteSequence(self, data):
+        for chunk in data:
+            self._bufferWrite(chunk)
+
+    def _checkHighWater(self):
+        if (self.producer is not None and not self._producerPaused and
+                self._bufferLen >= self.highWater):
+            self._producerPaused = True
+            self.producer.pauseProducing()
+
+    def _pauseWriting(self):
+        self._writePaused = True
+        self.write = self._bufferWrite
+        self.writeSequence = self._bufferWriteSequence
+        self._checkHighWater()
+
+    def _resumeWriting(self):
+        self._writePaused = False
+        # Writing may fill the underlying transport again, which pauses us
+        while self._buffer and not self._writePaused:
+            data = self._buffer.popleft()
+            self._bufferLen -= len(data)
+            self.t.write(data)
+        if not self._writePaused:
+            self.write = self.t.write
+            self.writeSequence = self.t.writeSequence
+        if self._producerPaused and self._bufferLen <= self.lowWater:
+            self._producerPaused = False
+            self.producer.resumeProducing()
+
+    def _stopWriting(self):
+        self._buffer.clear()
+        self._bufferLen = 0
+        if self.producer is not None:
+            self.producer.stopProducing()
+
 
 class I2PServerTunnelProtocol(Protocol):
     def __init__(self, wrappedProto, serverAddr):
         self.wrappedProto = wrappedProto
         self._serverAddr = serverAddr
         self.peer = None
+        self._buffer = b''
 
     def connectionMade(self):
         # Substitute transport for an I2P wrapper
@@ -97,15 +406,25 @@ class I2PServerTunnelProtocol(Protocol):
         self.wrappedProto.makeConnection(self.transport)
 
     def dataReceived(self, data):
-        if self.peer:
-            # Pass all other data to the wrapped Protocol.
-            self.wrappedProto.dataReceived(data.encode('utf-8'))
-        else:
-            # First line is the peer's Destination.
-            self.setPeer(data)
+        # First line is the peer's Destination, which may arrive in pieces.
+        self._buffer += data
+        line, sep, rest = self._buffer.partition(b'\n')
+        if not sep:
+            if len(self._buffer) > MAX_TUNNEL_LINE:
+                self._buffer = b''
+                # Ignore anything else sent before the connection closes
+                self.dataReceived = lambda data: None
+                self.transport.loseConnection()
+            return
+        self._buffer = b''
+        self.setPeer(line)
+        # Pass all other data straight to the wrapped Protocol.
+        self.dataReceived = self.wrappedProto.dataReceived
+        if rest:
+            self.wrappedProto.dataReceived(rest)
 
-    def setPeer(self, data):
-        self.peer = I2PAddress(data.split('\n')[0])
+    def setPeer(self, line):
+        self.peer = I2PAddress(line.decode('ascii'))
         self.transport.peerAddr = self.peer
 
     def connectionLost(self, reason):
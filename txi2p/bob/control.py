@@ -0,0 +1,312 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from collections import deque
+from twisted.internet import defer, reactor, task
+from twisted.internet.error import ConnectionDone
+from twisted.internet.protocol import ClientFactory
+from twisted.python import log
+
+from txi2p.bob.inventory import (DEFAULT_TUNNEL_LIST_TTL, PortAllocator,
+                                 TunnelInventory)
+from txi2p.bob.protocol import BOBError, BOBSender, makeBOBProtocol
+
+# Commands that do not change any tunnel
+READ_ONLY_COMMANDS = ('getdest', 'getkeys', 'getnick', 'list', 'show',
+                      'showprops', 'status', 'verify', 'visit')
+
+# Seconds before the first retry of a command refused by a busy tunnel
+RETRY_INITIAL_DELAY = 0.1
+# Each retry waits this many times longer than the one before
+RETRY_FACTOR = 2
+DEFAULT_MAX_RETRIES = 10
+# Seconds spent waiting to retry, in total, before giving up
+DEFAULT_MAX_RETRY_WAIT = 30
+
+
+class RetryBackoff(object):
+    """Spaces out the retries of a command with an exponential backoff.
+
+    BOB refuses some commands while a tunnel is starting or stopping. Rather
+    than resending them straight away, each retry waits twice as long as the
+    one before, until ``maxRetries`` retries have been made or ``maxWait``
+    seconds have been spent waiting.
+
+    Args:
+        clock: The clock used to schedule the retries.
+        maxRetries (int): The number of retries allowed.
+        maxWait (int): The total seconds that may be spent waiting.
+    """
+
+    def __init__(self, clock, maxRetries=DEFAULT_MAX_RETRIES,
+                 maxWait=DEFAULT_MAX_RETRY_WAIT):
+        self._clock = clock
+        self.maxRetries = maxRetries
+        self.maxWait = maxWait
+        self.retries = 0
+        self.waited = 0
+
+    def wait(self, reason):
+        """Wait before the next retry.
+
+        Args:
+            reason (twisted.python.failure.Failure): Why the command is being
+                retried.
+
+        Returns:
+            twisted.internet.defer.Deferred: Fires once the command should be
+            retried, or fails with ``reason`` if there are no retries left.
+        """
+        if self.retries >= self.maxRetries or self.waited >= self.maxWait:
+            return defer.fail(reason)
+        delay = min(RETRY_INITIAL_DELAY * RETRY_FACTOR**self.retries,
+                    self.maxWait - self.waited)
+        self.retries += 1
+        self.waited += delay
+        return task.deferLater(self._clock, delay, lambda: None)
+
+
+class BOBControlReceiver(object):
+    currentRule = 'State_init'
+
+    def __init__(self, sender):
+        self.sender = sender
+
+    def prepareParsing(self, parser):
+        # Store the factory for later use
+        self.factory = parser.factory
+
+    def finishParsing(self, reason):
+        self.factory.connectionFailed(reason)
+
+    def initBOB(self, version):
+        # Every reply after the greeting is parsed the same way
+        self.currentRule = 'State_reply'
+        self.factory.connectionReady(self)
+
+    def reply(self, success, info, data):
+        self.factory.replied(success, info, data)
+
+
+# A Protocol that sends BOB commands for as long as it is connected
+BOBControlProtocol = makeBOBProtocol(
+    BOBSender,
+    BOBControlReceiver)
+
+
+class BOBControlFactory(ClientFactory):
+    protocol = BOBControlProtocol
+    bobProto = None
+
+    def _cancel(self, d):
+        if self.bobProto:
+            self.bobProto.sender.transport.abortConnection()
+
+    def __init__(self, client):
+        self._client = client
+        self.deferred = defer.Deferred(self._cancel)
+
+    def buildProtocol(self, addr):
+        proto = self.protocol()
+        proto.factory = self
+        self.bobProto = proto
+        return proto
+
+    def connectionReady(self, receiver):
+        self.deferred.callback(receiver)
+
+    def replied(self, success, info, data):
+        self._client._replied(success, info, data)
+
+    def connectionFailed(self, reason):
+        if self.deferred.called:
+            self._client._connectionLost(reason)
+        else:
+            self.deferred.errback(reason)
+
+    # This method is not called if an endpoint deferred errbacks
+    def clientConnectionFailed(self, connector, reason):
+        self.connectionFailed(reason)
+
+
+class BOBControlClient(object):
+    """Sends commands to the BOB API over one persistent connection.
+
+    The connection is opened by the first command, and reopened by the next
+    command if it is lost. Commands are pipelined: each one is sent as soon as
+    it is requested, without waiting for earlier replies, and BOB answers them
+    in order.
+
+    BOB commands act on the tunnel selected on the connection with
+    ``getnick`` or ``setnick``, so operations on tunnels must not interleave.
+    :meth:`run` queues operations so that they run one at a time.
+
+    The tunnels BOB has are listed by :meth:`listTunnels`, which reuses the
+    last listing until it is ``listTTL`` seconds old, or a command that
+    changes a tunnel is sent. Tunnels created or changed by other BOB clients
+    may therefore be missed for up to ``listTTL`` seconds.
+
+    Args:
+        bobEndpoint (twisted.internet.interfaces.IStreamClientEndpoint): An
+            endpoint that will connect to the BOB API.
+        listTTL (int): Seconds a listing of the tunnels is reused for.
+        maxRetries (int): The number of times a command refused by a busy
+            tunnel is retried. See :class:`RetryBackoff`.
+        maxRetryWait (int): The total seconds spent waiting to retry a
+            command refused by a busy tunnel.
+        clock: The clock used to age the listing and schedule retries.
+            Defaults to the reactor.
+
+    Attributes:
+        ports (txi2p.bob.inventory.PortAllocator): Picks the ports of new
+            tunnels.
+    """
+
+    def __init__(self, bobEndpoint, listTTL=DEFAULT_TUNNEL_LIST_TTL,
+                 maxRetries=DEFAULT_MAX_RETRIES,
+                 maxRetryWait=DEFAULT_MAX_RETRY_WAIT, clock=None):
+        self.bobEndpoint = bobEndpoint
+        self.listTTL = listTTL
+        self.maxRetries = maxRetries
+        self.maxRetryWait = maxRetryWait
+        self._clock = clock or reactor
+        self.ports = PortAllocator()
+        self._inventory = None
+        self._listedAt = None
+        # Counts the commands sent that change tunnels
+        self._changes = 0
+        self._receiver = None
+        self._connecting = None
+        # Commands waiting to be sent, before the connection is ready
+        self._unsent = []
+        # Commands sent, in the order their replies will arrive
+        self._sent = deque()
+        self._lock = defer.DeferredLock()
+
+    def command(self, command, *args):
+        """Send a BOB command.
+
+        Args:
+            command (str): The command, e.g. ``getnick``.
+            *args: The arguments of the command.
+
+        Returns:
+            twisted.internet.defer.Deferred: Fires with the information BOB
+            replied with, or for ``list``, with a list of tunnel status dicts.
+            Errbacks with :class:`txi2p.bob.protocol.BOBError` if the command
+            failed.
+        """
+        if command not in READ_ONLY_COMMANDS:
+            self._inventory = None
+            self._changes += 1
+        d = defer.Deferred()
+        if self._receiver:
+            self._send(command, args, d)
+        else:
+            self._unsent.append((command, args, d))
+            self._connect()
+        return d
+
+    def listTunnels(self):
+        """List the tunnels BOB has.
+
+        Returns:
+            twisted.internet.defer.Deferred: Fires with a
+            :class:`txi2p.bob.inventory.TunnelInventory`.
+        """
+        now = self._clock.seconds()
+        if self._inventory is not None and \
+                now - self._listedAt < self.listTTL:
+            return defer.succeed(self._inventory)
+        changes = self._changes
+        def listed(tunnels):
+            inventory = TunnelInventory(tunnels)
+            # Replies come in order, so the listing is out of date if a
+            # change was sent after it.
+            if changes == self._changes:
+                self._inventory = inventory
+                self._listedAt = now
+            return inventory
+        return self.command('list').addCallback(listed)
+
+    def backoff(self):
+        """Get a :class:`RetryBackoff` for retrying a command."""
+        return RetryBackoff(self._clock, self.maxRetries, self.maxRetryWait)
+
+    def run(self, operation, *args, **kwargs):
+        """Run an operation once the operations before it have finished.
+
+        Args:
+            operation: A callable taking this client (followed by ``args``
+                and ``kwargs``), that sends commands and returns a Deferred
+                firing once the operation has finished.
+
+        Returns:
+            twisted.internet.defer.Deferred: Fires with the result of the
+            operation.
+        """
+        return self._lock.run(operation, self, *args, **kwargs)
+
+    def close(self):
+        """Close the connection. Outstanding commands fail."""
+        if self._receiver:
+            self._receiver.sender.transport.loseConnection()
+        elif self._connecting:
+            self._connecting.cancel()
+
+    def _send(self, command, args, d):
+        self._sent.append((command, d))
+        send = getattr(self._receiver.sender, 'send' + command.capitalize())
+        send(*args)
+
+    def _connect(self):
+        if self._connecting:
+            return
+        fac = BOBControlFactory(self)
+        d = self.bobEndpoint.connect(fac)
+        d.addCallback(lambda proto: fac.deferred)
+        self._connecting = d
+        d.addCallbacks(self._connected, self._connectionLost)
+
+    def _connected(self, receiver):
+        self._connecting = None
+        self._receiver = receiver
+        unsent, self._unsent = self._unsent, []
+        for command, args, d in unsent:
+            self._send(command, args, d)
+
+    def _replied(self, success, info, data):
+        if not self._sent:
+            log.msg('Unexpected BOB reply: %s' % info)
+            return
+        command, d = self._sent.popleft()
+        if not success:
+            d.errback(BOBError(command, info))
+        elif command == 'list':
+            d.callback(data)
+        else:
+            d.callback(info)
+
+    def _connectionLost(self, reason):
+        self._connecting = None
+        self._receiver = None
+        waiting = [d for command, args, d in self._unsent]
+        waiting.extend(d for command, d in self._sent)
+        self._unsent = []
+        self._sent.clear()
+        if reason.check(defer.CancelledError):
+            reason = ConnectionDone()
+        for d in waiting:
+            d.errback(reason)
+
+
+_clients = {}
+
+
+def getBOBControlClient(bobEndpoint):
+    """Get the control client shared by everything using a BOB API endpoint.
+    """
+    if bobEndpoint not in _clients:
+        _clients[bobEndpoint] = BOBControlClient(bobEndpoint)
+    return _clients[bobEndpoint]
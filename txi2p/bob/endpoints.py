@@ -6,6 +6,7 @@ from twisted.internet import interfaces
 from zope.interface import implementer
 
 from txi2p.bob.factory import BOBI2PClientFactory, BOBI2PServerFactory
+from txi2p.bob.tunnels import getClientTunnelRegistry
 
 
 def _validateDestination(dest):
@@ -38,6 +39,15 @@ class BOBI2PClientEndpoint(object):
         inport (int): The port that the tunnel created by BOB will listen on.
             Defaults to a port over 9000.
         options (dict): I2CP options to configure the tunnel with.
+        tunnelRegistry (txi2p.bob.tunnels.ClientTunnelRegistry): The
+            registry of client tunnels to share. Defaults to the registry
+            shared by all client endpoints.
+
+    Client tunnels are shared by all endpoints with the same BOB API endpoint,
+    tunnel nickname, inhost, inport and options, whatever their Destination.
+    Only the first connection creates the tunnel; later connections just
+    connect to its inport. A tunnel is removed once it has not been used for
+    ``tunnelRegistry.linger`` seconds.
     """
 
     def __init__(self, reactor, bobEndpoint, dest,
@@ -45,7 +55,8 @@ class BOBI2PClientEndpoint(object):
                  tunnelNick=None,
                  inhost='localhost',
                  inport=None,
-                 options=None):
+                 options=None,
+                 tunnelRegistry=None):
         _validateDestination(dest)
         self._reactor = reactor
         self._bobEndpoint = bobEndpoint
@@ -55,6 +66,9 @@ class BOBI2PClientEndpoint(object):
         self._inhost = inhost
         self._inport = inport
         self._options = options
+        if tunnelRegistry is None:
+            tunnelRegistry = getClientTunnelRegistry()
+        self._tunnelRegistry = tunnelRegistry
 
     def connect(self, fac):
         """Connect over I2P.
@@ -66,17 +80,24 @@ class BOBI2PClientEndpoint(object):
         will immediately close.
         """
 
+        tunnel, isNew = self._tunnelRegistry.acquire(
+            self._bobEndpoint, self._tunnelNick,
+            self._inhost, self._inport, self._options)
+        if not isNew:
+            # Wait for the tunnel to be created, then connect through it.
+            d = tunnel.whenCreated()
+            d.addCallback(
+                lambda tunnel: tunnel.connect(self._reactor, fac, self._dest))
+            return d
+
         i2pFac = BOBI2PClientFactory(self._reactor, fac, self._bobEndpoint, self._dest,
                                      self._tunnelNick,
                                      self._inhost,
                                      self._inport,
-                                     self._options)
-        d = self._bobEndpoint.connect(i2pFac)
-        # Once the BOB IProtocol is returned, wait for the
-        # real IProtocol to be returned after tunnel creation,
-        # and pass it to any further registered callbacks.
-        d.addCallback(lambda proto: i2pFac.deferred)
-        return d
+                                     self._options,
+                                     tunnel)
+        # The real IProtocol is returned after tunnel creation.
+        return i2pFac.createTunnel()
 
 
 @implementer(interfaces.IStreamServerEndpoint)
@@ -138,9 +159,5 @@ class BOBI2PServerEndpoint(object):
                                      self._outhost,
                                      self._outport,
                                      self._options)
-        d = self._bobEndpoint.connect(i2pFac)
-        # Once the BOB IProtocol is returned, wait for the
-        # IListeningPort to be returned after tunnel creation,
-        # and pass it to any further registered callbacks.
-        d.addCallback(lambda proto: i2pFac.deferred)
-        return d
+        # The IListeningPort is returned after tunnel creation.
+        return i2pFac.createTunnel()
@@ -3,34 +3,81 @@
 
 from __future__ import print_function
 from builtins import object
+from twisted.internet import defer
 from twisted.internet.defer import Deferred
-from twisted.internet.endpoints import TCP4ClientEndpoint, TCP4ServerEndpoint
-from twisted.internet.protocol import ClientFactory, Factory
+from twisted.internet.endpoints import TCP4ServerEndpoint
 
 from txi2p.address import I2PAddress
-from txi2p.bob.protocol import (I2PClientTunnelCreatorBOBClient,
-                                I2PServerTunnelCreatorBOBClient,
-                                I2PTunnelRemoverBOBClient,
+from txi2p.keystore import getKeyStore
+from txi2p.bob.control import getBOBControlClient
+from txi2p.bob.protocol import (I2PClientTunnelCreator,
+                                I2PServerTunnelCreator,
+                                I2PTunnelRemover,
                                 I2PClientTunnelProtocol,
                                 I2PServerTunnelProtocol,
                                 I2PListeningPort)
 
 
-class BOBI2PClientFactory(ClientFactory):
-    protocol = I2PClientTunnelCreatorBOBClient
-    bobProto = None
+class BOBI2PFactoryCommon(object):
+    """Creates a BOB tunnel, then hands it to the wrapped factory.
+
+    Tunnel operations from all factories sharing a BOB API endpoint are
+    queued on its :class:`txi2p.bob.control.BOBControlClient`.
+    """
+    creator = None
     canceled = False
     removeTunnelWhenFinished = True
 
     def _cancel(self, d):
-        self.bobProto.sender.transport.abortConnection()
         self.canceled = True
 
+    def startFactory(self):
+        pass
+
+    def createTunnel(self):
+        """Create the tunnel.
+
+        Returns:
+            twisted.internet.defer.Deferred: The factory's ``deferred``.
+        """
+        self.startFactory()
+        self._control = getBOBControlClient(self._bobEndpoint)
+        d = self._control.run(self.creator(self).run)
+        d.addCallbacks(self._tunnelCreated, self.bobConnectionFailed)
+        return self.deferred
+
+    def _tunnelCreated(self, result):
+        if self.canceled:
+            self.i2pTunnelAbandoned()
+            return
+        self.i2pTunnelCreated()
+
+    def i2pTunnelAbandoned(self):
+        # Nobody is waiting for the tunnel any more
+        if self.removeTunnelWhenFinished:
+            self._control.run(I2PTunnelRemover(self.tunnelNick).run)
+
+    def bobConnectionFailed(self, reason):
+        if not self.canceled:
+            self.deferred.errback(reason)
+
+
+class BOBI2PClientFactory(BOBI2PFactoryCommon):
+    creator = I2PClientTunnelCreator
+
+    def _cancel(self, d):
+        BOBI2PFactoryCommon._cancel(self, d)
+        if self.tunnel and not self.tunnel.created:
+            # Only drop this connection's reference. The tunnel is still
+            # created for any other connections waiting for it.
+            self.tunnel.release()
+
     def __init__(self, reactor, clientFactory, bobEndpoint, dest,
                  tunnelNick=None,
                  inhost='localhost',
                  inport=None,
-                 options={}):
+                 options={},
+                 tunnel=None):
         self._reactor = reactor
         self._clientFactory = clientFactory
         self._bobEndpoint = bobEndpoint
@@ -39,34 +86,28 @@ class BOBI2PClientFactory(ClientFactory):
         self.inhost = inhost
         self.inport = inport
         self.options = options
+        self.tunnel = tunnel
         self.deferred = Deferred(self._cancel);
 
-    def buildProtocol(self, addr):
-        proto = self.protocol()
-        proto.factory = self
-        self.bobProto = proto
-        return proto
-
     def bobConnectionFailed(self, reason):
-        if not self.canceled:
-            self.deferred.errback(reason)
-
-    # This method is not called if an endpoint deferred errbacks
-    def clientConnectionFailed(self, connector, reason):
-        self.bobConnectionFailed(reason)
+        if self.tunnel:
+            self.tunnel.tunnelFailed(reason)
+        BOBI2PFactoryCommon.bobConnectionFailed(self, reason)
+
+    def i2pTunnelAbandoned(self):
+        if self.tunnel:
+            if self.tunnel.connections:
+                # Hand the tunnel to the connections still waiting for it
+                self.tunnel.tunnelCreated(self)
+                return
+            # Nobody is waiting, so nobody is told
+            self.tunnel.tunnelFailed(defer.CancelledError())
+        BOBI2PFactoryCommon.i2pTunnelAbandoned(self)
 
     def i2pTunnelCreated(self):
-        # BOB is now listening for a tunnel.
-        # BOB only listens on TCP4 (for now).
-        clientEndpoint = TCP4ClientEndpoint(self._reactor, self.inhost, self.inport)
-        # Wrap the client Factory.
-        wrappedFactory = BOBClientFactoryWrapper(self._clientFactory,
-                                                 self._bobEndpoint,
-                                                 I2PAddress(self.localDest),
-                                                 self.tunnelNick,
-                                                 self.removeTunnelWhenFinished)
-        wrappedFactory.setDest(self.dest)
-        d = clientEndpoint.connect(wrappedFactory)
+        # BOB is now listening for a tunnel, which later connections share.
+        self.tunnel.tunnelCreated(self)
+        d = self.tunnel.connect(self._reactor, self._clientFactory, self.dest)
         def checkProto(proto):
             if proto is None:
                 self.deferred.cancel()
@@ -76,26 +117,23 @@ class BOBI2PClientFactory(ClientFactory):
         d.chainDeferred(self.deferred)
 
 
-class BOBI2PServerFactory(Factory):
-    protocol = I2PServerTunnelCreatorBOBClient
-    bobProto = None
-    canceled = False
-    removeTunnelWhenFinished = True
-
-    def _cancel(self, d):
-        self.bobProto.sender.transport.abortConnection()
-        self.canceled = True
+class BOBI2PServerFactory(BOBI2PFactoryCommon):
+    creator = I2PServerTunnelCreator
 
     def __init__(self, reactor, serverFactory, bobEndpoint, keyfile,
                  tunnelNick=None,
                  outhost='localhost',
                  outport=None,
-                 options={}):
+                 options={},
+                 keystore=None):
         self._reactor = reactor
         self._serverFactory = serverFactory
         self._bobEndpoint = bobEndpoint
         self._keyfile = keyfile
+        self._keystore = keystore or getKeyStore()
         self._writeKeypair = False
+        self._keyLoad = None
+        self.keypair = None
         self.tunnelNick = tunnelNick
         self.outhost = outhost
         self.outport = outport
@@ -103,36 +141,29 @@ class BOBI2PServerFactory(Factory):
         self.deferred = Deferred(self._cancel)
 
     def startFactory(self):
-        try:
-            f = open(self._keyfile, 'r')
-            self.keypair = f.read()
-            f.close()
-        except IOError:
-            self.keypair = None
-            self._writeKeypair = True
+        self._keyLoad = self._keystore.load(self._keyfile)
+        self._keyLoad.addCallbacks(self._keyLoaded, self._keyLoadFailed)
 
-    def buildProtocol(self, addr):
-        proto = self.protocol()
-        proto.factory = self
-        self.bobProto = proto
-        return proto
+    def _keyLoaded(self, keypair):
+        self.keypair = keypair
 
-    def bobConnectionFailed(self, reason):
-        if not self.canceled:
-            self.deferred.errback(reason)
+    def _keyLoadFailed(self, reason):
+        self.keypair = None
+        self._writeKeypair = True
 
-    # This method is not called if an endpoint deferred errbacks
-    def clientConnectionFailed(self, connector, reason):
-        self.bobConnectionFailed(reason)
+    def whenKeyLoaded(self):
+        """Get a Deferred that fires once the keyfile has been read."""
+        d = Deferred()
+        if self._keyLoad is None:
+            d.callback(None)
+        else:
+            self._keyLoad.addCallback(d.callback)
+        return d
 
     def i2pTunnelCreated(self):
         if self._writeKeypair:
-            try:
-                f = open(self._keyfile, 'w')
-                f.write(self.keypair)
-                f.close()
-            except IOError:
-                print('Could not save keypair')
+            d = self._keystore.save(self._keyfile, self.keypair)
+            d.addErrback(lambda f: print('Could not save keypair'))
         # BOB will now forward data to a listener.
         # BOB only forwards to TCP4 (for now).
         serverEndpoint = TCP4ServerEndpoint(self._reactor, self.outport)
@@ -173,6 +204,15 @@ class BOBFactoryWrapperCommon(object):
 class BOBClientFactoryWrapper(BOBFactoryWrapperCommon):
     protocol = I2PClientTunnelProtocol
 
+    def __init__(self, wrappedFactory,
+                       bobEndpoint,
+                       localAddr,
+                       tunnelNick,
+                       tunnel):
+        BOBFactoryWrapperCommon.__init__(self, wrappedFactory, bobEndpoint,
+                                         localAddr, tunnelNick, False)
+        self.tunnel = tunnel
+
     def setDest(self, dest):
         self.dest = dest
 
@@ -183,16 +223,9 @@ class BOBClientFactoryWrapper(BOBFactoryWrapperCommon):
         return proto
 
     def i2pConnectionLost(self, wrappedProto, reason):
-        if self.removeTunnelWhenFinished:
-            # Notify the underlying Protocol once the tunnel has
-            # been removed, in case they stop the reactor.
-            rmTunnelFac = BOBI2PClientTunnelRemoverFactory(self.tunnelNick,
-                                                           wrappedProto,
-                                                           reason)
-            self.bobEndpoint.connect(rmTunnelFac)
-        else:
-            # Notify the underlying Protocol now.
-            wrappedProto.connectionLost(reason)
+        wrappedProto.connectionLost(reason)
+        # The tunnel is removed once no connections have used it for a while
+        self.tunnel.release()
 
 
 class BOBServerFactoryWrapper(BOBFactoryWrapperCommon):
@@ -208,36 +241,10 @@ class BOBServerFactoryWrapper(BOBFactoryWrapperCommon):
         if self.removeTunnelWhenFinished:
             # Notify the underlying ListeningPort once the tunnel
             # has been removed, in case they stop the reactor.
-            rmTunnelFac = BOBI2PServerTunnelRemoverFactory(self.tunnelNick,
-                                                           wrappedPort)
-            self.bobEndpoint.connect(rmTunnelFac)
+            control = getBOBControlClient(self.bobEndpoint)
+            d = control.run(I2PTunnelRemover(self.tunnelNick).run)
+            d.addErrback(lambda f: print('Could not remove tunnel: %s' % f.value))
+            d.addCallback(lambda _: wrappedPort.stopListening())
         else:
             # Notify the underlying ListeningPort now.
             wrappedPort.stopListening()
-
-
-class BOBI2PClientTunnelRemoverFactory(ClientFactory):
-    protocol = I2PTunnelRemoverBOBClient
-
-    def __init__(self, tunnelNick, protoToNotify, reason):
-        self.tunnelNick = tunnelNick
-        self._protoToNotify = protoToNotify
-        self._reason = reason
-
-    def i2pTunnelRemoved(self):
-        # Now that the I2P tunnel has been removed,
-        # notify the underlying Protocol.
-        self._protoToNotify.connectionLost(self._reason)
-
-
-class BOBI2PServerTunnelRemoverFactory(ClientFactory):
-    protocol = I2PTunnelRemoverBOBClient
-
-    def __init__(self, tunnelNick, portToNotify):
-        self.tunnelNick = tunnelNick
-        self._portToNotify = portToNotify
-
-    def i2pTunnelRemoved(self):
-        # Now that the I2P tunnel has been removed,
-        # notify the underlying ListeningPort.
-        self._portToNotify.stopListening()
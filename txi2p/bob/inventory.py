@@ -0,0 +1,121 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+
+from txi2p.bob.protocol import DEFAULT_INPORT, DEFAULT_OUTPORT
+
+# Seconds a listing of BOB's tunnels is used for before BOB is asked again
+DEFAULT_TUNNEL_LIST_TTL = 5
+
+MAX_PORT = 65535
+
+
+class TunnelInventory(object):
+    """The tunnels that BOB has, as given by ``list``.
+
+    Tunnels are indexed by nickname, and the ports they use are kept in a set,
+    so that finding a tunnel or checking a port takes constant time however
+    many tunnels BOB has.
+
+    Args:
+        tunnels (list): The tunnel status dicts parsed from ``list``.
+    """
+
+    def __init__(self, tunnels):
+        self.tunnels = tunnels
+        self._byNick = {}
+        self.usedPorts = set()
+        for tunnel in tunnels:
+            self._byNick[tunnel['nickname']] = tunnel
+            for setting in ('inport', 'outport'):
+                if tunnel[setting]:
+                    self.usedPorts.add(tunnel[setting])
+
+    def __len__(self):
+        return len(self.tunnels)
+
+    def get(self, tunnelNick):
+        """Get the status dict of a tunnel, or `None` if BOB does not have it.
+        """
+        return self._byNick.get(tunnelNick)
+
+
+class PortAllocator(object):
+    """Picks the ports of new BOB tunnels.
+
+    Each tunnel is given the pair ``DEFAULT_INPORT + offset`` and
+    ``DEFAULT_OUTPORT + offset``. Ports handed out stay reserved for their
+    tunnel until they are released, so that a pair is not handed out twice
+    while the tunnel using it is still being set up. Offsets are taken from
+    those released, or else from a cursor that starts at the end of the
+    tunnels list, so allocating does not rescan the offsets before it.
+    """
+
+    def __init__(self):
+        # offset -> the ports of its pair that are still reserved
+        self._offsets = {}
+        # tunnelNick -> the offsets reserved for it
+        self._byNick = {}
+        self._free = []
+        self._next = None
+
+    def __len__(self):
+        return sum(len(ports) for ports in self._offsets.values())
+
+    def allocate(self, inventory, tunnelNick):
+        """Reserve a free pair of ports for a tunnel.
+
+        Args:
+            inventory (TunnelInventory): The tunnels BOB has.
+            tunnelNick (str): The nickname of the tunnel.
+
+        Returns:
+            tuple: ``(inport, outport)``.
+        """
+        offset = None
+        while self._free:
+            candidate = self._free.pop()
+            if self._pairFree(candidate, inventory):
+                offset = candidate
+                break
+        if offset is None:
+            if self._next is None:
+                self._next = 2*len(inventory)
+            while not self._pairFree(self._next, inventory):
+                self._next += 2
+            offset = self._next
+            self._next += 2
+        ports = (DEFAULT_INPORT + offset, DEFAULT_OUTPORT + offset)
+        if ports[1] > MAX_PORT:
+            raise ValueError('No free ports left for BOB tunnels')
+        self._offsets[offset] = set(ports)
+        self._byNick.setdefault(tunnelNick, []).append(offset)
+        return ports
+
+    def release(self, tunnelNick, *ports):
+        """Release the ports reserved for a tunnel.
+
+        Args:
+            tunnelNick (str): The nickname of the tunnel.
+            *ports: The ports to release. Defaults to all of them.
+        """
+        offsets = self._byNick.get(tunnelNick, [])
+        for offset in list(offsets):
+            reserved = self._offsets[offset]
+            if ports:
+                reserved.difference_update(ports)
+            else:
+                reserved.clear()
+            if not reserved:
+                # Both ports of the pair can be handed out again
+                del self._offsets[offset]
+                offsets.remove(offset)
+                self._free.append(offset)
+        if not offsets:
+            self._byNick.pop(tunnelNick, None)
+
+    def _pairFree(self, offset, inventory):
+        return offset not in self._offsets and \
+            DEFAULT_INPORT + offset not in inventory.usedPorts and \
+            DEFAULT_OUTPORT + offset not in inventory.usedPorts
@@ -2,10 +2,11 @@
 # See COPYING for details.
 
 from __future__ import print_function
-from builtins import range
 from builtins import object
+import functools
 import os
-from parsley import makeProtocol
+from ometa.protocol import ParserProtocol
+from twisted.internet import defer
 from twisted.internet.error import ConnectError, UnknownHostError
 from twisted.internet.interfaces import IListeningPort
 from twisted.internet.protocol import Protocol
@@ -17,12 +18,25 @@ from txi2p.address import (
     I2PAddress,
     I2PTunnelTransport,
     I2PServerTunnelProtocol,
+    MAX_TUNNEL_LINE,
 )
 
 DEFAULT_INPORT  = 9000
 DEFAULT_OUTPORT = 9001
 
 
+class BOBParserProtocol(ParserProtocol):
+    def __init__(self, senderFactory, receiverFactory):
+        # All BOB protocols share one grammar, compiled on first use.
+        ParserProtocol.__init__(self, grammar.getBOBGrammar(),
+                                senderFactory, receiverFactory, {})
+
+
+def makeBOBProtocol(senderFactory, receiverFactory):
+    return functools.partial(
+        BOBParserProtocol, senderFactory, receiverFactory)
+
+
 class BOBSender(object):
     def __init__(self, transport):
         self.transport = transport
@@ -107,314 +121,271 @@ class BOBSender(object):
         self.transport.write(b'visit\n')
 
 
-class BOBReceiver(object):
-    currentRule = 'State_init'
+class BOBError(ConnectError):
+    """A BOB command failed.
+
+    Attributes:
+        command (str): The command that failed.
+        info (str): The error BOB gave.
+    """
+
+    def __init__(self, command, info):
+        ConnectError.__init__(self, string='%s: %s' % (command, info))
+        self.command = command
+        self.info = info
+
+
+# Errors BOB gives for changes made while a tunnel is running or stopping
+RETRY_ERRORS = ('tunnel is active', 'tunnel shutting down')
 
-    def __init__(self, sender):
-        self.sender = sender
-        self.tunnelExists = False
 
-    def prepareParsing(self, parser):
-        # Store the factory for later use
-        self.factory = parser.factory
+def _gather(ds):
+    # Fails with the first error, which is the earliest command to fail
+    # because BOB replies in order.
+    d = defer.gatherResults(ds, consumeErrors=True)
+    d.addErrback(lambda f: f.value.subFailure)
+    return d
 
-    def finishParsing(self, reason):
-        if self.currentRule != 'State_quit':
-            self.factory.bobConnectionFailed(reason)
 
-    def initBOB(self, version):
-        self.sender.sendList()
-        self.currentRule = 'State_list'
+class I2PTunnelCreator(object):
+    """Creates a BOB tunnel for a factory, or reuses an existing one.
 
-    def processTunnelList(self, tunnels):
+    Commands that do not depend on an earlier reply are sent back to back:
+    after ``list``, only the selection of the tunnel is waited for, because
+    the commands that follow act on whichever tunnel is selected.
+    """
+    # The settings that the tunnel needs, in the order they are sent
+    tunnelSettings = ()
+    startedMessage = None
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.tunnelExists = False
+        self.tunnelRunning = False
+        # The settings that the tunnel does not have yet
+        self.unsetSettings = set(self.tunnelSettings)
+        self._allocatedPorts = ()
+
+    def run(self, client):
+        """Create the tunnel over a :class:`txi2p.bob.control.BOBControlClient`.
+
+        Returns:
+            twisted.internet.defer.Deferred: Fires once the tunnel is running,
+            with the factory's ``localDest``, ``inport`` etc. set.
+        """
+        self.client = client
+        d = client.listTunnels()
+        d.addCallback(self._listed)
+        d.addCallbacks(self._created, self._failed)
+        return d
+
+    def processTunnelList(self, inventory):
         if not (hasattr(self.factory, 'tunnelNick') and self.factory.tunnelNick):
             # All tunnels in the same process use the same tunnelNick
             # TODO is using the PID a security risk?
             self.factory.tunnelNick = 'txi2p-%d' % os.getpid()
 
-        used_ports = []
-        for i in range(0, len(tunnels)):
-            if tunnels[i]['nickname'] == self.factory.tunnelNick:
-                # Tunnel already exists, use its settings.
-                self.tunnelExists = True
-                self.tunnelRunning = tunnels[i]['running']
-                self.factory.inhost = tunnels[i]['inhost']
-                self.factory.inport = tunnels[i]['inport']
-                self.factory.outhost = tunnels[i]['outhost']
-                self.factory.outport = tunnels[i]['outport']
-                # The tunnel will be removed by the Factory
-                # that created it.
-                self.factory.removeTunnelWhenFinished = False
-                break
-            else:
-                if tunnels[i]['inport']:
-                    used_ports.append(tunnels[i]['inport'])
-                if tunnels[i]['outport']:
-                    used_ports.append(tunnels[i]['outport'])
-        else:
-            # This is a new tunnel.
-            # Default port offset is at the end of the tunnels list
-            offset = 2*(len(tunnels))
-            # Find an offset that does not clash
-            while (DEFAULT_INPORT + offset) in used_ports or (DEFAULT_OUTPORT + offset) in used_ports:
-                offset += 2
-            # If the in/outport were not user-configured, set them.
+        tunnel = inventory.get(self.factory.tunnelNick)
+        if tunnel:
+            # Tunnel already exists. Use its settings where none were
+            # requested, and reconfigure it where they differ.
+            self.tunnelExists = True
+            # A tunnel that is stopping can only be started once it has stopped
+            self.tunnelRunning = tunnel['running'] and not tunnel['stopping']
+            for setting in ('inhost', 'inport', 'outhost', 'outport'):
+                value = tunnel[setting]
+                if value is None or value == 'not_set':
+                    continue
+                requested = getattr(self.factory, setting, None)
+                if requested is None:
+                    setattr(self.factory, setting, value)
+                elif str(requested) != str(value):
+                    continue
+                self.unsetSettings.discard(setting)
+            # The tunnel will be removed by the Factory
+            # that created it.
+            self.factory.removeTunnelWhenFinished = False
+
+        # If the in/outport were not user-configured or set on an existing
+        # tunnel, set them.
+        if not (getattr(self.factory, 'inport', None) and
+                getattr(self.factory, 'outport', None)):
+            inport, outport = self.client.ports.allocate(
+                inventory, self.factory.tunnelNick)
+            self._allocatedPorts = (inport, outport)
             if not (hasattr(self.factory, 'inport') and self.factory.inport):
-                self.factory.inport = DEFAULT_INPORT + offset
+                self.factory.inport = inport
             if not (hasattr(self.factory, 'outport') and self.factory.outport):
-                self.factory.outport = DEFAULT_OUTPORT + offset
-
-    def getnick(self, success, info):
-        if success:
-            if self.tunnelRunning:
-                self.sender.sendStop()
-                self.currentRule = 'State_stop'
-            else:
-                # Update the local Destination
-                self.sender.sendGetdest()
-                self.currentRule = 'State_getdest'
-        else:
-            print('ERROR: %s' % info)
-
-    def stop(self, success, info):
-        if success:
-            # Update the local Destination
-            self.sender.sendGetdest()
-            self.currentRule = 'State_getdest'
-        else:
-            print('stop ERROR: %s' % info)
+                self.factory.outport = outport
 
-    def setnick(self, success, info):
-        if success:
-            # Set the options
-            self.sender.sendOption(self.factory.options)
-            self.currentRule = 'State_option'
-        else:
-            print('setnick ERROR: %s' % info)
-
-    def option(self, success, info):
-        if success:
-            if hasattr(self.factory, 'keypair') and self.factory.keypair: # If a keypair was provided, use it
-                self.sender.sendSetkeys(self.factory.keypair)
-                self.currentRule = 'State_setkeys'
-            else: # Get a new keypair
-                self.sender.sendNewkeys()
-                self.currentRule = 'State_newkeys'
-        else:
-            print('option ERROR: %s' % info)
-
-    def setkeys(self, success, info):
-        if success:
-            # Update the local Destination
-            self.sender.sendGetdest()
-            self.currentRule = 'State_getdest'
-        else:
-            print('setkeys ERROR: %s' % info)
-
-    def newkeys(self, success, info):
-        if success:
-            # Save the new local Destination
-            self.factory.localDest = info
-            # Get the new keypair
-            self.sender.sendGetkeys()
-            self.currentRule = 'State_getkeys'
+    def _listed(self, inventory):
+        self.processTunnelList(inventory)
+        if self.tunnelExists:
+            d = self.client.command('getnick', self.factory.tunnelNick)
+            d.addCallback(lambda _: self._reuseTunnel())
         else:
-            print('newkeys ERROR: %s' % info)
-
-    def quit(self, success, info):
-        pass
-
-
-class I2PClientTunnelCreatorBOBReceiver(BOBReceiver):
-    def list(self, success, info, data):
-        if success:
-            self.processTunnelList(data)
-            if self.tunnelExists:
-                self.sender.sendGetnick(self.factory.tunnelNick)
-                self.currentRule = 'State_getnick'
-            else:
-                # Set tunnel nickname (and update keypair/localDest state)
-                self.sender.sendSetnick(self.factory.tunnelNick)
-                self.currentRule = 'State_setnick'
-        else:
-            print('list ERROR: %s' % info)
-
-    def getdest(self, success, info):
-        if success:
-            # Save the local Destination
-            self.factory.localDest = info
-            if self.tunnelExists:
-                # Get the keypair
-                self.sender.sendGetkeys()
-                self.currentRule = 'State_getkeys'
-            else:
-                self._setInhost()
-        else:
-            print('getdest ERROR: %s' % info)
-
-    def getkeys(self, success, info):
-        if success:
-            # Save the keypair
-            self.factory.keypair = info
-            self._setInhost()
-        else:
-            print('getkeys ERROR: %s' % info)
-
-    def _setInhost(self):
-        self.sender.sendInhost(self.factory.inhost)
-        self.currentRule = 'State_inhost'
-
-    def inhost(self, success, info):
-        if success:
-            self.sender.sendInport(self.factory.inport)
-            self.currentRule = 'State_inport'
-        else:
-            if info in ['tunnel is active',
-                        'tunnel shutting down']:
-                # Try again. TODO: Limit retries
-                self.sender.sendInhost(self.factory.inhost)
-            else:
-                print('inhost ERROR: %s' % info)
-
-    def inport(self, success, info):
-        if success:
-            self.sender.sendStart()
-            self.currentRule = 'State_start'
-        else:
-            print('inport ERROR: %s' % info)
-
-    def start(self, success, info):
-        if success:
-            print("Client tunnel started")
-            self.factory.i2pTunnelCreated()
-            self.sender.sendQuit()
-            self.currentRule = 'State_quit'
-        else:
-            print('start ERROR: %s' % info)
-
-
-class I2PServerTunnelCreatorBOBReceiver(BOBReceiver):
-    def list(self, success, info, data):
-        if success:
-            self.processTunnelList(data)
-            if self.tunnelExists:
-                self.sender.sendGetnick(self.factory.tunnelNick)
-                self.currentRule = 'State_getnick'
-            else:
-                # Set tunnel nickname (and update keypair/localDest state)
-                self.sender.sendSetnick(self.factory.tunnelNick)
-                self.currentRule = 'State_setnick'
-        else:
-            print('list ERROR: %s' % info)
-
-    def getdest(self, success, info):
-        if success:
-            # Save the local Destination
-            self.factory.localDest = info
-            self._setOuthost()
-        else:
-            print('getdest ERROR: %s' % info)
-
-    def getkeys(self, success, info):
-        if success:
-            # Save the keypair
-            self.factory.keypair = info
-            self._setOuthost()
-        else:
-            print('getkeys ERROR: %s' % info)
-
-    def _setOuthost(self):
-        self.sender.sendOuthost(self.factory.outhost)
-        self.currentRule = 'State_outhost'
-
-    def outhost(self, success, info):
-        if success:
-            self.sender.sendOutport(self.factory.outport)
-            self.currentRule = 'State_outport'
-        else:
-            if info in ['tunnel is active',
-                        'tunnel shutting down']:
-                # Try again. TODO: Limit retries
-                self.sender.sendOuthost(self.factory.outhost)
-            else:
-                print('outhost ERROR: %s' % info)
-
-    def outport(self, success, info):
-        if success:
-            self.sender.sendStart()
-            self.currentRule = 'State_start'
-        else:
-            print('outport ERROR: %s' % info)
-
-    def start(self, success, info):
-        if success:
-            print("Server tunnel started")
-            self.factory.i2pTunnelCreated()
-            self.sender.sendQuit()
-            self.currentRule = 'State_quit'
-        else:
-            print('start ERROR: %s' % info)
-
-class I2PTunnelRemoverBOBReceiver(BOBReceiver):
-    def list(self, success, info, data):
-        if success:
-            self.processTunnelList(data)
-            if self.tunnelExists:
-                # Get tunnel for nickname
-                self.sender.sendGetnick(self.factory.tunnelNick)
-                self.currentRule = 'State_getnick'
-            else:
-                # Tunnel already removed
-                pass
-        else:
-            print('list ERROR: %s' % info)
-
-    def getnick(self, success, info):
-        if success:
-            self.sender.sendStop()
-            self.currentRule = 'State_stop'
-        else:
-            print('getnick ERROR: %s' % info)
-
-    def stop(self, success, info):
-        if success:
-            self.sender.sendClear()
-            self.currentRule = 'State_clear'
-        else:
-            print('stop ERROR: %s' % info)
-
-    def clear(self, success, info):
-        if success:
-            print('Tunnel removed')
-            self.factory.i2pTunnelRemoved()
-            self.sender.sendQuit()
-            self.currentRule = 'State_quit'
-        else:
-            if info in ['tunnel is active',
-                        'tunnel shutting down']:
-                # Try again. TODO: Limit retries
-                self.sender.sendClear()
-            else:
-                print('clear ERROR: %s ' % info)
-
-
-# A Protocol for making an I2P client tunnel via BOB
-I2PClientTunnelCreatorBOBClient = makeProtocol(
-    grammar.bobGrammarSource,
-    BOBSender,
-    I2PClientTunnelCreatorBOBReceiver)
-
-# A Protocol for making an I2P server tunnel via BOB
-I2PServerTunnelCreatorBOBClient = makeProtocol(
-    grammar.bobGrammarSource,
-    BOBSender,
-    I2PServerTunnelCreatorBOBReceiver)
-
-# A Protocol for removing a BOB I2P tunnel
-I2PTunnelRemoverBOBClient = makeProtocol(
-    grammar.bobGrammarSource,
-    BOBSender,
-    I2PTunnelRemoverBOBReceiver)
+            # Set tunnel nickname (and update keypair/localDest state)
+            d = self.client.command('setnick', self.factory.tunnelNick)
+            d.addCallback(lambda _: self._whenKeyLoaded())
+            d.addCallback(lambda _: self._newTunnel())
+        return d
+
+    def _created(self, result):
+        # The ports the tunnel uses stay reserved until it is removed.
+        # Release the rest.
+        used = [getattr(self.factory, setting)
+                for setting in self.tunnelSettings if setting.endswith('port')]
+        unused = [port for port in self._allocatedPorts if port not in used]
+        if unused:
+            self.client.ports.release(self.factory.tunnelNick, *unused)
+        return result
+
+    def _failed(self, f):
+        # The allocated ports will not be used
+        if self._allocatedPorts:
+            self.client.ports.release(self.factory.tunnelNick,
+                                      *self._allocatedPorts)
+        return f
+
+    def _whenKeyLoaded(self):
+        whenKeyLoaded = getattr(self.factory, 'whenKeyLoaded', None)
+        if whenKeyLoaded:
+            # The keyfile is read in the background
+            return whenKeyLoaded()
+
+    def _newTunnel(self):
+        c = self.client
+        ds = [c.command('option', self.factory.options or {})]
+        if getattr(self.factory, 'keypair', None): # If a keypair was provided, use it
+            ds.append(c.command('setkeys', self.factory.keypair))
+            ds.append(c.command('getdest').addCallback(self._setLocalDest))
+        else: # Get a new keypair
+            ds.append(c.command('newkeys').addCallback(self._setLocalDest))
+            ds.append(c.command('getkeys').addCallback(self._setKeypair))
+        ds.append(self._configure(newTunnel=True))
+        return _gather(ds)
+
+    def _reuseTunnel(self):
+        c = self.client
+        ds = []
+        if self.tunnelRunning and self.unsetSettings:
+            # Settings can only be changed while the tunnel is stopped
+            ds.append(c.command('stop'))
+            self.tunnelRunning = False
+        # Update the local Destination
+        ds.append(c.command('getdest').addCallback(self._setLocalDest))
+        ds.append(self._configure())
+        return _gather(ds)
+
+    def _setLocalDest(self, dest):
+        self.factory.localDest = dest
+
+    def _setKeypair(self, keypair):
+        self.factory.keypair = keypair
+
+    def _configure(self, newTunnel=False):
+        # Only send the settings that the tunnel does not have yet
+        settings = [s for s in self.tunnelSettings if s in self.unsetSettings]
+        backoff = self.client.backoff()
+        d = self._sendSettings(settings, backoff)
+        if self.tunnelRunning:
+            # The existing tunnel can be used as it is
+            return d
+        if newTunnel:
+            # A new tunnel is not stopping, so it can be started right away
+            return _gather([d, self._start(backoff)])
+        # An existing tunnel may still be stopping, so the settings may be
+        # retried before it can start
+        d.addCallback(lambda _: self._start(backoff))
+        return d
+
+    def _sendSettings(self, settings, backoff):
+        ds = [self.client.command(setting, getattr(self.factory, setting))
+              for setting in settings]
+        d = _gather(ds)
+        def retry(f):
+            f.trap(BOBError)
+            if f.value.info not in RETRY_ERRORS:
+                return f
+            # Try again from the refused setting, once the tunnel has had
+            # time to stop.
+            d = backoff.wait(f)
+            d.addCallback(lambda _: self._sendSettings(
+                settings[settings.index(f.value.command):], backoff))
+            return d
+        d.addErrback(retry)
+        return d
+
+    def _start(self, backoff):
+        d = self.client.command('start')
+        def retry(f):
+            f.trap(BOBError)
+            if f.value.info not in RETRY_ERRORS:
+                return f
+            # Try again once the tunnel has finished stopping
+            d = backoff.wait(f)
+            d.addCallback(lambda _: self._start(backoff))
+            return d
+        d.addCallbacks(lambda _: print(self.startedMessage), retry)
+        return d
+
+
+class I2PClientTunnelCreator(I2PTunnelCreator):
+    tunnelSettings = ('inhost', 'inport')
+    startedMessage = 'Client tunnel started'
+
+
+class I2PServerTunnelCreator(I2PTunnelCreator):
+    tunnelSettings = ('outhost', 'outport')
+    startedMessage = 'Server tunnel started'
+
+
+class I2PTunnelRemover(object):
+    """Stops and removes a BOB tunnel, if it exists."""
+
+    def __init__(self, tunnelNick):
+        self.tunnelNick = tunnelNick
+
+    def run(self, client):
+        """Remove the tunnel over a :class:`txi2p.bob.control.BOBControlClient`.
+
+        Returns:
+            twisted.internet.defer.Deferred: Fires once the tunnel is gone.
+        """
+        self.client = client
+        # Get tunnel for nickname
+        d = client.command('getnick', self.tunnelNick)
+        d.addCallbacks(self._remove, self._notFound)
+        return d
+
+    def _notFound(self, f):
+        f.trap(BOBError)
+        # Tunnel already removed
+        self.client.ports.release(self.tunnelNick)
+
+    def _remove(self, result):
+        # The tunnel may not be running
+        stop = self.client.command('stop').addErrback(lambda f: f.trap(BOBError))
+        d = _gather([stop, self._clear(self.client.backoff())])
+        d.addCallback(self._removed)
+        return d
+
+    def _removed(self, result):
+        self.client.ports.release(self.tunnelNick)
+        print('Tunnel removed')
+
+    def _clear(self, backoff):
+        d = self.client.command('clear')
+        def retry(f):
+            f.trap(BOBError)
+            if f.value.info not in RETRY_ERRORS:
+                return f
+            # Try again once the tunnel has had time to stop
+            d = backoff.wait(f)
+            d.addCallback(lambda _: self._clear(backoff))
+            return d
+        d.addErrback(retry)
+        return d
 
 
 class I2PClientTunnelProtocol(Protocol):
@@ -423,6 +394,7 @@ class I2PClientTunnelProtocol(Protocol):
         self._clientAddr = clientAddr
         self.dest = dest
         self._errmsg = None
+        self._buffer = b''
 
     def connectionMade(self):
         # Substitute transport for an I2P wrapper
@@ -434,20 +406,36 @@ class I2PClientTunnelProtocol(Protocol):
         self.wrappedProto.makeConnection(self.transport)
 
     def dataReceived(self, data):
-        # Check for a successful connection
-        if not self.isConnected:
-            if data.startswith('ERROR'):
-                self._errmsg = data[6:]
-                # I2P connection failed
-                self.transport.loseConnection()
-                return
-            else:
-                self.isConnected = True
-
-        # Pass all received data to the wrapped Protocol.
-        self.wrappedProto.dataReceived(data.encode('utf-8'))
+        # Check for a successful connection. BOB only replies if the
+        # connection failed, so hold back data that could be the start of
+        # an ERROR line until it is known not to be one.
+        self._buffer += data
+        if self._buffer.startswith(b'ERROR'):
+            line, sep, rest = self._buffer.partition(b'\n')
+            if sep or len(self._buffer) > MAX_TUNNEL_LINE:
+                self._failed(line)
+            return
+        if b'ERROR'.startswith(self._buffer):
+            return
+        data, self._buffer = self._buffer, b''
+        self.isConnected = True
+        # Pass all further data straight to the wrapped Protocol.
+        self.dataReceived = self.wrappedProto.dataReceived
+        self.wrappedProto.dataReceived(data)
+
+    def _failed(self, line):
+        self._buffer = b''
+        self._errmsg = line[6:].decode('utf-8', 'replace')
+        # I2P connection failed
+        self.transport.loseConnection()
 
     def connectionLost(self, reason):
+        if self._buffer.startswith(b'ERROR'):
+            # BOB closed the connection after an unterminated ERROR line
+            self._errmsg = self._buffer[6:].decode('utf-8', 'replace')
+        elif self._buffer:
+            self.wrappedProto.dataReceived(self._buffer)
+        self._buffer = b''
         if self._errmsg:
             if self._errmsg.startswith("Can't find destination"):
                 reason = Failure(UnknownHostError(string=self._errmsg))
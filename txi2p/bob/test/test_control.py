@@ -0,0 +1,235 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.internet.error import (ConnectionDone, ConnectionLost,
+                                    ConnectionRefusedError)
+from twisted.python import failure
+from twisted.trial import unittest
+
+from txi2p.bob.control import (BOBControlClient, RetryBackoff,
+                                getBOBControlClient)
+from txi2p.bob.protocol import BOBError
+from txi2p.test.util import FakeEndpoint
+
+connectionLostFailure = failure.Failure(ConnectionLost())
+connectionRefusedFailure = failure.Failure(ConnectionRefusedError())
+
+
+class BOBControlClientTest(unittest.TestCase):
+    def setUp(self):
+        self.bobEndpoint = FakeEndpoint()
+        self.clock = Clock()
+        self.client = BOBControlClient(self.bobEndpoint, listTTL=5,
+                                       clock=self.clock)
+
+    def greet(self):
+        self.bobEndpoint.proto.dataReceived('BOB 00.00.10\nOK\n')
+
+    def reply(self, data):
+        self.bobEndpoint.proto.dataReceived(data)
+
+    def sent(self):
+        value = self.bobEndpoint.transport.value()
+        self.bobEndpoint.transport.clear()
+        return value
+
+    def test_connectsOnFirstCommand(self):
+        self.assertFalse(hasattr(self.bobEndpoint, 'factory'))
+        self.client.command('getnick', 'spam')
+        self.assertEqual(self.sent(), b'')
+        self.greet()
+        self.assertEqual(self.sent(), b'getnick spam\n')
+
+    def test_commandsPipelined(self):
+        self.client.command('getnick', 'spam')
+        self.greet()
+        self.client.command('getdest')
+        self.client.command('inport', 1234)
+        self.assertEqual(self.sent(), b'getnick spam\ngetdest\ninport 1234\n')
+
+    def test_repliesMatchedInOrder(self):
+        d1 = self.client.command('getnick', 'spam')
+        d2 = self.client.command('getdest')
+        self.greet()
+        self.reply('OK Nickname set to spam\n')
+        self.assertEqual(self.successResultOf(d1), 'Nickname set to spam')
+        self.assertNoResult(d2)
+        self.reply('OK shrubbery\n')
+        self.assertEqual(self.successResultOf(d2), 'shrubbery')
+
+    def test_errorReply(self):
+        d1 = self.client.command('start')
+        d2 = self.client.command('getdest')
+        self.greet()
+        self.reply('ERROR tunnel is active\nOK shrubbery\n')
+        f = self.failureResultOf(d1, BOBError)
+        self.assertEqual((f.value.command, f.value.info),
+                         ('start', 'tunnel is active'))
+        self.assertEqual(self.successResultOf(d2), 'shrubbery')
+
+    def test_listReply(self):
+        d = self.client.command('list')
+        self.greet()
+        self.reply('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: not_set OUTHOST: localhost\nOK Listing done\n')
+        tunnels = self.successResultOf(d)
+        self.assertEqual([(t['nickname'], t['inport'], t['outport'])
+                          for t in tunnels], [('spam', 12345, None)])
+
+    def listTunnels(self):
+        d = self.client.listTunnels()
+        self.reply('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: not_set OUTHOST: localhost\nOK Listing done\n')
+        return self.successResultOf(d)
+
+    def test_listTunnels(self):
+        self.client.command('getnick', 'eggs')
+        self.greet()
+        self.reply('OK Nickname set to eggs\n')
+        inventory = self.listTunnels()
+        self.assertEqual(inventory.get('spam')['inport'], 12345)
+        self.assertEqual(inventory.usedPorts, set([12345]))
+
+    def test_listingReused(self):
+        self.client.command('getnick', 'eggs')
+        self.greet()
+        self.reply('OK Nickname set to eggs\n')
+        self.sent()
+        inventory = self.listTunnels()
+        self.assertEqual(self.sent(), b'list\n')
+        self.client.command('getdest')
+        self.clock.advance(4)
+        self.assertIdentical(
+            self.successResultOf(self.client.listTunnels()), inventory)
+        self.assertEqual(self.sent(), b'getdest\n')
+
+    def test_listingExpires(self):
+        self.client.command('getnick', 'eggs')
+        self.greet()
+        self.reply('OK Nickname set to eggs\n')
+        self.listTunnels()
+        self.sent()
+        self.clock.advance(5)
+        self.client.listTunnels()
+        self.assertEqual(self.sent(), b'list\n')
+
+    def test_listingInvalidatedByChange(self):
+        self.client.command('getnick', 'eggs')
+        self.greet()
+        self.reply('OK Nickname set to eggs\n')
+        self.listTunnels()
+        self.client.command('start')
+        self.sent()
+        self.client.listTunnels()
+        self.assertEqual(self.sent(), b'list\n')
+
+    def test_listingNotCachedIfChangeSentAfterList(self):
+        self.client.command('getnick', 'eggs')
+        self.greet()
+        self.reply('OK Nickname set to eggs\n')
+        d = self.client.listTunnels()
+        self.client.command('stop')
+        self.reply('OK Listing done\n')
+        self.successResultOf(d)
+        self.sent()
+        self.client.listTunnels()
+        self.assertEqual(self.sent(), b'list\n')
+
+    def test_connectionReused(self):
+        self.client.command('getdest')
+        self.greet()
+        fac = self.bobEndpoint.factory
+        self.reply('OK shrubbery\n')
+        self.sent()
+        self.client.command('getdest')
+        self.assertIdentical(self.bobEndpoint.factory, fac)
+        self.assertEqual(self.sent(), b'getdest\n')
+
+    def test_connectionLostFailsOutstanding(self):
+        d = self.client.command('getdest')
+        self.greet()
+        self.bobEndpoint.proto.connectionLost(connectionLostFailure)
+        self.failureResultOf(d, ConnectionLost)
+
+    def test_reconnectsAfterConnectionLost(self):
+        self.client.command('getdest').addErrback(lambda f: None)
+        self.greet()
+        fac = self.bobEndpoint.factory
+        self.bobEndpoint.proto.connectionLost(connectionLostFailure)
+        self.client.command('getdest')
+        self.assertNotIdentical(self.bobEndpoint.factory, fac)
+
+    def test_connectionFailedFailsCommands(self):
+        client = BOBControlClient(FakeEndpoint(failure=connectionRefusedFailure))
+        d = client.command('getdest')
+        self.failureResultOf(d, ConnectionRefusedError)
+
+    def test_closeBeforeConnected(self):
+        self.bobEndpoint.deferred = defer.Deferred()
+        d = self.client.command('getdest')
+        self.client.close()
+        self.failureResultOf(d, ConnectionDone)
+
+    def test_runSerializesOperations(self):
+        ran = []
+        def operation(client, name):
+            ran.append(name)
+            return client.command('getnick', name)
+        d1 = self.client.run(operation, 'spam')
+        d2 = self.client.run(operation, 'eggs')
+        self.greet()
+        self.assertEqual((ran, self.sent()), (['spam'], b'getnick spam\n'))
+        self.reply('OK Nickname set to spam\n')
+        self.successResultOf(d1)
+        self.assertEqual((ran, self.sent()), (['spam', 'eggs'], b'getnick eggs\n'))
+        self.assertNoResult(d2)
+
+    def test_failedOperationDoesNotBlockNext(self):
+        d1 = self.client.run(lambda client: client.command('getnick', 'spam'))
+        d2 = self.client.run(lambda client: client.command('getdest'))
+        self.greet()
+        self.reply('ERROR no such nickname\n')
+        self.failureResultOf(d1, BOBError)
+        self.assertEqual(self.sent(), b'getnick spam\ngetdest\n')
+        self.assertNoResult(d2)
+
+
+class RetryBackoffTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.reason = failure.Failure(BOBError('clear', 'tunnel is active'))
+
+    def delays(self, backoff):
+        delays = []
+        d = backoff.wait(self.reason)
+        while not d.called:
+            call, = self.clock.getDelayedCalls()
+            delay = call.getTime() - self.clock.seconds()
+            delays.append(round(delay, 2))
+            self.clock.advance(delay)
+            self.successResultOf(d)
+            d = backoff.wait(self.reason)
+        self.failureResultOf(d, BOBError)
+        return delays
+
+    def test_delaysDouble(self):
+        backoff = RetryBackoff(self.clock, maxRetries=4, maxWait=30)
+        self.assertEqual(self.delays(backoff), [0.1, 0.2, 0.4, 0.8])
+        self.assertEqual(backoff.retries, 4)
+
+    def test_totalWaitLimited(self):
+        backoff = RetryBackoff(self.clock, maxRetries=10, maxWait=1)
+        self.assertEqual(self.delays(backoff), [0.1, 0.2, 0.4, 0.3])
+
+    def test_failsWithReason(self):
+        backoff = RetryBackoff(self.clock, maxRetries=0)
+        f = self.failureResultOf(backoff.wait(self.reason), BOBError)
+        self.assertIdentical(f, self.reason)
+
+
+class GetBOBControlClientTest(unittest.TestCase):
+    def test_sharedPerEndpoint(self):
+        bobEndpoint = FakeEndpoint()
+        client = getBOBControlClient(bobEndpoint)
+        self.assertIdentical(getBOBControlClient(bobEndpoint), client)
+        self.assertNotIdentical(getBOBControlClient(FakeEndpoint()), client)
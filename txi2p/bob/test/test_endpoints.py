@@ -1,11 +1,14 @@
 # Copyright (c) str4d <str4d@mail.i2p>
 # See COPYING for details.
 
+from twisted.internet.defer import CancelledError
 from twisted.internet.error import ConnectionLost, ConnectionRefusedError
 from twisted.python import failure
+from twisted.test import proto_helpers
 from twisted.trial import unittest
 
 from txi2p.bob import endpoints
+from txi2p.bob.tunnels import ClientTunnelRegistry
 from txi2p.test.util import FakeEndpoint, FakeFactory
 
 
@@ -27,6 +30,83 @@ class BOBI2PClientEndpointTestCase(unittest.TestCase):
         return self.assertFailure(d, ConnectionRefusedError)
 
 
+    def test_bobConnectionFailedDiscardsTunnel(self):
+        reactor = object()
+        bobEndpoint = FakeEndpoint(failure=connectionRefusedFailure)
+        registry = ClientTunnelRegistry()
+        endpoint = endpoints.BOBI2PClientEndpoint(reactor, bobEndpoint, '',
+                                                  tunnelRegistry=registry)
+        d = endpoint.connect(None)
+        self.assertEqual(len(registry), 0)
+        return self.assertFailure(d, ConnectionRefusedError)
+
+
+    def test_tunnelSharedBetweenConnections(self):
+        reactor = object()
+        bobEndpoint = FakeEndpoint()
+        registry = ClientTunnelRegistry()
+        endpoint = endpoints.BOBI2PClientEndpoint(reactor, bobEndpoint, 'foo.i2p',
+                                                  tunnelRegistry=registry)
+        endpoint2 = endpoints.BOBI2PClientEndpoint(reactor, bobEndpoint, 'bar.i2p',
+                                                   tunnelRegistry=registry)
+        endpoint.connect(None)
+        bobFac = bobEndpoint.factory
+        d = endpoint2.connect(None)
+        # The second connection waits for the first to create the tunnel
+        self.assertIdentical(bobEndpoint.factory, bobFac)
+        self.assertNoResult(d)
+        self.assertEqual(len(registry), 1)
+
+
+    def startSharedTunnel(self):
+        self.mreactor = proto_helpers.MemoryReactor()
+        self.bobEndpoint = FakeEndpoint()
+        self.registry = ClientTunnelRegistry()
+        endpoint = endpoints.BOBI2PClientEndpoint(
+            self.mreactor, self.bobEndpoint, 'foo.i2p', tunnelNick='spam',
+            tunnelRegistry=self.registry)
+        endpoint2 = endpoints.BOBI2PClientEndpoint(
+            self.mreactor, self.bobEndpoint, 'bar.i2p', tunnelNick='spam',
+            tunnelRegistry=self.registry)
+        d = endpoint.connect(FakeFactory())
+        d2 = endpoint2.connect(FakeFactory())
+        self.bobEndpoint.proto.dataReceived('BOB 00.00.10\nOK\n')
+        return d, d2
+
+    def finishTunnelCreation(self):
+        self.bobEndpoint.proto.dataReceived(
+            'OK Listing done\nOK Nickname set to spam\n')
+        self.bobEndpoint.transport.clear()
+        # option, newkeys, getkeys, inhost, inport and start
+        self.bobEndpoint.proto.dataReceived(
+            'OK HTTP 418\nOK shrubbery\nOK rubberyeggs\n'
+            'OK HTTP 418\nOK HTTP 418\nOK tunnel starting\n')
+
+    def test_canceledConnectionLeavesTunnelForOthers(self):
+        d, d2 = self.startSharedTunnel()
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.assertNoResult(d2)
+        self.finishTunnelCreation()
+        # The tunnel is not removed, and the second connection uses it
+        self.assertEqual(self.bobEndpoint.transport.value(), b'')
+        self.assertEqual(len(self.mreactor.tcpClients), 1)
+        tunnel, = self.registry._tunnels.values()
+        self.assertEqual((tunnel.created, tunnel.connections), (True, 1))
+
+    def test_tunnelRemovedOnceAllConnectionsCanceled(self):
+        d, d2 = self.startSharedTunnel()
+        d.cancel()
+        d2.cancel()
+        self.failureResultOf(d2, CancelledError)
+        self.finishTunnelCreation()
+        self.assertEqual(self.bobEndpoint.transport.value(),
+                         b'getnick spam\n')
+        self.assertEqual(len(self.mreactor.tcpClients), 0)
+        self.assertEqual(len(self.registry), 0)
+        self.failureResultOf(d, CancelledError)
+
+
     def TODO_test_destination(self):
         reactor = object()
         bobEndpoint = FakeEndpoint()
@@ -8,57 +8,83 @@ from twisted.python import failure
 from twisted.test import proto_helpers
 from twisted.trial import unittest
 
+from txi2p.bob.control import getBOBControlClient
 from txi2p.bob.factory import (BOBI2PClientFactory,
                                BOBI2PServerFactory,
                                BOBClientFactoryWrapper,
                                BOBServerFactoryWrapper)
-from txi2p.test.util import FakeFactory
+from txi2p.bob.protocol import BOBError
+from txi2p.bob.tunnels import ClientTunnelRegistry
+from txi2p.keystore import KeyStore
+from txi2p.test.util import FakeEndpoint, FakeFactory
 
 connectionLostFailure = failure.Failure(ConnectionLost())
 connectionRefusedFailure = failure.Failure(ConnectionRefusedError())
 
 
 class BOBFactoryTestMixin(object):
-    def setUp(self):
-        self.aborted = []
+    factoryKwargs = {}
 
-    def makeProto(self, *a, **kw):
-        fac = self.factory(*a, **kw)
-        proto = fac.buildProtocol(None)
-        transport = proto_helpers.StringTransport()
-        transport.abortConnection = lambda: self.aborted.append(True)
-        proto.makeConnection(transport)
-        return fac, proto
+    def makeFactory(self, *a):
+        self.bobEndpoint = FakeEndpoint()
+        fac = self.factory(None, None, self.bobEndpoint, '', *a,
+                           **self.factoryKwargs)
+        d = fac.createTunnel()
+        return fac, d
+
+    def reply(self, data):
+        self.bobEndpoint.proto.dataReceived(data)
 
     def test_cancellation(self):
-        fac, proto = self.makeProto(None, None, None, '')
-        fac.deferred.cancel()
-        self.assert_(self.aborted)
-        return self.assertFailure(fac.deferred, defer.CancelledError)
+        fac, d = self.makeFactory()
+        d.cancel()
+        return self.assertFailure(d, defer.CancelledError)
 
     def test_cancellationBeforeFailure(self):
-        fac, proto = self.makeProto(None, None, None, '')
-        fac.deferred.cancel()
-        proto.connectionLost(connectionLostFailure)
-        self.assert_(self.aborted)
-        return self.assertFailure(fac.deferred, defer.CancelledError)
+        fac, d = self.makeFactory()
+        d.cancel()
+        self.bobEndpoint.proto.connectionLost(connectionLostFailure)
+        return self.assertFailure(d, defer.CancelledError)
 
     def test_cancellationAfterFailure(self):
-        fac, proto = self.makeProto(None, None, None, '')
-        proto.connectionLost(connectionLostFailure)
-        fac.deferred.cancel()
-        self.assertFalse(self.aborted)
-        return self.assertFailure(fac.deferred, ConnectionLost)
-
-    def test_clientConnectionFailed(self):
-        fac, proto = self.makeProto(None, None, None, '')
-        fac.clientConnectionFailed(None, connectionRefusedFailure)
-        return self.assertFailure(fac.deferred, ConnectionRefusedError)
+        fac, d = self.makeFactory()
+        self.bobEndpoint.proto.connectionLost(connectionLostFailure)
+        d.cancel()
+        return self.assertFailure(d, ConnectionLost)
+
+    def test_bobConnectionFailed(self):
+        self.bobEndpoint = FakeEndpoint(failure=connectionRefusedFailure)
+        fac = self.factory(None, None, self.bobEndpoint, '',
+                           **self.factoryKwargs)
+        d = fac.createTunnel()
+        return self.assertFailure(d, ConnectionRefusedError)
 
     def test_defaultFactoryListsTunnels(self):
-        fac, proto = self.makeProto(None, None, None, '')
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        self.assertEqual(proto.transport.value(), b'list\n')
+        fac, d = self.makeFactory()
+        self.reply('BOB 00.00.10\nOK\n')
+        self.assertEqual(self.bobEndpoint.transport.value(), b'list\n')
+
+    def test_canceledTunnelRemoved(self):
+        fac, d = self.makeFactory('spam')
+        self.reply('BOB 00.00.10\nOK\n')
+        d.cancel()
+        self.reply('OK Listing done\nOK Nickname set to spam\n')
+        self.bobEndpoint.transport.clear()
+        # option, newkeys, getkeys, the two settings and start
+        self.reply('OK HTTP 418\nOK shrubbery\nOK rubberyeggs\n'
+                   'OK HTTP 418\nOK HTTP 418\nOK tunnel starting\n')
+        self.assertEqual(self.bobEndpoint.transport.value(),
+                         b'getnick spam\n')
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_retriesExhaustedFailsCreation(self):
+        fac, d = self.makeFactory('spam')
+        getBOBControlClient(self.bobEndpoint).maxRetries = 0
+        self.reply('BOB 00.00.10\nOK\n')
+        self.reply('DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: true KEYS: true QUIET: false INPORT: not_set INHOST: localhost OUTPORT: not_set OUTHOST: localhost\nOK Listing done\n')
+        self.reply('OK Nickname set to spam\nOK shrubbery\n'
+                   'ERROR tunnel shutting down\n')
+        return self.assertFailure(d, BOBError)
 
 
 class TestBOBI2PClientFactory(BOBFactoryTestMixin, unittest.TestCase):
@@ -67,37 +93,36 @@ class TestBOBI2PClientFactory(BOBFactoryTestMixin, unittest.TestCase):
     def TODO_test_noProtocolFromWrappedFactory(self):
         wrappedFac = FakeFactory(returnNoProtocol=True)
         mreactor = proto_helpers.MemoryReactor()
-        fac, proto = self.makeProto(mreactor, wrappedFac, None, '')
-        fac.tunnelNick = 'spam'
-        # Shortcut to end of BOB protocol
-        proto.receiver.currentRule = 'State_start'
-        proto._parser._setupInterp()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assert_(self.aborted) # TODO: Check the Deferred chain
-        return self.assertFailure(fac.deferred, defer.CancelledError)
+        tunnel, _ = ClientTunnelRegistry().acquire(None, 'spam', 'localhost',
+                                                   None, None)
+        fac = BOBI2PClientFactory(mreactor, wrappedFac, None, '',
+                                  'spam', tunnel=tunnel)
+        fac.inport = 9000
+        fac.localDest = 'spam.i2p'
+        # Shortcut to end of tunnel creation
+        fac.i2pTunnelCreated()
+        return self.assertFailure(fac.deferred, defer.CancelledError) # TODO: Check the Deferred chain
 
 
 class TestBOBI2PServerFactory(BOBFactoryTestMixin, unittest.TestCase):
     factory = BOBI2PServerFactory
+    # There is no keyfile, so new keys are made
+    factoryKwargs = {'keystore': KeyStore(threaded=False)}
 
     def TODO_test_noProtocolFromWrappedFactory(self):
         wrappedFac = FakeFactory(returnNoProtocol=True)
         mreactor = proto_helpers.MemoryReactor()
-        fac, proto = self.makeProto(mreactor, wrappedFac, None, '')
-        fac.tunnelNick = 'spam'
+        fac = BOBI2PServerFactory(mreactor, wrappedFac, None, '', 'spam')
         fac.localDest = 'spam.i2p'
-        # Shortcut to end of BOB protocol
-        proto.receiver.currentRule = 'State_start'
-        proto._parser._setupInterp()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assert_(self.aborted) # TODO: Check the Deferred chain
-        return self.assertFailure(fac.deferred, defer.CancelledError)
+        # Shortcut to end of tunnel creation
+        fac.i2pTunnelCreated()
+        return self.assertFailure(fac.deferred, defer.CancelledError) # TODO: Check the Deferred chain
 
 
 class TestBOBClientFactoryWrapper(unittest.TestCase):
     def test_buildProtocol(self):
         wrappedFac = FakeFactory()
-        fac = BOBClientFactoryWrapper(wrappedFac, None, None, '', True)
+        fac = BOBClientFactoryWrapper(wrappedFac, None, None, '', None)
         fac.setDest('spam.i2p')
         proto = fac.buildProtocol(None)
         self.assertEqual(proto.wrappedProto.factory, wrappedFac)
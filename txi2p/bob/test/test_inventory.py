@@ -0,0 +1,97 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.trial import unittest
+
+from txi2p.bob.inventory import PortAllocator, TunnelInventory
+from txi2p.bob.protocol import DEFAULT_INPORT, DEFAULT_OUTPORT
+
+
+def makeTunnel(nickname, inport=None, outport=None, running=False):
+    return {
+        'nickname': nickname,
+        'starting': False,
+        'running': running,
+        'stopping': False,
+        'keys': True,
+        'quiet': False,
+        'inport': inport,
+        'inhost': 'localhost',
+        'outport': outport,
+        'outhost': 'localhost',
+    }
+
+
+class TestTunnelInventory(unittest.TestCase):
+    def test_tunnelsByNick(self):
+        spam = makeTunnel('spam', 12345)
+        inventory = TunnelInventory([spam, makeTunnel('eggs')])
+        self.assertEqual(len(inventory), 2)
+        self.assertIdentical(inventory.get('spam'), spam)
+        self.assertEqual(inventory.get('ham'), None)
+
+    def test_usedPorts(self):
+        inventory = TunnelInventory([makeTunnel('spam', 12345, 23456),
+                                     makeTunnel('eggs', outport=34567)])
+        self.assertEqual(inventory.usedPorts, set([12345, 23456, 34567]))
+
+
+class TestPortAllocator(unittest.TestCase):
+    def setUp(self):
+        self.ports = PortAllocator()
+
+    def test_startsAtEndOfTunnels(self):
+        inventory = TunnelInventory([makeTunnel('spam'), makeTunnel('eggs')])
+        self.assertEqual(self.ports.allocate(inventory, 'ham'),
+                         (DEFAULT_INPORT + 4, DEFAULT_OUTPORT + 4))
+
+    def test_usedPortsSkipped(self):
+        inventory = TunnelInventory([
+            makeTunnel('spam', DEFAULT_INPORT + 4),
+            makeTunnel('eggs', outport=DEFAULT_OUTPORT + 6)])
+        self.assertEqual(self.ports.allocate(inventory, 'ham'),
+                         (DEFAULT_INPORT + 8, DEFAULT_OUTPORT + 8))
+
+    def test_reservedPortsNotReused(self):
+        inventory = TunnelInventory([])
+        self.assertEqual(self.ports.allocate(inventory, 'spam'),
+                         (DEFAULT_INPORT, DEFAULT_OUTPORT))
+        self.assertEqual(self.ports.allocate(inventory, 'eggs'),
+                         (DEFAULT_INPORT + 2, DEFAULT_OUTPORT + 2))
+
+    def test_releasedPortsReused(self):
+        inventory = TunnelInventory([])
+        ports = self.ports.allocate(inventory, 'spam')
+        self.ports.allocate(inventory, 'eggs')
+        self.ports.release('spam')
+        self.assertEqual(len(self.ports), 2)
+        self.assertEqual(self.ports.allocate(inventory, 'ham'), ports)
+
+    def test_halfReleasedPairStaysReserved(self):
+        inventory = TunnelInventory([])
+        inport, outport = self.ports.allocate(inventory, 'spam')
+        self.ports.release('spam', outport)
+        self.assertEqual(len(self.ports), 1)
+        self.assertEqual(self.ports.allocate(inventory, 'eggs'),
+                         (inport + 2, outport + 2))
+        self.ports.release('spam', inport)
+        self.assertEqual(self.ports.allocate(inventory, 'ham'),
+                         (inport, outport))
+
+    def test_releasedPortsListedByBOBNotReused(self):
+        ports = self.ports.allocate(TunnelInventory([]), 'spam')
+        self.ports.release('spam')
+        inventory = TunnelInventory([makeTunnel('eggs', *ports)])
+        self.assertEqual(self.ports.allocate(inventory, 'ham'),
+                         (DEFAULT_INPORT + 2, DEFAULT_OUTPORT + 2))
+
+    def test_releaseUnknownTunnel(self):
+        self.ports.release('spam')
+        self.assertEqual(len(self.ports), 0)
+
+    def test_manyTunnels(self):
+        inventory = TunnelInventory([
+            makeTunnel('tunnel%d' % i, DEFAULT_INPORT + 2*i,
+                       DEFAULT_OUTPORT + 2*i) for i in range(500)])
+        self.assertEqual(self.ports.allocate(inventory, 'spam'),
+                         (DEFAULT_INPORT + 1000, DEFAULT_OUTPORT + 1000))
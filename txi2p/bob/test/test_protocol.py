@@ -2,541 +2,403 @@
 # See COPYING for details.
 
 from builtins import object
+import gc
 import os
-from twisted.internet.error import UnknownHostError
-from twisted.internet.protocol import ClientFactory
+from twisted.internet.defer import Deferred
+from twisted.internet.error import (ConnectError, ConnectionLost,
+                                    UnknownHostError)
+from twisted.internet.task import Clock
 from twisted.python.failure import Failure
 from twisted.test import proto_helpers
 from twisted.trial import unittest
 
-from txi2p.bob.protocol import (I2PClientTunnelCreatorBOBClient,
-                                I2PServerTunnelCreatorBOBClient,
-                                I2PTunnelRemoverBOBClient,
+from txi2p.address import MAX_TUNNEL_LINE
+from txi2p.bob.control import BOBControlClient
+from txi2p.bob.factory import BOBI2PClientFactory, BOBI2PServerFactory
+from txi2p.bob.inventory import TunnelInventory
+from txi2p.bob.protocol import (BOBError,
+                                I2PClientTunnelCreator,
+                                I2PServerTunnelCreator,
+                                I2PTunnelRemover,
                                 I2PClientTunnelProtocol,
                                 I2PServerTunnelProtocol,
                                 DEFAULT_INPORT, DEFAULT_OUTPORT)
+from txi2p.test.util import FakeEndpoint, FastProducer
 
 TEST_B64 = "2wDRF5nDfeTNgM4X-TI5xEk3R-WiaTABvkMQ2eYpvEzayUZQJgr9E2T6Y2m9HHn3xHYGEOg-RLisjW9AubTaUTx-v66AsEEtv745qPcuWuV1SP~w1bdzYEn8MSoK7Zh4mwHBg1uHq8z17TUNvWz19q76vHNth-2PDuBToD7ySBn3cGBFDUU83wJJXPD6OueLY8yosWWtksk7WZk60~6z~nVePPSEY8JDry3myLDe11szAVER4A8eX1sFpw247cXGGJK9wQhV-TXFj~m76GPVcFKh7u79zwTwZnZ1GXXKqqyRoj1c4-U69CvvJsQRLmdLFwFEpRkxwV8z6LIFclYJk443YpTnPXC7vNdFOzqqS4FLR1ra~DNfN5foMtR2~2VxuR5m2dYiOS6GzHDxA4acJJSGqnasJjcEIFNVSQKxMnFu9PvGLNJHZ83EraHCErENcOGkPlnVgcJCtPGNGiirwCbBz38jE0lfjkrNrWabc6uWeU559CobG8F8KUDx1irpAAAA"
 
 
-class BOBProtoTestMixin(object):
-    def makeProto(self, *a, **kw):
-        protoClass = kw.pop('_protoClass', self.protocol)
-        fac = ClientFactory(*a, **kw)
-        fac.protocol = protoClass
-        fac.options = {}
-        def raise_(reason):
-            raise reason.value
-        fac.bobConnectionFailed = lambda reason: raise_(reason)
-        proto = fac.buildProtocol(None)
-        transport = proto_helpers.StringTransport()
-        transport.abortConnection = lambda: None
-        proto.makeConnection(transport)
-        return fac, proto
-
-    def test_initBOBListsTunnels(self):
-        fac, proto = self.makeProto()
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        self.assertEqual(proto.transport.value(), b'list\n')
-
-    def TODO_test_quitDoesNotErrback(self):
-        fac, proto = self.makeProto()
-        # Shortcut to end of BOB protocol
-        proto.receiver.currentRule = 'State_quit'
-        proto._parser._setupInterp()
-        proto.dataReceived('OK Bye!\n')
-        self.assertTrue(False, 'TODO: Test something') # TODO: Test something
-
-class BOBTunnelCreationMixin(BOBProtoTestMixin):
-    def test_defaultInportSelected(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        self.assertTrue(hasattr(fac, 'inport'))
-        self.assertEqual(fac.inport, DEFAULT_INPORT)
-
-    def test_higherInportSelectedWhenDefaultBusy(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: test STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: 9000 INHOST: localhost OUTPORT: not_set OUTHOST: localhost\nOK Listing done\n')
-        self.assertTrue(hasattr(fac, 'inport'))
-        self.assertEqual(fac.inport, DEFAULT_INPORT + 2)
-
-    def test_existingInhostAndInportSelectedForExistingTunnel(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        fac.inport = 1234
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: 2345 INHOST: localhost OUTPORT: not_set OUTHOST: localhost\nOK Listing done\n')
-        self.assertEqual(fac.inhost, 'localhost')
-        self.assertEqual(fac.inport, 2345)
-
-    def test_defaultOutportSelected(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        self.assertTrue(hasattr(fac, 'outport'))
-        self.assertEqual(fac.outport, DEFAULT_OUTPORT)
-
-    def test_higherOutportSelectedWhenDefaultBusy(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.outhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: test STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: not_set INHOST: localhost OUTPORT: 9001 OUTHOST: localhost\nOK Listing done\n')
-        self.assertTrue(hasattr(fac, 'outport'))
-        self.assertEqual(fac.outport, DEFAULT_OUTPORT + 2)
-
-    def test_existingOuthostAndOutportSelectedForExistingTunnel(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.outhost = 'camelot'
-        fac.outport = 1234
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: not_set INHOST: localhost OUTPORT: 2345 OUTHOST: localhost\nOK Listing done\n')
-        self.assertEqual(fac.outhost, 'localhost')
-        self.assertEqual(fac.outport, 2345)
+class BOBOperationTestMixin(object):
+    def runOperation(self, operation, client=None):
+        if client is not None:
+            return client.run(operation.run)
+        self.bobEndpoint = FakeEndpoint()
+        self.clock = Clock()
+        self.client = BOBControlClient(self.bobEndpoint, maxRetries=3,
+                                       maxRetryWait=10, clock=self.clock)
+        d = self.client.run(operation.run)
+        self.reply('BOB 00.00.10\nOK\n')
+        return d
+
+    def reply(self, data):
+        self.bobEndpoint.proto.dataReceived(data)
+
+    def sent(self):
+        value = self.bobEndpoint.transport.value()
+        self.bobEndpoint.transport.clear()
+        return value
+
+
+class BOBTunnelCreationMixin(BOBOperationTestMixin):
+    def makeFactory(self, tunnelNick='spam'):
+        fac = self.factory(None, None, None, '')
+        fac.tunnelNick = tunnelNick
+        return fac
+
+    def runCreator(self, fac, tunnels=''):
+        d = self.runOperation(self.creator(fac))
+        self.assertEqual(self.sent(), b'list\n')
+        self.reply(tunnels + 'OK Listing done\n')
+        return d
+
+    def test_defaultPortSelected(self):
+        fac = self.makeFactory()
+        self.runCreator(fac) # No DATA, no tunnels
+        self.assertEqual(getattr(fac, self.portSetting), self.defaultPort)
+
+    def test_higherPortSelectedWhenDefaultBusy(self):
+        fac = self.makeFactory()
+        self.runCreator(fac, 'DATA NICKNAME: test STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: 9000 INHOST: localhost OUTPORT: 9001 OUTHOST: localhost\n')
+        self.assertEqual(getattr(fac, self.portSetting), self.defaultPort + 2)
+
+    def test_portsReservedBetweenCreations(self):
+        self.runCreator(self.makeFactory())
+        self.sent()
+        fac = self.makeFactory('eggs')
+        # Run alongside the first creation, which BOB has not yet listed
+        self.creator(fac).run(self.client)
+        self.assertEqual(self.sent(), b'list\n')
+        self.reply('OK Nickname set to spam\nOK Listing done\n')
+        self.assertEqual(getattr(fac, self.portSetting), self.defaultPort + 2)
+
+    def test_portsReleasedIfCreationFails(self):
+        d = self.runCreator(self.makeFactory())
+        self.sent()
+        self.reply('ERROR spam\n')
+        self.failureResultOf(d, BOBError)
+        fac = self.makeFactory('eggs')
+        self.runOperation(self.creator(fac), self.client)
+        self.reply('OK Listing done\n')
+        self.assertEqual(getattr(fac, self.portSetting), self.defaultPort)
+
+    def test_existingPortSelectedForExistingTunnel(self):
+        fac = self.makeFactory()
+        self.runCreator(fac, 'DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: 2345 INHOST: localhost OUTPORT: 2345 OUTHOST: localhost\n')
+        self.assertEqual(getattr(fac, self.hostSetting), 'localhost')
+        self.assertEqual(getattr(fac, self.portSetting), 2345)
+        self.assertFalse(fac.removeTunnelWhenFinished)
+
+    def test_requestedHostAndPortKeptForExistingTunnel(self):
+        fac = self.makeFactory()
+        setattr(fac, self.hostSetting, 'camelot')
+        setattr(fac, self.portSetting, 1234)
+        self.runCreator(fac, 'DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: 2345 INHOST: localhost OUTPORT: 2345 OUTHOST: localhost\n')
+        self.assertEqual(getattr(fac, self.hostSetting), 'camelot')
+        self.assertEqual(getattr(fac, self.portSetting), 1234)
+        self.sent()
+        self.reply('OK Nickname set to spam\n')
+        # The tunnel is started once the settings have been accepted
+        self.assertEqual(self.sent().decode('utf-8'),
+                         'getdest\n%s camelot\n%s 1234\n' % (
+                             self.hostSetting, self.portSetting))
+        self.reply('OK shrubbery\nOK HTTP 418\nOK HTTP 418\n')
+        self.assertEqual(self.sent(), b'start\n')
+
+    def test_mismatchedPortReconfiguresRunningTunnel(self):
+        fac = self.makeFactory()
+        setattr(fac, self.portSetting, 1234)
+        self.runCreator(fac, 'DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 2345 INHOST: localhost OUTPORT: 2345 OUTHOST: localhost\n')
+        self.sent()
+        self.reply('OK Nickname set to spam\n')
+        self.assertEqual(self.sent().decode('utf-8'),
+                         'stop\ngetdest\n%s 1234\n' % self.portSetting)
+        self.reply('OK tunnel stopping\nOK shrubbery\nOK HTTP 418\n')
+        self.assertEqual(self.sent(), b'start\n')
 
     def test_defaultNickSetsNick(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = None
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        self.assertEqual(proto.transport.value().decode('utf-8'), 'setnick txi2p-%d\n' % os.getpid())
+        fac = self.makeFactory(None)
+        self.runCreator(fac) # No DATA, no tunnels
+        self.assertEqual(self.sent().decode('utf-8'), 'setnick txi2p-%d\n' % os.getpid())
 
     def test_newNickSetsNick(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        self.assertEqual(proto.transport.value(), b'setnick spam\n')
-
-    def test_nickSetSendsOptions(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
+        fac = self.makeFactory()
+        self.runCreator(fac) # No DATA, no tunnels
+        self.assertEqual(self.sent(), b'setnick spam\n')
+
+    def test_newTunnelConfiguredAfterNickSet(self):
+        fac = self.makeFactory()
+        setattr(fac, self.hostSetting, 'camelot')
+        self.runCreator(fac) # No DATA, no tunnels
+        self.sent()
+        self.reply('OK Nickname set to spam\n')
+        # Everything else is sent back to back
+        self.assertEqual(self.sent().decode('utf-8'),
+                         'option\nnewkeys\ngetkeys\n%s camelot\n%s %d\nstart\n' % (
+                             self.hostSetting, self.portSetting, self.defaultPort))
+
+    def test_newTunnelSendsOptions(self):
+        fac = self.makeFactory()
         fac.options = {'foo': 'bar', 'spam': 'eggs'}
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value(), b'option foo=bar spam=eggs\n')
-
-    def test_nickSetWithKeypair(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
+        self.runCreator(fac) # No DATA, no tunnels
+        self.sent()
+        self.reply('OK Nickname set to spam\n')
+        self.assertTrue(self.sent().startswith(b'option foo=bar spam=eggs\n'))
+
+    def test_newTunnelWithKeypair(self):
+        fac = self.makeFactory()
         fac.keypair = 'eggs'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        self.assertEqual(proto.transport.value(), b'setkeys eggs\n')
-
-    def test_destFetchedAfterNickSetWithKeypair(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
+        self.runCreator(fac) # No DATA, no tunnels
+        self.sent()
+        self.reply('OK Nickname set to spam\n')
+        self.assertTrue(self.sent().startswith(b'option\nsetkeys eggs\ngetdest\n'))
+
+    def test_newTunnelWaitsForKeyfile(self):
+        fac = self.makeFactory()
+        keyLoaded = Deferred()
+        fac.whenKeyLoaded = lambda: keyLoaded
+        self.runCreator(fac) # No DATA, no tunnels
+        self.sent()
+        self.reply('OK Nickname set to spam\n')
+        self.assertEqual(self.sent(), b'')
         fac.keypair = 'eggs'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value(), b'getdest\n')
-
-    def test_nickSetWithNoKeypair(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        self.assertEqual(proto.transport.value(), b'newkeys\n')
-
-    def test_keypairFetchedAfterNickSetWithNoKeypair(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        proto.transport.clear()
-        proto.dataReceived('OK shrubbery\n') # The new Destination
-        self.assertEqual(proto.transport.value(), b'getkeys\n')
+        keyLoaded.callback(None)
+        self.assertTrue(self.sent().startswith(b'option\nsetkeys eggs\n'))
+
+    def test_newTunnelCreated(self):
+        fac = self.makeFactory()
+        d = self.runCreator(fac) # No DATA, no tunnels
+        self.reply('OK Nickname set to spam\n')
+        self.assertNoResult(d)
+        self.reply('OK HTTP 418\n')
+        self.reply('OK shrubbery\n') # The new Destination
+        self.reply('OK rubberyeggs\n') # The new keypair
+        self.reply('OK HTTP 418\nOK HTTP 418\n')
+        self.assertNoResult(d)
+        self.reply('OK tunnel starting\n')
+        self.successResultOf(d)
+        self.assertEqual((fac.localDest, fac.keypair),
+                         ('shrubbery', 'rubberyeggs'))
+        # Only the port the tunnel uses stays reserved
+        self.assertEqual(len(self.client.ports), 1)
+
+    def test_errorFailsCreation(self):
+        fac = self.makeFactory()
+        d = self.runCreator(fac) # No DATA, no tunnels
+        self.reply('ERROR Nickname exists\n')
+        f = self.failureResultOf(d, BOBError)
+        self.assertEqual((f.value.command, f.value.info),
+                         ('setnick', 'Nickname exists'))
 
     def test_existingNickGetsNick(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
-        self.assertEqual(proto.transport.value(), b'getnick spam\n')
-
-    def test_stopRequestedForRunningTunnel(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value(), b'stop\n')
-
-    def test_stopNotRequestedForStoppedTunnel(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertNotEqual(proto.transport.value(), b'stop\n') # TODO: Refactor to test against what is actually expected
-
-    def test_quitRequestedAfterStart(self):
-        fac, proto = self.makeProto()
-        called = []
-        fac.i2pTunnelCreated = lambda: called.append(True)
-        # Shortcut
-        proto.receiver.currentRule = 'State_start'
-        proto._parser._setupInterp()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual((called, proto.transport.value()), ([True], b'quit\n'))
-
-class TestI2PClientTunnelCreatorBOBClient(BOBTunnelCreationMixin, unittest.TestCase):
-    protocol = I2PClientTunnelCreatorBOBClient
-
-    def test_inhostRequestRepeatedIfActive(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        # Shortcut
-        proto.receiver.currentRule = 'State_inhost'
-        proto._parser._setupInterp()
-        proto.dataReceived('ERROR tunnel is active\n')
-        self.assertEqual(proto.transport.value(), b'inhost camelot\n')
-
-    def test_inhostRequestRepeatedIfShuttingDown(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        # Shortcut
-        proto.receiver.currentRule = 'State_inhost'
-        proto._parser._setupInterp()
-        proto.dataReceived('ERROR tunnel shutting down\n')
-        self.assertEqual(proto.transport.value(), b'inhost camelot\n')
-
-    def test_inhostSetAfterNickSetWithKeypair(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.keypair = 'eggs'
-        fac.inhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK shrubbery\n') # The Destination
-        self.assertEqual(proto.transport.value(), b'inhost camelot\n')
-
-    def test_inhostSetAfterNickSetWithNoKeypair(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        proto.transport.clear()
-        proto.dataReceived('OK shrubbery\n') # The new Destination
-        proto.transport.clear()
-        proto.dataReceived('OK rubberyeggs\n') # The new keypair
-        self.assertEqual(proto.transport.value(), b'inhost camelot\n')
-
-    def test_defaultInportSet(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        proto.transport.clear()
-        proto.dataReceived('OK shrubbery\n') # The new Destination
-        proto.transport.clear()
-        proto.dataReceived('OK rubberyeggs\n') # The new keypair
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value().decode('utf-8'), 'inport %d\n' % DEFAULT_INPORT)
-
-    def test_inportSet(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        fac.inport = '1234'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        proto.transport.clear()
-        proto.dataReceived('OK shrubbery\n') # The new Destination
-        proto.transport.clear()
-        proto.dataReceived('OK rubberyeggs\n') # The new keypair
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value(), b'inport 1234\n')
-
-    def test_startRequested(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        fac.inport = '1234'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        proto.transport.clear()
-        proto.dataReceived('OK shrubbery\n') # The new Destination
-        proto.transport.clear()
-        proto.dataReceived('OK rubberyeggs\n') # The new keypair
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value(), b'start\n')
-
-
-class TestI2PServerTunnelCreatorBOBClient(BOBTunnelCreationMixin, unittest.TestCase):
-    protocol = I2PServerTunnelCreatorBOBClient
-
-    def test_outhostRequestRepeatedIfActive(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.outhost = 'camelot'
-        # Shortcut
-        proto.receiver.currentRule = 'State_outhost'
-        proto._parser._setupInterp()
-        proto.dataReceived('ERROR tunnel is active\n')
-        self.assertEqual(proto.transport.value(), b'outhost camelot\n')
-
-    def test_outhostRequestRepeatedIfShuttingDown(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.outhost = 'camelot'
-        # Shortcut
-        proto.receiver.currentRule = 'State_outhost'
-        proto._parser._setupInterp()
-        proto.dataReceived('ERROR tunnel shutting down\n')
-        self.assertEqual(proto.transport.value(), b'outhost camelot\n')
-
-    def test_outhostSetAfterNickSetWithKeypair(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.keypair = 'eggs'
-        fac.outhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK shrubbery\n') # The Destination
-        self.assertEqual(proto.transport.value(), b'outhost camelot\n')
-
-    def test_outhostSetAfterNickSetWithNoKeypair(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.outhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        proto.transport.clear()
-        proto.dataReceived('OK shrubbery\n') # The new Destination
-        proto.transport.clear()
-        proto.dataReceived('OK rubberyeggs\n') # The new keypair
-        self.assertEqual(proto.transport.value(), b'outhost camelot\n')
-
-    def test_defaultOutportSet(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.outhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        proto.transport.clear()
-        proto.dataReceived('OK shrubbery\n') # The new Destination
-        proto.transport.clear()
-        proto.dataReceived('OK rubberyeggs\n') # The new keypair
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value().decode('utf-8'), 'outport %d\n' % DEFAULT_OUTPORT)
-
-    def test_outportSet(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.outhost = 'camelot'
-        fac.outport = '1234'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        proto.transport.clear()
-        proto.dataReceived('OK shrubbery\n') # The new Destination
-        proto.transport.clear()
-        proto.dataReceived('OK rubberyeggs\n') # The new keypair
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value(), b'outport 1234\n')
-
-    def test_startRequested(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.outhost = 'camelot'
-        fac.outport = '1234'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418 options set\n')
-        proto.transport.clear()
-        proto.dataReceived('OK shrubbery\n') # The new Destination
-        proto.transport.clear()
-        proto.dataReceived('OK rubberyeggs\n') # The new keypair
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value(), b'start\n')
-
-
-class TestI2PTunnelRemoverBOBClient(BOBProtoTestMixin, unittest.TestCase):
-    protocol = I2PTunnelRemoverBOBClient
+        fac = self.makeFactory()
+        self.runCreator(fac, 'DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\n')
+        self.assertEqual(self.sent(), b'getnick spam\n')
+
+    def test_stopRequestedForRunningTunnelWithUnsetPorts(self):
+        fac = self.makeFactory()
+        self.runCreator(fac, 'DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: not_set INHOST: localhost OUTPORT: not_set OUTHOST: localhost\n')
+        self.sent()
+        self.reply('OK Nickname set to spam\n')
+        self.assertEqual(self.sent().decode('utf-8'), 'stop\ngetdest\n%s %d\n' % (
+            self.portSetting, self.defaultPort + 2))
+        self.reply('OK tunnel stopping\nOK shrubbery\nOK HTTP 418\n')
+        self.assertEqual(self.sent(), b'start\n')
+
+    def test_portRequestRepeatedIfShuttingDown(self):
+        fac = self.makeFactory()
+        self.runCreator(fac, 'DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: not_set INHOST: localhost OUTPORT: not_set OUTHOST: localhost\n')
+        self.reply('OK Nickname set to spam\n')
+        self.sent()
+        self.reply('OK tunnel stopping\nOK shrubbery\nERROR tunnel shutting down\n')
+        self.assertEqual(self.sent(), b'')
+        self.clock.advance(0.1)
+        self.assertEqual(self.sent().decode('utf-8'), '%s %d\n' % (
+            self.portSetting, self.defaultPort + 2))
+        self.reply('ERROR tunnel is active\n')
+        self.clock.advance(0.1)
+        self.assertEqual(self.sent(), b'')
+        self.clock.advance(0.1)
+        self.assertEqual(self.sent().decode('utf-8'), '%s %d\n' % (
+            self.portSetting, self.defaultPort + 2))
+        self.reply('OK HTTP 418\n')
+        self.assertEqual(self.sent(), b'start\n')
+
+    def test_portRetriesLimited(self):
+        fac = self.makeFactory()
+        d = self.runCreator(fac, 'DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: not_set INHOST: localhost OUTPORT: not_set OUTHOST: localhost\n')
+        self.reply('OK Nickname set to spam\n')
+        self.reply('OK tunnel stopping\nOK shrubbery\nERROR tunnel is active\n')
+        for delay in (0.1, 0.2, 0.4):
+            self.assertNoResult(d)
+            self.clock.advance(delay)
+            self.reply('ERROR tunnel is active\n')
+        f = self.failureResultOf(d, BOBError)
+        self.assertEqual(f.value.info, 'tunnel is active')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_matchingRunningTunnelReused(self):
+        fac = self.makeFactory()
+        d = self.runCreator(fac, 'DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\n')
+        self.sent()
+        self.reply('OK Nickname set to spam\n')
+        self.assertEqual(self.sent(), b'getdest\n')
+        self.reply('OK shrubbery\n') # The Destination
+        self.successResultOf(d)
+        self.assertEqual((fac.localDest, self.sent()), ('shrubbery', b''))
+
+    def test_matchingStoppedTunnelStarted(self):
+        fac = self.makeFactory()
+        d = self.runCreator(fac, 'DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\n')
+        self.sent()
+        self.reply('OK Nickname set to spam\n')
+        self.assertEqual(self.sent(), b'getdest\nstart\n')
+        self.reply('OK shrubbery\nOK tunnel starting\n')
+        self.successResultOf(d)
+
+
+    def test_stoppingTunnelReconfiguredThenStarted(self):
+        fac = self.makeFactory()
+        setattr(fac, self.portSetting, 1234)
+        d = self.runCreator(fac, 'DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: true KEYS: true QUIET: false INPORT: 2345 INHOST: localhost OUTPORT: 2345 OUTHOST: localhost\n')
+        self.sent()
+        self.reply('OK Nickname set to spam\n')
+        # Already stopping, so not stopped again
+        self.assertEqual(self.sent().decode('utf-8'),
+                         'getdest\n%s 1234\n' % self.portSetting)
+        self.reply('OK shrubbery\nERROR tunnel shutting down\n')
+        self.clock.advance(0.1)
+        self.assertEqual(self.sent().decode('utf-8'),
+                         '%s 1234\n' % self.portSetting)
+        self.reply('OK HTTP 418\n')
+        self.assertEqual(self.sent(), b'start\n')
+        self.reply('OK tunnel starting\n')
+        self.successResultOf(d)
+
+    def test_startRepeatedIfShuttingDown(self):
+        fac = self.makeFactory()
+        d = self.runCreator(fac, 'DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: true KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\n')
+        self.sent()
+        self.reply('OK Nickname set to spam\n')
+        self.assertEqual(self.sent(), b'getdest\nstart\n')
+        self.reply('OK shrubbery\nERROR tunnel shutting down\n')
+        self.assertNoResult(d)
+        self.clock.advance(0.1)
+        self.assertEqual(self.sent(), b'start\n')
+        self.reply('OK tunnel starting\n')
+        self.successResultOf(d)
+
+
+class TestI2PClientTunnelCreator(BOBTunnelCreationMixin, unittest.TestCase):
+    creator = I2PClientTunnelCreator
+    factory = BOBI2PClientFactory
+    hostSetting = 'inhost'
+    portSetting = 'inport'
+    defaultPort = DEFAULT_INPORT
+
+
+class TestI2PServerTunnelCreator(BOBTunnelCreationMixin, unittest.TestCase):
+    creator = I2PServerTunnelCreator
+    factory = BOBI2PServerFactory
+    hostSetting = 'outhost'
+    portSetting = 'outport'
+    defaultPort = DEFAULT_OUTPORT
+
+
+class TestI2PTunnelRemover(BOBOperationTestMixin, unittest.TestCase):
+    def test_tunnelGetsNick(self):
+        self.runOperation(I2PTunnelRemover('spam'))
+        self.assertEqual(self.sent(), b'getnick spam\n')
 
     def test_noTunnelWithNick(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        self.assertEqual(proto.transport.value(), b'')
-
-    def test_tunnelExistsGetsNick(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
-        self.assertEqual(proto.transport.value(), b'getnick spam\n')
-
-    def test_stopRequested(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value(), b'stop\n')
-
-    def test_clearRequested(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        proto.transport.clear()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value(), b'clear\n')
+        d = self.runOperation(I2PTunnelRemover('spam'))
+        self.sent()
+        self.reply('ERROR no such nickname\n')
+        self.successResultOf(d)
+        self.assertEqual(self.sent(), b'')
+
+    def test_stopAndClearRequested(self):
+        d = self.runOperation(I2PTunnelRemover('spam'))
+        self.sent()
+        self.reply('OK Nickname set to spam\n')
+        self.assertEqual(self.sent(), b'stop\nclear\n')
+        self.reply('OK tunnel stopping\nOK cleared\n')
+        self.successResultOf(d)
+
+    def test_removalReleasesPorts(self):
+        d = self.runOperation(I2PTunnelRemover('spam'))
+        self.client.ports.allocate(TunnelInventory([]), 'spam')
+        self.reply('OK Nickname set to spam\n')
+        self.reply('OK tunnel stopping\nOK cleared\n')
+        self.successResultOf(d)
+        self.assertEqual(len(self.client.ports), 0)
+
+    def test_noTunnelReleasesPorts(self):
+        d = self.runOperation(I2PTunnelRemover('spam'))
+        self.client.ports.allocate(TunnelInventory([]), 'spam')
+        self.reply('ERROR no such nickname\n')
+        self.successResultOf(d)
+        self.assertEqual(len(self.client.ports), 0)
+
+    def test_stoppedTunnelCleared(self):
+        d = self.runOperation(I2PTunnelRemover('spam'))
+        self.reply('OK Nickname set to spam\n')
+        self.reply('ERROR tunnel is inactive\nOK cleared\n')
+        self.successResultOf(d)
 
     def test_clearRequestRepeatedIfActive(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        # Shortcut
-        proto.receiver.currentRule = 'State_clear'
-        proto._parser._setupInterp()
-        proto.dataReceived('ERROR tunnel is active\n')
-        self.assertEqual(proto.transport.value(), b'clear\n')
+        self.runOperation(I2PTunnelRemover('spam'))
+        self.reply('OK Nickname set to spam\n')
+        self.sent()
+        self.reply('OK tunnel stopping\nERROR tunnel is active\n')
+        self.assertEqual(self.sent(), b'')
+        self.clock.advance(0.1)
+        self.assertEqual(self.sent(), b'clear\n')
 
     def test_clearRequestRepeatedIfShuttingDown(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        # Shortcut
-        proto.receiver.currentRule = 'State_clear'
-        proto._parser._setupInterp()
-        proto.dataReceived('ERROR tunnel shutting down\n')
-        self.assertEqual(proto.transport.value(), b'clear\n')
-
-    def test_quitRequestedAfterClearSuccess(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.i2pTunnelRemoved = lambda: None
-        # Shortcut
-        proto.receiver.currentRule = 'State_clear'
-        proto._parser._setupInterp()
-        proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value(), b'quit\n')
+        self.runOperation(I2PTunnelRemover('spam'))
+        self.reply('OK Nickname set to spam\n')
+        self.sent()
+        self.reply('OK tunnel stopping\nERROR tunnel shutting down\n')
+        self.clock.advance(0.1)
+        self.assertEqual(self.sent(), b'clear\n')
+
+    def test_clearRetriesLimitedByTotalWait(self):
+        d = self.runOperation(I2PTunnelRemover('spam'))
+        self.client.maxRetries = 10
+        self.client.maxRetryWait = 0.5
+        self.reply('OK Nickname set to spam\n')
+        self.reply('OK tunnel stopping\nERROR tunnel is active\n')
+        # The last wait is cut short so that no more than 0.5s is waited
+        for delay in (0.1, 0.2, 0.2):
+            self.assertNoResult(d)
+            self.clock.advance(delay)
+            self.reply('ERROR tunnel is active\n')
+        self.failureResultOf(d, BOBError)
+
+    def test_stopConnectionLostFailsRemoval(self):
+        d = self.runOperation(I2PTunnelRemover('spam'))
+        self.reply('OK Nickname set to spam\n')
+        self.bobEndpoint.proto.connectionLost(
+            Failure(ConnectionLost()))
+        self.failureResultOf(d, ConnectionLost)
+        # The failed stop is not left unhandled
+        gc.collect()
+
+    def test_clearErrorFailsRemoval(self):
+        d = self.runOperation(I2PTunnelRemover('spam'))
+        self.reply('OK Nickname set to spam\n')
+        self.reply('OK tunnel stopping\nERROR no such tunnel\n')
+        self.failureResultOf(d, BOBError)
 
 
 class FakeDisconnectingFactory(object):
@@ -564,7 +426,7 @@ class TestI2PClientTunnelProtocol(unittest.TestCase):
 
     def test_connectionFailed(self):
         proto = self.makeProto()
-        proto.dataReceived("ERROR Can't find destination: spam.i2p")
+        proto.dataReceived(b"ERROR Can't find destination: spam.i2p\n")
         self.assertEqual(proto.wrappedProto.closed, 1)
 
         expected = UnknownHostError(string="Can't find destination: spam.i2p")
@@ -572,11 +434,66 @@ class TestI2PClientTunnelProtocol(unittest.TestCase):
         self.assertEqual(type(expected), type(got))
         self.assertEqual(expected.args, got.args)
 
+    def test_connectionFailedAcrossChunks(self):
+        proto = self.makeProto()
+        proto.dataReceived(b'ERR')
+        proto.dataReceived(b'OR timed ')
+        self.assertEqual(proto.wrappedProto.closed, 0)
+        proto.dataReceived(b'out\n')
+        self.assertEqual(proto.wrappedProto.closed, 1)
+        got = proto.wrappedProto.closedReason.value
+        self.assertEqual(type(got), ConnectError)
+        self.assertEqual(got.args, ('timed out',))
+        self.assertEqual(proto.wrappedProto.data, b'')
+
+    def test_unterminatedErrorLine(self):
+        proto = self.makeProto()
+        proto.dataReceived(b'ERROR timed out')
+        proto.transport.loseConnection()
+        got = proto.wrappedProto.closedReason.value
+        self.assertEqual(got.args, ('timed out',))
+
+    def test_errorLineBounded(self):
+        proto = self.makeProto()
+        proto.dataReceived(b'ERROR ' + b'x' * MAX_TUNNEL_LINE)
+        self.assertEqual(proto.wrappedProto.closed, 1)
+        self.assertEqual(type(proto.wrappedProto.closedReason.value),
+                         ConnectError)
+
     def test_dataPassed(self):
         proto = self.makeProto()
-        proto.dataReceived('shrubbery')
+        proto.dataReceived(b'shrubbery')
         self.assertEqual(proto.wrappedProto.data, b'shrubbery')
 
+    def test_dataLikeErrorHeldBack(self):
+        proto = self.makeProto()
+        proto.dataReceived(b'ERR')
+        self.assertEqual(proto.wrappedProto.data, b'')
+        proto.dataReceived(b'ant knight')
+        self.assertEqual(proto.wrappedProto.data, b'ERRant knight')
+
+    def test_laterDataNotChecked(self):
+        proto = self.makeProto()
+        proto.dataReceived(b'shrubbery')
+        proto.dataReceived(b'ERROR not an error\n')
+        self.assertEqual(proto.wrappedProto.data,
+                         b'shrubberyERROR not an error\n')
+        self.assertEqual(proto.wrappedProto.closed, 0)
+
+    def test_producerThrottledByTunnel(self):
+        proto = self.makeProto()
+        producer = FastProducer(proto.wrappedProto.transport, 300)
+        proto.wrappedProto.transport.registerProducer(producer, True)
+        tunnel = proto.transport.t
+        self.assertTrue(tunnel.streaming)
+        # The BOB tunnel stops accepting writes
+        tunnel.producer.pauseProducing()
+        producer.resumeProducing()
+        self.assertTrue(producer.paused)
+        tunnel.clear()
+        tunnel.producer.resumeProducing()
+        self.assertTrue(producer.expected().startswith(tunnel.value()))
+
 
 class TestI2PServerTunnelProtocol(unittest.TestCase):
     def makeProto(self):
@@ -593,11 +510,39 @@ class TestI2PServerTunnelProtocol(unittest.TestCase):
 
     def test_peerDestStored(self):
         proto = self.makeProto()
-        proto.dataReceived('%s\n' % TEST_B64)
+        proto.dataReceived(('%s\n' % TEST_B64).encode('utf-8'))
+        self.assertEqual(proto.peer.destination, TEST_B64)
+
+    def test_peerDestAcrossChunks(self):
+        proto = self.makeProto()
+        line = ('%s\n' % TEST_B64).encode('utf-8')
+        proto.dataReceived(line[:100])
+        self.assertEqual(proto.peer, None)
+        proto.dataReceived(line[100:])
         self.assertEqual(proto.peer.destination, TEST_B64)
+        self.assertEqual(proto.wrappedProto.data, b'')
 
     def test_dataAfterPeerDestPassed(self):
         proto = self.makeProto()
-        proto.dataReceived('%s\n' % TEST_B64)
-        proto.dataReceived('shrubbery')
+        proto.dataReceived(('%s\n' % TEST_B64).encode('utf-8'))
+        proto.dataReceived(b'shrubbery')
         self.assertEqual(proto.wrappedProto.data, b'shrubbery')
+
+    def test_dataWithPeerDestPassed(self):
+        proto = self.makeProto()
+        proto.dataReceived(('%s\nshrubbery' % TEST_B64).encode('utf-8'))
+        self.assertEqual(proto.peer.destination, TEST_B64)
+        self.assertEqual(proto.wrappedProto.data, b'shrubbery')
+
+    def test_peerDestBounded(self):
+        proto = self.makeProto()
+        proto.dataReceived(b'x' * (MAX_TUNNEL_LINE + 1))
+        self.assertTrue(proto.transport.t.disconnecting)
+        self.assertEqual(proto.peer, None)
+
+    def test_dataAfterPeerDestOverflowIgnored(self):
+        proto = self.makeProto()
+        proto.dataReceived(b'x' * (MAX_TUNNEL_LINE + 1))
+        proto.dataReceived(('%s\nshrubbery' % TEST_B64).encode('utf-8'))
+        self.assertEqual(proto.peer, None)
+        self.assertEqual(proto.wrappedProto.data, b'')
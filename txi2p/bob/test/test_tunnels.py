@@ -0,0 +1,149 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from twisted.internet.error import ConnectionLost, ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txi2p.bob.control import BOBControlFactory
+from txi2p.bob.tunnels import ClientTunnelRegistry
+from txi2p.test.util import FakeEndpoint, FakeFactory
+
+connectionLostFailure = failure.Failure(ConnectionLost())
+connectionRefusedFailure = failure.Failure(ConnectionRefusedError())
+
+
+class FakeCreatorFactory(object):
+    tunnelNick = 'spam'
+    inhost = 'localhost'
+    inport = 9000
+    localDest = 'eggs'
+    removeTunnelWhenFinished = True
+
+
+class ClientTunnelRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.registry = ClientTunnelRegistry(linger=10, clock=self.clock)
+        self.bobEndpoint = FakeEndpoint()
+
+    def acquire(self, tunnelNick='spam', options=None):
+        return self.registry.acquire(self.bobEndpoint, tunnelNick,
+                                     'localhost', None, options)
+
+    def createdTunnel(self):
+        tunnel, isNew = self.acquire()
+        tunnel.tunnelCreated(FakeCreatorFactory())
+        return tunnel
+
+    def test_firstAcquireIsNew(self):
+        tunnel, isNew = self.acquire()
+        self.assertTrue(isNew)
+        self.assertEqual((tunnel.connections, len(self.registry)), (1, 1))
+
+    def test_sameTunnelShared(self):
+        tunnel, _ = self.acquire(options={'foo': 'bar'})
+        tunnel2, isNew = self.acquire(options={'foo': 'bar'})
+        self.assertIdentical(tunnel2, tunnel)
+        self.assertFalse(isNew)
+        self.assertEqual(tunnel.connections, 2)
+
+    def test_differentTunnelsNotShared(self):
+        tunnel, _ = self.acquire()
+        tunnel2, isNew = self.acquire('eggs')
+        tunnel3, isNew3 = self.acquire(options={'foo': 'bar'})
+        self.assertTrue(isNew and isNew3)
+        self.assertEqual(len(self.registry), 3)
+
+    def test_whenCreatedWaitsForTunnel(self):
+        tunnel, _ = self.acquire()
+        d = self.acquire()[0].whenCreated()
+        self.assertNoResult(d)
+        tunnel.tunnelCreated(FakeCreatorFactory())
+        self.assertIdentical(self.successResultOf(d), tunnel)
+        self.assertEqual((tunnel.inport, tunnel.localDest), (9000, 'eggs'))
+
+    def test_whenCreatedAfterCreation(self):
+        tunnel = self.createdTunnel()
+        self.assertIdentical(self.successResultOf(tunnel.whenCreated()), tunnel)
+
+    def test_whenCreatedCancellationReleases(self):
+        tunnel, _ = self.acquire()
+        d = self.acquire()[0].whenCreated()
+        d.cancel()
+        self.failureResultOf(d)
+        self.assertEqual(tunnel.connections, 1)
+
+    def test_tunnelFailedFailsWaiters(self):
+        tunnel, _ = self.acquire()
+        d = self.acquire()[0].whenCreated()
+        tunnel.tunnelFailed(connectionRefusedFailure)
+        self.failureResultOf(d, ConnectionRefusedError)
+        self.assertEqual(len(self.registry), 0)
+        self.assertTrue(self.acquire()[1])
+
+    def test_tunnelFailedIgnoredOnceCreated(self):
+        tunnel = self.createdTunnel()
+        tunnel.tunnelFailed(connectionLostFailure)
+        self.assertEqual(len(self.registry), 1)
+
+    def test_tunnelLingersAfterLastRelease(self):
+        tunnel = self.createdTunnel()
+        tunnel.release()
+        self.clock.advance(9)
+        self.assertEqual(len(self.registry), 1)
+        self.assertFalse(hasattr(self.bobEndpoint, 'factory'))
+        self.clock.advance(1)
+        self.assertEqual(len(self.registry), 0)
+        self.assertIsInstance(self.bobEndpoint.factory, BOBControlFactory)
+        self.bobEndpoint.proto.dataReceived('BOB 00.00.10\nOK\n')
+        self.assertEqual(self.bobEndpoint.transport.value(), b'getnick spam\n')
+
+    def test_acquireDuringLingerKeepsTunnel(self):
+        tunnel = self.createdTunnel()
+        tunnel.release()
+        self.clock.advance(5)
+        tunnel2, isNew = self.acquire()
+        self.clock.advance(10)
+        self.assertIdentical(tunnel2, tunnel)
+        self.assertFalse(isNew)
+        self.assertEqual(len(self.registry), 1)
+
+    def test_existingTunnelNotRemoved(self):
+        tunnel, _ = self.acquire()
+        fac = FakeCreatorFactory()
+        fac.removeTunnelWhenFinished = False
+        tunnel.tunnelCreated(fac)
+        tunnel.release()
+        self.clock.advance(10)
+        self.assertEqual(len(self.registry), 0)
+        self.assertFalse(hasattr(self.bobEndpoint, 'factory'))
+
+    def test_connectUsesInport(self):
+        tunnel = self.createdTunnel()
+        mreactor = proto_helpers.MemoryReactor()
+        tunnel.connect(mreactor, FakeFactory(), 'foo.i2p')
+        host, port, wrapper = mreactor.tcpClients[0][:3]
+        self.assertEqual((host, port), ('localhost', 9000))
+
+    def test_connectionLostReleases(self):
+        tunnel = self.createdTunnel()
+        mreactor = proto_helpers.MemoryReactor()
+        tunnel.connect(mreactor, FakeFactory(), 'foo.i2p')
+        wrapper = mreactor.tcpClients[0][2]
+        proto = wrapper.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        proto.connectionLost(connectionLostFailure)
+        self.assertEqual(tunnel.connections, 0)
+
+    def test_refusedConnectionDiscardsTunnel(self):
+        tunnel = self.createdTunnel()
+        mreactor = proto_helpers.MemoryReactor()
+        d = tunnel.connect(mreactor, FakeFactory(), 'foo.i2p')
+        mreactor.tcpClients[0][2].clientConnectionFailed(
+            None, connectionRefusedFailure)
+        self.failureResultOf(d, ConnectionRefusedError)
+        self.assertEqual((tunnel.connections, len(self.registry)), (0, 0))
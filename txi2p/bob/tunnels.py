@@ -0,0 +1,177 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from twisted.internet import defer, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.error import ConnectionRefusedError
+from twisted.python import log
+
+from txi2p.address import I2PAddress
+from txi2p.bob.control import getBOBControlClient
+from txi2p.bob.factory import BOBClientFactoryWrapper
+from txi2p.bob.protocol import I2PTunnelRemover
+
+# Seconds an unused client tunnel is kept before it is removed
+DEFAULT_CLIENT_TUNNEL_LINGER = 60
+
+
+class ClientTunnel(object):
+    """A BOB client tunnel, shared by all connections made through it.
+
+    BOB client tunnels are not tied to a Destination: each connection to the
+    tunnel's inport names the Destination it wants in its first line. So once
+    the tunnel has been created, a connection only costs a TCP connection to
+    the inport.
+
+    The tunnel counts the connections using it. Once the last one is lost,
+    the tunnel lingers for a while in case it is needed again, and is then
+    removed from BOB (unless it existed before we used it).
+    """
+
+    def __init__(self, registry, key, bobEndpoint):
+        self._registry = registry
+        self._key = key
+        self.bobEndpoint = bobEndpoint
+        self.created = False
+        self.connections = 0
+        self.tunnelNick = None
+        self.inhost = None
+        self.inport = None
+        self.localDest = None
+        self.removeTunnelWhenFinished = True
+        self._waiting = []
+        self._lingerCall = None
+
+    def whenCreated(self):
+        """Get a Deferred that fires with this tunnel once BOB has started it.
+        """
+        if self.created:
+            return defer.succeed(self)
+        def cancel(d):
+            if d in self._waiting:
+                self._waiting.remove(d)
+                self.release()
+        d = defer.Deferred(cancel)
+        self._waiting.append(d)
+        return d
+
+    def tunnelCreated(self, fac):
+        """Record the settings of the tunnel started by a creator factory."""
+        self.created = True
+        self.tunnelNick = fac.tunnelNick
+        self.inhost = fac.inhost
+        self.inport = fac.inport
+        self.localDest = fac.localDest
+        self.removeTunnelWhenFinished = fac.removeTunnelWhenFinished
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(self)
+
+    def tunnelFailed(self, reason):
+        """Note that the tunnel could not be created."""
+        if self.created:
+            return
+        self._registry._discard(self)
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(reason)
+
+    def acquire(self):
+        self.connections += 1
+        if self._lingerCall is not None:
+            self._lingerCall.cancel()
+            self._lingerCall = None
+
+    def release(self):
+        self.connections -= 1
+        if self.connections == 0 and self.created:
+            self._lingerCall = self._registry._clock.callLater(
+                self._registry.linger, self._expire)
+
+    def _expire(self):
+        self._lingerCall = None
+        self._registry._discard(self)
+        if self.removeTunnelWhenFinished:
+            control = getBOBControlClient(self.bobEndpoint)
+            d = control.run(I2PTunnelRemover(self.tunnelNick).run)
+            d.addErrback(lambda f: log.msg(
+                'Could not remove tunnel %s: %s' % (self.tunnelNick, f.value)))
+
+    def connect(self, reactor, clientFactory, dest):
+        """Connect to a Destination through the tunnel.
+
+        The caller must hold a reference from :meth:`acquire`, which is
+        released when the connection is lost, or fails.
+        """
+        # BOB only listens on TCP4 (for now).
+        clientEndpoint = TCP4ClientEndpoint(reactor, self.inhost, self.inport)
+        # Wrap the client Factory.
+        wrappedFactory = BOBClientFactoryWrapper(clientFactory,
+                                                 self.bobEndpoint,
+                                                 I2PAddress(self.localDest),
+                                                 self.tunnelNick,
+                                                 self)
+        wrappedFactory.setDest(dest)
+        d = clientEndpoint.connect(wrappedFactory)
+        def connectFailed(reason):
+            if reason.check(ConnectionRefusedError):
+                # The tunnel has gone, so don't hand it out again
+                self._registry._discard(self)
+            self.release()
+            return reason
+        d.addErrback(connectFailed)
+        return d
+
+
+class ClientTunnelRegistry(object):
+    """The BOB client tunnels in use, so that connections can share them.
+
+    Tunnels are shared by endpoints with the same BOB API endpoint, tunnel
+    nickname, inhost, inport and options.
+
+    Args:
+        linger (int): Seconds an unused tunnel is kept before it is removed.
+        clock: The clock used to time the linger. Defaults to the reactor.
+    """
+
+    def __init__(self, linger=DEFAULT_CLIENT_TUNNEL_LINGER, clock=None):
+        self.linger = linger
+        self._clock = clock or reactor
+        self._tunnels = {}
+
+    def __len__(self):
+        return len(self._tunnels)
+
+    def acquire(self, bobEndpoint, tunnelNick, inhost, inport, options):
+        """Get a reference to a tunnel.
+
+        Returns:
+            tuple: ``(tunnel, isNew)``. If ``isNew`` is `True`, the caller
+            must create the tunnel, and call :meth:`ClientTunnel.tunnelCreated`
+            or :meth:`ClientTunnel.tunnelFailed`.
+        """
+        key = (bobEndpoint, tunnelNick, inhost, inport,
+               tuple(sorted((options or {}).items())))
+        tunnel = self._tunnels.get(key)
+        isNew = tunnel is None
+        if isNew:
+            tunnel = ClientTunnel(self, key, bobEndpoint)
+            self._tunnels[key] = tunnel
+        tunnel.acquire()
+        return tunnel, isNew
+
+    def _discard(self, tunnel):
+        if self._tunnels.get(tunnel._key) is tunnel:
+            del self._tunnels[tunnel._key]
+
+
+_registry = None
+
+
+def getClientTunnelRegistry():
+    """Get the client tunnel registry shared by all BOB client endpoints."""
+    global _registry
+    if _registry is None:
+        _registry = ClientTunnelRegistry()
+    return _registry
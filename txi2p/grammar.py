@@ -1,6 +1,10 @@
 # Copyright (c) str4d <str4d@mail.i2p>
 # See COPYING for details.
 
+import hashlib
+import json
+import os
+
 # General I2P grammar
 i2pGrammarSource = r"""
 digit = anything:x ?(x in '0123456789')
@@ -53,6 +57,7 @@ BOB_outhost   = (ERROR | OK)
 BOB_outport   = (ERROR | OK)
 BOB_quiet     = (ERROR | OK)
 BOB_quit      = (OK)
+BOB_reply     = ((DATA_TUNNEL_STATUS)*:data (ERROR | OK):(result, info) -> (result, info, data))
 BOB_setkeys   = (ERROR | OK)
 BOB_setnick   = (ERROR | OK)
 BOB_show      = ((ERROR:(result, info)              -> (result, info, {}))
@@ -80,6 +85,7 @@ State_outhost   = BOB_outhost:response   -> receiver.outhost(*response)
 State_outport   = BOB_outport:response   -> receiver.outport(*response)
 State_quiet     = BOB_quiet:response     -> receiver.quiet(*response)
 State_quit      = BOB_quit:response      -> receiver.quit(*response)
+State_reply     = BOB_reply:response     -> receiver.reply(*response)
 State_setkeys   = BOB_setkeys:response   -> receiver.setkeys(*response)
 State_setnick   = BOB_setnick:response   -> receiver.setnick(*response)
 State_show      = BOB_show:response      -> receiver.show(*response)
@@ -121,4 +127,95 @@ SAM_pong = 'PONG' KEEPALIVE_DATA:data '\n' -> data
 
 State_keepalive = ((SAM_ping:data -> receiver.ping(data))
                   |(SAM_pong:data -> receiver.pong(data)))
+
+State_primary = (State_keepalive
+                |(SAM_session_status:options -> receiver.sessionStatus(**options)))
 """
+
+
+# Set this environment variable to a directory to cache compiled grammars on
+# disk between runs.
+GRAMMAR_CACHE_ENV = 'TXI2P_GRAMMAR_CACHE'
+
+# Bump this if the on-disk cache format changes.
+_CACHE_FORMAT = 1
+
+# Dictionary containing all compiled grammars, keyed by source
+_grammars = {}
+
+
+def _termToData(term):
+    return [term.tag.name, term.data, [_termToData(a) for a in term.args]]
+
+def _termFromData(data):
+    from terml.nodes import Tag, Term
+    name, value, args = data
+    return Term(Tag(name), value, [_termFromData(a) for a in args], None)
+
+def _cachePath(cacheDir, source):
+    import parsley
+    key = hashlib.sha256(('%s\n%s\n%s' % (
+        _CACHE_FORMAT,
+        getattr(parsley, '__version__', ''),
+        source)).encode('utf-8')).hexdigest()
+    return os.path.join(cacheDir, 'txi2p-grammar-%s.json' % key)
+
+def _loadCached(path):
+    try:
+        with open(path, 'r') as f:
+            return _termFromData(json.load(f))
+    except (IOError, OSError, ValueError, TypeError):
+        return None
+
+def _saveCached(path, g):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(_termToData(g), f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def compileGrammar(source, cacheDir=None):
+    """Compile a Parsley grammar, using the on-disk cache if configured.
+
+    Args:
+        source (str): The grammar source.
+        cacheDir (str): Directory for the on-disk cache. Defaults to the value
+            of the ``TXI2P_GRAMMAR_CACHE`` environment variable; if neither is
+            set, the cache is not used.
+    """
+    if cacheDir is None:
+        cacheDir = os.environ.get(GRAMMAR_CACHE_ENV)
+    if cacheDir:
+        path = _cachePath(cacheDir, source)
+        g = _loadCached(path)
+        if g is not None:
+            return g
+
+    from ometa.grammar import OMeta
+    g = OMeta(source).parseGrammar('Grammar')
+    if cacheDir:
+        _saveCached(path, g)
+    return g
+
+def getGrammar(source):
+    """Get the shared compiled grammar for ``source``.
+
+    The grammar is compiled on first use, and the result is reused by every
+    protocol built from the same source.
+    """
+    try:
+        return _grammars[source]
+    except KeyError:
+        g = _grammars[source] = compileGrammar(source)
+        return g
+
+def getBOBGrammar():
+    return getGrammar(bobGrammarSource)
+
+def getSAMGrammar():
+    return getGrammar(samGrammarSource)
@@ -0,0 +1,173 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+import errno
+import os
+import tempfile
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+
+
+def _readKey(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def _fsyncDir(dirname):
+    # Make the rename itself durable. Not possible on all platforms.
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _writeKey(path, key, exclusive):
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(
+        prefix='.%s.' % os.path.basename(path), suffix='.tmp', dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(key)
+            f.flush()
+            os.fsync(f.fileno())
+        if exclusive:
+            if os.path.exists(path):
+                raise ValueError('The keyfile already exists')
+            if hasattr(os, 'link'):
+                # Fails instead of replacing a keyfile created meanwhile
+                try:
+                    os.link(tmp, path)
+                except OSError as e:
+                    if e.errno == errno.EEXIST:
+                        raise ValueError('The keyfile already exists')
+                    raise
+            else:
+                os.rename(tmp, path)
+        else:
+            getattr(os, 'replace', os.rename)(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    _fsyncDir(dirname)
+
+
+class KeyStore(object):
+    """Loads and saves the private keys of I2P Destinations.
+
+    File I/O is done in the reactor's thread pool, so that slow disks do not
+    stall the reactor. Keys are written atomically: to a temporary file that
+    is synced to disk and then renamed over the keyfile, so a crash part-way
+    through never leaves a truncated key behind. Temporary files, and so
+    keyfiles, are only readable by their owner.
+
+    Keys that have been loaded or saved are cached in memory, so endpoints
+    sharing a keyfile read it once. Changes made to a keyfile by other
+    processes are not seen until :meth:`forget` is called for it.
+
+    Args:
+        reactor: The reactor whose thread pool is used. Defaults to the global
+            reactor.
+        threaded (bool): If `False`, file I/O is done in the calling thread.
+    """
+
+    def __init__(self, reactor=None, threaded=True):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._threaded = threaded
+        self._cache = {}
+        self._loading = {}
+
+    def _run(self, f, *args):
+        if self._threaded:
+            return threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(), f, *args)
+        return defer.maybeDeferred(f, *args)
+
+    def load(self, path):
+        """Load the private key in a keyfile.
+
+        Concurrent loads of the same keyfile share one read.
+
+        Returns:
+            twisted.internet.defer.Deferred: Fires with the key (str).
+
+        Raises:
+            IOError: if the keyfile cannot be read.
+        """
+        path = os.path.abspath(path)
+        if path in self._cache:
+            return defer.succeed(self._cache[path])
+        d = defer.Deferred()
+        if path in self._loading:
+            self._loading[path].append(d)
+            return d
+        self._loading[path] = [d]
+        self._run(_readKey, path).addBoth(self._loaded, path)
+        return d
+
+    def _loaded(self, result, path):
+        waiting = self._loading.pop(path)
+        if not isinstance(result, Failure):
+            self._cache[path] = result
+        for d in waiting:
+            d.callback(result)
+
+    def save(self, path, key):
+        """Write a private key to a keyfile, replacing any existing key.
+
+        Returns:
+            twisted.internet.defer.Deferred: Fires with `None` once the key is
+            on disk.
+
+        Raises:
+            IOError: if the keyfile cannot be written.
+        """
+        return self._write(path, key, False)
+
+    def create(self, path, key):
+        """Write a private key to a new keyfile.
+
+        Returns:
+            twisted.internet.defer.Deferred: Fires with `None` once the key is
+            on disk.
+
+        Raises:
+            ValueError: if the keyfile already exists.
+            IOError: if the keyfile cannot be written.
+        """
+        return self._write(path, key, True)
+
+    def _write(self, path, key, exclusive):
+        path = os.path.abspath(path)
+        d = self._run(_writeKey, path, key, exclusive)
+        def cache(result):
+            self._cache[path] = key
+            return result
+        d.addCallback(cache)
+        return d
+
+    def forget(self, path=None):
+        """Drop a keyfile, or all keyfiles if `None`, from the cache."""
+        if path is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(os.path.abspath(path), None)
+
+
+_keystore = None
+
+
+def getKeyStore():
+    """Get the key store shared by all endpoints."""
+    global _keystore
+    if _keystore is None:
+        _keystore = KeyStore()
+    return _keystore
@@ -11,6 +11,7 @@ from txi2p.sam.endpoints import (
     SAMI2PStreamClientEndpoint,
     SAMI2PStreamServerEndpoint,
 )
+from txi2p.sam.stream import DEFAULT_MIN_ACCEPTS, DEFAULT_MAX_ACCEPTS
 from txi2p.utils import getApi
 
 from twisted.plugin import IPlugin
@@ -39,11 +40,13 @@ class I2PClientParser:
                      keyfile=None,
                      localPort=None,
                      options=None,
-                     sigType=None):
+                     sigType=None,
+                     poolSize=None):
         return SAMI2PStreamClientEndpoint.new(
             clientFromString(reactor, samEndpoint),
             host, port, nickname, autoClose, keyfile,
-            localPort and int(localPort) or None, _parseOptions(options), sigType)
+            localPort and int(localPort) or None, _parseOptions(options), sigType,
+            poolSize and int(poolSize) or 0)
 
     _apiParsers = {
         'BOB': _parseBOBClient,
@@ -82,10 +85,20 @@ class I2PServerParser:
                      nickname=None,
                      autoClose=False,
                      options=None,
-                     sigType=None):
+                     sigType=None,
+                     minAccepts=None,
+                     maxAccepts=None,
+                     forward=False):
+        # An explicit 0 is rejected, not replaced by the default
+        minAccepts = DEFAULT_MIN_ACCEPTS if minAccepts is None else int(minAccepts)
+        maxAccepts = DEFAULT_MAX_ACCEPTS if maxAccepts is None else int(maxAccepts)
+        if minAccepts < 1 or maxAccepts < minAccepts:
+            raise ValueError('Need 1 <= minAccepts <= maxAccepts')
         return SAMI2PStreamServerEndpoint.new(
             clientFromString(reactor, samEndpoint),
-            keyfile, port, nickname, autoClose, _parseOptions(options), sigType)
+            keyfile, port, nickname, autoClose, _parseOptions(options), sigType,
+            minAccepts, maxAccepts,
+            str(forward).lower() in ('1', 'true'), reactor)
 
     _apiParsers = {
         'BOB': _parseBOBServer,
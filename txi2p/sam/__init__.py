@@ -1,4 +1,6 @@
 from .endpoints import (
+    SAMI2PDatagramEndpoint,
+    SAMI2PRawEndpoint,
     SAMI2PStreamClientEndpoint,
     SAMI2PStreamServerEndpoint,
 )
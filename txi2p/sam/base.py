@@ -4,11 +4,10 @@
 from builtins import str
 from builtins import object
 import functools
-from ometa.grammar import OMeta
 from ometa.protocol import ParserProtocol
+from ometa.tube import TrampolinedParser
 import re
 import time
-from twisted.internet import reactor
 from twisted.internet.interfaces import IProtocolFactory
 from twisted.internet.protocol import ClientFactory
 from twisted.python.failure import Failure
@@ -16,13 +15,14 @@ from zope.interface import implementer
 
 from txi2p import grammar
 from txi2p.address import (
+    MAX_TUNNEL_LINE,
     I2PAddress,
     I2PServerTunnelProtocol,
     I2PTunnelTransport,
 )
 from txi2p.sam import constants as c
-
-KEEPALIVE_TIMEOUT = 2 * 60
+from txi2p.sam.keepalive import getKeepaliveScheduler
+from txi2p.sam.parser import SAMReplyParser
 
 
 def cmpSAM(a, b):
@@ -40,8 +40,48 @@ def peerSAM(data):
 
 
 class SAMParserProtocol(ParserProtocol):
-    def __init__(self, *args):
-        ParserProtocol.__init__(self, *args)
+    # Set to True to parse control replies with the Parsley grammar instead
+    # of the line-oriented fast path in txi2p.sam.parser.
+    useGrammar = False
+
+    def __init__(self, senderFactory, receiverFactory):
+        # The grammar is only needed if useGrammar is set; all SAM protocols
+        # share one, compiled on first use.
+        ParserProtocol.__init__(self, None,
+                                senderFactory, receiverFactory, {})
+
+    def connectionMade(self):
+        self.sender = self._senderFactory(self.transport)
+        self.receiver = self._receiverFactory(self.sender)
+        self.receiver.prepareParsing(self)
+        self._setUpParser()
+
+    def _setUpParser(self):
+        self._useGrammar = self.useGrammar
+        if self._useGrammar:
+            self._grammar = grammar.getSAMGrammar()
+            self._parser = TrampolinedParser(
+                self._grammar, self.receiver, self._bindings)
+        else:
+            self._parser = SAMReplyParser(self.receiver)
+
+    def handOver(self, factory):
+        """Continue this connection as a connection made by ``factory``.
+
+        The connection must have completed the HELLO exchange, and be idle.
+        A sender and receiver are created for the protocol of ``factory``,
+        which then sends its command straight away.
+        """
+        template = factory.protocol()
+        samVersion = self.factory.samVersion
+        self.factory = factory
+        factory.currentCandidate = self
+        factory.samVersion = samVersion
+        self.sender = template._senderFactory(self.transport)
+        self.receiver = template._receiverFactory(self.sender)
+        self.receiver.attachParser(self)
+        self._setUpParser()
+        self.receiver.command()
 
     def dataReceived(self, data):
         """
@@ -57,10 +97,13 @@ class SAMParserProtocol(ParserProtocol):
             # Shortcut for efficiency
             self.receiver.dataReceived(data)
         else:
-            # Duplicated from Parsley because it expects a str but Twisted
-            # provides a bytes.
             try:
-                self._parser.receive(data.decode('utf-8'))
+                if self._useGrammar:
+                    # Duplicated from Parsley because it expects a str but
+                    # Twisted provides a bytes.
+                    self._parser.receive(data.decode('utf-8'))
+                else:
+                    self._parser.receive(data)
             except Exception:
                 self.connectionLost(Failure())
                 self.transport.abortConnection()
@@ -68,9 +111,8 @@ class SAMParserProtocol(ParserProtocol):
 
 
 def makeSAMProtocol(senderFactory, receiverFactory):
-    g = OMeta(grammar.samGrammarSource).parseGrammar('Grammar')
     return functools.partial(
-        SAMParserProtocol, g, senderFactory, receiverFactory, {})
+        SAMParserProtocol, senderFactory, receiverFactory)
 
 
 class SAMSender(object):
@@ -78,7 +120,7 @@ class SAMSender(object):
         self.transport = transport
 
     def sendHello(self):
-        self.transport.write(b'HELLO VERSION MIN=3.0 MAX=3.2\n')
+        self.transport.write(b'HELLO VERSION MIN=3.0 MAX=3.3\n')
 
     def sendNamingLookup(self, name):
         msg = 'NAMING LOOKUP NAME=%s\n' % name
@@ -100,17 +142,22 @@ class SAMSender(object):
 class SAMReceiver(object):
     wrappedProto = None
     currentRule = 'State_hello'
-    pinger = None
     lastPing = ''
-    pingTimeout = None
+    # The round-trip time of the last answered PING, in seconds
+    pingRTT = None
 
     def __init__(self, sender):
         self.sender = sender
+        self.keepalive = getKeepaliveScheduler()
 
     def prepareParsing(self, parser):
+        self.attachParser(parser)
+        self.sender.sendHello()
+
+    def attachParser(self, parser):
         # Store the factory for later use
         self.factory = parser.factory
-        self.sender.sendHello()
+        self.parser = parser
 
     def wrapProto(self, proto, peerAddress, invertTLS=False):
         self.wrappedProto = proto
@@ -128,7 +175,19 @@ class SAMReceiver(object):
     def dataReceived(self, data):
         self.wrappedProto.dataReceived(data)
 
+    def bindDataPath(self):
+        """Deliver all further data straight to the wrapped Protocol.
+
+        Once the stream is established, nothing more needs parsing, so the
+        transport can call the wrapped Protocol's ``dataReceived`` without
+        going through the parser or this receiver.
+        """
+        self.currentRule = 'State_readData'
+        if self.wrappedProto is not None:
+            self.parser.dataReceived = self.wrappedProto.dataReceived
+
     def finishParsing(self, reason):
+        self.stopPinging()
         if self.wrappedProto:
             self.wrappedProto.connectionLost(reason)
         else:
@@ -152,30 +211,31 @@ class SAMReceiver(object):
     def _sendPing(self):
         self.lastPing = str(time.time())
         self.sender.sendPing(self.lastPing)
-        self.pingTimeout = reactor.callLater(KEEPALIVE_TIMEOUT, self.sender.transport.loseConnection)
+        self.keepalive.pingSent(self)
+
+    def _pingTimedOut(self):
+        self.sender.transport.loseConnection()
 
-    def _resetPingTimeout(self):
-        if self.pingTimeout:
-            self.pingTimeout.cancel()
-        self.pinger = reactor.callLater(KEEPALIVE_TIMEOUT, self._sendPing)
+    @property
+    def awaitingPong(self):
+        return self.keepalive.awaitingPong(self)
 
     def ping(self, data):
         self.sender.sendPong(data)
-        self._resetPingTimeout()
+        self.keepalive.reset(self)
 
     def pong(self, data):
         if (data == str(self.lastPing)):
-            self._resetPingTimeout()
+            rtt = self.keepalive.pongReceived(self)
+            if rtt is not None:
+                self.pingRTT = rtt
 
     def startPinging(self):
-        self.pinger = reactor.callLater(KEEPALIVE_TIMEOUT, self._sendPing)
+        self.keepalive.add(self)
         self.currentRule = 'State_keepalive'
 
     def stopPinging(self):
-        if self.pinger and self.pinger.active():
-            self.pinger.cancel()
-        if self.pingTimeout and self.pingTimeout.active():
-            self.pingTimeout.cancel()
+        self.keepalive.remove(self)
 
 class SAMFactory(ClientFactory):
     currentCandidate = None
@@ -204,10 +264,52 @@ class SAMFactory(ClientFactory):
 
 
 class SAMI2PServerTunnelProtocol(I2PServerTunnelProtocol):
+    """A stream forwarded by the SAM bridge with ``STREAM FORWARD``.
+
+    The first line received is the peer's Destination and ports. The wrapped
+    Protocol is only built once it has arrived, so that it is built for, and
+    connected with, the peer's address.
+    """
+
+    def __init__(self, wrappedFactory, serverAddr):
+        I2PServerTunnelProtocol.__init__(self, None, serverAddr)
+        self._wrappedFactory = wrappedFactory
+        self._header = b''
+
+    def connectionMade(self):
+        # Substitute transport for an I2P wrapper
+        self.transport = I2PTunnelTransport(self.transport, self._serverAddr)
+
+    def dataReceived(self, data):
+        self._header += data
+        if b'\n' not in self._header:
+            if len(self._header) > MAX_TUNNEL_LINE:
+                self._header = None
+                self.dataReceived = lambda data: None
+                self.transport.loseConnection()
+            return
+        line, data = self._header.split(b'\n', 1)
+        self._header = None
+        self.setPeer(line)
+        self.wrappedProto = self._wrappedFactory.buildProtocol(self.peer)
+        if self.wrappedProto is None:
+            self.dataReceived = lambda data: None
+            self.transport.loseConnection()
+            return
+        self.wrappedProto.makeConnection(self.transport)
+        # Deliver all further data straight to the wrapped Protocol
+        self.dataReceived = self.wrappedProto.dataReceived
+        if data:
+            self.wrappedProto.dataReceived(data)
+
     def setPeer(self, data):
         self.peer = peerSAM(data)
         self.transport.peerAddr = self.peer
 
+    def connectionLost(self, reason):
+        if self.wrappedProto is not None:
+            self.wrappedProto.connectionLost(reason)
+
 
 @implementer(IProtocolFactory)
 class I2PFactoryWrapper(object):
@@ -218,8 +320,7 @@ class I2PFactoryWrapper(object):
         self.serverAddr = serverAddr
 
     def buildProtocol(self, addr):
-        wrappedProto = self.w.buildProtocol(addr)
-        proto = self.protocol(wrappedProto, self.serverAddr)
+        proto = self.protocol(self.w, self.serverAddr)
         proto.factory = self
         return proto
 
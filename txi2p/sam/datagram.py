@@ -0,0 +1,214 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from collections import namedtuple
+from twisted.internet import defer, error
+from twisted.internet.interfaces import IListeningPort
+from twisted.internet.protocol import DatagramProtocol
+from twisted.python import log
+from zope.interface import implementer
+
+from txi2p.address import I2PAddress
+from txi2p.sam.base import cmpSAM, peerSAM
+
+# The port that the SAM server receives datagrams to send on
+DEFAULT_UDP_PORT = 7655
+# The largest payload that can be sent in a repliable datagram
+MAX_DATAGRAM_SIZE = 31744
+# The largest payload that can be sent in a raw datagram
+MAX_RAW_SIZE = 32768
+# The largest datagram the local UDP socket accepts from the SAM server.
+# Forwarded datagrams carry a header as well as the payload, and anything
+# larger than the socket's buffer is truncated.
+FORWARD_MAX_PACKET_SIZE = 65535
+# The I2CP protocol number that SAM uses for raw datagrams by default
+DEFAULT_RAW_PROTOCOL = 18
+
+
+# Delivered in place of a sender address for raw datagrams. Fields are `None`
+# unless the session was created with HEADER=true on SAM v3.2 or higher.
+RawDatagramInfo = namedtuple('RawDatagramInfo', 'fromPort toPort protocol')
+
+
+class DatagramForwardProtocol(DatagramProtocol):
+    """Owns the local UDP socket used to talk to the SAM server.
+
+    The SAM server forwards incoming datagrams to this socket, and datagrams
+    written to a :class:`SAMI2PDatagramPort` are sent from it. If ``samHost``
+    is set, datagrams from any other address are dropped.
+    """
+    port = None
+    samHost = None
+
+    def datagramReceived(self, data, addr):
+        if self.port is None:
+            return
+        if self.samHost is not None and addr[0] != self.samHost:
+            log.msg('Dropping datagram from %s, which is not the SAM server' % addr[0])
+            return
+        self.port.forwardedDatagramReceived(data)
+
+
+@implementer(IListeningPort)
+class SAMI2PDatagramPort(object):
+    """A datagram transport on a SAM ``DATAGRAM`` session.
+
+    The wrapped protocol's ``datagramReceived`` method is called with the
+    payload and the sender's :class:`txi2p.I2PAddress` for each datagram
+    received, as with :class:`twisted.internet.protocol.DatagramProtocol`.
+
+    Args:
+        session (txi2p.sam.SAMSession): The ``DATAGRAM`` session.
+        forwardProto (DatagramForwardProtocol): The protocol on the local UDP
+            socket that the session forwards datagrams to.
+        protocol: The protocol to deliver datagrams to.
+        samAddress (tuple): The host and port that the SAM server receives
+            datagrams to send on.
+    """
+    maxDatagramSize = MAX_DATAGRAM_SIZE
+
+    def __init__(self, session, forwardProto, protocol, samAddress):
+        self._session = session
+        self._forwardProto = forwardProto
+        self._protocol = protocol
+        self._samAddress = samAddress
+        self._prefix = '3.0 %s ' % session.id
+        self._withPorts = cmpSAM(session.samVersion, '3.2') >= 0
+        self.listening = False
+
+    def startListening(self):
+        self._session.addStream(self)
+        self._forwardProto.port = self
+        self.listening = True
+        self._protocol.makeConnection(self)
+
+    def stopListening(self):
+        if not self.listening:
+            return defer.succeed(None)
+        self.listening = False
+        self._forwardProto.port = None
+        self._protocol.doStop()
+        try:
+            self._session.removeStream(self)
+        except error.ConnectionDone:
+            # The session was already closed
+            pass
+        return defer.maybeDeferred(
+            self._forwardProto.transport.stopListening)
+
+    def getHost(self):
+        return self._session.address
+
+    def write(self, datagram, addr):
+        """Send a datagram.
+
+        Args:
+            datagram (bytes): The payload.
+            addr: The :class:`txi2p.I2PAddress` to send to, or an I2P
+                hostname or Destination. Ports are ignored if the SAM server
+                doesn't support SAM v3.2 or higher.
+
+        Raises:
+            twisted.internet.error.MessageLengthError: if ``datagram`` is
+                larger than ``maxDatagramSize``.
+        """
+        if len(datagram) > self.maxDatagramSize:
+            raise error.MessageLengthError(
+                'Datagram of %d bytes is larger than the maximum of %d' % (
+                    len(datagram), self.maxDatagramSize))
+        self._forwardProto.transport.write(
+            self._header(addr) + datagram, self._samAddress)
+
+    def writeSequence(self, datagrams, addr):
+        """Send several datagrams to the same address.
+
+        The header that the SAM server needs on each datagram is only built
+        once.
+
+        Args:
+            datagrams (list): The payloads.
+            addr: As for :meth:`write`.
+
+        Raises:
+            twisted.internet.error.MessageLengthError: if any datagram is
+                larger than ``maxDatagramSize``. No datagrams are sent.
+        """
+        for datagram in datagrams:
+            if len(datagram) > self.maxDatagramSize:
+                raise error.MessageLengthError(
+                    'Datagram of %d bytes is larger than the maximum of %d' % (
+                        len(datagram), self.maxDatagramSize))
+        header = self._header(addr)
+        write = self._forwardProto.transport.write
+        for datagram in datagrams:
+            write(header + datagram, self._samAddress)
+
+    def _header(self, addr):
+        if isinstance(addr, I2PAddress):
+            dest = addr.destination
+            toPort = addr.port
+        else:
+            dest = addr
+            toPort = None
+        header = self._prefix + dest
+        if self._withPorts:
+            if self._session.address.port:
+                header += ' FROM_PORT=%d' % self._session.address.port
+            if toPort:
+                header += ' TO_PORT=%d' % toPort
+        header += '\n'
+        return header.encode('utf-8')
+
+    def forwardedDatagramReceived(self, data):
+        # The first line is the sender's Destination, and (SAM v3.2+) ports
+        header, sep, payload = data.partition(b'\n')
+        if not sep:
+            log.msg('Dropping malformed datagram from the SAM server')
+            return
+        self._protocol.datagramReceived(payload, peerSAM(header))
+
+
+class SAMI2PRawPort(SAMI2PDatagramPort):
+    """A datagram transport on a SAM ``RAW`` session.
+
+    Raw datagrams are not signed and do not carry the sender's Destination,
+    so they are much smaller and cheaper to send than repliable datagrams,
+    but cannot be replied to. The wrapped protocol's ``datagramReceived``
+    method is called with the payload and a :class:`RawDatagramInfo`.
+
+    Args:
+        session (txi2p.sam.SAMSession): The ``RAW`` session.
+        forwardProto (DatagramForwardProtocol): The protocol on the local UDP
+            socket that the session forwards datagrams to.
+        protocol: The protocol to deliver datagrams to.
+        samAddress (tuple): The host and port that the SAM server receives
+            datagrams to send on.
+        header (bool): `true` if the session was created with ``HEADER=true``,
+            so that forwarded datagrams start with a line of ports and the
+            protocol number.
+    """
+    maxDatagramSize = MAX_RAW_SIZE
+
+    def __init__(self, session, forwardProto, protocol, samAddress,
+                 header=False):
+        SAMI2PDatagramPort.__init__(
+            self, session, forwardProto, protocol, samAddress)
+        # The header is only sent by SAM v3.2 and higher
+        self._hasHeader = header and self._withPorts
+        self._noInfo = RawDatagramInfo(None, None, None)
+
+    def forwardedDatagramReceived(self, data):
+        if not self._hasHeader:
+            self._protocol.datagramReceived(data, self._noInfo)
+            return
+        header, sep, payload = data.partition(b'\n')
+        if not sep:
+            log.msg('Dropping malformed datagram from the SAM server')
+            return
+        options = dict(x.split('=', 1) for x in
+                       header.decode('utf-8').split(' ') if '=' in x)
+        self._protocol.datagramReceived(payload, RawDatagramInfo(
+            int(options.get('FROM_PORT', 0)) or None,
+            int(options.get('TO_PORT', 0)) or None,
+            int(options.get('PROTOCOL', DEFAULT_RAW_PROTOCOL))))
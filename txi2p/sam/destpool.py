@@ -0,0 +1,214 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from collections import deque
+from twisted.internet import defer, error
+from twisted.python import log
+
+from txi2p.sam.base import SAMFactory, makeSAMProtocol
+from txi2p.sam.session import DestGenerateSender, DestGenerateReceiver
+
+DEFAULT_DESTINATION_POOL_SIZE = 4
+
+
+class PooledDestGenerateReceiver(DestGenerateReceiver):
+    def command(self):
+        self.sender.sendDestGenerate(
+            self.factory.samVersion,
+            self.factory.fallbackSigType or self.factory.sigType)
+        self.currentRule = 'State_dest'
+
+    def fallBack(self, sigType):
+        # Don't try the unsupported default again for every keypair
+        self.factory.fellBack(sigType)
+        DestGenerateReceiver.fallBack(self, sigType)
+
+    def destGenerated(self, result=None, pub=None, priv=None, message=None):
+        if result:
+            # Fallbacks and errors
+            DestGenerateReceiver.destGenerated(
+                self, result, pub, priv, message)
+            return
+        if self.factory.keypairGenerated(pub, priv):
+            # Keep generating on the same connection
+            self.command()
+        else:
+            self.sender.transport.loseConnection()
+
+
+# A Protocol that generates Destinations until the pool is full
+PooledDestGenerateProtocol = makeSAMProtocol(
+    DestGenerateSender,
+    PooledDestGenerateReceiver)
+
+
+class PooledDestGenerateFactory(SAMFactory):
+    protocol = PooledDestGenerateProtocol
+
+    def __init__(self, pool, sigType, fallbackSigType=None):
+        self._pool = pool
+        self.sigType = sigType
+        self.fallbackSigType = fallbackSigType
+        self.samVersion = None
+        self.deferred = defer.Deferred(self._cancel)
+
+    def fellBack(self, sigType):
+        self.fallbackSigType = sigType
+        self._pool._fallbacks[self.sigType] = sigType
+
+    def keypairGenerated(self, pubKey, privKey):
+        more = self._pool._generated(self.sigType, pubKey, privKey)
+        if not more:
+            self.deferred.callback(None)
+        return more
+
+
+class DestinationPool(object):
+    """A pool of freshly generated Destinations, ready to be used.
+
+    Generating a Destination takes a round trip to the SAM bridge, and some
+    work by the router. The pool keeps up to ``size`` keypairs of each SigType
+    generated in the background, so that they can be handed out without
+    waiting. Whenever one is taken, the pool is refilled over a single SAM
+    connection per SigType. If the pool is empty, callers wait for the next
+    keypair generated.
+
+    Each keypair is handed out once. Pass the pool to
+    :func:`txi2p.sam.getSession` or :func:`txi2p.sam.generateDestination` to
+    use it. The pool is started by the first :meth:`take` if :meth:`start`
+    was not called, but once stopped it must be started again explicitly.
+
+    Args:
+        samEndpoint (twisted.internet.interfaces.IStreamClientEndpoint): An
+            endpoint that will connect to the SAM API.
+        size (int): The number of keypairs to keep ready per SigType.
+        sigTypes (list): The SigTypes to generate in the background from
+            :meth:`start`. `None` is the default SigType. Other SigTypes are
+            pooled once they are first taken.
+
+    Attributes:
+        hits (int): The number of keypairs handed out without waiting.
+        misses (int): The number of times the pool was empty.
+    """
+
+    def __init__(self, samEndpoint, size=DEFAULT_DESTINATION_POOL_SIZE,
+                 sigTypes=(None,)):
+        self.samEndpoint = samEndpoint
+        self.size = size
+        self.sigTypes = list(sigTypes)
+        self._ready = {}
+        self._waiting = {}
+        self._generators = {}
+        # The fallback found for the default SigType, if it is unsupported
+        self._fallbacks = {}
+        self._started = False
+        self._stopped = False
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return sum(len(ready) for ready in self._ready.values())
+
+    def ready(self, sigType=None):
+        """The number of keypairs of a SigType ready to be taken."""
+        return len(self._ready.get(sigType, ()))
+
+    def start(self):
+        """Fill the pool."""
+        self._started = True
+        self._stopped = False
+        for sigType in self.sigTypes:
+            self._refill(sigType)
+
+    def stop(self):
+        """Stop generating keypairs, and discard those not taken.
+
+        Callers still waiting for a keypair fail with
+        :class:`twisted.internet.error.ConnectionDone`.
+        """
+        self._stopped = True
+        self._ready = {}
+        for fac in list(self._generators.values()):
+            if fac.currentCandidate is not None:
+                fac.currentCandidate.sender.transport.loseConnection()
+        waiting, self._waiting = self._waiting, {}
+        for waiters in waiting.values():
+            for d in waiters:
+                d.errback(error.ConnectionDone())
+
+    def take(self, sigType=None):
+        """Take a keypair from the pool.
+
+        Args:
+            sigType (str): The SigType of the keypair. Defaults to Ed25519 if
+                supported, falling back to ECDSA_SHA256_P256 and then DSA_SHA1.
+
+        Returns:
+            twisted.internet.defer.Deferred: Fires with a ``(pubKey,
+            privKey)`` tuple, or fails with
+            :class:`twisted.internet.error.ConnectionDone` if the pool has
+            been stopped.
+        """
+        if self._stopped:
+            return defer.fail(error.ConnectionDone())
+        if not self._started:
+            self.start()
+        if sigType not in self.sigTypes:
+            self.sigTypes.append(sigType)
+        ready = self._ready.get(sigType)
+        if ready:
+            self.hits += 1
+            keypair = ready.popleft()
+            self._refill(sigType)
+            return defer.succeed(keypair)
+        self.misses += 1
+        def cancel(d):
+            waiters = self._waiting.get(sigType, [])
+            if d in waiters:
+                waiters.remove(d)
+        d = defer.Deferred(cancel)
+        self._waiting.setdefault(sigType, []).append(d)
+        self._refill(sigType)
+        return d
+
+    def _needed(self, sigType):
+        return (self.size - len(self._ready.get(sigType, ())) +
+                len(self._waiting.get(sigType, ())))
+
+    def _refill(self, sigType):
+        if self._stopped or sigType in self._generators or \
+                self._needed(sigType) <= 0:
+            return
+        fac = PooledDestGenerateFactory(
+            self, sigType, self._fallbacks.get(sigType))
+        self._generators[sigType] = fac
+        d = self.samEndpoint.connect(fac)
+        d.addCallback(lambda proto: fac.deferred)
+        d.addCallbacks(self._finished, self._failed,
+                       callbackArgs=(sigType,), errbackArgs=(sigType,))
+
+    def _generated(self, sigType, pubKey, privKey):
+        if self._stopped:
+            return False
+        waiters = self._waiting.get(sigType)
+        if waiters:
+            waiters.pop(0).callback((pubKey, privKey))
+        else:
+            self._ready.setdefault(sigType, deque()).append((pubKey, privKey))
+        return self._needed(sigType) > 0
+
+    def _finished(self, result, sigType):
+        del self._generators[sigType]
+        # Keypairs may have been taken after the generator finished
+        self._refill(sigType)
+
+    def _failed(self, reason, sigType):
+        self._generators.pop(sigType, None)
+        if self._stopped:
+            return
+        # Not retried until the next keypair is taken, so that an
+        # unreachable SAM bridge isn't hammered.
+        log.msg('Could not generate pooled Destinations: %s' % reason.value)
+        for d in self._waiting.pop(sigType, []):
+            d.errback(reason)
@@ -2,19 +2,34 @@
 # See COPYING for details.
 
 from builtins import object
+import itertools
+import os
 from twisted.internet import defer, error, interfaces
 from twisted.internet.endpoints import serverFromString
 from zope.interface import implementer
 
 from txi2p.sam.base import I2PFactoryWrapper
+from txi2p.sam.datagram import (
+    DatagramForwardProtocol,
+    SAMI2PDatagramPort,
+    SAMI2PRawPort,
+    DEFAULT_RAW_PROTOCOL,
+    DEFAULT_UDP_PORT,
+    FORWARD_MAX_PACKET_SIZE,
+)
 from txi2p.sam.session import SAMSession, getSession
 from txi2p.sam.stream import (
     StreamConnectFactory,
     StreamAcceptPort,
     StreamForwardFactory,
     StreamForwardPort,
+    DEFAULT_MIN_ACCEPTS,
+    DEFAULT_MAX_ACCEPTS,
 )
 
+# Numbers the default sessions of datagram endpoints
+_datagramSessionIds = itertools.count(1)
+
 
 def _parseHost(host):
     # TODO: Validate I2P domain, B32 etc.
@@ -38,7 +53,7 @@ class SAMI2PStreamClientEndpoint(object):
     """
 
     @classmethod
-    def new(cls, samEndpoint, host, port=None, nickname=None, autoClose=False, keyfile=None, localPort=None, options=None, sigType=None):
+    def new(cls, samEndpoint, host, port=None, nickname=None, autoClose=False, keyfile=None, localPort=None, options=None, sigType=None, poolSize=0):
         """Create an I2P client endpoint backed by the SAM API.
 
         If a SAM session for ``nickname`` already exists, it will be used, and
@@ -68,10 +83,14 @@ class SAMI2PStreamClientEndpoint(object):
             sigType (str): The SigType to use if generating a new Destination.
                 Defaults to Ed25519 if supported, falling back to
                 ECDSA_SHA256_P256 and then DSA_SHA1.
+            poolSize (int): The number of idle SAM connections the session
+                should keep ready for opening streams. If 0, connections are
+                not pooled.
         """
         d = getSession(nickname,
                        samEndpoint=samEndpoint,
                        autoClose=autoClose,
+                       poolSize=poolSize,
                        keyfile=keyfile,
                        options=options,
                        sigType=sigType)
@@ -101,7 +120,22 @@ class SAMI2PStreamClientEndpoint(object):
             if self._session.style != 'STREAM':
                 raise error.UnsupportedSocketType()
 
-            i2pFac = StreamConnectFactory(fac, self._session, self._host, self._dest, self._port, self._localPort)
+            dest = self._dest
+            if not dest:
+                try:
+                    dest = self._session.namingCache.get(self._host)
+                except KeyError:
+                    pass
+                else:
+                    if dest is None:
+                        return defer.fail(error.UnknownHostError(
+                            string='%s not found' % self._host))
+
+            i2pFac = StreamConnectFactory(fac, self._session, self._host, dest, self._port, self._localPort)
+            pool = self._session.connectionPool
+            if pool and pool.take(i2pFac):
+                # Already connected and past HELLO
+                return i2pFac.deferred
             d = self._session.samEndpoint.connect(i2pFac)
             # Once the SAM IProtocol is returned, wait for the
             # real IProtocol to be returned after tunnel creation,
@@ -126,10 +160,22 @@ class SAMI2PStreamServerEndpoint(object):
 
     Args:
         session (txi2p.sam.SAMSession): The SAM session to listen on.
+        minAccepts (int): The minimum number of concurrent ``STREAM ACCEPT`` s
+            to keep open. Ignored if the SAM server doesn't support SAM v3.2
+            or higher.
+        maxAccepts (int): The maximum number of concurrent ``STREAM ACCEPT`` s
+            to keep open during bursts of incoming streams. Ignored if the SAM
+            server doesn't support SAM v3.2 or higher.
+        forward (bool): `true` to have the SAM server forward incoming streams
+            to a local TCP port with ``STREAM FORWARD``, instead of requesting
+            each one with ``STREAM ACCEPT``. The SAM server must be able to
+            connect to this host on ``127.0.0.1``.
+        reactor: The reactor to listen for forwarded streams with. Defaults
+            to the global reactor.
     """
 
     @classmethod
-    def new(cls, samEndpoint, keyfile, port=None, nickname=None, autoClose=False, options=None, sigType=None):
+    def new(cls, samEndpoint, keyfile, port=None, nickname=None, autoClose=False, options=None, sigType=None, minAccepts=DEFAULT_MIN_ACCEPTS, maxAccepts=DEFAULT_MAX_ACCEPTS, forward=False, reactor=None):
         """Create an I2P server endpoint backed by the SAM API.
 
         If a SAM session for ``nickname`` already exists, it will be used, and
@@ -154,6 +200,13 @@ class SAMI2PStreamServerEndpoint(object):
             sigType (str): The SigType to use if generating a new Destination.
                 Defaults to Ed25519 if supported, falling back to
                 ECDSA_SHA256_P256 and then DSA_SHA1.
+            minAccepts (int): The minimum number of concurrent
+                ``STREAM ACCEPT`` s to keep open.
+            maxAccepts (int): The maximum number of concurrent
+                ``STREAM ACCEPT`` s to keep open.
+            forward (bool): `true` to have incoming streams forwarded to a
+                local TCP port instead of accepting each one.
+            reactor: The reactor to listen for forwarded streams with.
         """
         d = getSession(nickname,
                        samEndpoint=samEndpoint,
@@ -162,9 +215,16 @@ class SAMI2PStreamServerEndpoint(object):
                        localPort=port,
                        options=options,
                        sigType=sigType)
-        return cls(d)
-
-    def __init__(self, session):
+        return cls(d, minAccepts, maxAccepts, forward, reactor)
+
+    def __init__(self, session, minAccepts=DEFAULT_MIN_ACCEPTS,
+                 maxAccepts=DEFAULT_MAX_ACCEPTS, forward=False, reactor=None):
+        self._minAccepts = minAccepts
+        self._maxAccepts = maxAccepts
+        self._forward = forward
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
         if isinstance(session, SAMSession):
             self._session = session
         else:
@@ -185,40 +245,221 @@ class SAMI2PStreamServerEndpoint(object):
             if self._session.style != 'STREAM':
                 raise error.UnsupportedSocketType()
 
-            p = StreamAcceptPort(self._session, fac)
+            p = StreamAcceptPort(self._session, fac,
+                                 self._minAccepts, self._maxAccepts)
             p.startListening()
             return p
 
-#        def createForwardingStream(val):
-#            if self._session.style != 'STREAM':
-#                raise error.UnsupportedSocketType()
-#
-#            serverEndpoint = serverFromString(self._reactor,
-#                                              'tcp:0:interface=127.0.0.1')
-#            wrappedFactory = I2PFactoryWrapper(fac, self._session.address)
-#            d = serverEndpoint.listen(wrappedFactory)
-#
-#            def setupForward(port):
-#                local_port = port.getHost().port
-#                i2pFac = StreamForwardFactory(self._session, local_port)
-#                d2 = self._session.samEndpoint.connect(i2pFac)
-#                d2.addCallback(lambda proto: i2pFac.deferred)
-#                d2.addCallback(lambda forwardingProto: (port, forwardingProto))
-#                return d2
-#
-#            def handlePort((port, forwardingProto)):
-#                return StreamForwardPort(port, forwardingProto, self._session.address)
-#
-#            d.addCallback(setupForward)
-#            d.addCallback(handlePort)
-#            return d
+        def createForwardingStream(val):
+            if self._session.style != 'STREAM':
+                raise error.UnsupportedSocketType()
+
+            serverEndpoint = serverFromString(self._reactor,
+                                              'tcp:0:interface=127.0.0.1')
+            wrappedFactory = I2PFactoryWrapper(fac, self._session.address)
+            d = serverEndpoint.listen(wrappedFactory)
+
+            def setupForward(port):
+                local_port = port.getHost().port
+                i2pFac = StreamForwardFactory(self._session, local_port)
+                d2 = self._session.samEndpoint.connect(i2pFac)
+                d2.addCallback(lambda proto: i2pFac.deferred)
+                d2.addCallback(lambda forwardingProto: (port, forwardingProto))
+
+                def stopLocalPort(f):
+                    port.stopListening()
+                    return f
+                d2.addErrback(stopLocalPort)
+                return d2
+
+            def handlePort(result):
+                port, forwardingProto = result
+                return StreamForwardPort(port, forwardingProto, self._session.address)
+
+            d.addCallback(setupForward)
+            d.addCallback(handlePort)
+            return d
+
+        if self._forward:
+            createStream = createForwardingStream
+        else:
+            createStream = createAcceptingStream
 
         if self._session:
-            return createAcceptingStream(None)
+            return createStream(None)
 
         def saveSession(session):
             self._session = session
             return None
         self._sessionDeferred.addCallback(saveSession)
-        self._sessionDeferred.addCallback(createAcceptingStream)
+        self._sessionDeferred.addCallback(createStream)
         return self._sessionDeferred
+
+
+class SAMI2PDatagramEndpoint(object):
+    """I2P datagram endpoint backed by the SAM API.
+
+    Datagrams are exchanged with the SAM server over UDP: incoming datagrams
+    are forwarded by the SAM server to a local port, and outgoing datagrams
+    are sent to the SAM server's UDP port. Unless ``nickname`` is given, each
+    endpoint uses its own ``DATAGRAM`` session, which cannot be shared with
+    stream endpoints. Listening again after the port stops listening reuses
+    the same local UDP port, so that an open session still forwards to it.
+
+    Args:
+        samEndpoint (twisted.internet.interfaces.IStreamClientEndpoint): An
+            endpoint that will connect to the SAM API.
+        keyfile (str): Path to a local file containing the keypair to use for
+            the session Destination. If unset or `None`, a transient
+            Destination is used. If non-existent, new keys will be generated
+            and stored.
+        port (int): The port to send and receive on inside I2P. If unset or
+            `None`, the default (null) port is used. Ignored if the SAM server
+            doesn't support SAM v3.2 or higher.
+        nickname (str): The SAM session nickname. Endpoints given the same
+            nickname share a session, so only one of them can listen at once.
+        autoClose (bool): `true` if the session should close automatically
+            once the port stops listening.
+        options (dict): I2CP options to configure the session with.
+        sigType (str): The SigType to use if generating a new Destination.
+            Defaults to Ed25519 if supported, falling back to
+            ECDSA_SHA256_P256 and then DSA_SHA1.
+        samUDPPort (int): The UDP port that the SAM server receives datagrams
+            to send on.
+        forwardHost (str): The local address that the SAM server should
+            forward incoming datagrams to.
+        reactor: The reactor to listen for forwarded datagrams with. Defaults
+            to the global reactor.
+        primary (txi2p.sam.SAMSession): A ``PRIMARY`` session to add the
+            session to as a subsession, sharing its Destination and tunnels.
+            ``keyfile``, ``options`` and ``sigType`` are then ignored.
+        checkSender (bool): `true` to drop forwarded datagrams that do not
+            come from the address the SAM API connection is to. Only enable
+            this if the SAM server sends datagrams from that same address.
+    """
+    style = 'DATAGRAM'
+
+    def __init__(self, samEndpoint, keyfile=None, port=None, nickname=None,
+                 autoClose=False, options=None, sigType=None,
+                 samUDPPort=DEFAULT_UDP_PORT, forwardHost='127.0.0.1',
+                 reactor=None, primary=None, checkSender=False):
+        self._samEndpoint = samEndpoint
+        self._keyfile = keyfile
+        self._port = port
+        if not nickname:
+            # Kept apart from the default session of stream endpoints
+            nickname = 'txi2p-%d-%s-%d' % (
+                os.getpid(), self.style.lower(), next(_datagramSessionIds))
+        self._nickname = nickname
+        self._autoClose = autoClose
+        self._options = options
+        self._sigType = sigType
+        self._samUDPPort = samUDPPort
+        self._forwardHost = forwardHost
+        # Bound on the first listen, and then reused
+        self._forwardPort = 0
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._primary = primary
+        self._checkSender = checkSender
+
+    def listen(self, protocol):
+        """Listen for datagrams over I2P.
+
+        The provided protocol will have its ``makeConnection`` method called
+        with a :class:`txi2p.sam.datagram.SAMI2PDatagramPort` once the session
+        has been created, and ``datagramReceived`` called for each datagram.
+
+        Returns:
+            A Deferred that fires with the
+            :class:`txi2p.sam.datagram.SAMI2PDatagramPort`.
+        """
+        forwardProto = DatagramForwardProtocol()
+        udpPort = self._reactor.listenUDP(
+            self._forwardPort, forwardProto, interface=self._forwardHost,
+            maxPacketSize=FORWARD_MAX_PACKET_SIZE)
+        forwardPort = self._forwardPort = udpPort.getHost().port
+
+        def createPort(session):
+            if session.style != self.style:
+                raise error.UnsupportedSocketType()
+            if session.forwardPort != forwardPort:
+                raise error.CannotListenError(
+                    self._forwardHost, forwardPort,
+                    'Session %s forwards datagrams elsewhere' % self._nickname)
+
+            if self._checkSender:
+                forwardProto.samHost = session.samHost
+            p = self._makePort(session, forwardProto, protocol,
+                               (session.samHost, self._samUDPPort))
+            p.startListening()
+            return p
+
+        def stopLocalPort(f):
+            udpPort.stopListening()
+            return f
+
+        d = defer.maybeDeferred(getSession, self._nickname,
+                                samEndpoint=self._samEndpoint,
+                                autoClose=self._autoClose,
+                                keyfile=self._keyfile,
+                                localPort=self._port,
+                                options=self._sessionOptions(),
+                                sigType=self._sigType,
+                                style=self.style,
+                                forwardPort=forwardPort,
+                                forwardHost=self._forwardHost,
+                                primary=self._primary)
+        d.addCallback(createPort)
+        d.addErrback(stopLocalPort)
+        return d
+
+    def _sessionOptions(self):
+        return self._options
+
+    def _makePort(self, session, forwardProto, protocol, samAddress):
+        return SAMI2PDatagramPort(session, forwardProto, protocol, samAddress)
+
+
+class SAMI2PRawEndpoint(SAMI2PDatagramEndpoint):
+    """I2P raw datagram endpoint backed by the SAM API.
+
+    Raw datagrams are unsigned and anonymous, so they have far less overhead
+    than repliable datagrams, but the receiver cannot tell who sent them.
+    The protocol's ``datagramReceived`` method is called with the payload and
+    a :class:`txi2p.sam.datagram.RawDatagramInfo`.
+
+    Takes the same arguments as :class:`SAMI2PDatagramEndpoint`, and:
+
+    Args:
+        rawProtocol (int): The I2CP protocol number to send and receive raw
+            datagrams with.
+        header (bool): `true` to have the SAM server report the ports and
+            protocol number of each received datagram. Ignored if the SAM
+            server doesn't support SAM v3.2 or higher.
+    """
+    style = 'RAW'
+
+    def __init__(self, samEndpoint, keyfile=None, port=None, nickname=None,
+                 autoClose=False, options=None, sigType=None,
+                 samUDPPort=DEFAULT_UDP_PORT, forwardHost='127.0.0.1',
+                 reactor=None, primary=None, rawProtocol=DEFAULT_RAW_PROTOCOL,
+                 header=False, checkSender=False):
+        SAMI2PDatagramEndpoint.__init__(
+            self, samEndpoint, keyfile, port, nickname, autoClose, options,
+            sigType, samUDPPort, forwardHost, reactor, primary, checkSender)
+        self._rawProtocol = rawProtocol
+        self._header = header
+
+    def _sessionOptions(self):
+        options = dict(self._options or {})
+        if self._rawProtocol != DEFAULT_RAW_PROTOCOL:
+            options['PROTOCOL'] = self._rawProtocol
+        if self._header:
+            options['HEADER'] = 'true'
+        return options
+
+    def _makePort(self, session, forwardProto, protocol, samAddress):
+        return SAMI2PRawPort(session, forwardProto, protocol, samAddress,
+                             self._header)
@@ -0,0 +1,148 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from builtins import range
+from twisted.internet import reactor
+
+# Seconds of silence after which a PING is sent
+DEFAULT_INTERVAL = 2 * 60
+# Seconds to wait for the PONG before closing the connection
+DEFAULT_TIMEOUT = 2 * 60
+# Granularity of the scheduler, in seconds
+DEFAULT_TICK = 5
+
+
+class KeepaliveScheduler(object):
+    """Sends keepalive PINGs for many SAM connections from one timer.
+
+    Connections are kept in a timer wheel: a ring of slots, one per ``tick``
+    seconds, each holding the connections with something due in it. A single
+    timer advances the wheel one slot per tick, sending PINGs for all
+    connections due in that slot and closing those whose PONG has not arrived
+    in time. Rescheduling a connection moves it between slots, so activity on
+    a connection costs no timers at all, and the timer only runs while there
+    are connections to keep alive.
+
+    Deadlines are only kept to within ``tick`` seconds.
+
+    A connection is any object with ``_sendPing()`` and ``_pingTimedOut()``
+    methods, where ``_sendPing()`` calls :meth:`pingSent`;
+    :class:`txi2p.sam.base.SAMReceiver` provides these.
+
+    Args:
+        interval (int): Seconds of silence after which a PING is sent.
+        timeout (int): Seconds to wait for the PONG.
+        tick (int): Granularity of the scheduler, in seconds.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, timeout=DEFAULT_TIMEOUT,
+                 tick=DEFAULT_TICK, clock=None):
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        self._clock = clock or reactor
+        self._intervalTicks = -(-interval // tick)
+        self._timeoutTicks = -(-timeout // tick)
+        self._slots = [set() for i in range(
+            max(self._intervalTicks, self._timeoutTicks) + 1)]
+        self._current = 0
+        # conn -> (slot, time the PING was sent or None)
+        self._entries = {}
+        self._timer = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, conn):
+        return conn in self._entries
+
+    def add(self, conn):
+        """Start keeping a connection alive.
+
+        A PING will be sent after ``interval`` seconds unless :meth:`reset`
+        is called first.
+        """
+        self._schedule(conn, self._intervalTicks, None)
+
+    def remove(self, conn):
+        """Stop keeping a connection alive."""
+        entry = self._entries.pop(conn, None)
+        if entry is not None:
+            self._slots[entry[0]].discard(conn)
+            if not self._entries:
+                self._stop()
+
+    def reset(self, conn):
+        """Note activity on a connection, deferring its next PING.
+
+        Connections that are not being kept alive are ignored.
+        """
+        if conn in self._entries:
+            self._schedule(conn, self._intervalTicks, None)
+
+    def pingSent(self, conn):
+        """Start waiting for the PONG to a PING sent on a connection."""
+        self._schedule(conn, self._timeoutTicks, self._clock.seconds())
+
+    def pongReceived(self, conn):
+        """Note that the PONG arrived on a connection.
+
+        Returns:
+            float: The round-trip time of the PING, in seconds, or ``None`` if
+            no PING was outstanding.
+        """
+        entry = self._entries.get(conn)
+        if entry is None:
+            return None
+        self._schedule(conn, self._intervalTicks, None)
+        if entry[1] is None:
+            return None
+        return self._clock.seconds() - entry[1]
+
+    def awaitingPong(self, conn):
+        """Whether a PING has been sent on a connection without a PONG."""
+        entry = self._entries.get(conn)
+        return entry is not None and entry[1] is not None
+
+    def _schedule(self, conn, ticks, sentAt):
+        entry = self._entries.get(conn)
+        if entry is not None:
+            self._slots[entry[0]].discard(conn)
+        slot = (self._current + ticks) % len(self._slots)
+        self._slots[slot].add(conn)
+        self._entries[conn] = (slot, sentAt)
+        if self._timer is None:
+            self._timer = self._clock.callLater(self.tick, self._advance)
+
+    def _stop(self):
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+
+    def _advance(self):
+        self._timer = None
+        self._current = (self._current + 1) % len(self._slots)
+        due = self._slots[self._current]
+        self._slots[self._current] = set()
+        for conn in due:
+            sentAt = self._entries.pop(conn)[1]
+            if sentAt is None:
+                # The connection calls pingSent() to be scheduled again
+                conn._sendPing()
+            else:
+                conn._pingTimedOut()
+        if self._entries and self._timer is None:
+            self._timer = self._clock.callLater(self.tick, self._advance)
+
+
+_scheduler = None
+
+
+def getKeepaliveScheduler():
+    """Get the keepalive scheduler shared by all SAM connections."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = KeepaliveScheduler()
+    return _scheduler
@@ -0,0 +1,269 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from collections import OrderedDict, deque
+from twisted.internet import defer, reactor
+from twisted.internet.error import ConnectionDone, UnknownHostError
+from twisted.python import log
+
+from txi2p.sam import constants as c
+from txi2p.sam.base import (
+    makeSAMProtocol,
+    SAMSender,
+    SAMReceiver,
+    SAMFactory,
+)
+
+DEFAULT_MAX_SIZE = 256
+DEFAULT_TTL = 10 * 60
+DEFAULT_NEGATIVE_TTL = 60
+
+
+class NamingCache(object):
+    """A bounded cache of ``NAMING LOOKUP`` results.
+
+    Entries expire after ``ttl`` seconds, or ``negativeTTL`` seconds for names
+    that were not found. Once ``maxSize`` entries are cached, the least
+    recently used entry is evicted.
+
+    Attributes:
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups not answered from the cache.
+    """
+
+    def __init__(self, maxSize=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL,
+                 negativeTTL=DEFAULT_NEGATIVE_TTL, clock=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.negativeTTL = negativeTTL
+        self._clock = clock or reactor
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name):
+        """Look up a name in the cache.
+
+        Returns:
+            str: The cached Destination, or ``None`` if the name is cached as
+            not found.
+
+        Raises:
+            KeyError: if the name is not cached.
+        """
+        try:
+            expires, dest = self._entries.pop(name)
+        except KeyError:
+            self.misses += 1
+            raise
+        if expires <= self._clock.seconds():
+            self.misses += 1
+            raise KeyError(name)
+        # Re-insert to mark as most recently used
+        self._entries[name] = (expires, dest)
+        self.hits += 1
+        return dest
+
+    def put(self, name, dest):
+        """Cache the Destination a name resolved to."""
+        self._put(name, dest, self.ttl)
+
+    def putNotFound(self, name):
+        """Cache that a name was not found."""
+        self._put(name, None, self.negativeTTL)
+
+    def _put(self, name, dest, ttl):
+        if ttl <= 0 or self.maxSize <= 0:
+            return
+        self._entries.pop(name, None)
+        self._entries[name] = (self._clock.seconds() + ttl, dest)
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all cached entries."""
+        self._entries.clear()
+
+
+class NamingLookupReceiver(SAMReceiver):
+    def command(self):
+        self.currentRule = 'State_naming'
+        self.factory.connectionReady(self)
+
+    def lookupReply(self, result, name=None, value=None, message=None):
+        self.factory.lookupReplied(result, name, value, message)
+
+    def finishParsing(self, reason):
+        self.factory.connectionFailed(reason)
+
+
+# A Protocol that sends NAMING LOOKUPs for as long as it is connected
+NamingLookupProtocol = makeSAMProtocol(
+    SAMSender,
+    NamingLookupReceiver)
+
+
+class NamingLookupFactory(SAMFactory):
+    protocol = NamingLookupProtocol
+
+    def __init__(self, resolver):
+        self._resolver = resolver
+        self.samVersion = None
+        self.deferred = defer.Deferred(self._cancel)
+
+    def connectionReady(self, receiver):
+        self.deferred.callback(receiver)
+
+    def lookupReplied(self, result, name, value, message):
+        self._resolver._lookupReplied(result, name, value, message)
+
+    def connectionFailed(self, reason):
+        if self.deferred.called:
+            self._resolver._connectionLost(reason)
+        else:
+            SAMFactory.connectionFailed(self, reason)
+
+
+class NamingResolver(object):
+    """Resolves I2P hostnames over one persistent SAM connection.
+
+    The connection is opened on the first lookup, and kept open until
+    :meth:`close` is called. Lookups are pipelined: each ``NAMING LOOKUP`` is
+    sent as soon as it is requested, without waiting for earlier replies, and
+    the SAM server answers them in order. Concurrent lookups of the same name
+    share one request.
+
+    Args:
+        samEndpoint (twisted.internet.interfaces.IStreamClientEndpoint): An
+            endpoint that will connect to the SAM API.
+        namingCache (NamingCache): A cache to answer lookups from, and to
+            store results in. If `None`, results are not cached.
+    """
+
+    def __init__(self, samEndpoint, namingCache=None):
+        self.samEndpoint = samEndpoint
+        self.namingCache = namingCache
+        self._receiver = None
+        self._connecting = None
+        # Names waiting to be sent, before the connection is ready
+        self._unsent = []
+        # Names sent, in the order their replies will arrive
+        self._sent = deque()
+        # Deferreds waiting on each outstanding name
+        self._waiting = {}
+
+    def lookup(self, name):
+        """Look up an I2P hostname.
+
+        Returns:
+            A Deferred that fires with the Destination ``name`` resolves to,
+            or errbacks with
+            :class:`twisted.internet.error.UnknownHostError` if it was not
+            found.
+        """
+        if self.namingCache is not None:
+            try:
+                dest = self.namingCache.get(name)
+            except KeyError:
+                pass
+            else:
+                if dest is None:
+                    return defer.fail(UnknownHostError(
+                        string='%s not found' % name))
+                return defer.succeed(dest)
+
+        d = defer.Deferred()
+        if name in self._waiting:
+            self._waiting[name].append(d)
+            return d
+        self._waiting[name] = [d]
+        if self._receiver:
+            self._send(name)
+        else:
+            self._unsent.append(name)
+            self._connect()
+        return d
+
+    def lookupMany(self, names):
+        """Look up several I2P hostnames at once.
+
+        All lookups are sent back to back on the same connection.
+
+        Returns:
+            A Deferred that fires with a dict mapping each name to the
+            Destination it resolves to, or ``None`` if it was not found.
+        """
+        names = list(names)
+
+        def notFound(f):
+            f.trap(UnknownHostError)
+            return None
+
+        ds = [self.lookup(name).addErrback(notFound) for name in names]
+        d = defer.gatherResults(ds, consumeErrors=True)
+        d.addCallback(lambda dests: dict(zip(names, dests)))
+        d.addErrback(lambda f: f.value.subFailure)
+        return d
+
+    def close(self):
+        """Close the connection. Outstanding lookups fail."""
+        if self._receiver:
+            self._receiver.sender.transport.loseConnection()
+        elif self._connecting:
+            self._connecting.cancel()
+
+    def _send(self, name):
+        self._sent.append(name)
+        self._receiver.sender.sendNamingLookup(name)
+
+    def _connect(self):
+        if self._connecting:
+            return
+        fac = NamingLookupFactory(self)
+        d = self.samEndpoint.connect(fac)
+        d.addCallback(lambda proto: fac.deferred)
+        self._connecting = d
+        d.addCallbacks(self._connected, self._connectionLost)
+
+    def _connected(self, receiver):
+        self._connecting = None
+        self._receiver = receiver
+        unsent, self._unsent = self._unsent, []
+        for name in unsent:
+            self._send(name)
+
+    def _lookupReplied(self, result, name, value, message):
+        if not self._sent:
+            log.msg('Unexpected NAMING REPLY for %s' % name)
+            return
+        sentName = self._sent.popleft()
+        waiting = self._waiting.pop(sentName, [])
+        cache = self.namingCache
+        if result == c.RESULT_OK:
+            if cache is not None:
+                cache.put(sentName, value)
+            for d in waiting:
+                d.callback(value)
+            return
+        if result == c.RESULT_KEY_NOT_FOUND and cache is not None:
+            cache.putNotFound(sentName)
+        error = c.samErrorMap.get(result, UnknownHostError)
+        for d in waiting:
+            d.errback(error(string=(message if message else
+                                    '%s: %s' % (sentName, result))))
+
+    def _connectionLost(self, reason):
+        self._connecting = None
+        self._receiver = None
+        self._unsent = []
+        self._sent.clear()
+        waiting, self._waiting = self._waiting, {}
+        if reason.check(defer.CancelledError):
+            reason = ConnectionDone()
+        for ds in waiting.values():
+            for d in ds:
+                d.errback(reason)
@@ -0,0 +1,149 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+
+
+# Reply prefix and receiver method for each parser state, matching the
+# State_* rules in txi2p.grammar.samGrammarSource.
+_REPLIES = {
+    'State_hello':   ('HELLO REPLY ',    'hello'),
+    'State_create':  ('SESSION STATUS ', 'create'),
+    'State_connect': ('STREAM STATUS ',  'connect'),
+    'State_accept':  ('STREAM STATUS ',  'accept'),
+    'State_forward': ('STREAM STATUS ',  'forward'),
+    'State_naming':  ('NAMING REPLY ',   'lookupReply'),
+    'State_dest':    ('DEST REPLY ',     'destGenerated'),
+}
+
+# The longest reply line that is buffered while waiting for its newline.
+# The longest real replies carry a private key, well under this.
+MAX_REPLY_LINE = 16384
+
+
+class SAMParseError(ValueError):
+    pass
+
+
+def parseOptions(s):
+    """Parse the ``KEY=VALUE`` options of a SAM reply.
+
+    Keys are lowercased, and values may be double-quoted, exactly as for the
+    ``OPTIONS`` rule of the SAM grammar.
+
+    Args:
+        s (str): The reply line after its prefix, without the trailing newline.
+
+    Returns:
+        dict: The options.
+
+    Raises:
+        SAMParseError: if ``s`` is not a valid option list.
+    """
+    options = {}
+    if not s:
+        return options
+    pos = 0
+    end = len(s)
+    while True:
+        eq = s.find('=', pos)
+        if eq < 0:
+            raise SAMParseError('Option without value: %r' % s[pos:])
+        key = s[pos:eq].lower()
+        pos = eq + 1
+        close = s.find('"', pos + 1) if s.startswith('"', pos) else -1
+        if close >= 0:
+            value = s[pos + 1:close]
+            pos = close + 1
+        else:
+            space = s.find(' ', pos)
+            if space < 0:
+                space = end
+            value = s[pos:space]
+            pos = space
+        options[key] = value
+        if pos == end:
+            return options
+        if s[pos] != ' ':
+            raise SAMParseError('Unexpected data after option: %r' % s[pos:])
+        pos += 1
+
+
+def parseKeepaliveData(s):
+    """Parse the optional data following ``PING`` or ``PONG``.
+
+    Returns:
+        str: The data, or ``None`` if there was none.
+
+    Raises:
+        SAMParseError: if ``s`` is not valid keepalive data.
+    """
+    if not s:
+        return None
+    data = s.lstrip(' ')
+    if not s.startswith(' ') or not data:
+        raise SAMParseError('Invalid keepalive data: %r' % s)
+    return data
+
+
+class SAMReplyParser(object):
+    """A line-oriented parser for SAM control replies.
+
+    This is a fast path for the ``State_*`` rules of the SAM grammar; it has
+    the same interface as :class:`ometa.tube.TrampolinedParser`, but works on
+    ``bytes`` and dispatches whole lines to the receiver.
+    """
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self._buffer = b''
+
+    def _setupInterp(self):
+        # The current rule is read for every line, so there is no
+        # interpreter state to reset.
+        pass
+
+    def receive(self, data):
+        if self._buffer:
+            data = self._buffer + data
+            self._buffer = b''
+        receiver = self.receiver
+        # Walk the data by offset, as pipelined replies can arrive together
+        # and slicing off each line would copy the rest every time.
+        pos = 0
+        end = len(data)
+        while pos < end:
+            rule = receiver.currentRule
+            if rule == 'State_readData':
+                receiver.dataReceived(data[pos:] if pos else data)
+                return
+            i = data.find(b'\n', pos)
+            if i < 0:
+                if end - pos > MAX_REPLY_LINE:
+                    raise SAMParseError('Reply line too long')
+                self._buffer = data[pos:]
+                return
+            line = data[pos:i].decode('utf-8')
+            pos = i + 1
+            self.dispatch(rule, line)
+
+    def dispatch(self, rule, line):
+        receiver = self.receiver
+        if rule == 'State_keepalive' or rule == 'State_primary':
+            if line.startswith('PING'):
+                receiver.ping(parseKeepaliveData(line[4:]))
+            elif line.startswith('PONG'):
+                receiver.pong(parseKeepaliveData(line[4:]))
+            elif rule == 'State_primary' and line.startswith('SESSION STATUS '):
+                # Reply to SESSION ADD or SESSION REMOVE
+                receiver.sessionStatus(**parseOptions(line[15:]))
+            else:
+                raise SAMParseError('Expected PING or PONG: %r' % line)
+            return
+        try:
+            prefix, method = _REPLIES[rule]
+        except KeyError:
+            raise SAMParseError('Unknown rule %s' % rule)
+        if not line.startswith(prefix):
+            raise SAMParseError('Expected %r: %r' % (prefix, line))
+        getattr(receiver, method)(**parseOptions(line[len(prefix):]))
@@ -0,0 +1,157 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from builtins import range
+from collections import OrderedDict
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from txi2p.sam.base import (
+    makeSAMProtocol,
+    SAMSender,
+    SAMReceiver,
+    SAMFactory,
+)
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_IDLE_TIMEOUT = 30
+
+
+class PooledConnectionReceiver(SAMReceiver):
+    def command(self):
+        # Park the connection until it is handed over
+        self.factory.connectionReady(self.parser)
+
+    def finishParsing(self, reason):
+        self.factory.connectionFailed(reason)
+
+
+# A Protocol that completes HELLO and then waits to be handed over
+PooledConnectionProtocol = makeSAMProtocol(
+    SAMSender,
+    PooledConnectionReceiver)
+
+
+class PooledConnectionFactory(SAMFactory):
+    protocol = PooledConnectionProtocol
+
+    def __init__(self, pool):
+        self._pool = pool
+        self.samVersion = None
+        self.deferred = defer.Deferred(self._cancel)
+
+    def connectionReady(self, proto):
+        self.deferred.callback(proto)
+
+    def connectionFailed(self, reason):
+        if self.deferred.called:
+            # An idle connection was closed by the SAM bridge
+            self._pool._connectionLost(self.currentCandidate)
+        else:
+            SAMFactory.connectionFailed(self, reason)
+
+
+class ControlConnectionPool(object):
+    """A pool of idle SAM connections that have completed the HELLO exchange.
+
+    Taking a connection from the pool saves opening a new connection to the
+    SAM bridge, and the HELLO round trip. The pool is refilled in the
+    background whenever a connection is taken. Idle connections are closed
+    after ``idleTimeout`` seconds, and are not replaced until there is demand
+    for them again.
+
+    Args:
+        samEndpoint (twisted.internet.interfaces.IStreamClientEndpoint): An
+            endpoint that will connect to the SAM API.
+        size (int): The number of idle connections to keep ready.
+        idleTimeout (int): Seconds after which an idle connection is closed.
+
+    Attributes:
+        hits (int): The number of connections taken from the pool.
+        misses (int): The number of times the pool was empty.
+    """
+
+    def __init__(self, samEndpoint, size=DEFAULT_POOL_SIZE,
+                 idleTimeout=DEFAULT_IDLE_TIMEOUT, clock=None):
+        self.samEndpoint = samEndpoint
+        self.size = size
+        self.idleTimeout = idleTimeout
+        self._clock = clock or reactor
+        self._idle = OrderedDict()
+        self._pending = 0
+        self._stopped = False
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._idle)
+
+    def start(self):
+        """Fill the pool."""
+        self._stopped = False
+        self._refill()
+
+    def stop(self):
+        """Close all idle connections, and stop refilling the pool."""
+        self._stopped = True
+        while self._idle:
+            proto, expiry = self._idle.popitem(last=False)
+            expiry.cancel()
+            proto.transport.loseConnection()
+
+    def take(self, factory):
+        """Hand an idle connection over to ``factory``.
+
+        Args:
+            factory (txi2p.sam.base.SAMFactory): The factory whose protocol
+                should continue on the connection, as if it had made the
+                connection itself.
+
+        Returns:
+            The connection's protocol, or ``None`` if the pool was empty.
+        """
+        if not self._idle:
+            self.misses += 1
+            self._refill()
+            return None
+        proto, expiry = self._idle.popitem(last=False)
+        expiry.cancel()
+        self.hits += 1
+        self._refill()
+        proto.handOver(factory)
+        return proto
+
+    def _refill(self):
+        if self._stopped:
+            return
+        # Counted up front, as connection attempts may fail synchronously
+        for i in range(self.size - len(self._idle) - self._pending):
+            self._pending += 1
+            fac = PooledConnectionFactory(self)
+            d = self.samEndpoint.connect(fac)
+            d.addCallback(lambda proto, fac=fac: fac.deferred)
+            d.addCallbacks(self._connected, self._failed)
+
+    def _connected(self, proto):
+        self._pending -= 1
+        if self._stopped:
+            proto.transport.loseConnection()
+            return
+        self._idle[proto] = self._clock.callLater(
+            self.idleTimeout, self._expire, proto)
+
+    def _failed(self, reason):
+        self._pending -= 1
+        # Not retried until the next connection is taken, so that an
+        # unreachable SAM bridge isn't hammered.
+        log.msg('Could not open a pooled SAM connection: %s' % reason.value)
+
+    def _expire(self, proto):
+        del self._idle[proto]
+        proto.transport.loseConnection()
+
+    def _connectionLost(self, proto):
+        expiry = self._idle.pop(proto, None)
+        if expiry is not None and expiry.active():
+            expiry.cancel()
@@ -0,0 +1,130 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+
+# Directions of the streams in a StreamRegistry
+INBOUND = 'inbound'
+OUTBOUND = 'outbound'
+
+
+def _peerKey(peer):
+    # Accept an I2PAddress or a bare Destination
+    return getattr(peer, 'destination', peer)
+
+
+class StreamRegistry(object):
+    """The streams registered with a SAM session.
+
+    Adding and removing a stream takes constant time however many streams are
+    registered, and streams are indexed by peer Destination and direction, so
+    that the streams to a peer or in one direction can be found without
+    scanning the rest.
+
+    A stream may be registered without a peer or direction (datagram ports and
+    forwarding connections have neither), in which case it is only found by
+    iterating over the registry. Iteration is in registration order.
+    """
+
+    def __init__(self):
+        # stream -> (direction, peer key)
+        self._streams = {}
+        self._byPeer = {}
+        self._byDirection = {}
+
+    def __len__(self):
+        return len(self._streams)
+
+    def __iter__(self):
+        return iter(list(self._streams))
+
+    def __contains__(self, stream):
+        return stream in self._streams
+
+    def add(self, stream, direction=None, peer=None):
+        """Register a stream.
+
+        Registering a stream again updates its direction and peer.
+
+        Args:
+            stream: The stream.
+            direction (str): ``INBOUND``, ``OUTBOUND`` or `None`.
+            peer: The peer's Destination or ``I2PAddress``, or `None` if not
+                known yet.
+        """
+        self.remove(stream)
+        peer = _peerKey(peer)
+        self._streams[stream] = (direction, peer)
+        if direction is not None:
+            self._byDirection.setdefault(direction, set()).add(stream)
+        if peer is not None:
+            self._byPeer.setdefault(peer, set()).add(stream)
+
+    def remove(self, stream):
+        """Unregister a stream, if it is registered."""
+        entry = self._streams.pop(stream, None)
+        if entry is None:
+            return
+        direction, peer = entry
+        if direction is not None:
+            self._discard(self._byDirection, direction, stream)
+        if peer is not None:
+            self._discard(self._byPeer, peer, stream)
+
+    def setPeer(self, stream, peer):
+        """Set the peer of a registered stream, once it is known."""
+        if stream in self._streams:
+            self.add(stream, self._streams[stream][0], peer)
+
+    def clear(self):
+        """Unregister all streams."""
+        self._streams.clear()
+        self._byPeer.clear()
+        self._byDirection.clear()
+
+    def peerOf(self, stream):
+        """The peer Destination of a registered stream, or `None`."""
+        entry = self._streams.get(stream)
+        return entry[1] if entry else None
+
+    def directionOf(self, stream):
+        """The direction of a registered stream, or `None`."""
+        entry = self._streams.get(stream)
+        return entry[0] if entry else None
+
+    def find(self, peer=None, direction=None):
+        """Find registered streams.
+
+        Args:
+            peer: Only streams to or from this Destination or ``I2PAddress``.
+            direction (str): Only streams in this direction.
+
+        Returns:
+            list: The matching streams, or all streams if neither filter is
+            given.
+        """
+        if peer is None and direction is None:
+            return list(self._streams)
+        if peer is None:
+            return list(self._byDirection.get(direction, ()))
+        streams = self._byPeer.get(_peerKey(peer), ())
+        if direction is None:
+            return list(streams)
+        return [s for s in streams if self._streams[s][0] == direction]
+
+    def count(self, peer=None, direction=None):
+        """Count registered streams, with the same filters as :meth:`find`."""
+        if peer is None and direction is None:
+            return len(self._streams)
+        if peer is None:
+            return len(self._byDirection.get(direction, ()))
+        if direction is None:
+            return len(self._byPeer.get(_peerKey(peer), ()))
+        return len(self.find(peer, direction))
+
+    @staticmethod
+    def _discard(index, key, stream):
+        streams = index[key]
+        streams.discard(stream)
+        if not streams:
+            del index[key]
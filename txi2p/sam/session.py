@@ -3,14 +3,18 @@
 from __future__ import print_function
 
 from builtins import object
+from collections import OrderedDict
 import os
 import sys
 from twisted.internet import defer, error
-from twisted.python import failure, log
+from twisted.python import log
 
-from txi2p import grammar
-from txi2p.address import I2PAddress
+from txi2p.address import I2PAddress, destinationFromPrivateKey
+from txi2p.keystore import getKeyStore
 from txi2p.sam import constants as c
+from txi2p.sam.naming import NamingCache, NamingResolver
+from txi2p.sam.pool import ControlConnectionPool, DEFAULT_IDLE_TIMEOUT
+from txi2p.sam.registry import StreamRegistry
 from txi2p.sam.base import (
     cmpSAM,
     makeSAMProtocol,
@@ -19,12 +23,18 @@ from txi2p.sam.base import (
     SAMFactory,
 )
 
+# Session styles that can be created with getSession
+SESSION_STYLES = ('STREAM', 'DATAGRAM', 'RAW', 'PRIMARY')
+# Session styles that can be added to a PRIMARY session
+SUBSESSION_STYLES = ('STREAM', 'DATAGRAM', 'RAW')
+
+
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
 class SessionCreateSender(SAMSender):
-    def sendSessionCreate(self, samVersion, style, id, privKey, localPort, options, sigType):
+    def sendSessionCreate(self, samVersion, style, id, privKey, localPort, options, sigType, forwardPort=None, forwardHost=None):
         msg = 'SESSION CREATE'
         msg += ' STYLE=%s' % style
         msg += ' ID=%s' % id
@@ -33,19 +43,53 @@ class SessionCreateSender(SAMSender):
             msg += ' SIGNATURE_TYPE=%s' % (sigType and sigType or c.DEFAULT_SIGTYPE)
         if localPort:
             msg += ' FROM_PORT=%d' % localPort
+        if forwardPort:
+            msg += ' PORT=%d' % forwardPort
+            if forwardHost:
+                msg += ' HOST=%s' % forwardHost
         for key in options:
             msg += ' %s=%s' % (key, options[key])
         msg += '\n'
         self.transport.write(msg.encode('utf-8'))
 
+    def sendSessionAdd(self, style, id, localPort, options, forwardPort=None, forwardHost=None):
+        msg = 'SESSION ADD'
+        msg += ' STYLE=%s' % style
+        msg += ' ID=%s' % id
+        if localPort:
+            msg += ' FROM_PORT=%d' % localPort
+        if forwardPort:
+            msg += ' PORT=%d' % forwardPort
+            if forwardHost:
+                msg += ' HOST=%s' % forwardHost
+        for key in options:
+            msg += ' %s=%s' % (key, options[key])
+        msg += '\n'
+        self.transport.write(msg.encode('utf-8'))
+
+    def sendSessionRemove(self, id):
+        msg = 'SESSION REMOVE ID=%s\n' % id
+        self.transport.write(msg.encode('utf-8'))
+
 
 class SessionCreateReceiver(SAMReceiver):
+    primarySession = None
+
     def command(self):
+        if self.factory.style == 'PRIMARY' and \
+                cmpSAM(self.factory.samVersion, '3.3') < 0:
+            raise error.UnsupportedSocketType(
+                'PRIMARY sessions require SAM 3.3, the server supports %s'
+                % self.factory.samVersion)
+
         if not (hasattr(self.factory, 'nickname') and self.factory.nickname):
             # All tunnels in the same process use the same nickname
             # TODO is using the PID a security risk?
             self.factory.nickname = 'txi2p-%d' % os.getpid()
 
+        self.factory.whenKeyLoaded().addCallback(self._sendCreate)
+
+    def _sendCreate(self, _):
         self.sender.sendSessionCreate(
             self.factory.samVersion,
             self.factory.style,
@@ -53,7 +97,9 @@ class SessionCreateReceiver(SAMReceiver):
             self.factory.privKey,
             self.factory.localPort,
             self.factory.options,
-            self.factory.sigType)
+            self.factory.sigType,
+            self.factory.forwardPort,
+            self.factory.forwardHost)
         self.currentRule = 'State_create'
 
     def create(self, result, destination=None, message=None):
@@ -71,19 +117,31 @@ class SessionCreateReceiver(SAMReceiver):
                     self.factory.privKey,
                     self.factory.localPort,
                     self.factory.options,
-                    fallback)
+                    fallback,
+                    self.factory.forwardPort,
+                    self.factory.forwardHost)
             else:
                 self.factory.resultNotOK(result, message)
             return
 
         self.factory.privKey = destination
-        self.sender.sendNamingLookup('ME')
-        self.currentRule = 'State_naming'
+        try:
+            # The Destination is the start of the private key
+            dest = destinationFromPrivateKey(destination)
+        except ValueError:
+            # Ask the SAM server instead
+            self.sender.sendNamingLookup('ME')
+            self.currentRule = 'State_naming'
+        else:
+            self.postLookup(dest)
 
     def postLookup(self, dest):
         # Help keep the session open
         if cmpSAM(self.factory.samVersion, '3.2') >= 0:
             self.startPinging()
+            if self.factory.style == 'PRIMARY':
+                # Subsessions are added and removed on this connection
+                self.currentRule = 'State_primary'
         else:
             try:
                 self.sender.transport.setTcpKeepAlive(1)
@@ -91,6 +149,15 @@ class SessionCreateReceiver(SAMReceiver):
                 eprint(e)
         self.factory.sessionCreated(self, dest)
 
+    def sessionStatus(self, result, id=None, message=None, **kwargs):
+        self.primarySession._subsessionStatus(result, id, message)
+
+    def finishParsing(self, reason):
+        if self.primarySession:
+            # Subsessions still being added or removed never will be
+            self.primarySession._failPendingStatus(reason)
+        SAMReceiver.finishParsing(self, reason)
+
 
 # A Protocol for making a SAM session
 SessionCreateProtocol = makeSAMProtocol(
@@ -101,42 +168,63 @@ SessionCreateProtocol = makeSAMProtocol(
 class SessionCreateFactory(SAMFactory):
     protocol = SessionCreateProtocol
 
-    def __init__(self, nickname, style='STREAM', keyfile=None, localPort=None, options=None, sigType=None):
-        if style != 'STREAM':
+    def __init__(self, nickname, style='STREAM', keyfile=None, localPort=None, options=None, sigType=None, forwardPort=None, forwardHost=None, keystore=None, privKey=None):
+        if style not in SESSION_STYLES:
             raise error.UnsupportedSocketType()
         if options is None:
             options = {}
         self.nickname = nickname
         self.style = style
         self._keyfile = keyfile
+        self._keystore = keystore or getKeyStore()
         self.localPort = localPort
         self.options = options
         self.sigType = sigType
+        self.forwardPort = forwardPort
+        self.forwardHost = forwardHost
         self.deferred = defer.Deferred(self._cancel)
         self.samVersion = None
-        self.privKey = None
+        self.privKey = privKey
         self._writeKeypair = False
+        self._keyLoad = None
 
     def startFactory(self):
-        if self._keyfile:
-            try:
-                f = open(self._keyfile, 'r')
-                self.privKey = f.read()
-                f.close()
-            except IOError:
-                log.msg('Could not load private key from %s' % self._keyfile)
-                self._writeKeypair = True
+        if self._keyfile and not self.privKey:
+            self._keyLoad = self._keystore.load(self._keyfile)
+            self._keyLoad.addCallbacks(self._keyLoaded, self._keyLoadFailed)
+
+    def _keyLoaded(self, privKey):
+        self.privKey = privKey
+
+    def _keyLoadFailed(self, reason):
+        log.msg('Could not load private key from %s' % self._keyfile)
+        self._writeKeypair = True
+
+    def whenKeyLoaded(self):
+        """Get a Deferred that fires once the keyfile has been read."""
+        d = defer.Deferred()
+        if self._keyLoad is None:
+            d.callback(None)
+        else:
+            self._keyLoad.addCallback(d.callback)
+        return d
 
     def sessionCreated(self, proto, pubKey):
         if self._writeKeypair:
-            try:
-                f = open(self._keyfile, 'w')
-                f.write(str(self.privKey))
-                f.close()
-            except IOError:
-                log.msg('Could not save private key to %s' % self._keyfile)
+            d = self._keystore.save(self._keyfile, str(self.privKey))
+            d.addErrback(lambda f: log.msg(
+                'Could not save private key to %s' % self._keyfile))
+        else:
+            d = defer.succeed(None)
         # Now continue on with creation of SAMSession
-        self.deferred.callback((self.samVersion, self.style, self.nickname, proto, pubKey, self.localPort))
+        d.addCallback(self._keypairSaved, proto, pubKey)
+
+    def _keypairSaved(self, _, proto, pubKey):
+        # The connection may have been lost while the keyfile was written
+        if not self.deferred.called:
+            self.deferred.callback((
+                self.samVersion, self.style, self.nickname, proto, pubKey,
+                self.localPort))
 
 
 # Dictionary containing all active SAM sessions
@@ -152,16 +240,31 @@ class SAMSession(object):
         nickname (str): The user-assigned session nickname, can be `None`.
         samEndpoint (twisted.internet.interfaces.IStreamClientEndpoint): An
             endpoint that will connect to the SAM API.
+        samHost (str): The address of the SAM server that this session's
+            control connection is to, or `None` if it has no IP address.
         samVersion (str): The SAM version in use by this session.
         style (str): The session style.
         id (str): SAM Session ID, autogenerated if ``nickname`` is None, else
             ``nickname``.
         address (txi2p.I2PAddress): The Destination of this session.
+        namingCache (txi2p.sam.naming.NamingCache): Cached ``NAMING LOOKUP``
+            results for streams opened on this session.
+        resolver (txi2p.sam.naming.NamingResolver): Looks up hostnames over a
+            persistent SAM connection, sharing ``namingCache``. Use it to
+            resolve many names ahead of opening streams to them.
+        connectionPool (txi2p.sam.pool.ControlConnectionPool): Idle SAM
+            connections for opening streams on this session, or `None` if
+            connections are not pooled.
+        forwardPort (int): The local UDP port that the SAM server forwards
+            incoming datagrams to, or `None` for ``STREAM`` sessions.
+        primary (txi2p.sam.SAMSession): For a subsession, the ``PRIMARY``
+            session it was added to, otherwise `None`.
     """
 
     def __init__(self):
         self.nickname = None
         self.samEndpoint = None
+        self.samHost = None
         self.samVersion = ''
         self.style = 'STREAM'
         self.id = None
@@ -169,17 +272,42 @@ class SAMSession(object):
         self._proto = None
         self._autoClose = False
         self._closed = False
-        self._streams = []
+        self._streams = StreamRegistry()
+        self.namingCache = NamingCache()
+        self.resolver = None
+        self.connectionPool = None
+        self.forwardPort = None
+        self.primary = None
+        self._subsessions = {}
+        self._pendingStatus = OrderedDict()
+
+    @property
+    def pingRTT(self):
+        """The round-trip time of the last keepalive PING on this session's
+        control connection, in seconds, or `None` if none has been answered.
+        Only measured with SAM v3.2 or higher.
+        """
+        return self._proto.pingRTT if self._proto else None
 
-    def addStream(self, stream):
+    def addStream(self, stream, direction=None, peer=None):
         """Register a stream with this session.
 
+        Args:
+            stream: The stream.
+            direction (str): ``txi2p.sam.registry.INBOUND``, ``OUTBOUND``, or
+                `None` for things that are not streams to one peer.
+            peer: The peer's Destination or ``I2PAddress``, if known.
+
         Raises:
             twisted.internet.error.ConnectionDone: if the session is closed.
         """
         if self._closed:
             raise error.ConnectionDone
-        self._streams.append(stream)
+        self._streams.add(stream, direction, peer)
+
+    def setStreamPeer(self, stream, peer):
+        """Record the peer of a registered stream once it is known."""
+        self._streams.setPeer(stream, peer)
 
     def removeStream(self, stream):
         """Remove a stream from this session.
@@ -193,29 +321,174 @@ class SAMSession(object):
         if self._closed:
             raise error.ConnectionDone
         # Streams are only added once they have been established
-        if stream in self._streams:
-            self._streams.remove(stream)
+        self._streams.remove(stream)
         if not self._streams and self._autoClose:
             # No more streams, close the session
             self.close()
 
+    def streams(self, peer=None, direction=None):
+        """Get the streams registered with this session.
+
+        Args:
+            peer: Only streams to or from this Destination or ``I2PAddress``.
+            direction (str): Only streams in this direction,
+                ``txi2p.sam.registry.INBOUND`` or ``OUTBOUND``. Inbound
+                streams include open ``STREAM ACCEPT`` s still waiting for a
+                peer.
+
+        Returns:
+            list: The matching streams.
+        """
+        return self._streams.find(peer, direction)
+
+    def countStreams(self, peer=None, direction=None):
+        """Count the streams registered with this session.
+
+        Takes the same filters as :meth:`streams`, without building a list.
+        """
+        return self._streams.count(peer, direction)
+
+    def closeStreams(self, peer=None, direction=None):
+        """Close the streams registered with this session.
+
+        Takes the same filters as :meth:`streams`. Each stream is removed from
+        the session once its connection has closed.
+        """
+        for stream in self._streams.find(peer, direction):
+            if hasattr(stream, 'stopListening'):
+                stream.stopListening()
+            else:
+                stream.sender.transport.loseConnection()
+
     def close(self):
-        """Close the session."""
+        """Close the session.
+
+        Closing a ``PRIMARY`` session closes all of its subsessions. Closing a
+        subsession removes it from its ``PRIMARY`` session.
+        """
         self._closed = True
-        self._streams = []
-        self._proto.sender.transport.loseConnection()
+        self._streams.clear()
+        if self.connectionPool:
+            self.connectionPool.stop()
+        if self.resolver:
+            self.resolver.close()
+        if self.primary:
+            self.primary._removeSubsession(self)
+        else:
+            for sub in list(self._subsessions.values()):
+                sub._closed = True
+                sub._streams.clear()
+                if sub.connectionPool:
+                    sub.connectionPool.stop()
+                if sub.resolver:
+                    sub.resolver.close()
+                del _sessions[sub.nickname]
+            self._subsessions = {}
+            self._failPendingStatus(error.ConnectionDone())
+            self._proto.sender.transport.loseConnection()
         del _sessions[self.nickname]
 
+    def _addSubsession(self, nickname, style='STREAM', localPort=None,
+                       options=None, forwardPort=None, forwardHost=None,
+                       **kwargs):
+        # The subsession shares this session's Destination, so any keyfile
+        # or sigType is ignored.
+        if self._closed:
+            return defer.fail(error.ConnectionDone())
+        if style not in SUBSESSION_STYLES:
+            return defer.fail(error.UnsupportedSocketType())
+        if nickname in self._pendingStatus or nickname in self._subsessions:
+            return defer.fail(ValueError(
+                'Subsession %s already exists' % nickname))
+        d = defer.Deferred()
+        self._pendingStatus[nickname] = d
+        self._proto.sender.sendSessionAdd(
+            style, nickname, localPort, options or {}, forwardPort, forwardHost)
+        d.addCallback(lambda _: (self.samVersion, style, nickname, self._proto,
+                                 self.address.destination, localPort))
+        return d
+
+    def _removeSubsession(self, sub):
+        self._subsessions.pop(sub.id, None)
+        if self._closed:
+            return
+        d = defer.Deferred()
+        d.addErrback(lambda f: log.msg(
+            'Could not remove subsession %s: %s' % (sub.id, f.value)))
+        self._pendingStatus[sub.id] = d
+        self._proto.sender.sendSessionRemove(sub.id)
+
+    def _subsessionStatus(self, result, id, message):
+        if id in self._pendingStatus:
+            d = self._pendingStatus.pop(id)
+        elif self._pendingStatus:
+            # Replies arrive in the order the requests were sent
+            id, d = self._pendingStatus.popitem(last=False)
+        else:
+            log.msg('Unexpected SESSION STATUS for %s: %s' % (id, result))
+            return
+        if result == c.RESULT_OK:
+            d.callback(None)
+        else:
+            error_ = c.samErrorMap.get(result, error.ConnectError)
+            d.errback(error_(string=(message if message else result)))
+
+    def _failPendingStatus(self, reason):
+        pending = self._pendingStatus
+        self._pendingStatus = OrderedDict()
+        for d in pending.values():
+            d.errback(reason)
+
+
+def _samHost(receiver):
+    sender = getattr(receiver, 'sender', None)
+    if sender is None or sender.transport is None:
+        return None
+    # Not every transport is to an IP address
+    return getattr(sender.transport.getPeer(), 'host', None)
+
 
-def getSession(nickname, samEndpoint=None, autoClose=False, **kwargs):
+def getSession(nickname, samEndpoint=None, autoClose=False, poolSize=0,
+               poolIdleTimeout=DEFAULT_IDLE_TIMEOUT, primary=None,
+               destinationPool=None, **kwargs):
     """Get or create a SAM session.
 
+    A ``PRIMARY`` session (SAM v3.3 or higher) owns a Destination and its
+    tunnels, but cannot be used by endpoints directly. Instead, subsessions
+    of any other style are added to it by passing it as ``primary``; they all
+    share its Destination and tunnels. A subsession can be used anywhere a
+    session of the same style can.
+
     Args:
         nickname (str): The session nickname.
         samEndpoint (twisted.internet.interfaces.IStreamClientEndpoint): An
             endpoint that will connect to the SAM API.
         autoClose (bool): `true` if the session should close automatically once
             no more connections are using it.
+        poolSize (int): The number of idle SAM connections to keep ready for
+            opening streams. If 0, connections are not pooled.
+        poolIdleTimeout (int): Seconds after which an idle pooled connection
+            is closed.
+        style (str): The session style: ``'STREAM'`` (the default),
+            ``'DATAGRAM'``, ``'RAW'`` or ``'PRIMARY'``.
+        forwardPort (int): For ``DATAGRAM`` and ``RAW`` sessions, the UDP port
+            that the SAM server should forward incoming datagrams to.
+        forwardHost (str): The host that ``forwardPort`` is on. Defaults to
+            the SAM server's own idea of localhost.
+        primary (txi2p.sam.SAMSession): A ``PRIMARY`` session to add a
+            subsession to, instead of creating a new session. ``nickname``
+            must be set, and ``samEndpoint`` is not needed.
+        destinationPool (txi2p.sam.destpool.DestinationPool): If no
+            ``keyfile`` is given, the session uses a Destination from this
+            pool instead of having the SAM server generate a transient one.
+            The pool is started if it has not been; if it has been stopped,
+            creating the session fails with
+            :class:`twisted.internet.error.ConnectionDone`.
+
+    Raises:
+        twisted.internet.error.UnsupportedSocketType: if ``style`` is
+            ``'PRIMARY'`` and the SAM server doesn't support SAM v3.3 or
+            higher, or ``primary`` is not a ``PRIMARY`` session.
     """
     if nickname in _sessions:
         return defer.succeed(_sessions[nickname])
@@ -227,7 +500,13 @@ def getSession(nickname, samEndpoint=None, autoClose=False, **kwargs):
         _pending_sessions[nickname].append(d)
         return d
 
-    if not samEndpoint:
+    if primary is not None:
+        if not nickname:
+            raise ValueError('A subsession must have a nickname')
+        if primary.style != 'PRIMARY':
+            raise error.UnsupportedSocketType()
+        samEndpoint = primary.samEndpoint
+    elif not samEndpoint:
         raise ValueError('A new session cannot be created without an API Endpoint')
 
     def createSession(xxx_todo_changeme):
@@ -241,6 +520,20 @@ def getSession(nickname, samEndpoint=None, autoClose=False, **kwargs):
         s.address = I2PAddress(pubKey, port=localPort)
         s._proto = proto
         s._autoClose = autoClose
+        s.resolver = NamingResolver(samEndpoint, s.namingCache)
+        s.forwardPort = kwargs.get('forwardPort')
+        if primary is not None:
+            s.samHost = primary.samHost
+            s.primary = primary
+            primary._subsessions[id] = s
+        else:
+            s.samHost = _samHost(proto)
+        if style == 'PRIMARY':
+            proto.primarySession = s
+        if poolSize > 0:
+            s.connectionPool = ControlConnectionPool(
+                samEndpoint, poolSize, poolIdleTimeout)
+            s.connectionPool.start()
         _sessions[nickname] = s
 
         waiting = _pending_sessions.pop(nickname, [])
@@ -256,10 +549,21 @@ def getSession(nickname, samEndpoint=None, autoClose=False, **kwargs):
         return f
 
     _pending_sessions[nickname] = []
-    sessionFac = SessionCreateFactory(nickname, **kwargs)
-    d = samEndpoint.connect(sessionFac)
-    # Force caller to wait until the session is actually created
-    d.addCallback(lambda proto: sessionFac.deferred)
+    if primary is not None:
+        d = primary._addSubsession(nickname, **kwargs)
+    else:
+        def connect(privKey=None):
+            sessionFac = SessionCreateFactory(
+                nickname, privKey=privKey, **kwargs)
+            d = samEndpoint.connect(sessionFac)
+            # Force caller to wait until the session is actually created
+            d.addCallback(lambda proto: sessionFac.deferred)
+            return d
+        if destinationPool is not None and not kwargs.get('keyfile'):
+            d = destinationPool.take(kwargs.get('sigType'))
+            d.addCallback(lambda keypair: connect(keypair[1]))
+        else:
+            d = connect()
     d.addCallback(createSession)
     d.addErrback(errbackPending)
     return d
@@ -289,9 +593,7 @@ class DestGenerateReceiver(SAMReceiver):
                     not self.factory.sigType:
                 fallback = 'ECDSA_SHA256_P256' in message and 'DSA_SHA1' or 'ECDSA_SHA256_P256'
                 eprint('Warning: %s, falling back to %s' % (message, fallback))
-                self.sender.sendDestGenerate(
-                    self.factory.samVersion,
-                    fallback)
+                self.fallBack(fallback)
             else:
                 self.factory.resultNotOK(result, message)
             return
@@ -299,6 +601,9 @@ class DestGenerateReceiver(SAMReceiver):
         self.factory.destGenerated(pub, priv)
         self.sender.transport.loseConnection()
 
+    def fallBack(self, sigType):
+        self.sender.sendDestGenerate(self.factory.samVersion, sigType)
+
 
 # A Protocol for generating an I2P Destination via SAM
 DestGenerateProtocol = makeSAMProtocol(
@@ -309,26 +614,27 @@ DestGenerateProtocol = makeSAMProtocol(
 class DestGenerateFactory(SAMFactory):
     protocol = DestGenerateProtocol
 
-    def __init__(self, keyfile, sigType=None):
+    def __init__(self, keyfile, sigType=None, keystore=None):
         self._keyfile = keyfile
+        self._keystore = keystore or getKeyStore()
         self.sigType = sigType
         self.deferred = defer.Deferred(self._cancel)
+        self._generated = False
 
-    def destGenerated(self, pubKey, privKey):
-        if os.path.exists(self._keyfile):
-            self.deferred.errback(failure.Failure(ValueError('The keyfile already exists')))
-            return
+    def connectionFailed(self, reason):
+        # The connection is closed while the keyfile is being written
+        if not self._generated:
+            SAMFactory.connectionFailed(self, reason)
 
-        try:
-            f = open(self._keyfile, 'w')
-            f.write(str(privKey))
-            f.close()
-            self.deferred.callback(I2PAddress(pubKey))
-        except IOError as e:
-            self.deferred.errback(failure.Failure(e))
+    def destGenerated(self, pubKey, privKey):
+        self._generated = True
+        d = self._keystore.create(self._keyfile, str(privKey))
+        d.addCallback(lambda _: I2PAddress(pubKey))
+        d.chainDeferred(self.deferred)
 
 
-def generateDestination(keyfile, samEndpoint, sigType=None):
+def generateDestination(keyfile, samEndpoint, sigType=None,
+                        destinationPool=None):
     """Generate a new I2P Destination.
 
     The function returns a :class:`twisted.internet.defer.Deferred`; register
@@ -341,6 +647,10 @@ def generateDestination(keyfile, samEndpoint, sigType=None):
             endpoint that will connect to the SAM API.
         sigType (str): The SigType to generate. Defaults to Ed25519 if
             supported, falling back to ECDSA_SHA256_P256 and then DSA_SHA1.
+        destinationPool (txi2p.sam.destpool.DestinationPool): If given, the
+            Destination is taken from this pool instead of being generated.
+            The pool is started if it has not been; if it has been stopped,
+            this fails with :class:`twisted.internet.error.ConnectionDone`.
 
     Returns:
         txi2p.I2PAddress: The new Destination. Once this is received via the
@@ -350,6 +660,13 @@ def generateDestination(keyfile, samEndpoint, sigType=None):
         ValueError: if the ``keyfile`` already exists.
         IOError: if the ``keyfile`` write fails.
     """
+    if destinationPool is not None:
+        def save(keypair):
+            pubKey, privKey = keypair
+            d = getKeyStore().create(keyfile, str(privKey))
+            d.addCallback(lambda _: I2PAddress(pubKey))
+            return d
+        return destinationPool.take(sigType).addCallback(save)
     destFac = DestGenerateFactory(keyfile, sigType)
     d = samEndpoint.connect(destFac)
     d.addCallback(lambda proto: destFac.deferred)
@@ -3,9 +3,12 @@
 
 from builtins import range
 from builtins import object
+import math
+from twisted.internet import reactor
 from twisted.internet.defer import Deferred
 from twisted.internet.error import ConnectError, UnknownHostError
 from twisted.internet.interfaces import IListeningPort
+from twisted.python import log
 from zope.interface import implementer
 
 from txi2p.address import I2PAddress
@@ -18,6 +21,7 @@ from txi2p.sam.base import (
     SAMReceiver,
     SAMFactory,
 )
+from txi2p.sam.registry import INBOUND, OUTBOUND
 
 
 class StreamConnectSender(SAMSender):
@@ -42,6 +46,15 @@ class StreamConnectReceiver(SAMReceiver):
             self.sender.sendNamingLookup(self.factory.host)
             self.currentRule = 'State_naming'
 
+    def lookupReply(self, result, name, value=None, message=None):
+        cache = getattr(self.factory, 'namingCache', None)
+        if cache is not None:
+            if result == c.RESULT_OK:
+                cache.put(self.factory.host, value)
+            elif result == c.RESULT_KEY_NOT_FOUND:
+                cache.putNotFound(self.factory.host)
+        SAMReceiver.lookupReply(self, result, name, value, message)
+
     def postLookup(self, dest):
         self.factory.dest = dest
         self.doConnect()
@@ -58,7 +71,7 @@ class StreamConnectReceiver(SAMReceiver):
             return
 
         self.factory.streamConnectionEstablished(self)
-        self.currentRule = 'State_readData'
+        self.bindDataPath()
 
 
 StreamConnectProtocol = makeSAMProtocol(
@@ -76,10 +89,11 @@ class StreamConnectFactory(SAMFactory):
         self.dest = dest
         self.port = port
         self.localPort = localPort
+        self.namingCache = getattr(session, 'namingCache', None)
         self.deferred = Deferred(self._cancel);
 
     def streamConnectionEstablished(self, streamProto):
-        self.session.addStream(streamProto)
+        self.session.addStream(streamProto, OUTBOUND, self.dest)
         peerAddress = I2PAddress(self.dest, self.host, self.port)
         proto = self._clientFactory.buildProtocol(peerAddress)
         if proto is None:
@@ -127,10 +141,17 @@ class StreamAcceptReceiver(SAMReceiver):
                 # Create the wrapped Protocol...
                 self.factory.streamAcceptIncoming(self)
                 # ... and pass through any initial data.
-                if self.initialData:
-                    data, self.initialData = self.initialData, None
+                data, self.initialData = self.initialData, None
+                self.bindDataPath()
+                if data:
                     self.wrappedProto.dataReceived(data)
 
+    def finishParsing(self, reason):
+        if not self.wrappedProto:
+            # No peer arrived on this accept
+            self.factory.streamAcceptLost(self, reason)
+        SAMReceiver.finishParsing(self, reason)
+
 
 StreamAcceptProtocol = makeSAMProtocol(
     StreamAcceptSender,
@@ -147,11 +168,15 @@ class StreamAcceptFactory(SAMFactory):
         self.deferred = Deferred(self._cancel);
 
     def streamAcceptEstablished(self, streamProto):
-        self.session.addStream(streamProto)
+        self.session.addStream(streamProto, INBOUND)
         self.listeningPort.addAccept(streamProto)
 
+    def streamAcceptLost(self, streamProto, reason):
+        self.listeningPort.acceptLost(streamProto, reason)
+
     def streamAcceptIncoming(self, streamProto):
         self.listeningPort.removeAccept(streamProto)
+        self.session.setStreamPeer(streamProto, streamProto.peer)
         proto = self._clientFactory.buildProtocol(streamProto.peer)
         if proto is None:
             self.deferred.cancel()
@@ -159,35 +184,183 @@ class StreamAcceptFactory(SAMFactory):
         streamProto.wrapProto(proto, streamProto.peer, True)
 
 
+# Bounds on the number of concurrent STREAM ACCEPTs per listener on SAM 3.2+
+DEFAULT_MIN_ACCEPTS = 2
+DEFAULT_MAX_ACCEPTS = 32
+# Seconds between re-evaluations of the number of concurrent STREAM ACCEPTs
+ACCEPT_ADAPT_INTERVAL = 30
+# Seconds to wait before replacing STREAM ACCEPTs that were dropped
+ACCEPT_RETRY_DELAY = 5
+# Weight of the newest sample in the moving averages of StreamAcceptPort
+_EWMA_WEIGHT = 0.2
+
+
+def _ewma(average, sample):
+    if average is None:
+        return sample
+    return average + _EWMA_WEIGHT * (sample - average)
+
+
 @implementer(IListeningPort)
 class StreamAcceptPort(object):
-    def __init__(self, session, factory):
+    """Listens for incoming streams with concurrent ``STREAM ACCEPT`` s.
+
+    The number of concurrent accepts adapts between ``minAccepts`` and
+    ``maxAccepts``, to cover the peers expected to arrive while a used accept
+    is being replaced. Each used accept is replaced as soon as its peer
+    arrives. SAM servers older than 3.2 only allow one accept at a time.
+
+    Attributes:
+        target (int): The current number of concurrent accepts aimed for.
+        accepted (int): The number of incoming streams accepted.
+        refillLatency (float): Moving average of the seconds taken to open an
+            accept, or `None` if none have been opened yet.
+        acceptWait (float): Moving average of the seconds an open accept
+            waited for a peer, or `None` if no peers have arrived yet.
+    """
+
+    def __init__(self, session, factory, minAccepts=DEFAULT_MIN_ACCEPTS,
+                 maxAccepts=DEFAULT_MAX_ACCEPTS, clock=None):
+        if minAccepts < 1 or maxAccepts < minAccepts:
+            raise ValueError('Need 1 <= minAccepts <= maxAccepts')
         self.session = session
         self.factory = StreamAcceptFactory(factory, session, self)
+        # Failed accepts are handled by acceptLost
+        self.factory.deferred.addErrback(lambda f: None)
         self.accepts = []
+        self.minAccepts = minAccepts
+        self.maxAccepts = maxAccepts
+        self.target = minAccepts
+        self.accepted = 0
+        self.refillLatency = None
+        self.acceptWait = None
+        self._clock = clock or reactor
+        self._opening = 0
+        self._openedAt = {}
+        self._waitingSince = {}
+        self._closing = set()
+        self._interval = None
+        self._lastIncoming = None
+        self._listening = False
+        self._adaptCall = None
+        self._retryCall = None
+
+    @property
+    def depth(self):
+        """The number of accepts that are open or opening."""
+        return len(self.accepts) + self._opening
 
     def startListening(self):
-        if cmpSAM(self.session.samVersion, '3.2') >= 0:
-            active = 8
-        else:
-            active = 1
-        for i in range(0, active):
-            self.openAccept()
+        if cmpSAM(self.session.samVersion, '3.2') < 0:
+            self.minAccepts = self.maxAccepts = 1
+        self.target = self.minAccepts
+        self._listening = True
+        self._fill()
+        if self.minAccepts < self.maxAccepts:
+            self._adaptCall = self._clock.callLater(
+                ACCEPT_ADAPT_INTERVAL, self._adapt)
 
     def stopListening(self):
+        self._listening = False
+        for call in (self._adaptCall, self._retryCall):
+            if call and call.active():
+                call.cancel()
+        self._adaptCall = self._retryCall = None
         for pending in self.accepts:
             pending.sender.transport.loseConnection()
         self.accepts = []
+        self._waitingSince.clear()
 
     def openAccept(self):
-        self.session.samEndpoint.connect(self.factory)
+        self._opening += 1
+        started = self._clock.seconds()
+        d = self.session.samEndpoint.connect(self.factory)
+
+        def opened(proto):
+            self._openedAt[proto.receiver] = started
+
+        def failed(reason):
+            self._opening -= 1
+            log.msg('Could not open a STREAM ACCEPT: %s' % reason.value)
+            self._scheduleRetry()
+        d.addCallbacks(opened, failed)
 
     def addAccept(self, proto):
+        self._opening -= 1
+        now = self._clock.seconds()
+        opened = self._openedAt.pop(proto, None)
+        if opened is not None:
+            self.refillLatency = _ewma(self.refillLatency, now - opened)
+        if not self._listening:
+            proto.sender.transport.loseConnection()
+            return
         self.accepts.append(proto)
+        self._waitingSince[proto] = now
 
     def removeAccept(self, proto):
         self.accepts.remove(proto)
-        self.openAccept()
+        now = self._clock.seconds()
+        self.acceptWait = _ewma(self.acceptWait,
+                                now - self._waitingSince.pop(proto))
+        self.accepted += 1
+        if self._lastIncoming is not None:
+            self._interval = _ewma(self._interval, now - self._lastIncoming)
+        self._lastIncoming = now
+        self._updateTarget(now)
+        self._fill()
+
+    def acceptLost(self, proto, reason):
+        if proto in self._closing:
+            self._closing.discard(proto)
+            return
+        if not self._listening:
+            return
+        if proto in self.accepts:
+            self.accepts.remove(proto)
+            del self._waitingSince[proto]
+        else:
+            self._opening -= 1
+            self._openedAt.pop(proto, None)
+        log.msg('STREAM ACCEPT closed: %s' % reason.value)
+        self._scheduleRetry()
+
+    def _updateTarget(self, now):
+        if self._interval is None or self.refillLatency is None:
+            target = self.minAccepts
+        else:
+            # An idle period counts as a long interval, so the pool shrinks
+            interval = max(self._interval, now - self._lastIncoming, 1e-3)
+            # Peers expected while an accept is replaced, doubled for bursts
+            expected = 2 * self.refillLatency / interval
+            target = int(math.ceil(expected)) + 1
+        self.target = min(max(target, self.minAccepts), self.maxAccepts)
+
+    def _fill(self):
+        if not self._listening:
+            return
+        for i in range(self.target - self.depth):
+            self.openAccept()
+
+    def _adapt(self):
+        self._updateTarget(self._clock.seconds())
+        # Close the newest surplus accepts; the oldest get peers first
+        while self.accepts and self.depth > self.target:
+            proto = self.accepts.pop()
+            del self._waitingSince[proto]
+            self._closing.add(proto)
+            proto.sender.transport.loseConnection()
+        self._fill()
+        self._adaptCall = self._clock.callLater(
+            ACCEPT_ADAPT_INTERVAL, self._adapt)
+
+    def _scheduleRetry(self):
+        if self._listening and not self._retryCall:
+            self._retryCall = self._clock.callLater(
+                ACCEPT_RETRY_DELAY, self._retry)
+
+    def _retry(self):
+        self._retryCall = None
+        self._fill()
 
     def getHost(self):
         return self.session.address
@@ -248,8 +421,8 @@ class StreamForwardPort(object):
         self._listeningPort.startListening()
 
     def stopListening(self):
-        self._listeningPort.stopListening()
         self._forwardingProto.sender.transport.loseConnection()
+        return self._listeningPort.stopListening()
 
     def getHost(self):
         return self._serverAddr
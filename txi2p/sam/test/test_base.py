@@ -0,0 +1,79 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet.error import ConnectionDone
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txi2p.address import MAX_TUNNEL_LINE, I2PAddress
+from txi2p.sam.base import I2PFactoryWrapper
+from txi2p.test.util import TEST_B64, FakeFactory
+
+PEER_LINE = ('%s FROM_PORT=34444 TO_PORT=0\n' % TEST_B64).encode('utf-8')
+
+
+class TestSAMI2PServerTunnelProtocol(unittest.TestCase):
+    def makeProto(self, wrappedFactory=None):
+        if wrappedFactory is None:
+            wrappedFactory = FakeFactory()
+        fac = I2PFactoryWrapper(wrappedFactory, I2PAddress(TEST_B64, port=81))
+        proto = fac.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        return wrappedFactory, proto
+
+    def test_wrappedProtoBuiltForPeer(self):
+        wrappedFactory, proto = self.makeProto()
+        self.assertFalse(hasattr(wrappedFactory, 'proto'))
+        proto.dataReceived(PEER_LINE)
+        peer = I2PAddress(TEST_B64, port=34444)
+        self.assertEqual(peer, proto.peer)
+        self.assertEqual(peer, wrappedFactory.proto.transport.getPeer())
+        self.assertEqual(I2PAddress(TEST_B64, port=81),
+                         wrappedFactory.proto.transport.getHost())
+        self.assertTrue(wrappedFactory.proto.made)
+
+    def test_peerLineInParts(self):
+        wrappedFactory, proto = self.makeProto()
+        proto.dataReceived(PEER_LINE[:100])
+        proto.dataReceived(PEER_LINE[100:-5])
+        self.assertFalse(hasattr(wrappedFactory, 'proto'))
+        proto.dataReceived(PEER_LINE[-5:] + b'Egg a')
+        self.assertEqual(34444, proto.peer.port)
+        self.assertEqual(b'Egg a', wrappedFactory.proto.data)
+        proto.dataReceived(b'nd spam')
+        self.assertEqual(b'Egg and spam', wrappedFactory.proto.data)
+
+    def test_peerLineBounded(self):
+        wrappedFactory, proto = self.makeProto()
+        proto.dataReceived(b'x' * MAX_TUNNEL_LINE)
+        self.assertFalse(proto.transport.disconnecting)
+        proto.dataReceived(b'x')
+        self.assertTrue(proto.transport.disconnecting)
+        proto.dataReceived(b'\nspam')
+        self.assertFalse(hasattr(wrappedFactory, 'proto'))
+        self.assertEqual(None, proto.peer)
+
+    def test_dataPathBound(self):
+        wrappedFactory, proto = self.makeProto()
+        proto.dataReceived(PEER_LINE)
+        self.assertEqual(wrappedFactory.proto.dataReceived, proto.dataReceived)
+
+    def test_noWrappedProto(self):
+        wrappedFactory, proto = self.makeProto(FakeFactory(returnNoProtocol=True))
+        proto.dataReceived(PEER_LINE + b'spam')
+        self.assertTrue(proto.transport.disconnecting)
+        proto.dataReceived(b'eggs')
+        proto.connectionLost(failure.Failure(ConnectionDone()))
+
+    def test_connectionLost(self):
+        wrappedFactory, proto = self.makeProto()
+        proto.dataReceived(PEER_LINE)
+        proto.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertTrue(wrappedFactory.proto.closed)
+
+    def test_connectionLostBeforePeer(self):
+        wrappedFactory, proto = self.makeProto()
+        proto.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertFalse(hasattr(wrappedFactory, 'proto'))
@@ -0,0 +1,170 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet.error import MessageLengthError
+from twisted.internet.protocol import DatagramProtocol
+from twisted.trial import unittest
+
+from txi2p.address import I2PAddress
+from txi2p.sam.datagram import (
+    DatagramForwardProtocol,
+    RawDatagramInfo,
+    SAMI2PDatagramPort,
+    SAMI2PRawPort,
+    MAX_DATAGRAM_SIZE,
+    MAX_RAW_SIZE,
+)
+from txi2p.sam.session import SAMSession
+from txi2p.test.util import TEST_B64
+from .util import FakeUDPReactor
+
+
+class RecordingDatagramProtocol(DatagramProtocol):
+    def __init__(self):
+        self.received = []
+        self.stopped = False
+
+    def datagramReceived(self, datagram, addr):
+        self.received.append((datagram, addr))
+
+    def stopProtocol(self):
+        self.stopped = True
+
+
+class TestSAMI2PDatagramPort(unittest.TestCase):
+    portClass = SAMI2PDatagramPort
+    style = 'DATAGRAM'
+
+    def makePort(self, samVersion='3.2', localPort=None, **kw):
+        s = SAMSession()
+        s.samVersion = samVersion
+        s.id = 'foo'
+        s.style = self.style
+        s.address = I2PAddress(TEST_B64, port=localPort)
+        forwardProto = DatagramForwardProtocol()
+        udpPort = FakeUDPReactor().listenUDP(0, forwardProto, '127.0.0.1')
+        proto = RecordingDatagramProtocol()
+        port = self.portClass(s, forwardProto, proto, ('127.0.0.1', 7655), **kw)
+        port.startListening()
+        return s, udpPort, proto, port
+
+    def test_startListening(self):
+        s, udpPort, proto, port = self.makePort()
+        self.assertIs(port, proto.transport)
+        self.assertEqual([port], list(s._streams))
+        self.assertEqual(s.address, port.getHost())
+
+    def test_write(self):
+        s, udpPort, proto, port = self.makePort()
+        port.write(b'hello', 'bar.i2p')
+        self.assertEqual(
+            [(b'3.0 foo bar.i2p\nhello', ('127.0.0.1', 7655))],
+            udpPort.written)
+
+    def test_writeToAddressWithPorts(self):
+        s, udpPort, proto, port = self.makePort(localPort=34444)
+        port.write(b'hello', I2PAddress(TEST_B64, port=81))
+        self.assertEqual(
+            ('3.0 foo %s FROM_PORT=34444 TO_PORT=81\nhello' % TEST_B64).encode('utf-8'),
+            udpPort.written[0][0])
+
+    def test_writeIgnoresPortsBefore3point2(self):
+        s, udpPort, proto, port = self.makePort('3.1', localPort=34444)
+        port.write(b'hello', I2PAddress(TEST_B64, port=81))
+        self.assertEqual(
+            ('3.0 foo %s\nhello' % TEST_B64).encode('utf-8'),
+            udpPort.written[0][0])
+
+    def test_writeSequence(self):
+        s, udpPort, proto, port = self.makePort()
+        port.writeSequence([b'foo', b'bar'], 'bar.i2p')
+        self.assertEqual(
+            [(b'3.0 foo bar.i2p\nfoo', ('127.0.0.1', 7655)),
+             (b'3.0 foo bar.i2p\nbar', ('127.0.0.1', 7655))],
+            udpPort.written)
+
+    def test_writeSequenceTooLarge(self):
+        s, udpPort, proto, port = self.makePort()
+        self.assertRaises(MessageLengthError, port.writeSequence,
+                          [b'foo', b'x' * (port.maxDatagramSize + 1)],
+                          'bar.i2p')
+        self.assertEqual([], udpPort.written)
+
+    def test_writeTooLarge(self):
+        s, udpPort, proto, port = self.makePort()
+        self.assertEqual(MAX_DATAGRAM_SIZE, SAMI2PDatagramPort.maxDatagramSize)
+        self.assertRaises(MessageLengthError, port.write,
+                          b'x' * (port.maxDatagramSize + 1), 'bar.i2p')
+        self.assertEqual([], udpPort.written)
+
+    def test_datagramReceived(self):
+        s, udpPort, proto, port = self.makePort()
+        udpPort.proto.datagramReceived(
+            ('%s FROM_PORT=81 TO_PORT=0\nhello\nworld' % TEST_B64).encode('utf-8'),
+            ('127.0.0.1', 7655))
+        self.assertEqual(
+            [(b'hello\nworld', I2PAddress(TEST_B64, port=81))],
+            proto.received)
+
+    def test_datagramReceivedFromElsewhereIsDropped(self):
+        s, udpPort, proto, port = self.makePort()
+        udpPort.proto.samHost = '127.0.0.1'
+        udpPort.proto.datagramReceived(
+            ('%s\nhello' % TEST_B64).encode('utf-8'), ('10.0.0.1', 7655))
+        self.assertEqual([], proto.received)
+
+    def test_malformedDatagramIsDropped(self):
+        s, udpPort, proto, port = self.makePort()
+        udpPort.proto.datagramReceived(b'no newline', ('127.0.0.1', 7655))
+        self.assertEqual([], proto.received)
+
+    def test_stopListening(self):
+        s, udpPort, proto, port = self.makePort()
+        port.stopListening()
+        self.assertTrue(proto.stopped)
+        self.assertFalse(udpPort.listening)
+        self.assertEqual([], list(s._streams))
+        # Datagrams arriving late are not delivered
+        udpPort.proto.datagramReceived(
+            ('%s\nhello' % TEST_B64).encode('utf-8'), ('127.0.0.1', 7655))
+        self.assertEqual([], proto.received)
+        # Stopping again does nothing
+        self.successResultOf(port.stopListening())
+
+
+class TestSAMI2PRawPort(TestSAMI2PDatagramPort):
+    portClass = SAMI2PRawPort
+    style = 'RAW'
+
+    def test_maxDatagramSize(self):
+        s, udpPort, proto, port = self.makePort()
+        self.assertEqual(MAX_RAW_SIZE, port.maxDatagramSize)
+        port.write(b'x' * MAX_RAW_SIZE, 'bar.i2p')
+
+    def test_datagramReceived(self):
+        s, udpPort, proto, port = self.makePort()
+        udpPort.proto.datagramReceived(b'hello\nworld', ('127.0.0.1', 7655))
+        self.assertEqual(
+            [(b'hello\nworld', RawDatagramInfo(None, None, None))],
+            proto.received)
+
+    def test_datagramReceivedWithHeader(self):
+        s, udpPort, proto, port = self.makePort(header=True)
+        udpPort.proto.datagramReceived(
+            b'FROM_PORT=81 TO_PORT=0 PROTOCOL=42\nhello\nworld',
+            ('127.0.0.1', 7655))
+        self.assertEqual(
+            [(b'hello\nworld', RawDatagramInfo(81, None, 42))],
+            proto.received)
+
+    def test_headerIgnoredBefore3point2(self):
+        s, udpPort, proto, port = self.makePort('3.1', header=True)
+        udpPort.proto.datagramReceived(b'hello\nworld', ('127.0.0.1', 7655))
+        self.assertEqual(
+            [(b'hello\nworld', RawDatagramInfo(None, None, None))],
+            proto.received)
+
+    def test_malformedDatagramIsDropped(self):
+        s, udpPort, proto, port = self.makePort(header=True)
+        udpPort.proto.datagramReceived(b'no newline', ('127.0.0.1', 7655))
+        self.assertEqual([], proto.received)
@@ -0,0 +1,189 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet.error import ConnectionDone, ConnectionRefusedError
+from twisted.python import failure
+from twisted.trial import unittest
+
+from txi2p.address import I2PAddress
+from txi2p.sam import session
+from txi2p.sam.destpool import DestinationPool
+from txi2p.test.util import TEST_B64
+from .util import FakeSAMEndpoint
+
+
+class TestDestinationPool(unittest.TestCase):
+    def makePool(self, size=2, **kw):
+        self.samEndpoint = FakeSAMEndpoint()
+        self.generated = 0
+        pool = DestinationPool(self.samEndpoint, size, **kw)
+        pool.start()
+        self.samEndpoint.helloAll()
+        return pool
+
+    def reply(self, proto, count=1):
+        for i in range(count):
+            self.generated += 1
+            proto.transport.clear()
+            proto.dataReceived(('DEST REPLY PUB=pub%d PRIV=priv%d\n' % (
+                self.generated, self.generated)).encode('utf-8'))
+
+    def test_filledOverOneConnection(self):
+        pool = self.makePool(size=3)
+        self.assertEqual(1, len(self.samEndpoint.protos))
+        proto = self.samEndpoint.protos[0]
+        self.assertEqual(
+            b'HELLO VERSION MIN=3.0 MAX=3.3\n'
+            b'DEST GENERATE SIGNATURE_TYPE=EdDSA_SHA512_Ed25519\n',
+            proto.transport.value())
+        self.reply(proto, 2)
+        self.assertEqual(b'DEST GENERATE SIGNATURE_TYPE=EdDSA_SHA512_Ed25519\n',
+                         proto.transport.value())
+        self.reply(proto)
+        self.assertEqual(3, len(pool))
+        # The connection is closed once the pool is full
+        self.assertTrue(proto.transport.disconnecting)
+
+    def test_takeReady(self):
+        pool = self.makePool()
+        self.reply(self.samEndpoint.protos[0], 2)
+        self.assertEqual(('pub1', 'priv1'), self.successResultOf(pool.take()))
+        self.assertEqual((1, 0), (pool.hits, pool.misses))
+        # Refilled in the background
+        self.assertEqual(2, len(self.samEndpoint.protos))
+        self.samEndpoint.helloAll()
+        self.reply(self.samEndpoint.protos[1])
+        self.assertEqual(2, pool.ready())
+
+    def test_takeWhenEmptyWaits(self):
+        pool = self.makePool(size=1)
+        d1 = pool.take()
+        d2 = pool.take()
+        self.assertNoResult(d1)
+        self.assertEqual((0, 2), (pool.hits, pool.misses))
+        proto = self.samEndpoint.protos[0]
+        self.reply(proto)
+        self.assertEqual(('pub1', 'priv1'), self.successResultOf(d1))
+        self.assertNoResult(d2)
+        self.reply(proto, 2)
+        self.assertEqual(('pub2', 'priv2'), self.successResultOf(d2))
+        self.assertEqual(1, len(pool))
+        # Waiters were served by the same connection
+        self.assertEqual(1, len(self.samEndpoint.protos))
+
+    def test_takeCancelled(self):
+        pool = self.makePool(size=1)
+        d = pool.take()
+        d.cancel()
+        self.failureResultOf(d)
+        self.reply(self.samEndpoint.protos[0])
+        self.assertEqual(1, len(pool))
+
+    def test_sigTypes(self):
+        pool = self.makePool(size=1, sigTypes=[None, 'ECDSA_SHA256_P256'])
+        self.assertEqual(2, len(self.samEndpoint.protos))
+        self.assertIn(b'SIGNATURE_TYPE=ECDSA_SHA256_P256',
+                      self.samEndpoint.protos[1].transport.value())
+        self.reply(self.samEndpoint.protos[1])
+        self.assertEqual(0, pool.ready())
+        self.assertEqual(1, pool.ready('ECDSA_SHA256_P256'))
+        d = pool.take('DSA_SHA1')
+        self.assertNoResult(d)
+        self.assertEqual(3, len(self.samEndpoint.protos))
+        self.assertIn('DSA_SHA1', pool.sigTypes)
+
+    def test_fallbackSigTypeRemembered(self):
+        pool = self.makePool(size=3)
+        proto = self.samEndpoint.protos[0]
+        proto.transport.clear()
+        proto.dataReceived(
+            b'DEST REPLY RESULT=I2P_ERROR MESSAGE="SIGNATURE_TYPE '
+            b'EdDSA_SHA512_Ed25519 unsupported"\n')
+        self.assertEqual(
+            b'DEST GENERATE SIGNATURE_TYPE=ECDSA_SHA256_P256\n',
+            proto.transport.value())
+        self.reply(proto, 2)
+        # Later keypairs don't try the default first
+        self.assertEqual(
+            b'DEST GENERATE SIGNATURE_TYPE=ECDSA_SHA256_P256\n',
+            proto.transport.value())
+        self.reply(proto)
+        self.assertEqual(3, pool.ready())
+        # Nor do later connections
+        self.successResultOf(pool.take())
+        self.samEndpoint.helloAll()
+        self.assertIn(b'DEST GENERATE SIGNATURE_TYPE=ECDSA_SHA256_P256\n',
+                      self.samEndpoint.protos[1].transport.value())
+
+    def test_takeStartsPool(self):
+        self.samEndpoint = FakeSAMEndpoint()
+        pool = DestinationPool(self.samEndpoint, 1)
+        d = pool.take()
+        self.assertEqual(1, len(self.samEndpoint.protos))
+        self.samEndpoint.helloAll()
+        self.samEndpoint.protos[0].dataReceived(
+            b'DEST REPLY PUB=pub1 PRIV=priv1\n')
+        self.assertEqual(('pub1', 'priv1'), self.successResultOf(d))
+
+    def test_generationFailed(self):
+        pool = self.makePool(size=1)
+        d = pool.take()
+        self.samEndpoint.protos[0].connectionLost(
+            failure.Failure(ConnectionDone()))
+        self.failureResultOf(d, ConnectionDone)
+        # Retried on the next take
+        self.samEndpoint.failure = failure.Failure(ConnectionRefusedError())
+        self.failureResultOf(pool.take(), ConnectionRefusedError)
+
+    def test_stop(self):
+        pool = self.makePool(size=2)
+        proto = self.samEndpoint.protos[0]
+        self.reply(proto)
+        d = pool.take()
+        d2 = pool.take()
+        pool.stop()
+        self.failureResultOf(d2, ConnectionDone)
+        self.assertEqual(0, len(pool))
+        self.assertTrue(proto.transport.disconnecting)
+        self.failureResultOf(pool.take(), ConnectionDone)
+
+
+class TestDestinationPoolUsers(unittest.TestCase):
+    def setUp(self):
+        self.samEndpoint = FakeSAMEndpoint()
+        self.pool = DestinationPool(self.samEndpoint, 1)
+        self.pool.start()
+        self.samEndpoint.helloAll()
+        self.samEndpoint.protos[0].dataReceived(
+            ('DEST REPLY PUB=%s PRIV=privKey\n' % TEST_B64).encode('utf-8'))
+
+    def tearDown(self):
+        session._sessions = {}
+
+    def test_getSessionUsesPooledDestination(self):
+        d = session.getSession('foo', self.samEndpoint,
+                               destinationPool=self.pool)
+        # The pool is refilled, then the session is created
+        proto = self.samEndpoint.protos[2]
+        self.samEndpoint.helloAll()
+        self.assertEqual(
+            b'HELLO VERSION MIN=3.0 MAX=3.3\n'
+            b'SESSION CREATE STYLE=STREAM ID=foo DESTINATION=privKey\n',
+            proto.transport.value())
+        self.assertNoResult(d)
+
+    def test_getSessionWithKeyfileIgnoresPool(self):
+        session.getSession('foo', self.samEndpoint, keyfile=self.mktemp(),
+                           destinationPool=self.pool)
+        self.assertEqual(1, self.pool.ready())
+
+    def test_generateDestination(self):
+        tmp = self.mktemp()
+        d = session.generateDestination(tmp, self.samEndpoint,
+                                        destinationPool=self.pool)
+        def check(addr):
+            self.assertEqual(I2PAddress(TEST_B64), addr)
+            with open(tmp, 'r') as f:
+                self.assertEqual('privKey', f.read())
+        d.addCallback(check)
+        return d
@@ -1,16 +1,26 @@
 # Copyright (c) str4d <str4d@mail.i2p>
 # See COPYING for details.
 
-from twisted.internet.error import ConnectionLost, ConnectionRefusedError
-from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.error import (
+    CannotListenError,
+    ConnectionLost,
+    ConnectionRefusedError,
+    UnknownHostError,
+    UnsupportedSocketType,
+)
+from twisted.internet.protocol import DatagramProtocol, Factory, Protocol
 from twisted.internet.interfaces import IStreamServerEndpoint
 from twisted.python import failure
 from twisted.test import proto_helpers
 from twisted.trial import unittest
 
-from txi2p.sam import endpoints
+from txi2p.sam import endpoints, session as samSession
+from txi2p.sam.datagram import (MAX_DATAGRAM_SIZE, MAX_RAW_SIZE,
+                                SAMI2PDatagramPort, SAMI2PRawPort)
 from txi2p.sam.session import SAMSession
-from txi2p.test.util import FakeEndpoint, FakeFactory, fakeSession
+from txi2p.sam.stream import StreamForwardPort
+from txi2p.test.util import FakeEndpoint, FakeFactory, fakeSession, TEST_B64
+from .util import FakeSAMEndpoint, FakeUDPReactor
 
 
 connectionLostFailure = failure.Failure(ConnectionLost())
@@ -79,6 +89,31 @@ class SAMI2PStreamClientEndpointTestCase(unittest.TestCase):
         endpoint.connect(None)
         self.assertSubstring('HELLO VERSION', samEndpoint.transport.value().decode('utf-8'))
 
+    def test_streamConnectWithCachedName(self):
+        samEndpoint = FakeEndpoint()
+        session = SAMSession()
+        session.samEndpoint = samEndpoint
+        session.samVersion = '3.1'
+        session.id = 'foo'
+        session.namingCache.put('foo.i2p', 'foodest')
+        endpoint = endpoints.SAMI2PStreamClientEndpoint(session, 'foo.i2p')
+        endpoint.connect(None)
+        samEndpoint.transport.clear()
+        samEndpoint.proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        self.assertEqual(
+            b'STREAM CONNECT ID=foo DESTINATION=foodest SILENT=false\n',
+            samEndpoint.transport.value())
+
+    def test_streamConnectWithCachedNameNotFound(self):
+        samEndpoint = FakeEndpoint()
+        session = SAMSession()
+        session.samEndpoint = samEndpoint
+        session.namingCache.putNotFound('foo.i2p')
+        endpoint = endpoints.SAMI2PStreamClientEndpoint(session, 'foo.i2p')
+        d = endpoint.connect(None)
+        self.failureResultOf(d, UnknownHostError)
+        self.assertFalse(hasattr(samEndpoint, 'factory'))
+
 
 
 class SAMI2PStreamServerEndpointTestCase(unittest.TestCase):
@@ -121,3 +156,285 @@ class SAMI2PStreamServerEndpointTestCase(unittest.TestCase):
         endpoint = endpoints.SAMI2PStreamServerEndpoint(session)
         endpoint.listen(None)
         self.assertSubstring('HELLO VERSION', str(samEndpoint.transport.value()))
+
+    def test_streamForward(self):
+        reactor = proto_helpers.MemoryReactor()
+        samEndpoint = FakeEndpoint()
+        session = SAMSession()
+        session.samEndpoint = samEndpoint
+        session.samVersion = '3.2'
+        session.id = 'foo'
+        endpoint = endpoints.SAMI2PStreamServerEndpoint(
+            session, forward=True, reactor=reactor)
+        d = endpoint.listen(Factory.forProtocol(Protocol))
+        self.assertEqual(1, len(reactor.tcpServers))
+        self.assertEqual('127.0.0.1', reactor.tcpServers[0][3])
+        samEndpoint.proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.2\n')
+        self.assertEqual(
+            b'STREAM FORWARD ID=foo PORT=0 SILENT=false\n',
+            samEndpoint.transport.value().split(b'\n', 1)[1])
+        self.assertNoResult(d)
+        samEndpoint.proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
+        port = self.successResultOf(d)
+        self.assertIsInstance(port, StreamForwardPort)
+        port.stopListening()
+        self.assertTrue(samEndpoint.transport.disconnecting)
+
+    def test_streamForwardFailed(self):
+        reactor = proto_helpers.MemoryReactor()
+        samEndpoint = FakeEndpoint()
+        session = SAMSession()
+        session.samEndpoint = samEndpoint
+        session.samVersion = '3.2'
+        session.id = 'foo'
+        endpoint = endpoints.SAMI2PStreamServerEndpoint(
+            session, forward=True, reactor=reactor)
+        d = endpoint.listen(Factory.forProtocol(Protocol))
+        samEndpoint.proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.2\n')
+        samEndpoint.proto.dataReceived(
+            b'STREAM STATUS RESULT=I2P_ERROR MESSAGE="no"\n')
+        self.failureResultOf(d)
+
+
+class RecordingDatagramProtocol(DatagramProtocol):
+    def __init__(self):
+        self.received = []
+
+    def datagramReceived(self, datagram, addr):
+        self.received.append((datagram, addr))
+
+
+def listenOnFakeSAM(endpointClass, nickname, **kw):
+    reactor = FakeUDPReactor()
+    samEndpoint = FakeEndpoint()
+    endpoint = endpointClass(samEndpoint, nickname=nickname, reactor=reactor,
+                             **kw)
+    proto = RecordingDatagramProtocol()
+    d = endpoint.listen(proto)
+    samEndpoint.proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.2\n')
+    samEndpoint.proto.dataReceived(
+        b'SESSION STATUS RESULT=OK DESTINATION=bar\n')
+    samEndpoint.proto.dataReceived(
+        ('NAMING REPLY RESULT=OK NAME=ME VALUE=%s\n' % TEST_B64).encode('utf-8'))
+    samEndpoint.proto.receiver.stopPinging()
+    return reactor.udpPorts[0], proto, d
+
+
+class SAMI2PDatagramEndpointTestCase(unittest.TestCase):
+    """
+    Tests for I2P datagram Endpoint backed by the SAM API.
+    """
+
+    def tearDown(self):
+        samSession._sessions = {}
+
+    def test_samConnectionFailed(self):
+        reactor = FakeUDPReactor()
+        samEndpoint = FakeEndpoint(failure=connectionRefusedFailure)
+        endpoint = endpoints.SAMI2PDatagramEndpoint(samEndpoint, reactor=reactor)
+        d = endpoint.listen(DatagramProtocol())
+        self.failureResultOf(d, ConnectionRefusedError)
+        self.assertFalse(reactor.udpPorts[0].listening)
+
+    def test_datagramListen(self):
+        reactor = FakeUDPReactor()
+        samEndpoint = FakeEndpoint()
+        endpoint = endpoints.SAMI2PDatagramEndpoint(
+            samEndpoint, nickname='dgram', reactor=reactor)
+        proto = DatagramProtocol()
+        d = endpoint.listen(proto)
+        samEndpoint.proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        self.assertEqual(
+            b'SESSION CREATE STYLE=DATAGRAM ID=dgram DESTINATION=TRANSIENT '
+            b'SIGNATURE_TYPE=EdDSA_SHA512_Ed25519 PORT=40000 HOST=127.0.0.1\n',
+            samEndpoint.transport.value().split(b'\n', 1)[1])
+        samEndpoint.proto.dataReceived(
+            b'SESSION STATUS RESULT=OK DESTINATION=bar\n')
+        samEndpoint.proto.dataReceived(
+            ('NAMING REPLY RESULT=OK NAME=ME VALUE=%s\n' % TEST_B64).encode('utf-8'))
+        port = self.successResultOf(d)
+        self.assertIsInstance(port, SAMI2PDatagramPort)
+        self.assertIs(port, proto.transport)
+        self.assertEqual(TEST_B64, port.getHost().destination)
+        # Sent to the SAM server's UDP port
+        port.write(b'hello', 'bar.i2p')
+        self.assertEqual(
+            [(b'3.0 dgram bar.i2p\nhello', ('192.168.1.1', 7655))],
+            reactor.udpPorts[0].written)
+
+    def test_largeDatagramForwarded(self):
+        udpPort, proto, d = listenOnFakeSAM(
+            endpoints.SAMI2PDatagramEndpoint, 'dgram')
+        self.successResultOf(d)
+        payload = b'x' * MAX_DATAGRAM_SIZE
+        udpPort.deliver(TEST_B64.encode('utf-8') + b'\n' + payload,
+                        ('192.168.1.1', 7655))
+        self.assertEqual(payload, proto.received[0][0])
+
+    def test_listenAgainAfterStopListening(self):
+        reactor = FakeUDPReactor()
+        samEndpoint = FakeEndpoint()
+        endpoint = endpoints.SAMI2PDatagramEndpoint(
+            samEndpoint, reactor=reactor)
+        d = endpoint.listen(DatagramProtocol())
+        samEndpoint.proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        samEndpoint.proto.dataReceived(
+            b'SESSION STATUS RESULT=OK DESTINATION=bar\n')
+        samEndpoint.proto.dataReceived(
+            ('NAMING REPLY RESULT=OK NAME=ME VALUE=%s\n' % TEST_B64).encode('utf-8'))
+        port = self.successResultOf(d)
+        self.successResultOf(port.stopListening())
+        # The session is still open, and forwards to the same UDP port
+        port2 = self.successResultOf(endpoint.listen(DatagramProtocol()))
+        self.assertIs(port._session, port2._session)
+        self.assertEqual(40000, reactor.udpPorts[1].getHost().port)
+        self.assertTrue(port2.listening)
+
+    def test_defaultEndpointsUseOwnSessions(self):
+        reactor = FakeUDPReactor()
+        samEndpoint = FakeSAMEndpoint()
+        ds = [endpoints.SAMI2PDatagramEndpoint(
+                  samEndpoint, reactor=reactor).listen(DatagramProtocol())
+              for i in range(2)]
+        samEndpoint.helloAll()
+        for proto in samEndpoint.protos:
+            proto.dataReceived(b'SESSION STATUS RESULT=OK DESTINATION=bar\n')
+            proto.dataReceived(
+                ('NAMING REPLY RESULT=OK NAME=ME VALUE=%s\n' % TEST_B64).encode('utf-8'))
+        port1, port2 = [self.successResultOf(d) for d in ds]
+        self.assertNotEqual(port1._session.id, port2._session.id)
+        self.assertEqual(40000, port1._session.forwardPort)
+        self.assertEqual(40001, port2._session.forwardPort)
+
+    def test_datagramFromOtherAddressDelivered(self):
+        # The SAM server may send from another address than the API's
+        udpPort, proto, d = listenOnFakeSAM(
+            endpoints.SAMI2PDatagramEndpoint, 'dgram')
+        port = self.successResultOf(d)
+        self.assertEqual('192.168.1.1', port._session.samHost)
+        udpPort.deliver(TEST_B64.encode('utf-8') + b'\nhello',
+                        ('127.0.0.1', 7655))
+        self.assertEqual(b'hello', proto.received[0][0])
+
+    def test_checkSenderDropsDatagramFromOtherAddress(self):
+        udpPort, proto, d = listenOnFakeSAM(
+            endpoints.SAMI2PDatagramEndpoint, 'dgram', checkSender=True)
+        self.successResultOf(d)
+        udpPort.deliver(TEST_B64.encode('utf-8') + b'\nspam',
+                        ('127.0.0.1', 7655))
+        self.assertEqual([], proto.received)
+        udpPort.deliver(TEST_B64.encode('utf-8') + b'\nhello',
+                        ('192.168.1.1', 7655))
+        self.assertEqual(b'hello', proto.received[0][0])
+
+    def test_datagramListenOnPrimary(self):
+        reactor = FakeUDPReactor()
+        samEndpoint = FakeSAMEndpoint()
+        d = samSession.getSession('primary', samEndpoint, style='PRIMARY')
+        proto = samEndpoint.protos[0]
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.3\n')
+        proto.dataReceived(b'SESSION STATUS RESULT=OK DESTINATION=bar\n')
+        proto.dataReceived(
+            ('NAMING REPLY RESULT=OK NAME=ME VALUE=%s\n' % TEST_B64).encode('utf-8'))
+        self.addCleanup(proto.receiver.stopPinging)
+        primary = self.successResultOf(d)
+        proto.transport.clear()
+
+        endpoint = endpoints.SAMI2PDatagramEndpoint(
+            samEndpoint, nickname='dgram', reactor=reactor, primary=primary)
+        d = endpoint.listen(DatagramProtocol())
+        self.assertEqual(
+            b'SESSION ADD STYLE=DATAGRAM ID=dgram PORT=40000 HOST=127.0.0.1\n',
+            proto.transport.value())
+        proto.dataReceived(b'SESSION STATUS RESULT=OK ID=dgram\n')
+        port = self.successResultOf(d)
+        self.assertEqual(TEST_B64, port.getHost().destination)
+        port.write(b'hello', 'bar.i2p')
+        self.assertEqual(b'3.0 dgram bar.i2p\nhello',
+                         reactor.udpPorts[0].written[0][0])
+
+    def test_datagramListenOnStreamSession(self):
+        reactor = FakeUDPReactor()
+        s = SAMSession()
+        s.style = 'STREAM'
+        samSession._sessions['foo'] = s
+        endpoint = endpoints.SAMI2PDatagramEndpoint(
+            FakeEndpoint(), nickname='foo', reactor=reactor)
+        d = endpoint.listen(DatagramProtocol())
+        self.failureResultOf(d, UnsupportedSocketType)
+        self.assertFalse(reactor.udpPorts[0].listening)
+
+    def test_datagramListenTwiceOnSession(self):
+        reactor = FakeUDPReactor()
+        s = SAMSession()
+        s.style = 'DATAGRAM'
+        s.forwardPort = 12345
+        samSession._sessions['foo'] = s
+        endpoint = endpoints.SAMI2PDatagramEndpoint(
+            FakeEndpoint(), nickname='foo', reactor=reactor)
+        d = endpoint.listen(DatagramProtocol())
+        self.failureResultOf(d, CannotListenError)
+        self.assertFalse(reactor.udpPorts[0].listening)
+
+
+class SAMI2PRawEndpointTestCase(unittest.TestCase):
+    """
+    Tests for I2P raw datagram Endpoint backed by the SAM API.
+    """
+
+    def tearDown(self):
+        samSession._sessions = {}
+
+    def test_rawListen(self):
+        reactor = FakeUDPReactor()
+        samEndpoint = FakeEndpoint()
+        endpoint = endpoints.SAMI2PRawEndpoint(
+            samEndpoint, nickname='raw', reactor=reactor,
+            rawProtocol=42, header=True)
+        proto = DatagramProtocol()
+        d = endpoint.listen(proto)
+        samEndpoint.proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.2\n')
+        self.assertSubstring(
+            b'SESSION CREATE STYLE=RAW ID=raw DESTINATION=TRANSIENT',
+            samEndpoint.transport.value())
+        self.assertSubstring(b' PORT=40000 HOST=127.0.0.1',
+                             samEndpoint.transport.value())
+        self.assertSubstring(b' PROTOCOL=42', samEndpoint.transport.value())
+        self.assertSubstring(b' HEADER=true', samEndpoint.transport.value())
+        samEndpoint.proto.dataReceived(
+            b'SESSION STATUS RESULT=OK DESTINATION=bar\n')
+        samEndpoint.proto.dataReceived(
+            ('NAMING REPLY RESULT=OK NAME=ME VALUE=%s\n' % TEST_B64).encode('utf-8'))
+        port = self.successResultOf(d)
+        self.addCleanup(samEndpoint.proto.receiver.stopPinging)
+        self.assertIsInstance(port, SAMI2PRawPort)
+        self.assertIs(port, proto.transport)
+
+    def test_largeRawDatagramForwarded(self):
+        udpPort, proto, d = listenOnFakeSAM(
+            endpoints.SAMI2PRawEndpoint, 'raw', header=True)
+        self.successResultOf(d)
+        payload = b'x' * MAX_RAW_SIZE
+        udpPort.deliver(b'FROM_PORT=1 TO_PORT=2 PROTOCOL=18\n' + payload,
+                        ('192.168.1.1', 7655))
+        self.assertEqual(payload, proto.received[0][0])
+
+    def test_rawListenDefaultOptions(self):
+        reactor = FakeUDPReactor()
+        samEndpoint = FakeEndpoint()
+        endpoint = endpoints.SAMI2PRawEndpoint(
+            samEndpoint, nickname='raw', reactor=reactor)
+        endpoint.listen(DatagramProtocol())
+        samEndpoint.proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.2\n')
+        self.assertNotIn(b'PROTOCOL=', samEndpoint.transport.value())
+        self.assertNotIn(b'HEADER=', samEndpoint.transport.value())
+
+    def test_rawListenOnDatagramSession(self):
+        reactor = FakeUDPReactor()
+        s = SAMSession()
+        s.style = 'DATAGRAM'
+        samSession._sessions['foo'] = s
+        endpoint = endpoints.SAMI2PRawEndpoint(
+            FakeEndpoint(), nickname='foo', reactor=reactor)
+        d = endpoint.listen(DatagramProtocol())
+        self.failureResultOf(d, UnsupportedSocketType)
@@ -0,0 +1,116 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from builtins import range
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from txi2p.sam.keepalive import KeepaliveScheduler
+
+
+class FakeConnection(object):
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.pings = 0
+        self.timedOut = False
+
+    def _sendPing(self):
+        self.pings += 1
+        self.scheduler.pingSent(self)
+
+    def _pingTimedOut(self):
+        self.timedOut = True
+        self.scheduler.remove(self)
+
+
+class TestKeepaliveScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = KeepaliveScheduler(
+            interval=60, timeout=30, tick=5, clock=self.clock)
+
+    def advance(self, seconds):
+        # Clock.advance() only runs calls due by the end, so step by tick
+        self.clock.pump([self.scheduler.tick] * (seconds // self.scheduler.tick))
+
+    def test_pingAfterInterval(self):
+        conn = FakeConnection(self.scheduler)
+        self.scheduler.add(conn)
+        self.advance(55)
+        self.assertEqual(0, conn.pings)
+        self.advance(5)
+        self.assertEqual(1, conn.pings)
+        self.assertTrue(self.scheduler.awaitingPong(conn))
+
+    def test_resetDefersPing(self):
+        conn = FakeConnection(self.scheduler)
+        self.scheduler.add(conn)
+        self.advance(50)
+        self.scheduler.reset(conn)
+        self.advance(50)
+        self.assertEqual(0, conn.pings)
+        self.advance(10)
+        self.assertEqual(1, conn.pings)
+
+    def test_resetIgnoresUnknownConnection(self):
+        conn = FakeConnection(self.scheduler)
+        self.scheduler.reset(conn)
+        self.assertNotIn(conn, self.scheduler)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_pongReceived(self):
+        conn = FakeConnection(self.scheduler)
+        self.scheduler.add(conn)
+        self.advance(60)
+        self.clock.advance(2)
+        self.assertEqual(2, self.scheduler.pongReceived(conn))
+        self.assertFalse(self.scheduler.awaitingPong(conn))
+        # Not closed once the timeout passes
+        self.advance(30)
+        self.assertFalse(conn.timedOut)
+        self.assertIn(conn, self.scheduler)
+
+    def test_pongWithoutPing(self):
+        conn = FakeConnection(self.scheduler)
+        self.assertEqual(None, self.scheduler.pongReceived(conn))
+        self.scheduler.add(conn)
+        self.assertEqual(None, self.scheduler.pongReceived(conn))
+
+    def test_timeout(self):
+        conn = FakeConnection(self.scheduler)
+        self.scheduler.add(conn)
+        self.advance(60)
+        self.advance(25)
+        self.assertFalse(conn.timedOut)
+        self.advance(5)
+        self.assertTrue(conn.timedOut)
+
+    def test_oneTimerForManyConnections(self):
+        conns = [FakeConnection(self.scheduler) for i in range(100)]
+        for i, conn in enumerate(conns):
+            self.scheduler.add(conn)
+            # Activity on some connections
+            if i % 2:
+                self.scheduler.reset(conn)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.advance(60)
+        # All due in the same tick, so sent together
+        self.assertEqual([1] * 100, [conn.pings for conn in conns])
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+    def test_timerStopsWhenEmpty(self):
+        conn = FakeConnection(self.scheduler)
+        self.scheduler.add(conn)
+        self.scheduler.remove(conn)
+        self.assertEqual(0, len(self.scheduler))
+        self.assertEqual([], self.clock.getDelayedCalls())
+        # Removing again does nothing
+        self.scheduler.remove(conn)
+
+    def test_timerStopsAfterTimeout(self):
+        conn = FakeConnection(self.scheduler)
+        self.scheduler.add(conn)
+        self.advance(90)
+        self.assertTrue(conn.timedOut)
+        self.assertEqual([], self.clock.getDelayedCalls())
@@ -0,0 +1,177 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet.error import (
+    ConnectError,
+    ConnectionDone,
+    ConnectionLost,
+    ConnectionRefusedError,
+    UnknownHostError,
+)
+from twisted.internet.task import Clock
+from twisted.python import failure
+from twisted.trial import unittest
+
+from txi2p.sam.naming import NamingCache, NamingResolver
+from .util import FakeSAMEndpoint
+
+
+class TestNamingCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = NamingCache(maxSize=2, ttl=10, negativeTTL=5,
+                                 clock=self.clock)
+
+    def test_miss(self):
+        self.assertRaises(KeyError, self.cache.get, 'spam.i2p')
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+
+    def test_hit(self):
+        self.cache.put('spam.i2p', 'spamdest')
+        self.assertEqual('spamdest', self.cache.get('spam.i2p'))
+        self.assertEqual((1, 0), (self.cache.hits, self.cache.misses))
+
+    def test_notFound(self):
+        self.cache.putNotFound('spam.i2p')
+        self.assertEqual(None, self.cache.get('spam.i2p'))
+        self.assertEqual((1, 0), (self.cache.hits, self.cache.misses))
+
+    def test_expiry(self):
+        self.cache.put('spam.i2p', 'spamdest')
+        self.clock.advance(9)
+        self.assertEqual('spamdest', self.cache.get('spam.i2p'))
+        self.clock.advance(1)
+        self.assertRaises(KeyError, self.cache.get, 'spam.i2p')
+        self.assertEqual(0, len(self.cache))
+
+    def test_negativeExpiry(self):
+        self.cache.putNotFound('spam.i2p')
+        self.clock.advance(5)
+        self.assertRaises(KeyError, self.cache.get, 'spam.i2p')
+
+    def test_lruEviction(self):
+        self.cache.put('spam.i2p', 'spamdest')
+        self.cache.put('eggs.i2p', 'eggsdest')
+        # Use spam.i2p so that eggs.i2p is the least recently used
+        self.cache.get('spam.i2p')
+        self.cache.put('ham.i2p', 'hamdest')
+        self.assertEqual(2, len(self.cache))
+        self.assertEqual('spamdest', self.cache.get('spam.i2p'))
+        self.assertEqual('hamdest', self.cache.get('ham.i2p'))
+        self.assertRaises(KeyError, self.cache.get, 'eggs.i2p')
+
+    def test_putReplaces(self):
+        self.cache.putNotFound('spam.i2p')
+        self.cache.put('spam.i2p', 'spamdest')
+        self.assertEqual('spamdest', self.cache.get('spam.i2p'))
+
+    def test_clear(self):
+        self.cache.put('spam.i2p', 'spamdest')
+        self.cache.clear()
+        self.assertRaises(KeyError, self.cache.get, 'spam.i2p')
+
+
+class TestNamingResolver(unittest.TestCase):
+    def setUp(self):
+        self.samEndpoint = FakeSAMEndpoint()
+        self.cache = NamingCache(clock=Clock())
+        self.resolver = NamingResolver(self.samEndpoint, self.cache)
+
+    def connect(self):
+        self.samEndpoint.helloAll()
+        proto = self.samEndpoint.protos[-1]
+        # Drop the HELLO
+        sent = proto.transport.value().split(b'\n', 1)[1]
+        proto.transport.clear()
+        return proto, sent
+
+    def test_lookupsPipelined(self):
+        d1 = self.resolver.lookup('spam.i2p')
+        d2 = self.resolver.lookup('eggs.i2p')
+        self.assertEqual(1, len(self.samEndpoint.protos))
+        proto, sent = self.connect()
+        self.assertEqual(
+            b'NAMING LOOKUP NAME=spam.i2p\nNAMING LOOKUP NAME=eggs.i2p\n',
+            sent)
+        d3 = self.resolver.lookup('ham.i2p')
+        self.assertEqual(b'NAMING LOOKUP NAME=ham.i2p\n', proto.transport.value())
+        proto.dataReceived(
+            b'NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=spamdest\n'
+            b'NAMING REPLY RESULT=OK NAME=eggs.i2p VALUE=eggsdest\n')
+        self.assertEqual('spamdest', self.successResultOf(d1))
+        self.assertEqual('eggsdest', self.successResultOf(d2))
+        self.assertNoResult(d3)
+        proto.dataReceived(b'NAMING REPLY RESULT=OK NAME=ham.i2p VALUE=hamdest\n')
+        self.assertEqual('hamdest', self.successResultOf(d3))
+        self.assertFalse(proto.transport.disconnecting)
+
+    def test_lookupCached(self):
+        self.cache.put('spam.i2p', 'spamdest')
+        self.cache.putNotFound('eggs.i2p')
+        self.assertEqual('spamdest',
+                         self.successResultOf(self.resolver.lookup('spam.i2p')))
+        self.failureResultOf(self.resolver.lookup('eggs.i2p'), UnknownHostError)
+        self.assertEqual([], self.samEndpoint.protos)
+
+    def test_lookupSameNameShared(self):
+        d1 = self.resolver.lookup('spam.i2p')
+        d2 = self.resolver.lookup('spam.i2p')
+        proto, sent = self.connect()
+        self.assertEqual(b'NAMING LOOKUP NAME=spam.i2p\n', sent)
+        proto.dataReceived(b'NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=spamdest\n')
+        self.assertEqual('spamdest', self.successResultOf(d1))
+        self.assertEqual('spamdest', self.successResultOf(d2))
+        self.assertEqual('spamdest', self.cache.get('spam.i2p'))
+
+    def test_lookupNotFound(self):
+        d = self.resolver.lookup('spam.i2p')
+        proto, sent = self.connect()
+        proto.dataReceived(b'NAMING REPLY RESULT=KEY_NOT_FOUND NAME=spam.i2p\n')
+        self.failureResultOf(d, UnknownHostError)
+        self.assertEqual(None, self.cache.get('spam.i2p'))
+
+    def test_lookupMany(self):
+        d = self.resolver.lookupMany(['spam.i2p', 'eggs.i2p'])
+        proto, sent = self.connect()
+        proto.dataReceived(
+            b'NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=spamdest\n'
+            b'NAMING REPLY RESULT=KEY_NOT_FOUND NAME=eggs.i2p\n')
+        self.assertEqual({'spam.i2p': 'spamdest', 'eggs.i2p': None},
+                         self.successResultOf(d))
+
+    def test_lookupManyError(self):
+        d = self.resolver.lookupMany(['spam.i2p', 'eggs.i2p'])
+        proto, sent = self.connect()
+        proto.dataReceived(
+            b'NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=spamdest\n'
+            b'NAMING REPLY RESULT=I2P_ERROR NAME=eggs.i2p MESSAGE="foo"\n')
+        self.failureResultOf(d, ConnectError)
+
+    def test_connectionFailed(self):
+        self.samEndpoint.failure = failure.Failure(ConnectionRefusedError())
+        d = self.resolver.lookup('spam.i2p')
+        self.failureResultOf(d, ConnectionRefusedError)
+        # The next lookup tries again
+        self.samEndpoint.failure = None
+        self.resolver.lookup('spam.i2p')
+        self.assertEqual(1, len(self.samEndpoint.protos))
+
+    def test_connectionLost(self):
+        d = self.resolver.lookup('spam.i2p')
+        proto, sent = self.connect()
+        proto.connectionLost(failure.Failure(ConnectionLost()))
+        self.failureResultOf(d, ConnectionLost)
+        # The next lookup reconnects
+        self.resolver.lookup('spam.i2p')
+        self.assertEqual(2, len(self.samEndpoint.protos))
+
+    def test_close(self):
+        d = self.resolver.lookup('spam.i2p')
+        proto, sent = self.connect()
+        self.resolver.close()
+        self.assertTrue(proto.transport.disconnecting)
+
+    def test_closeWhileConnecting(self):
+        d = self.resolver.lookup('spam.i2p')
+        self.resolver.close()
+        self.failureResultOf(d, ConnectionDone)
@@ -0,0 +1,163 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from ometa.tube import TrampolinedParser
+from twisted.trial import unittest
+
+from txi2p import grammar
+from txi2p.sam import base, parser
+from txi2p.test.util import TEST_B64
+from . import test_session, test_stream
+
+
+class RecordingReceiver(object):
+    def __init__(self, rule):
+        self.currentRule = rule
+        self.calls = []
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+        return record
+
+
+# (rule, reply) pairs that both parsers must handle identically.
+CORPUS = [
+    ('State_hello', 'HELLO REPLY RESULT=OK VERSION=3.1\n'),
+    ('State_hello', 'HELLO REPLY RESULT=NOVERSION\n'),
+    ('State_hello', 'HELLO REPLY RESULT=I2P_ERROR MESSAGE="Something failed"\n'),
+    ('State_create', 'SESSION STATUS RESULT=OK DESTINATION=%s\n' % TEST_B64),
+    ('State_create', 'SESSION STATUS RESULT=DUPLICATED_ID\n'),
+    ('State_create', 'SESSION STATUS RESULT=I2P_ERROR MESSAGE="SIGNATURE_TYPE foo unsupported"\n'),
+    ('State_connect', 'STREAM STATUS RESULT=OK\n'),
+    ('State_connect', 'STREAM STATUS RESULT=CANT_REACH_PEER MESSAGE="Can\'t reach peer"\n'),
+    ('State_accept', 'STREAM STATUS RESULT=OK\n'),
+    ('State_accept', 'STREAM STATUS RESULT=INVALID_ID MESSAGE=""\n'),
+    ('State_forward', 'STREAM STATUS RESULT=I2P_ERROR MESSAGE="foo bar baz"\n'),
+    ('State_naming', 'NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=%s\n' % TEST_B64),
+    ('State_naming', 'NAMING REPLY RESULT=KEY_NOT_FOUND NAME=spam.i2p\n'),
+    ('State_naming', 'NAMING REPLY RESULT=OK NAME=ME VALUE=\n'),
+    ('State_dest', 'DEST REPLY PUB=%s PRIV=foobar\n' % TEST_B64),
+    ('State_dest', 'DEST REPLY RESULT=I2P_ERROR MESSAGE="SIGNATURE_TYPE foo unsupported"\n'),
+    ('State_keepalive', 'PING\n'),
+    ('State_keepalive', 'PING 1234567890\n'),
+    ('State_keepalive', 'PING   some random data\n'),
+    ('State_keepalive', 'PONG\n'),
+    ('State_keepalive', 'PONG 1234567890.123\n'),
+    ('State_primary', 'PING 1234567890\n'),
+    ('State_primary', 'SESSION STATUS RESULT=OK ID=foo MESSAGE="ADD foo"\n'),
+    ('State_primary', 'SESSION STATUS RESULT=DUPLICATED_ID ID=foo\n'),
+    # Oddities that the grammar accepts
+    ('State_hello', 'HELLO REPLY Result=OK result=NOVERSION\n'),
+    ('State_hello', 'HELLO REPLY RESULT=OK=OK\n'),
+    ('State_hello', 'HELLO REPLY RESULT=OK  VERSION=3.1\n'),
+    # Replies that both parsers reject
+    ('State_hello', 'HELLO REPLY\n'),
+    ('State_hello', 'SESSION STATUS RESULT=OK\n'),
+    ('State_connect', 'STREAM STATUS RESULT="OK"X\n'),
+    ('State_keepalive', 'PING \n'),
+    ('State_keepalive', 'PINGPONG\n'),
+    ('State_keepalive', 'HELLO REPLY RESULT=OK\n'),
+    ('State_keepalive', 'SESSION STATUS RESULT=OK ID=foo\n'),
+    ('State_primary', 'HELLO REPLY RESULT=OK\n'),
+]
+
+
+def grammarParse(rule, reply):
+    receiver = RecordingReceiver(rule)
+    p = TrampolinedParser(grammar.getSAMGrammar(), receiver, {})
+    try:
+        p.receive(reply)
+    except Exception:
+        return None
+    return receiver.calls
+
+def fastParse(rule, reply, chunkSize=None):
+    receiver = RecordingReceiver(rule)
+    p = parser.SAMReplyParser(receiver)
+    data = reply.encode('utf-8')
+    chunkSize = chunkSize or len(data)
+    try:
+        for i in range(0, len(data), chunkSize):
+            p.receive(data[i:i+chunkSize])
+    except parser.SAMParseError:
+        return None
+    return receiver.calls
+
+
+class TestSAMReplyParser(unittest.TestCase):
+    def test_corpusMatchesGrammar(self):
+        for rule, reply in CORPUS:
+            self.assertEqual(grammarParse(rule, reply), fastParse(rule, reply),
+                             'Parsers differ on %r' % reply)
+
+    def test_corpusSplitIntoChunks(self):
+        for rule, reply in CORPUS:
+            self.assertEqual(fastParse(rule, reply), fastParse(rule, reply, 3),
+                             'Chunking changed result for %r' % reply)
+
+    def test_partialLineBuffered(self):
+        receiver = RecordingReceiver('State_hello')
+        p = parser.SAMReplyParser(receiver)
+        p.receive(b'HELLO REPLY RESULT=OK')
+        self.assertEqual([], receiver.calls)
+        p.receive(b' VERSION=3.1\n')
+        self.assertEqual(
+            [('hello', (), {'result': 'OK', 'version': '3.1'})],
+            receiver.calls)
+
+    def test_partialLineBounded(self):
+        receiver = RecordingReceiver('State_hello')
+        p = parser.SAMReplyParser(receiver)
+        p.receive(b'HELLO REPLY ' + b'x' * (parser.MAX_REPLY_LINE - 12))
+        self.assertRaises(parser.SAMParseError, p.receive, b'x')
+        self.assertEqual([], receiver.calls)
+
+    def test_manyRepliesThenPartialLine(self):
+        receiver = RecordingReceiver('State_naming')
+        p = parser.SAMReplyParser(receiver)
+        reply = b'NAMING REPLY RESULT=OK NAME=spam VALUE=eggs\n'
+        p.receive(reply * 3 + reply[:10])
+        self.assertEqual(3, len(receiver.calls))
+        p.receive(reply[10:])
+        self.assertEqual(4, len(receiver.calls))
+        self.assertEqual(receiver.calls[0], receiver.calls[3])
+
+    def test_trailingDataAfterReadData(self):
+        receiver = RecordingReceiver('State_connect')
+        def connect(**options):
+            receiver.currentRule = 'State_readData'
+        receiver.connect = connect
+        p = parser.SAMReplyParser(receiver)
+        p.receive(b'STREAM STATUS RESULT=OK\nEgg and spam')
+        self.assertEqual(
+            [('dataReceived', (b'Egg and spam',), {})],
+            receiver.calls)
+
+    def test_parseOptions(self):
+        self.assertEqual({}, parser.parseOptions(''))
+        self.assertEqual(
+            {'result': 'OK', 'message': 'foo bar'},
+            parser.parseOptions('RESULT=OK MESSAGE="foo bar"'))
+        self.assertRaises(parser.SAMParseError, parser.parseOptions, 'RESULT')
+
+
+class GrammarPathMixin(object):
+    def setUp(self):
+        self.patch(base.SAMParserProtocol, 'useGrammar', True)
+
+
+class TestSessionCreateProtocolWithGrammar(
+        GrammarPathMixin, test_session.TestSessionCreateProtocol):
+    pass
+
+
+class TestStreamConnectProtocolWithGrammar(
+        GrammarPathMixin, test_stream.TestStreamConnectProtocol):
+    pass
+
+
+class TestStreamAcceptProtocolWithGrammar(
+        GrammarPathMixin, test_stream.TestStreamAcceptProtocol):
+    pass
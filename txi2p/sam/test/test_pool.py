@@ -0,0 +1,144 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet import task
+from twisted.internet.error import ConnectionLost, ConnectionRefusedError
+from twisted.python import failure
+from twisted.trial import unittest
+
+from txi2p.sam import endpoints
+from txi2p.sam.pool import ControlConnectionPool
+from txi2p.sam.session import SAMSession
+from txi2p.sam.stream import StreamConnectFactory
+from txi2p.test.util import TEST_B64, FakeFactory
+from .util import FakeSAMEndpoint
+
+
+class TestControlConnectionPool(unittest.TestCase):
+    def makePool(self, size=2, idleTimeout=30):
+        self.clock = task.Clock()
+        self.samEndpoint = FakeSAMEndpoint()
+        pool = ControlConnectionPool(self.samEndpoint, size, idleTimeout,
+                                     clock=self.clock)
+        pool.start()
+        self.samEndpoint.helloAll()
+        return pool
+
+    def makeSession(self):
+        session = SAMSession()
+        session.samVersion = '3.1'
+        session.id = 'foo'
+        return session
+
+    def test_filledAfterHello(self):
+        pool = self.makePool(size=3)
+        self.assertEqual(3, len(self.samEndpoint.protos))
+        self.assertEqual(3, len(pool))
+        for proto in self.samEndpoint.protos:
+            self.assertEqual(b'HELLO VERSION MIN=3.0 MAX=3.3\n',
+                             proto.transport.value())
+
+    def test_takeSkipsHello(self):
+        pool = self.makePool()
+        proto = self.samEndpoint.protos[0]
+        proto.transport.clear()
+        fac = StreamConnectFactory(FakeFactory(), self.makeSession(),
+                                   'spam.i2p', 'bar')
+        self.assertEqual(proto, pool.take(fac))
+        self.assertEqual(
+            b'STREAM CONNECT ID=foo DESTINATION=bar SILENT=false\n',
+            proto.transport.value())
+        self.assertEqual('3.1', fac.samVersion)
+        self.assertEqual(proto, fac.currentCandidate)
+        self.assertEqual((1, 0), (pool.hits, pool.misses))
+
+    def test_takeRefills(self):
+        pool = self.makePool()
+        fac = StreamConnectFactory(FakeFactory(), self.makeSession(),
+                                   'spam.i2p', 'bar')
+        pool.take(fac)
+        self.assertEqual(3, len(self.samEndpoint.protos))
+        self.samEndpoint.helloAll()
+        self.assertEqual(2, len(pool))
+
+    def test_takeWhenEmpty(self):
+        pool = self.makePool(size=1)
+        self.samEndpoint.protos[0].transport.loseConnection()
+        self.samEndpoint.protos[0].connectionLost(
+            failure.Failure(ConnectionLost()))
+        self.assertEqual(0, len(pool))
+        fac = StreamConnectFactory(FakeFactory(), self.makeSession(),
+                                   'spam.i2p', 'bar')
+        self.assertIsNone(pool.take(fac))
+        self.assertEqual((0, 1), (pool.hits, pool.misses))
+        # The miss triggers a refill
+        self.samEndpoint.helloAll()
+        self.assertEqual(1, len(pool))
+
+    def test_idleConnectionsExpire(self):
+        pool = self.makePool(idleTimeout=30)
+        self.clock.advance(29)
+        self.assertEqual(2, len(pool))
+        self.clock.advance(1)
+        self.assertEqual(0, len(pool))
+        for proto in self.samEndpoint.protos:
+            self.assertTrue(proto.transport.disconnecting)
+        # Not replaced until there is demand
+        self.assertEqual(2, len(self.samEndpoint.protos))
+
+    def test_takenConnectionDoesNotExpire(self):
+        pool = self.makePool(size=1, idleTimeout=30)
+        proto = self.samEndpoint.protos[0]
+        pool.take(StreamConnectFactory(FakeFactory(), self.makeSession(),
+                                       'spam.i2p', 'bar'))
+        self.clock.advance(30)
+        self.assertFalse(proto.transport.disconnecting)
+
+    def test_handedOverConnectionLost(self):
+        pool = self.makePool(size=1)
+        proto = self.samEndpoint.protos[0]
+        fac = StreamConnectFactory(FakeFactory(), self.makeSession(),
+                                   'spam.i2p', 'bar')
+        pool.take(fac)
+        proto.connectionLost(failure.Failure(ConnectionLost()))
+        self.failureResultOf(fac.deferred, ConnectionLost)
+
+    def test_connectFailed(self):
+        self.clock = task.Clock()
+        self.samEndpoint = FakeSAMEndpoint()
+        self.samEndpoint.failure = failure.Failure(ConnectionRefusedError())
+        pool = ControlConnectionPool(self.samEndpoint, 2, clock=self.clock)
+        pool.start()
+        self.assertEqual(0, len(pool))
+        self.assertEqual(0, pool._pending)
+        self.flushLoggedErrors(ConnectionRefusedError)
+
+    def test_stop(self):
+        pool = self.makePool()
+        pool.stop()
+        self.assertEqual(0, len(pool))
+        self.assertEqual([], self.clock.getDelayedCalls())
+        for proto in self.samEndpoint.protos:
+            self.assertTrue(proto.transport.disconnecting)
+        pool.take(StreamConnectFactory(FakeFactory(), self.makeSession(),
+                                       'spam.i2p', 'bar'))
+        self.assertEqual(2, len(self.samEndpoint.protos))
+
+    def test_endpointUsesPool(self):
+        pool = self.makePool(size=1)
+        proto = self.samEndpoint.protos[0]
+        proto.transport.clear()
+        session = self.makeSession()
+        session.samEndpoint = self.samEndpoint
+        session.connectionPool = pool
+        endpoint = endpoints.SAMI2PStreamClientEndpoint(session, TEST_B64)
+        wrappedFactory = FakeFactory()
+        d = endpoint.connect(wrappedFactory)
+        self.assertEqual(
+            ('STREAM CONNECT ID=foo DESTINATION=%s SILENT=false\n' % TEST_B64
+             ).encode('utf-8'),
+            proto.transport.value())
+        proto.dataReceived(b'STREAM STATUS RESULT=OK\nspam')
+        self.assertEqual(wrappedFactory.proto, self.successResultOf(d))
+        self.assertEqual(b'spam', wrappedFactory.proto.data)
+        self.assertEqual(wrappedFactory.proto.dataReceived, proto.dataReceived)
@@ -0,0 +1,83 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.trial import unittest
+
+from txi2p.address import I2PAddress
+from txi2p.sam.registry import StreamRegistry, INBOUND, OUTBOUND
+from txi2p.test.util import TEST_B64
+
+
+class TestStreamRegistry(unittest.TestCase):
+    def setUp(self):
+        self.r = StreamRegistry()
+
+    def test_add(self):
+        self.r.add('foo')
+        self.r.add('bar', OUTBOUND, TEST_B64)
+        self.assertEqual(2, len(self.r))
+        self.assertIn('foo', self.r)
+        self.assertEqual(['foo', 'bar'], list(self.r))
+        self.assertEqual(None, self.r.peerOf('foo'))
+        self.assertEqual(TEST_B64, self.r.peerOf('bar'))
+        self.assertEqual(OUTBOUND, self.r.directionOf('bar'))
+
+    def test_addAgainUpdates(self):
+        self.r.add('foo', OUTBOUND, 'bar')
+        self.r.add('foo', INBOUND, 'baz')
+        self.assertEqual(1, len(self.r))
+        self.assertEqual([], self.r.find('bar'))
+        self.assertEqual([], self.r.find(direction=OUTBOUND))
+        self.assertEqual(['foo'], self.r.find('baz', INBOUND))
+
+    def test_peerFromAddress(self):
+        self.r.add('foo', INBOUND, I2PAddress(TEST_B64, port=81))
+        self.assertEqual(TEST_B64, self.r.peerOf('foo'))
+        self.assertEqual(['foo'], self.r.find(TEST_B64))
+        self.assertEqual(['foo'], self.r.find(I2PAddress(TEST_B64)))
+
+    def test_remove(self):
+        self.r.add('foo', INBOUND, 'bar')
+        self.r.remove('foo')
+        self.assertEqual(0, len(self.r))
+        self.assertEqual({}, self.r._byPeer)
+        self.assertEqual({}, self.r._byDirection)
+        # Removing again does nothing
+        self.r.remove('foo')
+
+    def test_setPeer(self):
+        self.r.add('foo', INBOUND)
+        self.assertEqual(0, self.r.count('bar'))
+        self.r.setPeer('foo', 'bar')
+        self.assertEqual(['foo'], self.r.find('bar', INBOUND))
+        # Unregistered streams are ignored
+        self.r.setPeer('baz', 'bar')
+        self.assertNotIn('baz', self.r)
+
+    def test_findAndCount(self):
+        self.r.add('a', OUTBOUND, 'x')
+        self.r.add('b', INBOUND, 'x')
+        self.r.add('c', INBOUND, 'y')
+        self.r.add('d')
+        self.assertEqual(['a', 'b', 'c', 'd'], self.r.find())
+        self.assertEqual(['b', 'c'], sorted(self.r.find(direction=INBOUND)))
+        self.assertEqual(['a', 'b'], sorted(self.r.find('x')))
+        self.assertEqual(['b'], self.r.find('x', INBOUND))
+        self.assertEqual(4, self.r.count())
+        self.assertEqual(2, self.r.count(direction=INBOUND))
+        self.assertEqual(2, self.r.count('x'))
+        self.assertEqual(1, self.r.count('x', OUTBOUND))
+        self.assertEqual(0, self.r.count('z'))
+
+    def test_iterateWhileRemoving(self):
+        self.r.add('a')
+        self.r.add('b')
+        for stream in self.r:
+            self.r.remove(stream)
+        self.assertEqual(0, len(self.r))
+
+    def test_clear(self):
+        self.r.add('a', INBOUND, 'x')
+        self.r.clear()
+        self.assertEqual([], self.r.find())
+        self.assertEqual(0, self.r.count('x'))
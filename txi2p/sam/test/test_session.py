@@ -10,16 +10,23 @@ except:
     from mock import Mock
 import os
 import twisted
-from twisted.internet import defer
+from twisted.internet import defer, error
+from twisted.python import failure
 from twisted.python.versions import Version
 from twisted.test import proto_helpers
 from twisted.trial import unittest
 
 from txi2p.address import I2PAddress
+from txi2p.keystore import KeyStore
 from txi2p.sam import session
 from txi2p.sam.constants import DEFAULT_SIGTYPE
-from txi2p.test.util import TEST_B64
-from .util import SAMProtocolTestMixin, SAMFactoryTestMixin
+from txi2p.sam.registry import INBOUND, OUTBOUND
+from txi2p.test.util import TEST_B64, TEST_PRIV_B64
+from .util import (
+    SAMProtocolTestMixin,
+    SAMFactoryTestMixin,
+    FakeSAMEndpoint,
+)
 
 if twisted.version < Version('twisted', 12, 3, 0):
     skipSRO = 'TestCase.successResultOf() requires twisted 12.3 or newer'
@@ -48,6 +55,17 @@ class TestSessionCreateProtocol(SAMProtocolTestMixin, unittest.TestCase):
             b'SESSION CREATE STYLE=STREAM ID=foo DESTINATION=TRANSIENT\n',
             proto.transport.value())
 
+    def test_sessionCreateAfterHelloWithForwardPort(self):
+        fac, proto = self.makeProto()
+        fac.style = 'DATAGRAM'
+        fac.forwardPort = 40000
+        fac.forwardHost = '127.0.0.1'
+        proto.transport.clear()
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.0\n')
+        self.assertEquals(
+            b'SESSION CREATE STYLE=DATAGRAM ID=foo DESTINATION=TRANSIENT PORT=40000 HOST=127.0.0.1\n',
+            proto.transport.value())
+
     def test_sessionCreateAfterHelloWithSigType(self):
         fac, proto = self.makeProto()
         fac.style = 'STREAM'
@@ -150,6 +168,18 @@ class TestSessionCreateProtocol(SAMProtocolTestMixin, unittest.TestCase):
             b'NAMING LOOKUP NAME=ME\n',
             proto.transport.value())
 
+    def test_sessionCreatedWithoutNamingLookup(self):
+        fac, proto = self.makeProto()
+        fac.style = 'STREAM'
+        fac.sessionCreated = Mock()
+        proto.transport.clear()
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        proto.transport.clear()
+        proto.dataReceived(('SESSION STATUS RESULT=OK DESTINATION=%s\n' % TEST_PRIV_B64).encode('utf-8'))
+        self.assertEqual(b'', proto.transport.value())
+        self.assertEqual(TEST_PRIV_B64, fac.privKey)
+        fac.sessionCreated.assert_called_with(proto.receiver, TEST_B64)
+
     def test_sessionCreatedAfterNamingLookup(self):
         fac, proto = self.makeProto()
         fac.style = 'STREAM'
@@ -197,20 +227,39 @@ class TestSessionCreateFactory(SAMFactoryTestMixin, unittest.TestCase):
     blankFactoryArgs = ('',)
 
     def test_startFactory(self):
-        tmp = '/tmp/TestSessionCreateFactory.privKey'
-        fac, proto = self.makeProto('foo', keyfile=tmp)
+        tmp = self.mktemp()
+        fac, proto = self.makeProto(
+            'foo', keyfile=tmp, keystore=KeyStore(threaded=False))
         fac.doStart()
         self.assertTrue(fac._writeKeypair)
 
     def test_startFactoryWithExistingKeyfile(self):
-        tmp = '/tmp/TestSessionCreateFactory.privKey'
+        tmp = self.mktemp()
         f = open(tmp, 'w')
         f.write(u'foo')
         f.close()
-        fac, proto = self.makeProto('foo', keyfile=tmp)
+        fac, proto = self.makeProto(
+            'foo', keyfile=tmp, keystore=KeyStore(threaded=False))
         fac.doStart()
         self.assertEqual('foo', fac.privKey)
-        os.remove(tmp)
+        self.assertFalse(fac._writeKeypair)
+
+    def test_startFactoryReadsKeyfileInBackground(self):
+        tmp = self.mktemp()
+        f = open(tmp, 'w')
+        f.write(u'foo')
+        f.close()
+        fac, proto = self.makeProto('foo', keyfile=tmp, keystore=KeyStore())
+        fac.doStart()
+        d = fac.whenKeyLoaded()
+        d.addCallback(lambda _: self.assertEqual('foo', fac.privKey))
+        return d
+
+    def test_whenKeyLoadedWithoutKeyfile(self):
+        fac, proto = self.makeProto('foo')
+        fac.doStart()
+        self.successResultOf(fac.whenKeyLoaded())
+    test_whenKeyLoadedWithoutKeyfile.skip = skipSRO
 
     def test_sessionCreated(self):
         mreactor = proto_helpers.MemoryReactor()
@@ -225,9 +274,9 @@ class TestSessionCreateFactory(SAMFactoryTestMixin, unittest.TestCase):
     test_sessionCreated.skip = skipSRO
 
     def test_sessionCreatedWithKeyfile(self):
-        tmp = '/tmp/TestSessionCreateFactory.privKey'
+        tmp = self.mktemp()
         mreactor = proto_helpers.MemoryReactor()
-        fac, proto = self.makeProto('foo', keyfile=tmp)
+        fac, proto = self.makeProto('foo', keyfile=tmp, keystore=KeyStore())
         fac.samVersion = '3.1'
         fac.privKey = 'bar'
         fac._writeKeypair = True
@@ -235,12 +284,31 @@ class TestSessionCreateFactory(SAMFactoryTestMixin, unittest.TestCase):
         proto.receiver.currentRule = 'State_naming'
         proto._parser._setupInterp()
         proto.dataReceived(('NAMING REPLY RESULT=OK NAME=ME VALUE=%s\n' % TEST_B64).encode('utf-8'))
-        f = open(tmp, 'r')
-        privKey = f.read()
-        f.close()
-        self.assertEqual('bar', privKey)
-        # Cleanup
-        os.remove(tmp)
+        def checkKeyfile(_):
+            f = open(tmp, 'r')
+            privKey = f.read()
+            f.close()
+            self.assertEqual('bar', privKey)
+        # The session is only returned once the key has been written
+        fac.deferred.addCallback(checkKeyfile)
+        return fac.deferred
+
+    def test_sessionCreated_connectionLostWhileSaving(self):
+        keystore = Mock()
+        keystore.save.return_value = saved = defer.Deferred()
+        fac, proto = self.makeProto('foo', keyfile='foo.dat', keystore=keystore)
+        fac.samVersion = '3.1'
+        fac.privKey = 'bar'
+        fac._writeKeypair = True
+        # Shortcut to end of SAM session create protocol
+        proto.receiver.currentRule = 'State_naming'
+        proto._parser._setupInterp()
+        proto.dataReceived(('NAMING REPLY RESULT=OK NAME=ME VALUE=%s\n' % TEST_B64).encode('utf-8'))
+        proto.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.failureResultOf(fac.deferred, error.ConnectionDone)
+        # Finishing the write doesn't call back the failed Deferred
+        saved.callback(None)
+        self.assertIsNone(self.successResultOf(saved))
 
 
 class TestSAMSession(unittest.TestCase):
@@ -261,33 +329,65 @@ class TestSAMSession(unittest.TestCase):
         session._sessions = {}
 
     def test_addStream(self):
-        self.assertEqual([], self.s._streams)
+        self.assertEqual([], list(self.s._streams))
         self.s.addStream('foo')
-        self.assertEqual(['foo'], self.s._streams)
+        self.assertEqual(['foo'], list(self.s._streams))
 
     def test_removeStream_autoClose(self):
         self.s._autoClose = True
         self.s.addStream('bar')
         self.s.addStream('baz')
         self.s.removeStream('bar')
-        self.assertEqual(['baz'], self.s._streams)
+        self.assertEqual(['baz'], list(self.s._streams))
         self.assertEqual(True, 'foo' in session._sessions)
         self.assertEqual(self.s, session._sessions['foo'])
         self.s.removeStream('baz')
-        self.assertEqual([], self.s._streams)
+        self.assertEqual([], list(self.s._streams))
         self.assertEqual({}, session._sessions)
 
     def test_removeStream_noAutoClose(self):
         self.s.addStream('bar')
         self.s.addStream('baz')
         self.s.removeStream('bar')
-        self.assertEqual(['baz'], self.s._streams)
+        self.assertEqual(['baz'], list(self.s._streams))
         self.assertEqual(True, 'foo' in session._sessions)
         self.assertEqual(self.s, session._sessions['foo'])
         self.s.removeStream('baz')
-        self.assertEqual([], self.s._streams)
+        self.assertEqual([], list(self.s._streams))
         self.assertEqual({'foo': self.s}, session._sessions)
 
+    def test_streamsByPeerAndDirection(self):
+        self.s.addStream('out1', OUTBOUND, TEST_B64)
+        self.s.addStream('out2', OUTBOUND, 'bar')
+        self.s.addStream('in1', INBOUND)
+        self.s.setStreamPeer('in1', I2PAddress(TEST_B64))
+        self.s.addStream('port')
+        self.assertEqual(['out1', 'out2', 'in1', 'port'], self.s.streams())
+        self.assertEqual(['in1'], self.s.streams(direction=INBOUND))
+        self.assertEqual(
+            ['in1', 'out1'], sorted(self.s.streams(I2PAddress(TEST_B64))))
+        self.assertEqual(2, self.s.countStreams(TEST_B64))
+        self.assertEqual(1, self.s.countStreams(TEST_B64, OUTBOUND))
+        self.assertEqual(2, self.s.countStreams(direction=OUTBOUND))
+        self.s.removeStream('out1')
+        self.assertEqual(1, self.s.countStreams(TEST_B64))
+        self.assertEqual(0, self.s.countStreams('baz'))
+
+    def test_closeStreams(self):
+        inbound = Mock(spec=['sender'])
+        outbound = Mock(spec=['sender'])
+        self.s.addStream(inbound, INBOUND, TEST_B64)
+        self.s.addStream(outbound, OUTBOUND, TEST_B64)
+        self.s.closeStreams(direction=INBOUND)
+        inbound.sender.transport.loseConnection.assert_called_with()
+        self.assertFalse(outbound.sender.transport.loseConnection.called)
+
+    def test_closeStreamsStopsPorts(self):
+        port = Mock(spec=['stopListening'])
+        self.s.addStream(port)
+        self.s.closeStreams()
+        port.stopListening.assert_called_with()
+
 
 class TestGetSession(unittest.TestCase):
     def tearDown(self):
@@ -323,6 +423,23 @@ class TestGetSession(unittest.TestCase):
         self.assertEqual(81, s.address.port)
     test_getSession_newNickname_withPort.skip = skipSRO
 
+    def test_getSession_newNickname_datagram(self):
+        proto = proto_helpers.AccumulatingProtocol()
+        samEndpoint = FakeEndpoint()
+        samEndpoint.deferred = defer.succeed(None)
+        samEndpoint.facDeferred = defer.succeed(('3.1', 'DATAGRAM', 'nick', proto, TEST_B64, None))
+        d = session.getSession('nick', samEndpoint, style='DATAGRAM', forwardPort=40000)
+        s = self.successResultOf(d)
+        self.assertEqual('DATAGRAM', samEndpoint.factory.style)
+        self.assertEqual('DATAGRAM', s.style)
+        self.assertEqual(40000, s.forwardPort)
+    test_getSession_newNickname_datagram.skip = skipSRO
+
+    def test_getSession_unsupportedStyle(self):
+        samEndpoint = FakeEndpoint()
+        self.assertRaises(error.UnsupportedSocketType,
+                          session.getSession, 'nick', samEndpoint, style='FOO')
+
     def test_getSession_newNickname_withoutEndpoint(self):
         proto = proto_helpers.AccumulatingProtocol()
         samEndpoint = FakeEndpoint()
@@ -358,6 +475,127 @@ class TestGetSession(unittest.TestCase):
     test_getSession_existingNickname_withoutEndpoint.skip = skipSRO
 
 
+class TestPrimarySession(unittest.TestCase):
+    def tearDown(self):
+        session._sessions = {}
+
+    def createPrimary(self, version='3.3'):
+        samEndpoint = FakeSAMEndpoint()
+        d = session.getSession('primary', samEndpoint, style='PRIMARY')
+        proto = samEndpoint.protos[0]
+        proto.dataReceived(('HELLO REPLY RESULT=OK VERSION=%s\n' % version).encode('utf-8'))
+        return samEndpoint, proto, d
+
+    def makePrimary(self):
+        samEndpoint, proto, d = self.createPrimary()
+        self.assertEqual(
+            b'SESSION CREATE STYLE=PRIMARY ID=primary DESTINATION=TRANSIENT SIGNATURE_TYPE=%s\n' % DEFAULT_SIGTYPE.encode('utf-8'),
+            proto.transport.value().split(b'\n', 1)[1])
+        proto.dataReceived(b'SESSION STATUS RESULT=OK DESTINATION=privkey\n')
+        proto.dataReceived(('NAMING REPLY RESULT=OK NAME=ME VALUE=%s\n' % TEST_B64).encode('utf-8'))
+        self.addCleanup(proto.receiver.stopPinging)
+        proto.transport.clear()
+        return proto, self.successResultOf(d)
+
+    def test_primaryRequires3point3(self):
+        samEndpoint, proto, d = self.createPrimary('3.2')
+        self.failureResultOf(d, error.UnsupportedSocketType)
+        self.assertNotIn('primary', session._pending_sessions)
+
+    def test_primarySession(self):
+        proto, primary = self.makePrimary()
+        self.assertEqual('PRIMARY', primary.style)
+        self.assertEqual('State_primary', proto.receiver.currentRule)
+        self.assertIs(primary, proto.receiver.primarySession)
+
+    def test_addSubsession(self):
+        proto, primary = self.makePrimary()
+        d = session.getSession('sub', primary=primary, localPort=81)
+        self.assertEqual(
+            b'SESSION ADD STYLE=STREAM ID=sub FROM_PORT=81\n',
+            proto.transport.value())
+        self.assertNoResult(d)
+        proto.dataReceived(b'SESSION STATUS RESULT=OK ID=sub MESSAGE="ADD sub"\n')
+        sub = self.successResultOf(d)
+        self.assertIs(primary, sub.primary)
+        self.assertEqual('STREAM', sub.style)
+        self.assertEqual('sub', sub.id)
+        self.assertEqual('3.3', sub.samVersion)
+        self.assertEqual(I2PAddress(TEST_B64, port=81), sub.address)
+        self.assertIs(primary.samEndpoint, sub.samEndpoint)
+        self.assertIs(sub, self.successResultOf(session.getSession('sub')))
+
+    def test_addSubsessionsPipelined(self):
+        proto, primary = self.makePrimary()
+        d1 = session.getSession('sub1', primary=primary)
+        d2 = session.getSession('sub2', primary=primary, style='DATAGRAM',
+                                forwardPort=40000, forwardHost='127.0.0.1')
+        self.assertEqual(
+            b'SESSION ADD STYLE=STREAM ID=sub1\n'
+            b'SESSION ADD STYLE=DATAGRAM ID=sub2 PORT=40000 HOST=127.0.0.1\n',
+            proto.transport.value())
+        # Replies without an ID are matched in order
+        proto.dataReceived(b'SESSION STATUS RESULT=OK\n')
+        self.assertEqual('STREAM', self.successResultOf(d1).style)
+        proto.dataReceived(b'SESSION STATUS RESULT=OK ID=sub2\n')
+        sub2 = self.successResultOf(d2)
+        self.assertEqual('DATAGRAM', sub2.style)
+        self.assertEqual(40000, sub2.forwardPort)
+
+    def test_addSubsessionFailed(self):
+        proto, primary = self.makePrimary()
+        d = session.getSession('sub', primary=primary)
+        proto.dataReceived(b'SESSION STATUS RESULT=DUPLICATED_DEST ID=sub MESSAGE="no"\n')
+        self.failureResultOf(d, error.ConnectBindError)
+        self.assertNotIn('sub', session._sessions)
+        self.assertNotIn('sub', session._pending_sessions)
+
+    def test_addSubsessionUnsupportedStyle(self):
+        proto, primary = self.makePrimary()
+        d = session.getSession('sub', primary=primary, style='PRIMARY')
+        self.failureResultOf(d, error.UnsupportedSocketType)
+
+    def test_addSubsessionToNonPrimary(self):
+        s = session.SAMSession()
+        self.assertRaises(error.UnsupportedSocketType,
+                          session.getSession, 'sub', primary=s)
+
+    def test_addSubsessionWithoutNickname(self):
+        proto, primary = self.makePrimary()
+        self.assertRaises(ValueError, session.getSession, None, primary=primary)
+
+    def test_closeSubsession(self):
+        proto, primary = self.makePrimary()
+        d = session.getSession('sub', primary=primary)
+        proto.dataReceived(b'SESSION STATUS RESULT=OK ID=sub\n')
+        sub = self.successResultOf(d)
+        proto.transport.clear()
+        sub.close()
+        self.assertEqual(b'SESSION REMOVE ID=sub\n', proto.transport.value())
+        self.assertFalse(proto.transport.disconnecting)
+        self.assertNotIn('sub', session._sessions)
+        proto.dataReceived(b'SESSION STATUS RESULT=OK ID=sub MESSAGE="REMOVE sub"\n')
+        self.assertEqual({}, primary._subsessions)
+
+    def test_closePrimary(self):
+        proto, primary = self.makePrimary()
+        d = session.getSession('sub', primary=primary)
+        proto.dataReceived(b'SESSION STATUS RESULT=OK ID=sub\n')
+        sub = self.successResultOf(d)
+        d2 = session.getSession('sub2', primary=primary)
+        primary.close()
+        self.assertTrue(proto.transport.disconnecting)
+        self.assertTrue(sub._closed)
+        self.assertEqual({}, session._sessions)
+        self.failureResultOf(d2, error.ConnectionDone)
+
+    def test_connectionLostFailsPendingSubsessions(self):
+        proto, primary = self.makePrimary()
+        d = session.getSession('sub', primary=primary)
+        proto.connectionLost(failure.Failure(error.ConnectionLost()))
+        self.failureResultOf(d, error.ConnectionLost)
+
+
 class TestDestGenerateProtocol(SAMProtocolTestMixin, unittest.TestCase):
     protocol = session.DestGenerateProtocol
 
@@ -419,45 +657,60 @@ class TestDestGenerateFactory(SAMFactoryTestMixin, unittest.TestCase):
     blankFactoryArgs = ('', None)
 
     def test_destGenerated(self):
-        tmp = '/tmp/TestDestGenerateFactory.privKey'
+        tmp = self.mktemp()
         mreactor = proto_helpers.MemoryReactor()
-        fac, proto = self.makeProto(tmp)
+        fac, proto = self.makeProto(tmp, keystore=KeyStore(threaded=False))
         # Shortcut to end of SAM dest generate protocol
         proto.receiver.currentRule = 'State_dest'
         proto._parser._setupInterp()
         proto.dataReceived(('DEST REPLY PUB=%s PRIV=%s\n' % (TEST_B64, 'TEST_PRIV')).encode('utf-8'))
         s = self.successResultOf(fac.deferred)
         self.assertEqual(I2PAddress(TEST_B64), s)
-        os.remove(tmp)
     test_destGenerated.skip = skipSRO
 
     def test_destGenerated_privKeySaved(self):
-        tmp = '/tmp/TestDestGenerateFactory.privKey'
+        tmp = self.mktemp()
         mreactor = proto_helpers.MemoryReactor()
-        fac, proto = self.makeProto(tmp)
+        fac, proto = self.makeProto(tmp, keystore=KeyStore())
         # Shortcut to end of SAM dest generate protocol
         proto.receiver.currentRule = 'State_dest'
         proto._parser._setupInterp()
         proto.dataReceived(('DEST REPLY PUB=%s PRIV=%s\n' % (TEST_B64, 'TEST_PRIV')).encode('utf-8'))
-        f = open(tmp, 'r')
-        privKey = f.read()
-        f.close()
-        self.assertEqual('TEST_PRIV', privKey)
-        os.remove(tmp)
+        def checkKeyfile(_):
+            f = open(tmp, 'r')
+            privKey = f.read()
+            f.close()
+            self.assertEqual('TEST_PRIV', privKey)
+        fac.deferred.addCallback(checkKeyfile)
+        return fac.deferred
+
+    def test_destGenerated_connectionClosedWhileSaving(self):
+        tmp = self.mktemp()
+        fac, proto = self.makeProto(tmp, keystore=KeyStore())
+        # Shortcut to end of SAM dest generate protocol
+        proto.receiver.currentRule = 'State_dest'
+        proto._parser._setupInterp()
+        proto.dataReceived(('DEST REPLY PUB=%s PRIV=%s\n' % (TEST_B64, 'TEST_PRIV')).encode('utf-8'))
+        proto.connectionLost(failure.Failure(error.ConnectionDone()))
+        fac.deferred.addCallback(self.assertEqual, I2PAddress(TEST_B64))
+        return fac.deferred
 
     def test_destGenerated_keyfileExists(self):
-        tmp = '/tmp/TestDestGenerateFactory.privKey'
+        tmp = self.mktemp()
         f = open(tmp, 'w')
         f.write(u'foo')
         f.close()
         mreactor = proto_helpers.MemoryReactor()
-        fac, proto = self.makeProto(tmp)
+        fac, proto = self.makeProto(tmp, keystore=KeyStore(threaded=False))
         # Shortcut to end of SAM dest generate protocol
         proto.receiver.currentRule = 'State_dest'
         proto._parser._setupInterp()
         proto.dataReceived(('DEST REPLY PUB=%s PRIV=%s\n' % (TEST_B64, 'TEST_PRIV')).encode('utf-8'))
         self.assertIsInstance(self.failureResultOf(fac.deferred).value, ValueError)
-        os.remove(tmp)
+        # The existing key is untouched
+        f = open(tmp, 'r')
+        self.assertEqual('foo', f.read())
+        f.close()
     test_destGenerated_keyfileExists.skip = skipSRO
 
 
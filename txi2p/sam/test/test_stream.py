@@ -9,15 +9,24 @@ except:
     from mock import Mock
 import os
 import twisted
-from twisted.internet import defer
+from twisted.internet import defer, task
+from twisted.internet.error import (
+    ConnectionDone,
+    ConnectionLost,
+    ConnectionRefusedError,
+)
+from twisted.python import failure
 from twisted.python.versions import Version
 from twisted.test import proto_helpers
 from twisted.trial import unittest
 
 from txi2p.address import I2PAddress
 from txi2p.sam import stream
-from txi2p.test.util import TEST_B64, FakeFactory
-from .util import SAMProtocolTestMixin, SAMFactoryTestMixin
+from txi2p.sam.naming import NamingCache
+from txi2p.sam.registry import INBOUND, OUTBOUND
+from txi2p.sam.session import SAMSession
+from txi2p.test.util import TEST_B64, FakeFactory, FastProducer
+from .util import SAMProtocolTestMixin, SAMFactoryTestMixin, FakeSAMEndpoint
 
 if twisted.version < Version('twisted', 12, 3, 0):
     skipSRO = 'TestCase.successResultOf() requires twisted 12.3 or newer'
@@ -97,6 +106,27 @@ class TestStreamConnectProtocol(SAMProtocolTestMixin, unittest.TestCase):
             b'STREAM CONNECT ID=foo DESTINATION=bar SILENT=false\n',
             proto.transport.value())
 
+    def test_namingLookupCached(self):
+        fac, proto = self.makeProto()
+        fac.session = Mock()
+        fac.session.id = 'foo'
+        fac.dest = None
+        fac.host = 'spam.i2p'
+        fac.namingCache = NamingCache()
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        proto.dataReceived(b'NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=bar\n')
+        self.assertEqual('bar', fac.namingCache.get('spam.i2p'))
+
+    def test_namingLookupNotFoundCached(self):
+        fac, proto = self.makeProto()
+        fac.dest = None
+        fac.host = 'spam.i2p'
+        fac.namingCache = NamingCache()
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        proto.dataReceived(b'NAMING REPLY RESULT=KEY_NOT_FOUND NAME=spam.i2p\n')
+        self.assertEqual(None, fac.namingCache.get('spam.i2p'))
+        fac.resultNotOK.assert_called_with('KEY_NOT_FOUND', None)
+
     def test_streamConnectReturnsError(self):
         fac, proto = self.makeProto()
         fac.session = Mock()
@@ -134,11 +164,41 @@ class TestStreamConnectFactory(SAMFactoryTestMixin, unittest.TestCase):
         proto.receiver.currentRule = 'State_connect'
         proto._parser._setupInterp()
         proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
-        session.addStream.assert_called_with(proto.receiver)
+        session.addStream.assert_called_with(proto.receiver, OUTBOUND, 'foo')
         streamProto = self.successResultOf(fac.deferred)
         self.assertEqual(proto.receiver.wrappedProto, streamProto)
     test_streamConnectionEstablished.skip = skipSRO
 
+    def test_dataPathBoundAfterStreamConnect(self):
+        wrappedFactory = FakeFactory()
+        fac, proto = self.makeProto(wrappedFactory, Mock(), 'spam.i2p', 'foo')
+        # Shortcut to end of SAM stream connect protocol
+        proto.receiver.currentRule = 'State_connect'
+        proto._parser._setupInterp()
+        proto.dataReceived(b'STREAM STATUS RESULT=OK\nEgg a')
+        self.assertEqual(wrappedFactory.proto.dataReceived, proto.dataReceived)
+        proto.dataReceived(b'nd spam')
+        self.assertEqual(b'Egg and spam', wrappedFactory.proto.data)
+
+    def test_producerThrottledBySAMSocket(self):
+        wrappedFactory = FakeFactory()
+        fac, proto = self.makeProto(wrappedFactory, Mock(), 'spam.i2p', 'foo')
+        # Shortcut to end of SAM stream connect protocol
+        proto.receiver.currentRule = 'State_connect'
+        proto._parser._setupInterp()
+        proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
+        proto.transport.clear()
+        producer = FastProducer(wrappedFactory.proto.transport, 300)
+        wrappedFactory.proto.transport.registerProducer(producer, True)
+        # The SAM socket stops accepting writes
+        proto.transport.producer.pauseProducing()
+        producer.resumeProducing()
+        self.assertTrue(producer.paused)
+        self.assertEqual(b'', proto.transport.value())
+        proto.transport.producer.resumeProducing()
+        self.assertTrue(producer.expected().startswith(proto.transport.value()))
+        self.assertNotEqual(b'', proto.transport.value())
+
 
 class TestStreamAcceptProtocol(SAMProtocolTestMixin, unittest.TestCase):
     protocol = stream.StreamAcceptProtocol
@@ -249,7 +309,7 @@ class TestStreamAcceptFactory(SAMFactoryTestMixin, unittest.TestCase):
         proto.receiver.currentRule = 'State_accept'
         proto._parser._setupInterp()
         proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
-        session.addStream.assert_called_with(proto.receiver)
+        session.addStream.assert_called_with(proto.receiver, INBOUND)
         listeningPort.addAccept.assert_called_with(proto.receiver)
     test_streamAcceptEstablished.skip = skipSRO
 
@@ -264,9 +324,24 @@ class TestStreamAcceptFactory(SAMFactoryTestMixin, unittest.TestCase):
         proto._parser._setupInterp()
         proto.dataReceived(('%s FROM_PORT=34444 TO_PORT=0\n' % TEST_B64).encode('utf-8'))
         listeningPort.removeAccept.assert_called_with(proto.receiver)
+        session.setStreamPeer.assert_called_with(
+            proto.receiver, I2PAddress(TEST_B64, port=34444))
         self.assertEqual(wrappedFactory.proto, proto.receiver.wrappedProto)
     test_streamAcceptEstablished.skip = skipSRO
 
+    def test_dataPathBoundAfterPeerAddress(self):
+        wrappedFactory = FakeFactory()
+        session = Mock()
+        session.address = I2PAddress(TEST_B64)
+        fac, proto = self.makeProto(wrappedFactory, session, Mock())
+        # Shortcut to end of SAM stream accept protocol
+        proto.receiver.currentRule = 'State_readData'
+        proto._parser._setupInterp()
+        proto.dataReceived(('%s FROM_PORT=34444 TO_PORT=0\nEgg a' % TEST_B64).encode('utf-8'))
+        self.assertEqual(wrappedFactory.proto.dataReceived, proto.dataReceived)
+        proto.dataReceived(b'nd spam')
+        self.assertEqual(b'Egg and spam', wrappedFactory.proto.data)
+
 
 class TestStreamForwardProtocol(SAMProtocolTestMixin, unittest.TestCase):
     protocol = stream.StreamForwardProtocol
@@ -322,3 +397,140 @@ class TestStreamForwardFactory(SAMFactoryTestMixin, unittest.TestCase):
         streamProto = self.successResultOf(fac.deferred)
         self.assertEqual(proto.receiver, streamProto)
     test_streamForwardEstablished.skip = skipSRO
+
+
+class TestStreamAcceptPort(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.samEndpoint = FakeSAMEndpoint()
+        self.session = SAMSession()
+        self.session.samEndpoint = self.samEndpoint
+        self.session.samVersion = '3.2'
+        self.session.id = 'foo'
+        self.session.address = I2PAddress(TEST_B64)
+
+    def makePort(self, minAccepts=2, maxAccepts=8):
+        port = stream.StreamAcceptPort(self.session, FakeFactory(),
+                                       minAccepts, maxAccepts, self.clock)
+        port.startListening()
+        self.addCleanup(port.stopListening)
+        return port
+
+    def establishAll(self, latency=0):
+        # Complete all accepts that are still opening
+        self.clock.advance(latency)
+        for proto in self.samEndpoint.protos[self.samEndpoint._greeted:]:
+            proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.2\n')
+            proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
+        self.samEndpoint._greeted = len(self.samEndpoint.protos)
+
+    def incoming(self, port):
+        receiver = port.accepts[0]
+        receiver.parser.dataReceived(
+            ('%s FROM_PORT=0 TO_PORT=0\n' % TEST_B64).encode('utf-8'))
+        return receiver
+
+    def test_startListeningOpensMinimum(self):
+        port = self.makePort(minAccepts=3)
+        self.assertEqual(3, len(self.samEndpoint.protos))
+        self.assertEqual(3, port.depth)
+        self.establishAll()
+        self.assertEqual(3, len(port.accepts))
+        self.assertEqual(3, port.depth)
+
+    def test_singleAcceptBeforeSAM32(self):
+        self.session.samVersion = '3.1'
+        port = self.makePort(minAccepts=4, maxAccepts=16)
+        self.assertEqual(1, len(self.samEndpoint.protos))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_invalidBounds(self):
+        self.assertRaises(ValueError, stream.StreamAcceptPort,
+                          self.session, FakeFactory(), 0, 8)
+        self.assertRaises(ValueError, stream.StreamAcceptPort,
+                          self.session, FakeFactory(), 4, 2)
+
+    def test_refillsEagerly(self):
+        port = self.makePort()
+        self.establishAll(latency=0.5)
+        self.assertEqual(0.5, port.refillLatency)
+        self.clock.advance(3)
+        self.incoming(port)
+        # Replaced before the stream has even been used
+        self.assertEqual(3, len(self.samEndpoint.protos))
+        self.assertEqual(2, port.depth)
+        self.assertEqual(1, port.accepted)
+        self.assertEqual(3, port.acceptWait)
+
+    def burst(self, port, arrivals, interval=0.1, latency=1):
+        # Peers arrive every interval, and accepts take latency to open
+        opened = dict.fromkeys(self.samEndpoint.protos, self.clock.seconds())
+        for i in range(arrivals):
+            self.clock.advance(interval)
+            for proto in self.samEndpoint.protos:
+                opened.setdefault(proto, self.clock.seconds())
+            for proto in self.samEndpoint.protos[self.samEndpoint._greeted:]:
+                if self.clock.seconds() - opened[proto] < latency - 1e-9:
+                    break
+                proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.2\n')
+                proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
+                self.samEndpoint._greeted += 1
+            if port.accepts:
+                self.incoming(port)
+
+    def test_growsDuringBurst(self):
+        port = self.makePort(minAccepts=2, maxAccepts=8)
+        self.establishAll(latency=1)
+        self.burst(port, 50)
+        self.assertTrue(1 <= port.refillLatency < 1.2)
+        self.assertEqual(8, port.target)
+        self.assertEqual(8, port.depth)
+
+    def test_shrinksWhenIdle(self):
+        port = self.makePort(minAccepts=2, maxAccepts=8)
+        self.establishAll(latency=1)
+        self.burst(port, 50)
+        self.establishAll()
+        accepts = list(port.accepts)
+        self.clock.advance(stream.ACCEPT_ADAPT_INTERVAL)
+        self.assertEqual(2, port.target)
+        self.assertEqual(2, port.depth)
+        self.assertEqual(accepts[:2], port.accepts)
+        for receiver in accepts[2:]:
+            self.assertTrue(receiver.sender.transport.disconnecting)
+            receiver.parser.connectionLost(
+                failure.Failure(ConnectionDone()))
+        self.assertEqual(2, port.depth)
+        self.assertEqual(
+            [], [c for c in self.clock.getDelayedCalls()
+                 if c.func == port._retry])
+
+    def test_lostAcceptReplaced(self):
+        port = self.makePort()
+        self.establishAll()
+        port.accepts[0].parser.connectionLost(
+            failure.Failure(ConnectionLost()))
+        self.assertEqual(1, port.depth)
+        self.clock.advance(stream.ACCEPT_RETRY_DELAY)
+        self.assertEqual(2, port.depth)
+        self.assertEqual(3, len(self.samEndpoint.protos))
+
+    def test_failedOpenRetried(self):
+        self.samEndpoint.failure = failure.Failure(ConnectionRefusedError())
+        port = self.makePort()
+        self.assertEqual(0, port.depth)
+        self.samEndpoint.failure = None
+        self.clock.advance(stream.ACCEPT_RETRY_DELAY)
+        self.assertEqual(2, port.depth)
+
+    def test_stopListening(self):
+        port = self.makePort()
+        self.establishAll()
+        accepts = list(port.accepts)
+        port.stopListening()
+        self.assertEqual([], port.accepts)
+        self.assertEqual([], self.clock.getDelayedCalls())
+        for receiver in accepts:
+            self.assertTrue(receiver.sender.transport.disconnecting)
+            receiver.parser.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertEqual(2, len(self.samEndpoint.protos))
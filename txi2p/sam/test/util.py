@@ -9,6 +9,7 @@ except:
     # Python 2 (library)
     from mock import Mock
 from twisted.internet import defer
+from twisted.internet.address import IPv4Address
 from twisted.internet.error import ConnectionLost, ConnectionRefusedError
 from twisted.internet.protocol import ClientFactory
 from twisted.python import failure
@@ -30,6 +31,9 @@ class SAMProtocolTestMixin(object):
         fac.localPort = None
         fac.options = {}
         fac.sigType = None
+        fac.forwardPort = None
+        fac.forwardHost = None
+        fac.whenKeyLoaded = lambda: defer.succeed(None)
         fac.protocol = protoClass
         fac.resultNotOK = Mock()
         def raise_(reason):
@@ -86,13 +90,13 @@ class SAMProtocolTestMixin(object):
         self.assertEquals(
             'PING %s\n' % proto.receiver.lastPing,
             proto.transport.value().decode('utf-8'))
-        self.assertTrue(proto.receiver.pingTimeout.active())
+        self.assertTrue(proto.receiver.awaitingPong)
         proto.transport.clear()
         proto.dataReceived(b'PING\n')
         self.assertEquals(
             b'PONG\n',
             proto.transport.value())
-        self.assertFalse(proto.receiver.pingTimeout.active())
+        self.assertFalse(proto.receiver.awaitingPong)
 
     def test_validPongResponseResetsTimeout(self):
         fac, proto = self.makeProto()
@@ -105,10 +109,23 @@ class SAMProtocolTestMixin(object):
         self.assertEquals(
             'PING %s\n' % proto.receiver.lastPing,
             proto.transport.value().decode('utf-8'))
-        self.assertTrue(proto.receiver.pingTimeout.active())
+        self.assertTrue(proto.receiver.awaitingPong)
         proto.transport.clear()
         proto.dataReceived(('PONG %s\n' % proto.receiver.lastPing).encode('utf-8'))
-        self.assertFalse(proto.receiver.pingTimeout.active())
+        self.assertFalse(proto.receiver.awaitingPong)
+
+    def test_validPongResponseRecordsRTT(self):
+        fac, proto = self.makeProto()
+        self.addCleanup(proto.receiver.stopPinging)
+        proto.transport.clear()
+        # Enable keepalive
+        proto.receiver.currentRule = 'State_keepalive'
+        proto._parser._setupInterp()
+        proto.receiver.startPinging()
+        self.assertEqual(None, proto.receiver.pingRTT)
+        proto.receiver._sendPing()
+        proto.dataReceived(('PONG %s\n' % proto.receiver.lastPing).encode('utf-8'))
+        self.assertTrue(proto.receiver.pingRTT >= 0)
 
     def test_invalidPongResponseDoesNotResetTimeout(self):
         fac, proto = self.makeProto()
@@ -121,10 +138,10 @@ class SAMProtocolTestMixin(object):
         self.assertEquals(
             'PING %s\n' % proto.receiver.lastPing,
             proto.transport.value().decode('utf-8'))
-        self.assertTrue(proto.receiver.pingTimeout.active())
+        self.assertTrue(proto.receiver.awaitingPong)
         proto.transport.clear()
         proto.dataReceived(b'PONG not what was expected\n')
-        self.assertTrue(proto.receiver.pingTimeout.active())
+        self.assertTrue(proto.receiver.awaitingPong)
 
 
 class SAMFactoryTestMixin(object):
@@ -168,3 +185,60 @@ class SAMFactoryTestMixin(object):
         fac, proto = self.makeProto(*self.blankFactoryArgs)
         for result, error in list(c.samErrorMap.items()):
             self.assertRaises(error, fac.resultNotOK, result, '')
+
+
+class FakeSAMEndpoint(object):
+    def __init__(self):
+        self.protos = []
+        self.failure = None
+        self._greeted = 0
+
+    def connect(self, fac):
+        if self.failure:
+            return defer.fail(self.failure)
+        proto = fac.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        transport.abortConnection = lambda: None
+        proto.makeConnection(transport)
+        self.protos.append(proto)
+        return defer.succeed(proto)
+
+    def helloAll(self):
+        for proto in self.protos[self._greeted:]:
+            proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        self._greeted = len(self.protos)
+
+
+class FakeUDPPort(object):
+    def __init__(self, proto, port, interface, maxPacketSize):
+        self.proto = proto
+        self.host = IPv4Address('UDP', interface, port)
+        self.maxPacketSize = maxPacketSize
+        self.written = []
+        self.listening = True
+
+    def write(self, datagram, addr):
+        self.written.append((datagram, addr))
+
+    def deliver(self, datagram, addr):
+        # Larger datagrams are truncated, as by a real socket
+        self.proto.datagramReceived(datagram[:self.maxPacketSize], addr)
+
+    def getHost(self):
+        return self.host
+
+    def stopListening(self):
+        self.listening = False
+        self.proto.doStop()
+
+
+class FakeUDPReactor(object):
+    def __init__(self):
+        self.udpPorts = []
+
+    def listenUDP(self, port, proto, interface='', maxPacketSize=8192):
+        udpPort = FakeUDPPort(proto, port or 40000 + len(self.udpPorts),
+                              interface, maxPacketSize)
+        self.udpPorts.append(udpPort)
+        proto.makeConnection(udpPort)
+        return udpPort
@@ -1,10 +1,21 @@
 # Copyright (c) str4d <str4d@mail.i2p>
 # See COPYING for details.
 
+import base64
+import gc
 import unittest
 
-from txi2p.address import I2PAddress
-from txi2p.test.util import TEST_B64, TEST_B32
+from twisted.test import proto_helpers
+
+from txi2p import address
+from txi2p.address import I2PAddress, I2PTunnelTransport
+from txi2p.test.util import (
+    TEST_B64,
+    TEST_B32,
+    TEST_PRIV_B64,
+    FastProducer,
+    SlowTransport,
+)
 
 
 class TestI2PAddress(unittest.TestCase):
@@ -65,20 +76,255 @@ class TestI2PAddress(unittest.TestCase):
 
     def test_hashWithNoHostNoPort(self):
         addr = I2PAddress(TEST_B64)
-        self.assertEqual(hash(addr), hash((TEST_B32, None)))
+        self.assertEqual(hash(addr), hash((TEST_B64, None)))
 
     def test_hashWithHostNoPort(self):
         addr = I2PAddress(TEST_B64, 'spam.i2p')
-        self.assertEqual(hash(addr), hash(('spam.i2p', None)))
+        self.assertEqual(hash(addr), hash((TEST_B64, None)))
 
     def test_hashWithNoHostPort(self):
         addr = I2PAddress(TEST_B64, port=81)
-        self.assertEqual(hash(addr), hash((TEST_B32, 81)))
+        self.assertEqual(hash(addr), hash((TEST_B64, 81)))
 
     def test_hashWithHostPort(self):
         addr = I2PAddress(TEST_B64, 'spam.i2p', 81)
-        self.assertEqual(hash(addr), hash(('spam.i2p', 81)))
+        self.assertEqual(hash(addr), hash((TEST_B64, 81)))
 
     def test_hashWithPortString(self):
         addr = I2PAddress(TEST_B64, 'spam.i2p', '81')
-        self.assertEqual(hash(addr), hash(('spam.i2p', 81)))
+        self.assertEqual(hash(addr), hash((TEST_B64, 81)))
+
+    def test_equality(self):
+        self.assertEqual(I2PAddress(TEST_B64, 'spam.i2p', 81), I2PAddress(TEST_B64, port=81))
+        self.assertNotEqual(I2PAddress(TEST_B64, port=81), I2PAddress(TEST_B64, port=82))
+        self.assertNotEqual(I2PAddress(TEST_B64), TEST_B64)
+
+    def test_noInstanceDict(self):
+        addr = I2PAddress(TEST_B64)
+        self.assertFalse(hasattr(addr, '__dict__'))
+
+
+class TestDestinationInterning(unittest.TestCase):
+    def test_destinationShared(self):
+        dest1 = ''.join(list(TEST_B64))
+        dest2 = ''.join(list(TEST_B64))
+        self.assertIsNot(dest1, dest2)
+        addr1 = I2PAddress(dest1)
+        addr2 = I2PAddress(dest2, port=81)
+        self.assertIs(addr1.destination, addr2.destination)
+        self.assertEqual(TEST_B64, addr1.destination)
+
+    def test_destinationIsPlainStr(self):
+        addr = I2PAddress(TEST_B64)
+        self.assertIs(str, type(addr.destination))
+        self.assertIs(str, type(I2PAddress(addr).destination))
+
+    def test_destinationReleased(self):
+        dest = ''.join(reversed(TEST_B64))
+        addr = I2PAddress(dest)
+        self.assertIn(dest, address._destinations)
+        del addr
+        gc.collect()
+        self.assertNotIn(dest, address._destinations)
+
+
+class TestB32Computation(unittest.TestCase):
+    def setUp(self):
+        address._b32Cache.clear()
+
+    def test_hashDoesNotComputeHost(self):
+        addr = I2PAddress(TEST_B64, port=81)
+        hash(addr)
+        self.assertEqual(None, addr._host)
+
+    def test_hostComputedLazily(self):
+        addr = I2PAddress(TEST_B64)
+        self.assertEqual(None, addr._host)
+        self.assertEqual(TEST_B32, addr.host)
+        self.assertEqual(TEST_B32, addr._host)
+
+    def test_hostNotComputedForCopy(self):
+        addr = I2PAddress(TEST_B64)
+        addr2 = I2PAddress(addr, port=81)
+        self.assertEqual(None, addr._host)
+        self.assertEqual(None, addr2._host)
+        self.assertEqual(TEST_B32, addr2.host)
+
+    def test_equalityWithoutHost(self):
+        self.assertEqual(I2PAddress(TEST_B64), I2PAddress(TEST_B64))
+        self.assertEqual(0, len(address._b32Cache))
+
+    def test_hostMemoized(self):
+        self.assertEqual(TEST_B32, address.destinationToB32(TEST_B64))
+        self.assertEqual({TEST_B64: TEST_B32}, dict(address._b32Cache))
+        self.assertEqual(TEST_B32, I2PAddress(TEST_B64).host)
+        self.assertEqual(1, len(address._b32Cache))
+
+    def test_cacheBounded(self):
+        oldSize = address.B32_CACHE_SIZE
+        address.B32_CACHE_SIZE = 2
+        try:
+            for dest in ['AAAA', 'BBBB', 'CCCC']:
+                address.destinationToB32(dest)
+        finally:
+            address.B32_CACHE_SIZE = oldSize
+        self.assertEqual(['BBBB', 'CCCC'], list(address._b32Cache))
+
+
+def _b64(raw):
+    return base64.b64encode(raw, b'-~').decode('utf-8')
+
+
+class TestDestinationFromPrivateKey(unittest.TestCase):
+    def makeKeyCertDest(self, sigType, cryptoType=0):
+        return b'\x01' * 384 + b'\x05\x00\x04' + bytes(bytearray(
+            [0, sigType, 0, cryptoType]))
+
+    def test_nullCertificate(self):
+        self.assertEqual(
+            TEST_B64, address.destinationFromPrivateKey(TEST_PRIV_B64))
+
+    def test_keyCertificate(self):
+        # EdDSA_SHA512_Ed25519, ElGamal
+        dest = self.makeKeyCertDest(7)
+        self.assertEqual(_b64(dest), address.destinationFromPrivateKey(
+            _b64(dest + b'\x02' * (256 + 32))))
+        # ECDSA_SHA256_P256, ECIES-X25519
+        dest = self.makeKeyCertDest(1, 4)
+        self.assertEqual(_b64(dest), address.destinationFromPrivateKey(
+            _b64(dest + b'\x02' * (32 + 32))))
+
+    def test_wrongLength(self):
+        dest = self.makeKeyCertDest(7)
+        for extra in [0, 256 + 31, 256 + 33]:
+            self.assertRaises(ValueError, address.destinationFromPrivateKey,
+                              _b64(dest + b'\x02' * extra))
+        self.assertRaises(ValueError, address.destinationFromPrivateKey, TEST_B64)
+        self.assertRaises(ValueError, address.destinationFromPrivateKey, 'AAAA')
+
+    def test_unknownTypes(self):
+        dest = self.makeKeyCertDest(42)
+        self.assertRaises(ValueError, address.destinationFromPrivateKey,
+                          _b64(dest + b'\x02' * 512))
+        # Unknown certificate type
+        dest = b'\x01' * 384 + b'\x03\x00\x00'
+        self.assertRaises(ValueError, address.destinationFromPrivateKey,
+                          _b64(dest + b'\x02' * 276))
+
+    def test_invalidB64(self):
+        self.assertRaises(ValueError, address.destinationFromPrivateKey, 'A')
+
+
+class TestI2PTunnelTransport(unittest.TestCase):
+    def test_writeBound(self):
+        transport = proto_helpers.StringTransport()
+        wrapper = I2PTunnelTransport(transport, None)
+        self.assertEqual(transport.write, wrapper.write)
+        self.assertEqual(transport.writeSequence, wrapper.writeSequence)
+        wrapper.write(b'spam')
+        wrapper.writeSequence([b' and ', b'eggs'])
+        self.assertEqual(b'spam and eggs', transport.value())
+
+    def test_otherAttributesPassedThrough(self):
+        transport = proto_helpers.StringTransport()
+        wrapper = I2PTunnelTransport(transport, None)
+        wrapper.loseConnection()
+        self.assertTrue(transport.disconnecting)
+
+
+class TestI2PTunnelTransportBackpressure(unittest.TestCase):
+    def makeWrapper(self, **kwargs):
+        transport = SlowTransport()
+        wrapper = I2PTunnelTransport(transport, None, **kwargs)
+        return transport, wrapper
+
+    def test_fastProducerThrottled(self):
+        transport, wrapper = self.makeWrapper(highWater=2048, lowWater=512)
+        producer = FastProducer(wrapper, 1000)
+        wrapper.registerProducer(producer, True)
+        producer.resumeProducing()
+        while producer.sent < producer.chunks or wrapper._bufferLen:
+            self.assertTrue(producer.paused or producer.sent == producer.chunks)
+            # Never more than the high water mark plus one chunk held
+            self.assertLessEqual(wrapper._bufferLen, 2048 + producer.chunkSize)
+            transport.drain()
+        wrapper.unregisterProducer()
+        self.assertGreater(producer.pauses, 10)
+        self.assertLessEqual(
+            transport.maxPending, transport.bufferSize + producer.chunkSize)
+        self.assertEqual(producer.expected(), transport.value())
+
+    def test_resumedAtLowWater(self):
+        transport, wrapper = self.makeWrapper(highWater=2048, lowWater=512)
+        producer = FastProducer(wrapper, 100)
+        wrapper.registerProducer(producer, True)
+        producer.resumeProducing()
+        self.assertTrue(producer.paused)
+        held = wrapper._bufferLen
+        self.assertGreaterEqual(held, 2048)
+        # Draining once moves just over bufferSize bytes, leaving too many
+        transport.drain()
+        self.assertTrue(producer.paused)
+        self.assertLess(wrapper._bufferLen, held)
+        self.assertGreater(wrapper._bufferLen, 512)
+
+    def test_writesPassedThroughWhenNotPaused(self):
+        transport, wrapper = self.makeWrapper()
+        wrapper.registerProducer(FastProducer(wrapper, 0), True)
+        self.assertEqual(transport.write, wrapper.write)
+        wrapper.write(b'x' * (transport.bufferSize + 1))
+        self.assertNotEqual(transport.write, wrapper.write)
+        wrapper.write(b'spam')
+        self.assertEqual(4, wrapper._bufferLen)
+        transport.drain()
+        self.assertEqual(transport.write, wrapper.write)
+        self.assertEqual(0, wrapper._bufferLen)
+        self.assertTrue(transport.value().endswith(b'spam'))
+
+    def test_unregisterFlushes(self):
+        transport, wrapper = self.makeWrapper(highWater=4096, lowWater=1024)
+        producer = FastProducer(wrapper, 100)
+        wrapper.registerProducer(producer, True)
+        producer.resumeProducing()
+        wrapper.unregisterProducer()
+        self.assertIsNone(transport.producer)
+        self.assertEqual(0, wrapper._bufferLen)
+        self.assertEqual(transport.write, wrapper.write)
+        self.assertTrue(producer.expected().startswith(transport.value()))
+        self.assertEqual(producer.sent * producer.chunkSize,
+                         len(transport.value()))
+
+    def test_stopProducingDiscards(self):
+        transport, wrapper = self.makeWrapper()
+        producer = FastProducer(wrapper, 100)
+        wrapper.registerProducer(producer, True)
+        producer.resumeProducing()
+        transport.producer.stopProducing()
+        self.assertTrue(producer.stopped)
+        self.assertEqual(0, wrapper._bufferLen)
+
+    def test_pullProducerRegisteredDirectly(self):
+        transport, wrapper = self.makeWrapper()
+        producer = FastProducer(wrapper, 0)
+        wrapper.registerProducer(producer, False)
+        self.assertIs(producer, transport.producer)
+        self.assertFalse(transport.streaming)
+        wrapper.unregisterProducer()
+        self.assertIsNone(transport.producer)
+
+    def test_registerTwice(self):
+        transport, wrapper = self.makeWrapper()
+        wrapper.registerProducer(FastProducer(wrapper, 0), True)
+        self.assertRaises(RuntimeError, wrapper.registerProducer,
+                          FastProducer(wrapper, 0), True)
+
+    def test_pauseReading(self):
+        transport, wrapper = self.makeWrapper()
+        wrapper.pauseProducing()
+        self.assertEqual('paused', transport.producerState)
+        wrapper.resumeProducing()
+        self.assertEqual('producing', transport.producerState)
+
+    def test_waterMarksChecked(self):
+        self.assertRaises(ValueError, I2PTunnelTransport, SlowTransport(),
+                          None, highWater=10, lowWater=20)
@@ -1,10 +1,14 @@
 # Copyright (c) str4d <str4d@mail.i2p>
 # See COPYING for details.
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from parsley import makeGrammar, ParseError
 
+from txi2p import grammar
 from txi2p.grammar import bobGrammarSource, samGrammarSource
 
 
@@ -112,3 +116,37 @@ class TestSAMGrammar(unittest.TestCase):
     def test_SAM_pong(self):
         self._test('SAM_pong', 'PONG\n', None)
         self._test('SAM_pong', 'PONG 1234567890\n', '1234567890')
+
+
+class TestGrammarCompilation(unittest.TestCase):
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir)
+
+    def test_grammarShared(self):
+        self.assertIs(grammar.getSAMGrammar(), grammar.getSAMGrammar())
+        self.assertIs(grammar.getBOBGrammar(), grammar.getBOBGrammar())
+        self.assertIsNot(grammar.getSAMGrammar(), grammar.getBOBGrammar())
+
+    def test_cacheWritten(self):
+        grammar.compileGrammar(samGrammarSource, self.cacheDir)
+        self.assertEqual(1, len(os.listdir(self.cacheDir)))
+
+    def test_cacheRoundTrip(self):
+        g = grammar.compileGrammar(samGrammarSource, self.cacheDir)
+        cached = grammar.compileGrammar(samGrammarSource, self.cacheDir)
+        self.assertEqual(g, cached)
+
+    def test_cacheKeyedBySource(self):
+        grammar.compileGrammar(samGrammarSource, self.cacheDir)
+        grammar.compileGrammar(bobGrammarSource, self.cacheDir)
+        self.assertEqual(2, len(os.listdir(self.cacheDir)))
+
+    def test_corruptCacheIgnored(self):
+        g = grammar.compileGrammar(bobGrammarSource, self.cacheDir)
+        path = os.path.join(self.cacheDir, os.listdir(self.cacheDir)[0])
+        with open(path, 'w') as f:
+            f.write('spam')
+        self.assertEqual(g, grammar.compileGrammar(bobGrammarSource, self.cacheDir))
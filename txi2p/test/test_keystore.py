@@ -0,0 +1,102 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+import os
+import stat
+from twisted.trial import unittest
+
+from txi2p import keystore
+from txi2p.keystore import KeyStore
+
+
+class TestKeyStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = self.mktemp()
+        os.mkdir(self.dir)
+        self.path = os.path.join(self.dir, 'keyfile')
+
+    def writeKeyfile(self, key):
+        with open(self.path, 'w') as f:
+            f.write(key)
+
+    def readKeyfile(self):
+        with open(self.path, 'r') as f:
+            return f.read()
+
+    def test_load(self):
+        self.writeKeyfile('foo')
+        d = KeyStore().load(self.path)
+        d.addCallback(self.assertEqual, 'foo')
+        return d
+
+    def test_loadMissing(self):
+        d = KeyStore().load(self.path)
+        return self.assertFailure(d, IOError)
+
+    def test_loadCached(self):
+        self.writeKeyfile('foo')
+        ks = KeyStore(threaded=False)
+        self.assertEqual('foo', self.successResultOf(ks.load(self.path)))
+        os.remove(self.path)
+        self.assertEqual('foo', self.successResultOf(ks.load(self.path)))
+        # Relative and absolute paths share the cache
+        rel = os.path.relpath(self.path)
+        self.assertEqual('foo', self.successResultOf(ks.load(rel)))
+        ks.forget(self.path)
+        self.failureResultOf(ks.load(self.path), IOError)
+
+    def test_concurrentLoadsShareRead(self):
+        self.writeKeyfile('foo')
+        reads = []
+        def readKey(path):
+            reads.append(path)
+            with open(path, 'r') as f:
+                return f.read()
+        self.patch(keystore, '_readKey', readKey)
+        ks = KeyStore()
+        d1 = ks.load(self.path)
+        d2 = ks.load(self.path)
+        d = d1.addCallback(lambda key: d2.addCallback(lambda key2: (key, key2)))
+        def check(keys):
+            self.assertEqual(('foo', 'foo'), keys)
+            self.assertEqual(1, len(reads))
+        d.addCallback(check)
+        return d
+
+    def test_save(self):
+        self.writeKeyfile('foo')
+        ks = KeyStore()
+        d = ks.save(self.path, 'bar')
+        def check(_):
+            self.assertEqual('bar', self.readKeyfile())
+            self.assertEqual(['keyfile'], os.listdir(self.dir))
+            self.assertEqual(0o600, stat.S_IMODE(os.stat(self.path).st_mode))
+            # Saved keys are cached
+            os.remove(self.path)
+            return ks.load(self.path)
+        d.addCallback(check)
+        d.addCallback(self.assertEqual, 'bar')
+        return d
+
+    def test_saveFailureKeepsOldKey(self):
+        self.writeKeyfile('foo')
+        def fsync(fd):
+            raise OSError('disk full')
+        self.patch(os, 'fsync', fsync)
+        ks = KeyStore(threaded=False)
+        self.failureResultOf(ks.save(self.path, 'bar'), OSError)
+        self.assertEqual('foo', self.readKeyfile())
+        self.assertEqual(['keyfile'], os.listdir(self.dir))
+
+    def test_create(self):
+        ks = KeyStore()
+        d = ks.create(self.path, 'foo')
+        d.addCallback(lambda _: self.assertEqual('foo', self.readKeyfile()))
+        return d
+
+    def test_createExisting(self):
+        self.writeKeyfile('foo')
+        ks = KeyStore(threaded=False)
+        self.failureResultOf(ks.create(self.path, 'bar'), ValueError)
+        self.assertEqual('foo', self.readKeyfile())
+        self.assertEqual(['keyfile'], os.listdir(self.dir))
@@ -90,7 +90,7 @@ class I2PClientEndpointPluginTest(I2PPluginTestMixin, unittest.TestCase):
         from twisted.internet.endpoints import clientFromString
         with mock.patch('txi2p.sam.endpoints.getSession', fakeSession):
             ep = clientFromString(
-                MemoryReactor(), "i2p:stats.i2p:81:api=SAM:localPort=34444:options=inbound.length\:5,outbound.length\:5:sigType=foobar")
+                MemoryReactor(), "i2p:stats.i2p:81:api=SAM:localPort=34444:options=inbound.length\:5,outbound.length\:5:sigType=foobar:poolSize=4")
         self.assertIsInstance(ep, SAMI2PStreamClientEndpoint)
         self.assertEqual(ep._host, "stats.i2p")
         self.assertEqual(ep._port, 81)
@@ -98,6 +98,7 @@ class I2PClientEndpointPluginTest(I2PPluginTestMixin, unittest.TestCase):
         s = ep._sessionDeferred
         self.assertEqual(s.kwargs['options'], {'inbound.length': '5', 'outbound.length': '5'})
         self.assertEqual(s.kwargs['sigType'], 'foobar')
+        self.assertEqual(s.kwargs['poolSize'], 4)
 
 
 class I2PServerEndpointPluginTest(I2PPluginTestMixin, unittest.TestCase):
@@ -146,8 +147,18 @@ class I2PServerEndpointPluginTest(I2PPluginTestMixin, unittest.TestCase):
         from twisted.internet.endpoints import serverFromString
         with mock.patch('txi2p.sam.endpoints.getSession', fakeSession):
             ep = serverFromString(
-                MemoryReactor(), "i2p:/tmp/testkeys.foo:81:api=SAM:options=inbound.length\:5,outbound.length\:5:sigType=foobar")
+                MemoryReactor(), "i2p:/tmp/testkeys.foo:81:api=SAM:options=inbound.length\:5,outbound.length\:5:sigType=foobar:minAccepts=4:maxAccepts=16:forward=true")
         self.assertIsInstance(ep, SAMI2PStreamServerEndpoint)
+        self.assertEqual(ep._minAccepts, 4)
+        self.assertEqual(ep._maxAccepts, 16)
+        self.assertTrue(ep._forward)
         s = ep._sessionDeferred
         self.assertEqual(s.kwargs['options'], {'inbound.length': '5', 'outbound.length': '5'})
         self.assertEqual(s.kwargs['sigType'], 'foobar')
+
+    def test_stringDescription_SAM_zeroMinAccepts(self):
+        from twisted.internet.endpoints import serverFromString
+        with mock.patch('txi2p.sam.endpoints.getSession', fakeSession):
+            self.assertRaises(
+                ValueError, serverFromString, MemoryReactor(),
+                "i2p:/tmp/testkeys.foo:81:api=SAM:minAccepts=0")
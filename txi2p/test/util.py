@@ -8,11 +8,16 @@ try:
 except:
     # Python 2 (library)
     import mock
+import base64
 from twisted.internet import defer, protocol
 from twisted.test import proto_helpers
 
 TEST_B64 = "2wDRF5nDfeTNgM4X-TI5xEk3R-WiaTABvkMQ2eYpvEzayUZQJgr9E2T6Y2m9HHn3xHYGEOg-RLisjW9AubTaUTx-v66AsEEtv745qPcuWuV1SP~w1bdzYEn8MSoK7Zh4mwHBg1uHq8z17TUNvWz19q76vHNth-2PDuBToD7ySBn3cGBFDUU83wJJXPD6OueLY8yosWWtksk7WZk60~6z~nVePPSEY8JDry3myLDe11szAVER4A8eX1sFpw247cXGGJK9wQhV-TXFj~m76GPVcFKh7u79zwTwZnZ1GXXKqqyRoj1c4-U69CvvJsQRLmdLFwFEpRkxwV8z6LIFclYJk443YpTnPXC7vNdFOzqqS4FLR1ra~DNfN5foMtR2~2VxuR5m2dYiOS6GzHDxA4acJJSGqnasJjcEIFNVSQKxMnFu9PvGLNJHZ83EraHCErENcOGkPlnVgcJCtPGNGiirwCbBz38jE0lfjkrNrWabc6uWeU559CobG8F8KUDx1irpAAAA"
 TEST_B32 = "tv5iv4i5roywnv2rg6rjqufniqbogn4rokjkooa7n4jht3lex3ga.b32.i2p"
+# A private key for TEST_B64 (DSA_SHA1), with zeroed private keys
+TEST_PRIV_B64 = base64.b64encode(
+    base64.b64decode(TEST_B64.encode('utf-8'), b'-~') + b'\x00' * (256 + 20),
+    b'-~').decode('utf-8')
 
 
 def fakeSession(nickname, **kwargs):
@@ -56,3 +61,57 @@ class FakeEndpoint(object):
         self.proto.makeConnection(transport)
         self.transport = transport
         return defer.succeed(self.proto)
+
+
+class SlowTransport(proto_helpers.StringTransport):
+    """A transport that only accepts ``bufferSize`` bytes until drained."""
+    bufferSize = 1024
+
+    def __init__(self, *args, **kwargs):
+        proto_helpers.StringTransport.__init__(self, *args, **kwargs)
+        self.pending = 0
+        self.maxPending = 0
+
+    def write(self, data):
+        proto_helpers.StringTransport.write(self, data)
+        self.pending += len(data)
+        self.maxPending = max(self.maxPending, self.pending)
+        if (self.producer is not None and self.streaming and
+                self.pending > self.bufferSize):
+            self.producer.pauseProducing()
+
+    def drain(self):
+        self.pending = 0
+        if self.producer is not None:
+            self.producer.resumeProducing()
+
+
+class FastProducer(object):
+    """A push producer that writes as fast as it is allowed to."""
+
+    def __init__(self, consumer, chunks, chunkSize=256):
+        self.consumer = consumer
+        self.chunks = chunks
+        self.chunkSize = chunkSize
+        self.sent = 0
+        self.paused = False
+        self.pauses = 0
+        self.stopped = False
+
+    def pauseProducing(self):
+        self.paused = True
+        self.pauses += 1
+
+    def resumeProducing(self):
+        self.paused = False
+        while not self.paused and self.sent < self.chunks:
+            self.consumer.write(
+                (b'%d,' % self.sent).ljust(self.chunkSize, b'.'))
+            self.sent += 1
+
+    def stopProducing(self):
+        self.stopped = True
+
+    def expected(self):
+        return b''.join((b'%d,' % i).ljust(self.chunkSize, b'.')
+                        for i in range(self.chunks))